@@ -42,6 +42,7 @@ from miro import prefs
 from miro import schema
 from miro import signals
 from miro import util
+from miro.clock import clock
 from miro.data import item
 from miro.gtcache import gettext as _
 
@@ -394,7 +395,9 @@ class ItemTracker(signals.SignalEmitter):
     frontend:
 
     - Fetches ids first, then fetches row data when it's requested, or in
-      idle callbacks.
+      idle callbacks.  The idle callbacks load the rows that are on-screen
+      first, then continue from the first unloaded row, fetching as many
+      rows as fit in IDLE_TIME_BUDGET.
     - Can efficently tell what's changed in an item list when another process
       modifies the item data
 
@@ -407,6 +410,12 @@ class ItemTracker(signals.SignalEmitter):
 
     # how many rows we fetch at one time in _ensure_row_loaded()
     FETCH_ROW_CHUNK_SIZE = 25
+    # how long we want each do_idle_work() call to take.  We adjust the
+    # number of rows we fetch in idle callbacks to try to match this.
+    IDLE_TIME_BUDGET = 0.02
+    # limits for the number of rows we fetch in idle callbacks
+    MIN_IDLE_CHUNK_SIZE = FETCH_ROW_CHUNK_SIZE
+    MAX_IDLE_CHUNK_SIZE = 5000
 
     def __init__(self, idle_scheduler, query, item_source):
         """Create an ItemTracker
@@ -423,6 +432,8 @@ class ItemTracker(signals.SignalEmitter):
         self.create_signal("list-changed")
         self.idle_scheduler = idle_scheduler
         self.idle_work_scheduled = False
+        self.idle_chunk_size = self.MIN_IDLE_CHUNK_SIZE
+        self.visible_range = None
         self.item_fetcher = None
         self.item_source = item_source
         self._db_retry_callback_pending = False
@@ -489,6 +500,9 @@ class ItemTracker(signals.SignalEmitter):
             self._run_db_error_dialog()
         self.id_to_index = dict((id_, i) for i, id_ in enumerate(self.id_list))
         self.row_data = {}
+        # index of the first row that may not be loaded yet.  All rows
+        # before it are in row_data.
+        self.load_cursor = 0
         self.item_fetcher = self.make_item_fetcher(connection, self.id_list)
 
     def _schedule_idle_work(self):
@@ -505,20 +519,85 @@ class ItemTracker(signals.SignalEmitter):
             # destroy() was called while the idle callback was still
             # scheduled.  Just return.
             return
-        for i in xrange(len(self.id_list)):
-            if not self._row_loaded(i):
-                # row data unloaded, call _ensure_row_loaded to load this row
-                # and adjecent rows then schedule another run later
-                self._ensure_row_loaded(i)
-                self._schedule_idle_work()
-                return
-        # no rows need loading
-        self.item_fetcher.done_fetching()
+        rows_to_load = self._rows_to_load_in_idle()
+        if not rows_to_load:
+            # no rows need loading
+            self.item_fetcher.done_fetching()
+            return
+        start_time = clock()
+        self._load_rows(rows_to_load)
+        self._adjust_idle_chunk_size(len(rows_to_load), clock() - start_time)
+        self._schedule_idle_work()
+
+    def _rows_to_load_in_idle(self):
+        """Pick the rows to load in the next idle callback.
+
+        Rows near the visible part of the list come first.  After that we
+        load rows in order, starting at load_cursor.
+        """
+        rows_to_load = self._unloaded_rows_near_visible_range()
+        if rows_to_load:
+            return rows_to_load[:self.idle_chunk_size]
+        id_list = self.id_list
+        row_data = self.row_data
+        index = self.load_cursor
+        while index < len(id_list) and id_list[index] in row_data:
+            index += 1
+        self.load_cursor = index
+        while (index < len(id_list) and
+               len(rows_to_load) < self.idle_chunk_size):
+            if id_list[index] not in row_data:
+                rows_to_load.append(index)
+            index += 1
+        return rows_to_load
+
+    def _unloaded_rows_near_visible_range(self):
+        if self.visible_range is None:
+            return []
+        first, last = self.visible_range
+        # include a page worth of rows above and below the visible ones so
+        # that scrolling a bit doesn't hit the database.
+        page_size = last - first + 1
+        start = max(first - page_size, 0)
+        end = min(last + page_size + 1, len(self.id_list))
+        rows = [i for i in xrange(start, end) if not self._row_loaded(i)]
+        if not rows:
+            # everything around the visible rows is loaded, don't bother
+            # checking again until the visible range changes.
+            self.visible_range = None
+        return rows
+
+    def _adjust_idle_chunk_size(self, row_count, elapsed):
+        """Adjust idle_chunk_size so that loading a chunk takes about
+        IDLE_TIME_BUDGET seconds.
+        """
+        if elapsed > 0:
+            target = int(row_count * self.IDLE_TIME_BUDGET / elapsed)
+        else:
+            target = self.idle_chunk_size * 2
+        # average with the current value to smooth out random slowdowns
+        chunk_size = (self.idle_chunk_size + target) // 2
+        self.idle_chunk_size = max(self.MIN_IDLE_CHUNK_SIZE,
+                                   min(self.MAX_IDLE_CHUNK_SIZE, chunk_size))
+
+    def set_visible_range(self, first_row, last_row):
+        """Tell the ItemTracker which rows are currently visible.
+
+        The idle callbacks will load rows around these before any others.
+        """
+        if not self.id_list:
+            return
+        last_row = min(last_row, len(self.id_list) - 1)
+        if 0 <= first_row <= last_row:
+            self.visible_range = (first_row, last_row)
 
     def _uncache_row_data(self, id_list):
         for id_ in id_list:
             if id_ in self.row_data:
                 del self.row_data[id_]
+                index = self.id_to_index[id_]
+                if index < self.load_cursor:
+                    self.load_cursor = index
 
     def _refetch_id_list(self):
         """Refetch a new id list after we already have one."""
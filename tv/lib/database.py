@@ -188,6 +188,15 @@ class View(object):
     def count(self):
         return self._query_count()
 
+    def count_by(self, column):
+        """Count the objects in this view, grouped by column.
+
+        :returns: dict mapping column values to counts
+        """
+        return self.db_info.db.query_group_count(self.table_name, column,
+                                                 self.where, self.values,
+                                                 self.joins)
+
     def get_singleton(self):
         results = list(self)
         if len(results) == 1:
@@ -254,6 +263,7 @@ class ViewTracker(signals.SignalEmitter):
         self.joins = joins
         self.db_info = db_info
         self.bulk_mode = False
+        self._predicate = self._compile_predicate()
         self.current_ids = self._view_object_ids()
         vt_manager = self.db_info.view_tracker_manager
         vt_manager.trackers_for_table(self.table_name).add(self)
@@ -271,8 +281,24 @@ class ViewTracker(signals.SignalEmitter):
         """
         self.bulk_mode = bulk_mode
 
+    def _compile_predicate(self):
+        """Try to turn our WHERE clause into a python predicate.
+
+        This lets _obj_in_view() check the object we already have in memory
+        rather than sending a query to SQLite.  Views that use joins depend
+        on other tables, so for those we always use SQL.
+
+        :returns: predicate function or None
+        """
+        if self.joins:
+            return None
+        return self.db_info.db.compile_view_predicate(self.table_name,
+                                                      self.where, self.values)
+
     def _obj_in_view(self, obj):
         """Check if a single object is in our view."""
+        if self._predicate is not None:
+            return self._predicate(obj)
         where = '%s.id = ?' % (self.table_name,)
         if self.where:
             where += ' AND (%s)' % (self.where,)
@@ -742,6 +768,21 @@ class DDBObject(signals.SignalEmitter):
         self.db_info.view_tracker_manager.update_view_trackers(
             self, can_change_views)
 
+    def save_changes(self):
+        """Save changed attributes to disk without updating the view trackers.
+
+        Only use this for changes that can't affect any view.
+        """
+        if self.in_db_init:
+            return
+        if not self.id_exists():
+            msg = ("save_changes() called on non-existant object (id is %s)"
+                   % self.id)
+            raise DatabaseConstraintError, msg
+        if self.db_info.bulk_sql_manager.will_insert(self.id):
+            return
+        self.db_info.db.update_obj(self)
+
     def on_signal_change(self):
         pass
 
@@ -4321,3 +4321,29 @@ def upgrade197(cursor):
         if os.path.exists(filename):
             values.append((filename, feed_id))
     cursor.executemany("UPDATE feed SET thumbnail_path=? WHERE id=?", values)
+
+def upgrade198(cursor):
+    """Add the entry_digest column to item and the columns that let
+    rss_feed_impl skip parsing an unchanged feed body.
+    """
+    cursor.execute("ALTER TABLE item ADD COLUMN entry_digest text")
+    cursor.execute("CREATE INDEX item_feed_entry_digest ON "
+                   "item (feed_id, entry_digest)")
+    for column in ('body_digest', 'link', 'license'):
+        cursor.execute("ALTER TABLE rss_feed_impl ADD COLUMN %s text" %
+                       column)
+
+def upgrade199(cursor):
+    """Add the feed_update_state table."""
+    cursor.execute("CREATE TABLE feed_update_state (id integer PRIMARY KEY, "
+                   "feed_id integer, last_update real, last_change real, "
+                   "change_interval real, unchanged_count integer, "
+                   "error_count integer)")
+    cursor.execute("CREATE INDEX feed_update_state_feed ON "
+                   "feed_update_state (feed_id)")
+
+def upgrade200(cursor):
+    """Add indexes used to match feed entries with existing items."""
+    cursor.execute("CREATE INDEX item_feed_rss_id ON item (feed_id, rss_id)")
+    cursor.execute("CREATE INDEX item_feed_url_title ON "
+                   "item (feed_id, url, entry_title)")
@@ -0,0 +1,322 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""directoryscan.py -- Scan watched folders for added and removed files.
+
+Scanning happens in the thread pool, so that huge folders don't block the
+event loop.  We keep a snapshot of each directory in the tree: its mtime
+along with the files and subdirectories it contained.  Adding, removing or
+renaming an entry changes a directory's mtime, so if the mtime hasn't
+changed since the last scan, we can reuse the snapshot instead of listing
+the directory and stat-ing everything in it.  The snapshot is saved to
+disk so that this works across restarts too.
+
+The scan itself walks the tree with SCAN_THREADS threads, since most of the
+time is spent waiting on the filesystem (especially for network mounts).
+"""
+
+import Queue
+import cPickle
+import logging
+import os
+import threading
+import time
+
+from miro import fileutil
+from miro.plat.filebundle import is_file_bundle
+
+# number of threads to walk a directory tree with
+SCAN_THREADS = 4
+# Directories modified this close to when we scan them could change again
+# without their mtime changing (the mtime resolution can be as bad as 2
+# seconds), so we don't put them in the snapshot.
+MTIME_SLOP = 2.0
+# bump this if the snapshot format changes
+SNAPSHOT_VERSION = 1
+
+def _skip_name(name):
+    """Should we skip a directory entry while scanning?"""
+    name_lower = name.lower()
+    # thumbs.db is a windows file that speeds up thumbnails.  We know it's
+    # not a movie file.
+    return (name.startswith('.') or name_lower == 'thumbs.db' or
+            name_lower == "incomplete downloads")
+
+class DirectorySnapshot(object):
+    """Stores the contents of each directory in a tree.
+
+    dirs maps directory paths to (mtime, files, subdirs) tuples.  Paths are
+    in the same form that fileutil.miro_allfiles() returns.
+    """
+    def __init__(self, root, path=None):
+        self.root = root
+        self.path = path
+        self.dirs = {}
+        self.dirs_listed = 0
+        self.dirs_skipped = 0
+
+    @classmethod
+    def load(cls, root, path):
+        """Load a snapshot from disk.
+
+        If there's no snapshot for root at path, return an empty one.
+        """
+        snapshot = cls(root, path)
+        if path is None or not fileutil.exists(path):
+            return snapshot
+        try:
+            f = fileutil.open_file(path, 'rb')
+            try:
+                data = cPickle.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError,
+                ValueError, TypeError), e:
+            logging.warn("Error loading directory snapshot %s: %s", path, e)
+            return snapshot
+        if (data.get('version') == SNAPSHOT_VERSION and
+                data.get('root') == root):
+            snapshot.dirs = data['dirs']
+        return snapshot
+
+    def save(self):
+        if self.path is None:
+            return
+        data = {
+            'version': SNAPSHOT_VERSION,
+            'root': self.root,
+            'dirs': self.dirs,
+        }
+        temp_path = self.path + '.tmp'
+        try:
+            parent = os.path.dirname(self.path)
+            if not fileutil.exists(parent):
+                fileutil.makedirs(parent)
+            f = fileutil.open_file(temp_path, 'wb')
+            try:
+                cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            if fileutil.exists(self.path):
+                fileutil.remove(self.path)
+            fileutil.rename(temp_path, self.path)
+        except (IOError, OSError), e:
+            logging.warn("Error saving directory snapshot %s: %s", self.path,
+                         e)
+
+    def walk(self, threads=SCAN_THREADS):
+        """Walk our directory tree and update the snapshot.
+
+        :returns: list of the files in the tree
+        """
+        self.dirs_listed = self.dirs_skipped = 0
+        self._scan_start = time.time()
+        self._old_dirs = self.dirs
+        self._new_dirs = {}
+        self._checked = set()
+        self._lock = threading.Lock()
+        self._errors = []
+        files = []
+        queue = Queue.Queue()
+        queue.put(self.root)
+        workers = []
+        for i in xrange(threads):
+            t = threading.Thread(name='DirectoryScan - %d' % i,
+                                 target=self._walk_thread,
+                                 args=(queue, files))
+            t.setDaemon(True)
+            t.start()
+            workers.append(t)
+        queue.join()
+        for t in workers:
+            queue.put(None)
+        for t in workers:
+            t.join()
+        self.dirs = self._new_dirs
+        del self._old_dirs, self._new_dirs, self._checked
+        if self._errors:
+            raise self._errors[0]
+        return files
+
+    def _walk_thread(self, queue, files):
+        while True:
+            directory = queue.get()
+            if directory is None:
+                return
+            try:
+                dir_files, subdirs = self._scan_directory(directory)
+                files.extend(dir_files)
+                for subdir in subdirs:
+                    queue.put(subdir)
+            except Exception, e:
+                logging.warn("error scanning %r", directory, exc_info=True)
+                self._errors.append(e)
+            queue.task_done()
+
+    def _scan_directory(self, directory):
+        """Get the files and subdirectories for a directory.
+
+        We use the snapshot if the directory hasn't changed, otherwise we
+        list it.
+        """
+        expanded_directory = fileutil.expand_filename(directory)
+        expanded_directory = os.path.abspath(os.path.normcase(
+            expanded_directory))
+        real_directory = os.path.realpath(expanded_directory)
+        self._lock.acquire()
+        try:
+            if real_directory in self._checked:
+                logging.debug('%s is a symlink to a directory that has '
+                    'already been checked; skipping', repr(expanded_directory))
+                return [], []
+            self._checked.add(real_directory)
+        finally:
+            self._lock.release()
+        if (expanded_directory in fileutil.deletes_in_progress or
+                is_file_bundle(expanded_directory)):
+            return [], []
+        try:
+            mtime = os.stat(expanded_directory).st_mtime
+        except OSError:
+            logging.debug('OSError walking directory; continuing', exc_info=1)
+            return [], []
+        old = self._old_dirs.get(directory)
+        if old is not None and old[0] == mtime:
+            skipped = True
+            files, subdirs = old[1], old[2]
+        else:
+            skipped = False
+            files, subdirs = self._list_directory(directory,
+                                                  expanded_directory)
+        self._lock.acquire()
+        try:
+            if skipped:
+                self.dirs_skipped += 1
+            else:
+                self.dirs_listed += 1
+        finally:
+            self._lock.release()
+        if mtime < self._scan_start - MTIME_SLOP:
+            self._new_dirs[directory] = (mtime, files, subdirs)
+        if fileutil.deletes_in_progress.set:
+            files = [f for f in files if not self._deleting(f)]
+            subdirs = [d for d in subdirs if not self._deleting(d)]
+        return files, subdirs
+
+    def _deleting(self, path):
+        return fileutil.expand_filename(path) in fileutil.deletes_in_progress
+
+    def _list_directory(self, directory, expanded_directory):
+        try:
+            listing = os.listdir(expanded_directory)
+        except OSError:
+            logging.debug('OSError walking directory; continuing', exc_info=1)
+            return [], []
+        files = []
+        subdirs = []
+        for name in listing:
+            if _skip_name(name):
+                continue
+            path = os.path.join(directory, os.path.normcase(name))
+            expanded_path = os.path.join(expanded_directory,
+                                         os.path.normcase(name))
+            try:
+                if (os.path.isdir(expanded_path) and
+                        not is_file_bundle(expanded_path)):
+                    subdirs.append(path)
+                elif os.path.isfile(expanded_path):
+                    files.append(path)
+            except OSError:
+                logging.debug('OSError walking directory; continuing',
+                              exc_info=1)
+        return files, subdirs
+
+class ScanResult(object):
+    """Changes that a directory feed needs to make after a scan.
+
+    :attribute to_remove: ids of items to remove
+    :attribute duplicate_paths: paths that more than one item had
+    :attribute to_add: paths that we should create items for
+    """
+    def __init__(self):
+        self.to_remove = []
+        self.duplicate_paths = []
+        self.to_add = []
+        self.dirs_listed = 0
+        self.dirs_skipped = 0
+
+def scan_directory(scan_dir, snapshot_path, items, known_files,
+                   filter_paths):
+    """Figure out what's changed in a directory feed.
+
+    This runs in the thread pool, so it can't use the database.  Everything
+    it needs gets passed in.
+
+    :param scan_dir: directory to scan
+    :param snapshot_path: where to load and save our DirectorySnapshot
+    :param items: list of (item_id, filename) tuples for the feed's items
+    :param known_files: FileSet of paths that other feeds know about
+    :param filter_paths: function that takes an iterable of paths and the
+        FileSet of known files, and returns the paths that we should add
+    :returns: ScanResult
+    """
+    result = ScanResult()
+    my_files = set()
+    if fileutil.isdir(scan_dir) and not is_file_bundle(scan_dir):
+        snapshot = DirectorySnapshot.load(scan_dir, snapshot_path)
+        all_files = snapshot.walk()
+        snapshot.save()
+        result.dirs_listed = snapshot.dirs_listed
+        result.dirs_skipped = snapshot.dirs_skipped
+    else:
+        all_files = None
+    existing = set(all_files or ())
+
+    # Remove items with deleted files or that that are in other feeds.
+    # Files that we just found in the walk obviously exist, so we only need
+    # to stat the ones outside of scan_dir.
+    for item_id, filename in items:
+        if (filename is None or
+            (filename not in existing and not fileutil.isfile(filename)) or
+            known_files.contains_path(filename)):
+            result.to_remove.append(item_id)
+        if filename not in my_files:
+            my_files.add(filename)
+        else:
+            result.duplicate_paths.append(filename)
+            result.to_remove.append(item_id)
+
+    # add our files to known_files so that they don't get added multiple
+    # times to the feed.
+    for path in my_files:
+        if path is not None:
+            known_files.add_path(path)
+    if all_files is not None:
+        result.to_add = list(filter_paths(all_files, known_files))
+    return result
@@ -60,6 +60,13 @@ class DirectoryWatcher(signals.SignalEmitter):
     def startup(self, root_directory):
         raise NotImplementedError()
 
+    def stop(self):
+        """Stop watching the directory.
+
+        Subclasses should override this if they need to clean anything up.
+        """
+        pass
+
     @classmethod
     def install(cls):
         app.directory_watcher = cls
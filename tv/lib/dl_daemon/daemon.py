@@ -28,6 +28,7 @@
 # statement from all source files in the program, then also delete it here.
 
 from miro.dl_daemon import command
+from miro.dl_daemon import statuscodec
 import os
 import cPickle
 from struct import pack, unpack, calcsize
@@ -47,6 +48,15 @@ from miro import util
 
 SIZEOF_LONG = calcsize("Q")
 
+# The first byte of each command we send says how it's encoded.
+# BatchUpdateDownloadStatus commands are sent often and can be big, so they
+# get their own encoding, which is quicker to decode (see
+# miro.dl_daemon.statuscodec).  Everything else is pickled.
+MESSAGE_PICKLE = 'P'
+MESSAGE_STATUS_BATCH = 'S'
+STATUS_BATCH_HEADER = "!?H"
+SIZEOF_STATUS_BATCH_HEADER = calcsize(STATUS_BATCH_HEADER)
+
 class DaemonError(StandardError):
     """Exception while communicating to a daemon (either controller or
     downloader).
@@ -170,9 +180,11 @@ class Daemon(ConnectionHandler):
     def on_command(self):
         if self.buffer.length >= self.size:
             try:
-                comm = cPickle.loads(self.buffer.read(self.size))
+                comm = self.decode_command(self.buffer.read(self.size))
             except cPickle.UnpicklingError:
                 logging.exception("WARNING: error unpickling command.")
+            except statuscodec.StatusCodecError:
+                logging.exception("WARNING: error decoding status batch.")
             else:
                 self.process_command(comm)
             self.change_state('ready')
@@ -192,9 +204,41 @@ class Daemon(ConnectionHandler):
         if self.state == 'initializing':
             self.queued_commands.append((comm, callback))
         else:
-            raw = cPickle.dumps(comm, cPickle.HIGHEST_PROTOCOL)
+            raw = self.encode_command(comm)
             self.send_data(pack("Q", len(raw)) + raw, callback)
 
+    def encode_command(self, comm):
+        if isinstance(comm, command.BatchUpdateDownloadStatus):
+            statuses = comm.args[0]
+            cmd_done = len(comm.args) > 1 and comm.args[1]
+            command_id = str(comm.command_id)
+            return ''.join((MESSAGE_STATUS_BATCH,
+                            pack(STATUS_BATCH_HEADER, comm.orig,
+                                 len(command_id)),
+                            command_id,
+                            statuscodec.encode(statuses, cmd_done)))
+        else:
+            return MESSAGE_PICKLE + cPickle.dumps(comm,
+                                                  cPickle.HIGHEST_PROTOCOL)
+
+    def decode_command(self, raw):
+        message_type = raw[:1]
+        if message_type == MESSAGE_PICKLE:
+            return cPickle.loads(raw[1:])
+        elif message_type == MESSAGE_STATUS_BATCH:
+            pos = 1 + SIZEOF_STATUS_BATCH_HEADER
+            orig, id_length = unpack(STATUS_BATCH_HEADER, raw[1:pos])
+            command_id = raw[pos:pos+id_length]
+            statuses, cmd_done = statuscodec.decode(raw[pos+id_length:])
+            comm = command.BatchUpdateDownloadStatus(self, statuses,
+                                                     cmd_done)
+            comm.command_id = command_id
+            comm.orig = orig
+            return comm
+        else:
+            raise statuscodec.StatusCodecError(
+                "unknown message type: %r" % message_type)
+
 class DownloaderDaemon(Daemon):
     def __init__(self, host, port, short_app_name):
         # before anything else, write out our PID
@@ -405,6 +405,9 @@ class DownloadStatusUpdater(object):
     2. The update don't happen fairly infrequently (currently every 5
        seconds).
 
+    3. Downloaders whose status hasn't changed since the last update are
+       left out of the batch.
+
     Because updates happen infrequently, DownloadStatusUpdaters should
     only be used for progress updates, not events like downloads
     starting/finishing.  For those just call update_client() since
@@ -417,6 +420,8 @@ class DownloadStatusUpdater(object):
     def __init__(self):
         self.to_update = set()
         self.cmds_done = False
+        # maps dlids to the last status we sent for them
+        self.last_sent = {}
 
     def start_updates(self):
         eventloop.add_timeout(self.UPDATE_CLIENT_INTERVAL, self.do_update,
@@ -430,8 +435,16 @@ class DownloadStatusUpdater(object):
             TORRENT_SESSION.update_torrents()
             statuses = []
             for downloader in self.to_update:
-                statuses.append(downloader.get_status())
+                status = downloader.get_status()
+                # If cmds_done is set, we need to send all statuses, since
+                # the frontend ignores updates for downloads with pending
+                # commands until it gets one.
+                if (self.cmds_done or
+                        self.last_sent.get(downloader.dlid) != status):
+                    statuses.append(status)
+                    self.status_sent(status)
             self.to_update = set()
+            self._forget_removed_downloads()
             if statuses or self.cmds_done:
                 command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON,
                                                   statuses,
@@ -443,6 +456,16 @@ class DownloadStatusUpdater(object):
                                       self.do_update,
                                       "Download status update")
 
+    def status_sent(self, status):
+        """Remember a status that was sent to the frontend."""
+        self.last_sent[status['dlid']] = status
+
+    def _forget_removed_downloads(self):
+        if len(self.last_sent) > len(_downloads):
+            for dlid in self.last_sent.keys():
+                if dlid not in _downloads:
+                    del self.last_sent[dlid]
+
     def set_cmds_done(self):
         self.cmds_done = True
 
@@ -504,8 +527,10 @@ class BGDownloader(object):
         if not now:
             DOWNLOAD_UPDATER.queue_update(self)
         else:
+            status = self.get_status()
+            DOWNLOAD_UPDATER.status_sent(status)
             command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON,
-                                              [self.get_status()]).send()
+                                              [status]).send()
 
     def pick_initial_filename(self, suffix=".part", torrent=False,
                               is_directory=False, exists=False):
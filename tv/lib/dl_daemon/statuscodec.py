@@ -0,0 +1,82 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+"""miro.dl_daemon.statuscodec -- Encoding for download status batches.
+
+The downloader daemon sends a status dict for every active download each
+time BatchUpdateDownloadStatus runs, and the main process decodes them on
+the event loop.  Status dicts only hold basic types, so they're sent with
+marshal, which loads them in about two thirds of the time cPickle takes.
+A batch that marshal can't handle is pickled instead.  The first byte of
+the data says which one was used.
+
+The daemon leaves out downloads whose status hasn't changed since the last
+batch (see DownloadStatusUpdater in miro.dl_daemon.download), so every
+status is sent in full and neither side needs to keep any state.
+"""
+
+import cPickle
+import marshal
+
+FORMAT_MARSHAL = 'm'
+FORMAT_PICKLE = 'p'
+
+class StatusCodecError(ValueError):
+    """Error decoding a status batch."""
+    pass
+
+def encode(statuses, cmd_done):
+    """Encode a list of status dicts and the cmd_done flag."""
+    try:
+        return FORMAT_MARSHAL + marshal.dumps((statuses, cmd_done))
+    except ValueError:
+        # something in a status isn't a basic type
+        return FORMAT_PICKLE + cPickle.dumps((statuses, cmd_done),
+                                             cPickle.HIGHEST_PROTOCOL)
+
+def decode(data):
+    """Decode a status batch.
+
+    :returns: (statuses, cmd_done) tuple
+    """
+    data_format = data[:1]
+    try:
+        if data_format == FORMAT_MARSHAL:
+            statuses, cmd_done = marshal.loads(data[1:])
+        elif data_format == FORMAT_PICKLE:
+            statuses, cmd_done = cPickle.loads(data[1:])
+        else:
+            raise StatusCodecError("unknown status batch format: %r" %
+                                   data_format)
+    except (cPickle.UnpicklingError, EOFError, TypeError, ValueError), e:
+        if isinstance(e, StatusCodecError):
+            raise
+        raise StatusCodecError("error decoding status batch: %s" % e)
+    if not isinstance(statuses, list):
+        raise StatusCodecError("status batch isn't a list")
+    return statuses, cmd_done
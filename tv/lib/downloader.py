@@ -272,6 +272,10 @@ class RemoteDownloader(DDBObject):
         'current_size',
         'upload_size',
     ])
+    # status attributes that don't affect any views.  If only these change
+    # in a status update, we don't need to run the view trackers.
+    volatile_status_attributes = (set(temp_status_attributes) |
+                                  status_attributes_to_defer)
 
     def setup_new(self, url, item, content_type=None, channel_name=None):
         check_u(url)
@@ -324,7 +328,11 @@ class RemoteDownloader(DDBObject):
             setattr(self, attr_name, default)
 
     def update_status_attributes(self, status_dict):
-        """Reset the attributes that track downloading info."""
+        """Reset the attributes that track downloading info.
+
+        :returns: set of the attribute names that changed
+        """
+        changed = set()
         for attr_name in self.status_attributes:
             if attr_name in status_dict:
                 value = status_dict[attr_name]
@@ -334,6 +342,8 @@ class RemoteDownloader(DDBObject):
             # UPDATE statments contain less data
             if getattr(self, attr_name) != value:
                 setattr(self, attr_name, value)
+                changed.add(attr_name)
+        return changed
 
     def get_status_for_downloader(self):
         status = dict((name, getattr(self, name))
@@ -374,6 +384,18 @@ class RemoteDownloader(DDBObject):
             for item in self.item_list:
                 item.download_stats_changed()
 
+    def signal_volatile_change(self, changed):
+        """Call this instead of signal_change() when only
+        volatile_status_attributes have changed.
+
+        None of our views depend on these, so we skip the view trackers and
+        the item signal_change() calls.  The frontend reads them from the
+        remote_downloader table though, so they still get saved.
+        """
+        self.save_changes()
+        for item in self.item_list:
+            item.download_stats_changed(needs_signal_change=False)
+
     def on_content_type(self, info):
         if not self.id_exists():
             return
@@ -515,7 +537,7 @@ class RemoteDownloader(DDBObject):
             old_filename = self.get_filename()
 
             self.before_changing_rates()
-            self.update_status_attributes(data)
+            changed = self.update_status_attributes(data)
             self.after_changing_rates()
 
             # Store the time the download finished
@@ -529,7 +551,13 @@ class RemoteDownloader(DDBObject):
                       and self.get_upload_ratio() > app.config.get(prefs.UPLOAD_RATIO)))):
                 self.stop_upload()
 
-            self.signal_change()
+            if not changed:
+                # nothing to save or to tell the frontend about
+                pass
+            elif changed.issubset(self.volatile_status_attributes):
+                self.signal_volatile_change(changed)
+            else:
+                self.signal_change()
 
             self.update_item_list(finished, file_migrated)
         return True
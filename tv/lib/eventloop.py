@@ -46,6 +46,7 @@ import traceback
 
 from miro import app
 from miro import config
+from miro import perfstats
 from miro import trapcall
 from miro import signals
 from miro import util
@@ -84,6 +85,8 @@ class DelayedCall(object):
             if end-start > 0.5:
                 logging.timing("%s too slow (%.3f secs)",
                                self.name, end-start)
+            if perfstats.enabled:
+                perfstats.record_callback(self.name, end-start)
             try:
                 total = cumulative[self.name]
             except (KeyError, AttributeError):
@@ -32,6 +32,7 @@
 FIXME - talk about Feed architecture here
 """
 
+import hashlib
 import os
 import re
 import time
@@ -54,6 +55,7 @@ from miro import autodler
 from miro import iconcache
 from miro import databaselog
 from miro import dialogs
+from miro import directoryscan
 from miro import download_utils
 from miro import eventloop
 from miro import feedupdate
@@ -76,6 +78,16 @@ from miro.clock import clock
 # should we not use our worker process for feedparser.  This is just used in
 # the unittests to speed things up
 _RUN_FEED_PARSER_INLINE = False
+# should we scan watched folders in the event loop thread, rather than the
+# thread pool.  This is also just for the unittests.
+_RUN_DIRECTORY_SCAN_INLINE = False
+
+# feed bodies bigger than this get spooled to a temp file and parsed from
+# there, rather than being passed around in memory
+FEED_SPOOL_THRESHOLD = 1024 * 1024
+# create_items_for_parsed() handles this many entries at a time, letting
+# the event loop run in between batches
+NEW_ITEM_BATCH_SIZE = 250
 
 DEFAULT_FEED_ICON = "images/icon-podcast-small.png"
 
@@ -86,28 +98,6 @@ def default_feed_icon_url():
 def default_feed_icon_path():
     return resources.path(DEFAULT_FEED_ICON)
 
-class _RateLimiter(object):
-    """Helper class used by create_items_for_parsed() to avoid hogging the
-    GIL.
-
-    This class helps ensure that a potentially long-running operation doesn't
-    take more than a fixed-percentage of the CPU.  It's not really a great
-    solution, but it's the simplest way for 4.0.2
-    """
-    def __init__(self):
-        self.last_time = time.time()
-
-    def check_for_sleep(self):
-        elapsed = self.last_time - time.time()
-        if elapsed < 0.1:
-            return # don't sleep until a decent of time has passed.
-        # We want to yield at least 10% of the CPU.  Sleep for 10% of the time
-        # we took since the last check
-        sleep_time = elapsed / 10.0
-        time.sleep(sleep_time)
-        # get ready for the next check() call
-        self.last_time = time.time()
-
 # Notes on character set encoding of feeds:
 #
 # The parsing libraries built into Python mostly use byte strings
@@ -224,19 +214,191 @@ def _on_config_change(obj, key, value):
                 pass
             feed.set_update_frequency(update_freq)
 
-def run_feedparser(html, callback, errback):
+def run_feedparser(html, callback, errback, body_path=None, charset=None):
+    """Parse a feed, either from html or from a file at body_path.
+
+    If body_path is given, the file gets deleted once we're done with it.
+    """
+    if body_path is not None:
+        real_callback, real_errback = callback, errback
+        def callback(result):
+            _remove_body_file(body_path)
+            real_callback(result)
+        def errback(error):
+            _remove_body_file(body_path)
+            real_errback(error)
     if _RUN_FEED_PARSER_INLINE:
         try:
-            rv = feedparserutil.parse(html)
+            if body_path is not None:
+                rv = feedparserutil.parse_file(body_path, charset)
+            else:
+                rv = feedparserutil.parse(html)
         except StandardError, e:
             errback(e)
         else:
             callback(rv)
     else:
-        workerprocess.send(workerprocess.FeedparserTask(html),
+        task = workerprocess.FeedparserTask(html, body_path, charset)
+        workerprocess.send(task,
                            lambda msg, result: callback(result),
                            lambda msg, error: errback(error))
 
+class FeedParseStats(object):
+    """Counts how much feed parsing work the digest checks avoided.
+
+    parses_run/parses_skipped count feed bodies sent to (or kept away
+    from) feedparser.  entries_compared/entries_skipped count entries
+    that went through FeedParserValues and compare_to_item() versus
+    ones we matched to their item by digest alone.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.parses_run = 0
+        self.parses_skipped = 0
+        self.entries_compared = 0
+        self.entries_skipped = 0
+
+    def to_dict(self):
+        return {
+            'parses_run': self.parses_run,
+            'parses_skipped': self.parses_skipped,
+            'entries_compared': self.entries_compared,
+            'entries_skipped': self.entries_skipped,
+        }
+
+parse_stats = FeedParseStats()
+
+def body_digest(html):
+    """Get a digest for the body of a feed."""
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+    return unicode(hashlib.sha1(html).hexdigest())
+
+def _remove_body_file(path):
+    try:
+        fileutil.remove(path)
+    except OSError:
+        pass
+
+def body_file_digest(path):
+    """Get a digest for a feed body stored in a file."""
+    hasher = hashlib.sha1()
+    f = fileutil.open_file(path, 'rb')
+    try:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            hasher.update(data)
+    finally:
+        f.close()
+    return unicode(hasher.hexdigest())
+
+def _update_entry_digest(hasher, value):
+    if isinstance(value, dict):
+        hasher.update('{')
+        for key in sorted(value.keys()):
+            hasher.update(repr(key))
+            _update_entry_digest(hasher, value[key])
+        hasher.update('}')
+    elif isinstance(value, (list, tuple)):
+        hasher.update('[')
+        for child in value:
+            _update_entry_digest(hasher, child)
+        hasher.update(']')
+    else:
+        hasher.update(repr(value))
+
+def entry_digest(entry):
+    """Get a digest for a feedparser entry.
+
+    Dicts are hashed in key order, so the digest only depends on the
+    contents of the entry, not on how feedparser happened to build it.
+    """
+    hasher = hashlib.sha1()
+    _update_entry_digest(hasher, entry)
+    return unicode(hasher.hexdigest())
+
+def normalize_entry_title(title):
+    """Normalize an entry title for matching, ignoring case and whitespace.
+    """
+    if title is None:
+        return None
+    return u' '.join(title.split()).lower()
+
+class FeedItemIndex(object):
+    """Finds the existing item in a feed that matches a parsed entry.
+
+    Lookups go through the item table's (feed_id, rss_id) and (feed_id, url,
+    entry_title) indexes, so they don't depend on how many items the feed
+    has, and SQLite keeps the indexes current as items are added and removed.
+    """
+    def __init__(self, feed_id):
+        self.feed_id = feed_id
+
+    def get_item(self, item_id):
+        """Get an item in our feed by database id, or None if it's gone."""
+        if item_id is None:
+            return None
+        try:
+            item = models.Item.get_by_id(item_id)
+        except ObjectNotFoundError:
+            return None
+        if item.feed_id != self.feed_id:
+            return None
+        return item
+
+    def find_by_digest(self, digest):
+        """Find the item that we created or updated from an entry with the
+        same entry_digest().
+        """
+        rows = models.Item.select(['id'], 'feed_id=? AND entry_digest=?',
+                                  (self.feed_id, digest))
+        if rows:
+            return self.get_item(rows[0][0])
+        return None
+
+    def find(self, fp_values):
+        """Find the item for a FeedParserValues object.
+
+        Items are matched by rss_id, then by enclosure URL and normalized
+        title, then items without an rss_id are matched by their enclosure.
+
+        :returns: the matching Item or None
+        """
+        rss_id = fp_values.data['rss_id']
+        if rss_id is not None:
+            rows = models.Item.select(['id'], 'feed_id=? AND rss_id=?',
+                                      (self.feed_id, rss_id))
+            if rows:
+                return self.get_item(rows[0][0])
+        url = fp_values.data['url']
+        title = fp_values.data['entry_title']
+        if url is None and title is None:
+            return None
+        if url is None:
+            rows = models.Item.select(['id', 'entry_title', 'rss_id'],
+                                      'feed_id=? AND url IS NULL',
+                                      (self.feed_id,))
+        else:
+            rows = models.Item.select(['id', 'entry_title', 'rss_id'],
+                                      'feed_id=? AND url=?',
+                                      (self.feed_id, url))
+        title = normalize_entry_title(title)
+        keyless = []
+        for item_id, item_title, item_rss_id in rows:
+            if normalize_entry_title(item_title) == title:
+                return self.get_item(item_id)
+            if item_rss_id is None:
+                keyless.append(item_id)
+        for item_id in keyless:
+            item = self.get_item(item_id)
+            if item is not None and fp_values.compare_to_item_enclosures(item):
+                return item
+        return None
+
 # Wait X seconds before updating the feeds at startup
 INITIAL_FEED_UPDATE_DELAY = 5.0
 
@@ -320,6 +482,10 @@ class FeedImpl(DDBObject):
             self.scheduler.cancel()
             self.scheduler = None
 
+    def schedule_startup_update(self, firstTriggerDelay):
+        """Schedule the first update after restoring the feed."""
+        self.schedule_update_events(firstTriggerDelay)
+
     def update(self):
         """Subclasses should override this
         """
@@ -374,6 +540,11 @@ class FeedImpl(DDBObject):
         subclasses can perform cleanup here."""
         pass
 
+    def on_item_removed(self):
+        """Called when an item created for one of our feed entries is
+        removed."""
+        pass
+
     def __str__(self):
         return "%s - %s" % (self.__class__.__name__, stringify(self.title))
 
@@ -385,12 +556,89 @@ class FeedImpl(DDBObject):
         """
         pass
 
+class FeedCounts(object):
+    """Item counts for all feeds.
+
+    Rather than running COUNT queries for each feed, FeedCounts counts the
+    items for every feed that needs it with one GROUP BY query per count
+    type.  The first lookup counts all feeds.  After that, invalidate() marks
+    a feed dirty and the next lookup for any dirty feed recounts all of them
+    together.
+
+    Items invalidate the counts for their feed through the item change
+    tracker.  Feeds invalidate their own counts in recalc_counts(), since
+    download state changes don't show up as item attribute changes.
+    """
+    COUNT_NAMES = ('downloaded', 'downloading', 'unwatched', 'available',
+                   'auto_pending')
+
+    def __init__(self):
+        self.counts = dict((name, {}) for name in self.COUNT_NAMES)
+        self.loaded = False
+        self.dirty = set()
+
+    def invalidate(self, feed_id):
+        self.dirty.add(feed_id)
+
+    def invalidate_all(self):
+        self.loaded = False
+        self.dirty = set()
+
+    def forget(self, feed_id):
+        """Drop the counts for a feed that was removed."""
+        self.dirty.discard(feed_id)
+        for counts in self.counts.values():
+            counts.pop(feed_id, None)
+
+    def get(self, feed_id, name):
+        if not self.loaded:
+            self._recount(None)
+            self.loaded = True
+            self.dirty = set()
+        elif feed_id in self.dirty:
+            self._recount(list(self.dirty))
+            self.dirty = set()
+        return self.counts[name].get(feed_id, 0)
+
+    def _recount(self, feed_ids):
+        for name in self.COUNT_NAMES:
+            new_counts = models.Item.feed_counts(name, feed_ids)
+            counts = self.counts[name]
+            if feed_ids is None:
+                counts.clear()
+            else:
+                for feed_id in feed_ids:
+                    counts.pop(feed_id, None)
+            counts.update(new_counts)
+
+    def check_consistency(self):
+        """Compare our counts against a COUNT query for each feed.
+
+        This is slow and meant for the unittests.
+
+        :returns: list of (feed_id, name, our_count, real_count) tuples for
+            counts that don't match
+        """
+        errors = []
+        for feed in Feed.make_view():
+            for name in self.COUNT_NAMES:
+                real_count = models.Item._feed_count_view(name,
+                                                          feed.id).count()
+                our_count = self.get(feed.id, name)
+                if our_count != real_count:
+                    errors.append((feed.id, name, our_count, real_count))
+        return errors
+
+def setup_feed_counts():
+    Feed.counts = FeedCounts()
+
 class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
     """This class is a magic class that can become any type of feed it wants
 
     It works by passing on attributes to the actual feed.
     """
     ICON_CACHE_VITAL = True
+    counts = FeedCounts()
 
     def setup_new(self, url, initiallyAutoDownloadable=None,
                  search_term=None, title=None):
@@ -526,6 +774,10 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         self.feed_impl_id = feed_impl.id
 
     def signal_change(self, needs_save=True, needs_signal_folder=False):
+        if ('autoDownloadable' in self.changed_attributes or
+                'getEverything' in self.changed_attributes):
+            # these change which items are pending auto-download
+            self.invalidate_counts()
         if needs_signal_folder:
             folder = self.get_folder()
             if folder:
@@ -554,17 +806,14 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             self.loading = True
             eventloop.add_idle(lambda: self.generate_feed(True), "generate_feed")
         else:
-            self.schedule_update_events(INITIAL_FEED_UPDATE_DELAY)
+            self.actualFeed.schedule_startup_update(INITIAL_FEED_UPDATE_DELAY)
 
     def clean_old_items(self):
         if self.actualFeed:
             return self.actualFeed.clean_old_items()
 
     def invalidate_counts(self):
-        for cached_count_attr in ('_num_available', '_num_unwatched',
-                '_num_downloaded', '_num_downloading'):
-            if cached_count_attr in self.__dict__:
-                del self.__dict__[cached_count_attr]
+        self.counts.invalidate(self.id)
 
     def recalc_counts(self):
         self.invalidate_counts()
@@ -575,49 +824,30 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
     def num_downloaded(self):
         """Returns the number of downloaded items in the feed.
         """
-        try:
-            return self._num_downloaded
-        except AttributeError:
-            self._num_downloaded = self.downloaded_items.count()
-            return self._num_downloaded
+        return self.counts.get(self.id, 'downloaded')
 
     def num_downloading(self):
         """Returns the number of downloading items in the feed.
         """
-        try:
-            return self._num_downloading
-        except AttributeError:
-            self._num_downloading = self.downloading_items.count()
-            return self._num_downloading
+        return self.counts.get(self.id, 'downloading')
 
     def num_unwatched(self):
         """Returns string with number of unwatched videos in feed
         """
-        try:
-            return self._num_unwatched
-        except AttributeError:
-            self._num_unwatched = self.unwatched_items.count()
-            return self._num_unwatched
+        return self.counts.get(self.id, 'unwatched')
 
     def num_available(self):
         """Returns string with number of available videos in feed
         """
-        try:
-            return self._num_available
-        except AttributeError:
-            self._num_available = (self.available_items.count() -
-                    self.auto_pending_items.count())
-            return self._num_available
+        return (self.counts.get(self.id, 'available') -
+                self.counts.get(self.id, 'auto_pending'))
 
     def mark_as_viewed(self):
         """Sets the last time the feed was viewed to now
         """
-        try:
-            del self._num_available
-        except AttributeError:
-            pass
         for item in list(self.available_items):
             item.unset_new()
+        self.invalidate_counts()
         if self.in_folder():
             self.get_folder().signal_change()
         self.signal_change()
@@ -1156,6 +1386,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             app.bulk_sql_manager.finish()
         self.remove_icon_cache()
         DDBObject.remove(self)
+        self.counts.forget(self.id)
         self.actualFeed.remove()
         if self.in_folder():
             self.get_folder().signal_change()
@@ -1200,19 +1431,43 @@ class ThrottledUpdateFeedImpl(FeedImpl):
                     self.update)
         else:
             if self.updateFreq > 0:
-                feedupdate.schedule_update(self.updateFreq, self.ufeed,
-                        self.update)
+                feedupdate.schedule_periodic_update(self.updateFreq,
+                        self.ufeed, self.update)
+
+    def schedule_startup_update(self, firstTriggerDelay):
+        feedupdate.cancel_update(self.ufeed)
+        feedupdate.schedule_startup_update(firstTriggerDelay,
+                self.updateFreq, self.ufeed, self.update)
+
+    def cancel_update_events(self):
+        feedupdate.cancel_update(self.ufeed)
+
+    def remove(self):
+        feedupdate.remove_feed(self.ufeed)
+        FeedImpl.remove(self)
 
 class RSSFeedImplBase(ThrottledUpdateFeedImpl):
     """
     Base class from which RSSFeedImpl and SavedSearchFeedImpl derive.
     """
+    # Set to True by subclasses that store the digest of the entry each item
+    # came from on the item, so that unchanged entries can skip the
+    # comparison with their item.
+    track_entry_digests = False
+    # Set to False by subclasses that can't let the event loop run while
+    # items for new entries are being created.
+    create_items_in_batches = True
+
     def setup_new(self, url, ufeed, title):
         FeedImpl.setup_new(self, url, ufeed, title)
         self.schedule_update_events(0)
 
-    def _handle_new_entry(self, entry, fp_values, channel_title):
-        """Handle getting a new entry from a feed."""
+    def _handle_new_entry(self, entry, fp_values, channel_title,
+                          look_for_downloader=True):
+        """Handle getting a new entry from a feed.
+
+        :returns: the item created for the entry, or None
+        """
         enclosure = fp_values.first_video_enclosure
         if ((self.url.startswith('file://') and enclosure
              and enclosure['url'].startswith('file://'))):
@@ -1222,23 +1477,110 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
         else:
             item = models.Item(fp_values, feed_id=self.ufeed.id,
                     eligible_for_autodownload=not self.initialUpdate,
-                    channel_title=channel_title)
+                    channel_title=channel_title,
+                    look_for_downloader=look_for_downloader)
             if not item.matches_search(self.ufeed.searchTerm):
                 item.remove()
+                return None
+        return item
 
     def remember_old_items(self):
         self.old_items = set(self.items)
 
-    def create_items_for_parsed(self, parsed):
-        """Update the feed using parsed XML passed in"""
-        app.bulk_sql_manager.start()
-        try:
-            self._create_items_for_parsed(parsed)
-        finally:
-            app.bulk_sql_manager.finish()
+    def create_items_for_parsed(self, parsed, callback):
+        """Update the feed using parsed XML passed in
+
+        Entries get matched against our items, then items get created for
+        the new ones, NEW_ITEM_BATCH_SIZE entries at a time.  The first
+        batch is handled right away, any others from idle callbacks so that
+        huge feeds don't block the event loop.  callback is called once all
+        the items exist.
+        """
+        channel_title = self._update_from_feed_header(parsed)
+        batches = self._run_in_batches(
+                self._update_items(channel_title, parsed.entries, callback))
+        for unused in batches:
+            if self.create_items_in_batches:
+                # there's more than one batch, handle the rest later
+                eventloop.idle_iterate(lambda: batches,
+                                       'Create items for %s' % self.url)
+                break
+
+    def _run_in_batches(self, steps):
+        """Generator that pauses once the steps from _update_items() have
+        handled NEW_ITEM_BATCH_SIZE entries.
+
+        It stops early if our feed gets removed while paused.
+        """
+        entry_count = 0
+        for count in steps:
+            entry_count += count
+            if entry_count >= NEW_ITEM_BATCH_SIZE:
+                yield
+                if not self.ufeed.id_exists():
+                    return
+                entry_count = 0
+
+    def _update_items(self, channel_title, entries, callback):
+        """Generator that matches entries with our items, then creates items
+        for the new entries.
+
+        Each step handles up to NEW_ITEM_BATCH_SIZE entries and yields how
+        many it handled.
+
+        Sets self.entries_changed to True if any of our existing items
+        changed or there are entries that need new items.
+        """
+        index = FeedItemIndex(self.ufeed_id)
+        new_entries = []
+        self.entries_changed = False
+        for start in xrange(0, len(entries), NEW_ITEM_BATCH_SIZE):
+            batch = entries[start:start+NEW_ITEM_BATCH_SIZE]
+            app.bulk_sql_manager.start()
+            try:
+                new_entries.extend(self._match_entries(index, batch))
+            finally:
+                app.bulk_sql_manager.finish()
+            yield len(batch)
+        for start in xrange(0, len(new_entries), NEW_ITEM_BATCH_SIZE):
+            batch = new_entries[start:start+NEW_ITEM_BATCH_SIZE]
+            self._create_item_batch(channel_title, batch)
+            yield len(batch)
+        callback()
+
+    def _create_item_batch(self, channel_title, new_entries):
+        """Create items for a list of (entry, fp_values, digest) tuples.
+
+        The items get inserted together by bulk_sql_manager, and their icon
+        cache requests wait until they're all created.
+        """
+        urls = [fp_values.data['url'] for (entry, fp_values, digest)
+                in new_entries]
+        # find out which entries have downloaders with one query, rather
+        # than one per item
+        downloader_urls = set(row[0] for row in
+                models.RemoteDownloader.select(['orig_url'],
+                    'orig_url IN (%s)' % ', '.join('?' for url in urls),
+                    urls))
+        with app.icon_cache_updater.defer_requests():
+            app.bulk_sql_manager.start()
+            try:
+                for entry, fp_values, digest in new_entries:
+                    item = self._handle_new_entry(entry, fp_values,
+                            channel_title,
+                            fp_values.data['url'] in downloader_urls)
+                    if item is not None:
+                        # the item gets inserted when bulk_sql_manager
+                        # finishes, so we can just set the attribute
+                        item.entry_digest = digest
+            finally:
+                app.bulk_sql_manager.finish()
 
-    def _create_items_for_parsed(self, parsed):
-        rate_limiter = _RateLimiter()
+    def _update_from_feed_header(self, parsed):
+        """Update our title and thumbnail from the parsed feed.
+
+        :returns: the channel title, or None
+        """
         channel_title = None
         try:
             channel_title = parsed["feed"]["title"]
@@ -1266,56 +1608,43 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
             if image_url and self._allow_feed_to_override_thumbnail():
                 self.thumbURL = image_url
                 self.ufeed.icon_cache.request_update(is_vital=True)
+        return channel_title
 
-        items_byid = {}
-        items_byURLTitle = {}
-        items_nokey = []
-        for item in self.items:
-            rate_limiter.check_for_sleep()
-            try:
-                items_byid[item.get_rss_id()] = item
-            except KeyError:
-                items_nokey.append(item)
-            by_url_title_key = (item.url, item.entry_title)
-            if by_url_title_key != (None, None):
-                items_byURLTitle[by_url_title_key] = item
-        for entry in parsed.entries:
-            rate_limiter.check_for_sleep()
+    def _match_entries(self, index, entries):
+        """Match up parsed entries with our existing items.
+
+        Existing items get updated and removed from self.old_items.
+
+        :returns: list of (entry, fp_values, digest) tuples for the entries
+            that need new items
+        """
+        new_entries = []
+        digest = None
+        for entry in entries:
+            if self.track_entry_digests:
+                # If we've already seen this entry and its item is still
+                # around, there's nothing to compare.
+                digest = entry_digest(entry)
+                item = index.find_by_digest(digest)
+                if item is not None:
+                    parse_stats.entries_skipped += 1
+                    self.old_items.discard(item)
+                    continue
+            parse_stats.entries_compared += 1
             entry = self.add_scraped_thumbnail(entry)
             fp_values = FeedParserValues(entry)
-            new = True
-            if fp_values.data['rss_id'] is not None:
-                id_ = fp_values.data['rss_id']
-                if items_byid.has_key(id_):
-                    item = items_byid[id_]
-                    if not fp_values.compare_to_item(item):
-                        item.update_from_feed_parser_values(fp_values)
-                    new = False
-                    self.old_items.discard(item)
-            if new:
-                by_url_title_key = (fp_values.data['url'],
-                        fp_values.data['entry_title'])
-                if by_url_title_key != (None, None):
-                    if items_byURLTitle.has_key(by_url_title_key):
-                        item = items_byURLTitle[by_url_title_key]
-                        if not fp_values.compare_to_item(item):
-                            item.update_from_feed_parser_values(fp_values)
-                        new = False
-                        self.old_items.discard(item)
-            if new:
-                for item in items_nokey:
-                    if fp_values.compare_to_item(item):
-                        new = False
-                    else:
-                        try:
-                            if fp_values.compare_to_item_enclosures(item):
-                                item.update_from_feed_parser_values(fp_values)
-                                new = False
-                                self.old_items.discard(item)
-                        except StandardError:
-                            pass
-            if new and fp_values.first_video_enclosure is not None:
-                self._handle_new_entry(entry, fp_values, channel_title)
+            item = index.find(fp_values)
+            if item is not None:
+                if not fp_values.compare_to_item(item):
+                    item.update_from_feed_parser_values(fp_values)
+                    self.entries_changed = True
+                if self.track_entry_digests:
+                    item.set_entry_digest(digest)
+                self.old_items.discard(item)
+            elif fp_values.first_video_enclosure is not None:
+                new_entries.append((entry, fp_values, digest))
+                self.entries_changed = True
+        return new_entries
 
     def _allow_feed_to_override_title(self):
         """Should the RSS feed override the default title?
@@ -1375,7 +1704,8 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
 
         candidates = []
         for item in self.old_items:
-            if item.downloader is None:
+            # items can get removed while we create items in batches
+            if item.id_exists() and item.downloader is None:
                 candidates.append((item.creation_time, item))
         candidates.sort()
         for time_, item in candidates[:extra]:
@@ -1392,6 +1722,8 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
         return entry
 
 class RSSFeedImpl(RSSFeedImplBase):
+    track_entry_digests = True
+
     def setup_new(self, url, ufeed, title=None, initialHTML=None, etag=None,
                   modified=None):
         RSSFeedImplBase.setup_new(self, url, ufeed, title)
@@ -1399,23 +1731,25 @@ class RSSFeedImpl(RSSFeedImplBase):
         self.etag = etag
         self.modified = modified
         self.download = None
+        self.body_digest = None
+        self.pending_body_digest = None
+        self.link = None
+        self.license = None
 
     @returns_unicode
     def get_base_href(self):
-        try:
-            return self.parsed.link
-        except AttributeError:
-            return FeedImpl.get_base_href(self)
+        if self.link is not None:
+            return self.link
+        return FeedImpl.get_base_href(self)
 
     @returns_unicode
     def get_link(self):
         """Returns a link to a webpage associated with the feed
         """
         self.ufeed.confirm_db_thread()
-        try:
-            return self.parsed.link
-        except AttributeError:
-            return u""
+        if self.link is not None:
+            return self.link
+        return u""
 
     def feedparser_finished(self):
         self.updating = False
@@ -1426,6 +1760,7 @@ class RSSFeedImpl(RSSFeedImplBase):
         if not self.ufeed.id_exists():
             return
         logging.warning("Error updating feed: %s: %s", self.url, e)
+        feedupdate.report_result(self.ufeed, feedupdate.UPDATE_ERROR)
         self.feedparser_finished()
 
     def feedparser_callback(self, parsed):
@@ -1434,29 +1769,89 @@ class RSSFeedImpl(RSSFeedImplBase):
             return
         if len(parsed.entries) == len(parsed.feed) == 0:
             logging.warn("Empty feed, not updating: %s", self.url)
+            feedupdate.report_result(self.ufeed, feedupdate.UPDATE_ERROR)
             self.feedparser_finished()
             return
         start = clock()
         self.parsed = parsed
+        self.body_digest = self.pending_body_digest
+        self._remember_parsed_values(parsed)
         self.remember_old_items()
-        self.create_items_for_parsed(parsed)
+        def items_created():
+            if self.entries_changed:
+                result = feedupdate.UPDATE_CHANGED
+            else:
+                result = feedupdate.UPDATE_UNCHANGED
+            feedupdate.report_result(self.ufeed, result)
 
-        try:
-            updateFreq = self.parsed["feed"]["ttl"]
-        except KeyError:
-            updateFreq = 0
-        self.set_update_frequency(updateFreq)
+            try:
+                updateFreq = parsed["feed"]["ttl"]
+            except KeyError:
+                updateFreq = 0
+            self.set_update_frequency(updateFreq)
 
-        self.feedparser_finished()
+            self.feedparser_finished()
+        self.create_items_for_parsed(parsed, items_created)
         end = clock()
         if end - start > 1.0:
             logging.timing("feed update for: %s too slow (%.3f secs)",
                            self.url, end - start)
 
-    def call_feedparser(self, html):
+    def _remember_parsed_values(self, parsed):
+        """Store the values from the feed header that we need later.
+
+        They get saved with the feed, so we still have them if an unchanged
+        body lets us skip the parse after a restart.
+        """
+        try:
+            self.link = unicodify(parsed.link)
+        except AttributeError:
+            self.link = None
+        try:
+            self.license = unicodify(parsed["feed"]["license"])
+        except (AttributeError, KeyError):
+            self.license = None
+
+    def call_feedparser(self, html, body_path=None, charset=None):
+        """Parse our feed.
+
+        :param html: feed body, or None if body_path is given
+        :param body_path: file that the feed body was spooled to.  It gets
+            deleted once we're done with it.
+        :param charset: charset to declare in the XML header of the file at
+            body_path
+        """
         self.ufeed.confirm_db_thread()
+        if body_path is not None:
+            digest = body_file_digest(body_path)
+        else:
+            digest = body_digest(html)
+        if self._can_skip_parse(digest):
+            logging.debug("RSSFeedImpl: feed body unchanged (%s)", self.url)
+            if body_path is not None:
+                _remove_body_file(body_path)
+            parse_stats.parses_skipped += 1
+            feedupdate.report_result(self.ufeed, feedupdate.UPDATE_UNCHANGED)
+            self.feedparser_finished()
+            return
+        parse_stats.parses_run += 1
+        self.pending_body_digest = digest
         run_feedparser(html, self.feedparser_callback,
-                self.feedparser_errback)
+                self.feedparser_errback, body_path, charset)
+
+    def _can_skip_parse(self, digest):
+        """Check if parsing a feed body would be a no-op.
+
+        That's the case if it's the same body we parsed last time.
+        body_digest gets cleared when one of the items for its entries is
+        removed, since parsing the body again would bring the item back.
+        """
+        return digest is not None and digest == self.body_digest
+
+    def on_item_removed(self):
+        if self.body_digest is not None or self.pending_body_digest is not None:
+            self.body_digest = self.pending_body_digest = None
+            self.signal_change()
 
     def update(self):
         """Updates a feed
@@ -1485,30 +1880,43 @@ class RSSFeedImpl(RSSFeedImplBase):
             logging.debug("updating %s", self.url)
             self.download = grab_url(self.url, self._update_callback,
                     self._update_errback, etag=etag, modified=modified,
-                                    default_mime_type=u'application/rss+xml')
+                                    default_mime_type=u'application/rss+xml',
+                                    spool_threshold=FEED_SPOOL_THRESHOLD)
 
     def _update_errback(self, error):
         if not self.ufeed.id_exists():
             return
         logging.warn("WARNING: error in Feed.update for %s -- %s",
             self.ufeed, stringify(error))
+        feedupdate.report_result(self.ufeed, feedupdate.UPDATE_ERROR)
         self.schedule_update_events(-1)
         self.updating = False
         self.ufeed.signal_change(needs_save=False)
 
     def _update_callback(self, info):
+        body_path = info.get('body-path')
         if not self.ufeed.id_exists():
+            if body_path is not None:
+                _remove_body_file(body_path)
             return
         if info.get('status') == 304:
             logging.debug("RSSFeedImpl: _update_callback: "
                           "status 304 (%s)", self.ufeed)
+            feedupdate.report_result(self.ufeed, feedupdate.UPDATE_UNCHANGED)
             self.schedule_update_events(-1)
             self.updating = False
             self.ufeed.signal_change()
             return
-        html = info['body']
-        if info.has_key('charset'):
-            html = fix_xml_header(html, info['charset'])
+        charset = info.get('charset')
+        if body_path is not None:
+            # the body was too big to keep in memory.  The worker fixes the
+            # XML header when it reads the file.
+            html = None
+        else:
+            html = info['body']
+            if charset is not None:
+                html = fix_xml_header(html, charset)
+                charset = None
 
         # FIXME HTML can be non-unicode here --NN
         self.url = unicodify(info['updated-url'])
@@ -1520,16 +1928,14 @@ class RSSFeedImpl(RSSFeedImplBase):
             self.modified = unicodify(info['last-modified'])
         else:
             self.modified = None
-        self.call_feedparser(html)
+        self.call_feedparser(html, body_path, charset)
 
     @returns_unicode
     def get_license(self):
         """Returns the URL of the license associated with the feed
         """
-        try:
-            return self.parsed["feed"]["license"]
-        except (AttributeError, KeyError):
-            pass
+        if self.license is not None:
+            return self.license
         return u""
 
     def on_remove(self):
@@ -1542,13 +1948,21 @@ class RSSFeedImpl(RSSFeedImplBase):
         """
         FeedImpl.setup_restored(self)
         self.download = None
+        self.pending_body_digest = None
 
     def clean_old_items(self):
         self.modified = None
         self.etag = None
+        # make sure we go through feedparser_callback, which is where old
+        # items get truncated.
+        self.body_digest = None
         self.update()
 
 class RSSMultiFeedBase(RSSFeedImplBase):
+    # Several URLs can be parsed at once.  Matching entries from one against
+    # our items only works if the items from the others have been created.
+    create_items_in_batches = False
+
     def setup_new(self, url, ufeed, title):
         RSSFeedImplBase.setup_new(self, url, ufeed, title)
         self.etag = {}
@@ -1609,8 +2023,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         if not self.ufeed.id_exists() or url not in self.download_dc:
             return
         start = clock()
-        self.create_items_for_parsed(parsed)
-        self.feedparser_finished(url)
+        self.create_items_for_parsed(parsed,
+                                     lambda: self.feedparser_finished(url))
         end = clock()
         if end - start > 1.0:
             logging.timing("feed update for: %s too slow (%.3f secs)",
@@ -2019,6 +2433,14 @@ class DirectoryScannerImplBase(FeedImpl):
         FeedImpl.setup_restored(self)
         self.pending_paths_to_add = []
 
+    def on_remove(self):
+        if getattr(self, 'watcher', None) is not None:
+            self.watcher.stop()
+        if getattr(self, '_watcher_update_timeout', None) is not None:
+            self._watcher_update_timeout.cancel()
+            self._watcher_update_timeout = None
+        self._remove_snapshot()
+
     def expire_items(self):
         """Directory Items shouldn't automatically expire
         """
@@ -2169,108 +2591,110 @@ class DirectoryScannerImplBase(FeedImpl):
             self.updating = True
             self.schedule_update()
 
-    @eventloop.idle_iterator
-    def do_update(self):
+    def _snapshot_path(self):
+        """Get the path to store our DirectorySnapshot at."""
+        scan_dir = self._scan_dir()
+        if isinstance(scan_dir, unicode):
+            scan_dir = scan_dir.encode('utf-8')
+        return os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+                            'directory-scan',
+                            hashlib.sha1(scan_dir).hexdigest())
 
-        def should_halt_early():
-            """Check if we should halt before completing the entire update.
+    def _remove_snapshot(self):
+        try:
+            fileutil.remove(self._snapshot_path())
+        except OSError:
+            # we never saved one
+            pass
 
-            This should be called after each yield statement.
-            """
-            return not self.id_exists()
+    def do_update(self):
+        """Scan our directory and update our items to match it.
 
-        if should_halt_early():
+        The filesystem work happens in the thread pool, see directoryscan.py
+        for details.  Here we just gather up what it needs from the
+        database, then apply the changes it finds.
+        """
+        if not self.id_exists():
             return
 
         self._before_update()
 
-        known_files = self.calc_known_files()
-        my_files = set()
-        my_items = list(self.items)
-        # pause after doing prep work
-        yield
-        if should_halt_early():
-            return
-
-        # Remove items with deleted files or that that are in feeds
-        to_remove = []
-        duplicate_paths = []
-        start = time.time()
-        for item in my_items:
-            if not item.id_exists():
-                continue
-            filename = item.get_filename()
-            if (filename is None or
-                not fileutil.isfile(filename) or
-                known_files.contains_path(filename)):
-                to_remove.append(item)
-            if filename not in my_files:
-                my_files.add(filename)
+        # Using a select statement is good here because we don't want to
+        # construct all the Item objects if we don't need to.
+        items = models.Item.select(['id', 'filename'], 'feed_id=?',
+                                   (self.ufeed_id,))
+        args = (self._scan_dir(), self._snapshot_path(), items,
+                self.calc_known_files(), self._filter_paths)
+        if _RUN_DIRECTORY_SCAN_INLINE:
+            try:
+                result = directoryscan.scan_directory(*args)
+            except StandardError, e:
+                self._scan_errback(e)
             else:
-                duplicate_paths.append(filename)
-                to_remove.append(item)
-            if time.time() - start > 0.4:
-                yield
-                if should_halt_early():
-                    return
-                start = time.time()
-        if duplicate_paths:
+                self._scan_callback(result)
+        else:
+            eventloop.call_in_thread(self._scan_callback, self._scan_errback,
+                                     directoryscan.scan_directory,
+                                     'scan directory %s' % self.url, *args)
+
+    def _scan_callback(self, result):
+        if not self.id_exists():
+            # we were removed while the scan saved our snapshot
+            self._remove_snapshot()
+            return
+        logging.debug("scanned %s: %d dirs listed, %d unchanged", self.url,
+                      result.dirs_listed, result.dirs_skipped)
+        if result.duplicate_paths:
             app.controller.failed_soft("scanning directory",
                 "duplicate paths in directory watcher: %s (impl: %s" %
-                (duplicate_paths, self))
+                (result.duplicate_paths, self))
         app.bulk_sql_manager.start()
         try:
-            for item in to_remove:
-                if item.id_exists():
-                    item.remove()
+            for item_id in set(result.to_remove):
+                try:
+                    item = models.Item.get_by_id(item_id)
+                except ObjectNotFoundError:
+                    continue
+                item.remove()
         finally:
             app.bulk_sql_manager.finish()
 
-        # now that we've checked for items that need to be removed, we
-        # add our items to known_files so that they don't get added
-        # multiple times to this feed.
-        for path in my_files:
-            known_files.add_path(path)
+        # The directory watcher may have added items while we were
+        # scanning, don't add those again.
+        my_files = fileutil.FileSet(row[0] for row in
+                models.Item.select(['filename'],
+                    'feed_id=? AND filename IS NOT NULL', (self.ufeed_id,)))
+        to_add = [path for path in result.to_add
+                  if not my_files.contains_path(path)]
+        # Keep track of the paths we will add in case we get directory
+        # watcher updates.  In that case, we want these paths to be in
+        # known_files.
+        self.pending_paths_to_add = to_add
+        self._add_scanned_files(to_add)
+
+    def _scan_errback(self, error):
+        if not self.id_exists():
+            self._remove_snapshot()
+            return
+        logging.warn("Error scanning %s: %s", self._scan_dir(), error)
+        self._finish_update()
 
-        # adds any files we don't know about
-        # files on the filesystem
-        scan_dir = self._scan_dir()
-        if fileutil.isdir(scan_dir) and not is_file_bundle(scan_dir):
-            all_files = []
-            start = time.time()
-            for f in fileutil.miro_allfiles(scan_dir):
-                all_files.append(f)
-                if time.time() - start > 0.4:
-                    yield
-                    if should_halt_early():
-                        return
-                    start = time.time()
-            start = time.time()
-            to_add = []
-            for path in self._filter_paths(all_files, known_files):
-                to_add.append(path)
-                if time.time() - start > 0.4:
-                    yield
-                    if should_halt_early():
-                        return
-                    start = time.time()
-
-            # Keep track of the paths we will add in case we get directory
-            # watcher updates.  In that case, we want these paths to be in
-            # known_files.  It's very important that the next line come before
-            # the first yield statement to avoid a race condition.
-            self.pending_paths_to_add = to_add
-            path_iter = iter(to_add)
-            finished = False
-            yield # yield after doing prep work
-            if should_halt_early():
-                return
-            with app.local_metadata_manager.bulk_add():
-                while not finished:
-                    finished = self._add_batch_of_videos(path_iter, 0.1)
-                    yield # yield after each batch
-                    if should_halt_early():
-                        return
+    @eventloop.idle_iterator
+    def _add_scanned_files(self, to_add):
+        path_iter = iter(to_add)
+        finished = False
+        yield # yield after doing prep work
+        if not self.id_exists():
+            return
+        with app.local_metadata_manager.bulk_add():
+            while not finished:
+                finished = self._add_batch_of_videos(path_iter, 0.1)
+                yield # yield after each batch
+                if not self.id_exists():
+                    return
+        self._finish_update()
+
+    def _finish_update(self):
         self._after_update()
         self.updating = False
         self.pending_paths_to_add = []
@@ -2468,10 +2892,11 @@ class SearchFeedImpl(RSSMultiFeedBase):
         self.update()
         self.ufeed.signal_change()
 
-    def _handle_new_entry(self, entry, fp_values, channel_title):
+    def _handle_new_entry(self, entry, fp_values, channel_title,
+                          look_for_downloader=True):
         """Handle getting a new entry from a feed."""
         url = fp_values.data['url']
-        if url is not None:
+        if url is not None and look_for_downloader:
             dl = downloader.get_existing_downloader_by_url(url)
             if dl is not None:
                 for item in dl.item_list:
@@ -2492,7 +2917,8 @@ class SearchFeedImpl(RSSMultiFeedBase):
                             if not fp_values.compare_to_item(item):
                                 item.update_from_feed_parser_values(fp_values)
                             return
-        RSSMultiFeedBase._handle_new_entry(self, entry, fp_values, channel_title)
+        RSSMultiFeedBase._handle_new_entry(self, entry, fp_values,
+                                           channel_title, look_for_downloader)
 
     def update_finished(self):
         self.searching = False
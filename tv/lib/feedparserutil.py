@@ -42,6 +42,7 @@ from miro import feedparser
 from miro import filetypes
 from miro import flashscraper
 from miro import util
+from miro.xhtmltools import fix_xml_header
 
 # values from feedparser dicts that don't have to convert in
 # normalize_feedparser_dict()
@@ -90,6 +91,21 @@ def parse(url_file_stream_or_string):
     _yahoo_hack(parsed['entries'])
     return parsed
 
+def parse_file(path, charset=None):
+    """Parse a feed body that was spooled to a file.
+
+    :param charset: if given, make sure the XML header declares it, like
+        fix_xml_header() does for in-memory bodies.
+    """
+    f = open(path, 'rb')
+    try:
+        if charset is None:
+            return parse(f)
+        data = f.read()
+    finally:
+        f.close()
+    return parse(fix_xml_header(data, charset))
+
 def _yahoo_hack(feedparser_entries):
     """Hack yahoo search to provide enclosures"""
     for entry in feedparser_entries:
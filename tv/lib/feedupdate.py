@@ -30,28 +30,156 @@
 """feedupdate.py -- Handles updating feeds.
 
 Our basic strategy is to limit the number of feeds that are
-simultaniously updating at any given time.  Right now the limit is set
-to 3.
+simultaniously updating at any given time, both overall and for each
+host that we fetch feeds from.
+
+We also keep track of how often each feed actually changes.  Feeds that
+keep returning the same content (or 304 responses, or errors) get
+checked less often, up to MAX_BACKOFF times their normal update
+frequency.  That state is stored in the database, so that we don't
+re-check everything right after startup.
 """
 
 import collections
+import logging
+import math
+import time
+import urlparse
 
 from miro import eventloop
+from miro.database import DDBObject, ObjectNotFoundError
+
+# max number of feeds updating at once
+MAX_UPDATES = 8
+# max number of feeds updating at once from a single host
+MAX_UPDATES_PER_HOST = 2
+# max factor that we will stretch a feed's update frequency by
+MAX_BACKOFF = 8
+# factor to stretch the update frequency by for each unchanged update
+UNCHANGED_BACKOFF = 1.25
+# how much weight to give the most recent change when estimating how often
+# a feed changes
+CHANGE_INTERVAL_WEIGHT = 0.3
+# past these counts, calc_delay() always returns the MAX_BACKOFF delay, so we
+# stop counting.
+MAX_UNCHANGED_COUNT = int(math.ceil(math.log(MAX_BACKOFF) /
+                                    math.log(UNCHANGED_BACKOFF)))
+MAX_ERROR_COUNT = int(math.ceil(math.log(MAX_BACKOFF, 2)))
+
+# results that feeds pass to report_result()
+UPDATE_CHANGED = 'changed'
+UPDATE_UNCHANGED = 'unchanged'
+UPDATE_ERROR = 'error'
+
+class FeedUpdateState(DDBObject):
+    """Tracks how a feed has behaved for past updates."""
+
+    def setup_new(self, feed_id):
+        self.feed_id = feed_id
+        self.last_update = None
+        self.last_change = None
+        self.change_interval = None
+        self.unchanged_count = 0
+        self.error_count = 0
+
+    @classmethod
+    def get_by_feed_id(cls, feed_id):
+        return cls.make_view('feed_id=?', (feed_id,)).get_singleton()
+
+    def record_result(self, result, now):
+        """Update our state after an update of the feed.
+
+        :param result: UPDATE_CHANGED, UPDATE_UNCHANGED or UPDATE_ERROR
+        :param now: timestamp of the update
+        """
+        old_values = (self.last_change, self.change_interval,
+                      self.unchanged_count, self.error_count)
+        if result == UPDATE_ERROR:
+            self.error_count = min(self.error_count + 1, MAX_ERROR_COUNT)
+        elif result == UPDATE_UNCHANGED:
+            self.error_count = 0
+            self.unchanged_count = min(self.unchanged_count + 1,
+                                       MAX_UNCHANGED_COUNT)
+        elif result == UPDATE_CHANGED:
+            if self.last_change is not None:
+                interval = max(now - self.last_change, 0)
+                if self.change_interval is None:
+                    self.change_interval = interval
+                else:
+                    self.change_interval = (
+                        CHANGE_INTERVAL_WEIGHT * interval +
+                        (1 - CHANGE_INTERVAL_WEIGHT) * self.change_interval)
+            self.last_change = now
+            self.error_count = 0
+            self.unchanged_count = 0
+        else:
+            raise ValueError("Unknown update result: %r" % result)
+        self.last_update = now
+        if old_values != (self.last_change, self.change_interval,
+                          self.unchanged_count, self.error_count):
+            self.signal_change()
+        else:
+            # Only last_update changed.  Nothing watches that, so just save
+            # it.
+            self.save_changes()
+
+    def calc_delay(self, update_freq):
+        """Calculate how long to wait before the next update.
 
-MAX_UPDATES = 3
+        update_freq is the feed's normal update frequency.  We never
+        update more often than that, and never wait more than
+        MAX_BACKOFF times as long.
+        """
+        if self.error_count > 0:
+            delay = update_freq * (2 ** self.error_count)
+        else:
+            delay = update_freq
+            if self.change_interval is not None:
+                # check about twice as often as the feed changes
+                delay = max(delay, self.change_interval / 2)
+            delay *= UNCHANGED_BACKOFF ** self.unchanged_count
+        return min(delay, update_freq * MAX_BACKOFF)
+
+class FeedUpdateScheduler(object):
+    """Schedules feed updates.
 
-class FeedUpdateQueue(object):
+    Feeds get put in update_queue when their update is due.  We start
+    updates from the queue in order, skipping over feeds whose host
+    already has MAX_UPDATES_PER_HOST updates in progress.
+    """
     def __init__(self):
         self.update_queue = collections.deque()
         self.timeouts = {}
         self.callback_handles = {}
-        self.currently_updating = set()
+        self.currently_updating = {}
+        self.host_counts = collections.defaultdict(int)
+        self.max_queue_depth = 0
+        # maps feed ids to FeedUpdateState objects that we've looked up
+        self.states = {}
 
     def schedule_update(self, delay, feed, update_callback):
         name = "Feed update (%s)" % feed.get_title()
-        self.timeouts[feed.id] = eventloop.add_timeout(delay, self.do_update, 
+        self.timeouts[feed.id] = eventloop.add_timeout(delay, self.do_update,
                 name, args=(feed, update_callback))
 
+    def schedule_periodic_update(self, update_freq, feed, update_callback):
+        state = self._get_state(feed)
+        if state is None:
+            delay = update_freq
+        else:
+            delay = state.calc_delay(update_freq)
+        self.schedule_update(delay, feed, update_callback)
+
+    def schedule_startup_update(self, min_delay, update_freq, feed,
+                                update_callback):
+        state = self._get_state(feed)
+        if state is None or state.last_update is None or update_freq <= 0:
+            delay = min_delay
+        else:
+            next_update = state.last_update + state.calc_delay(update_freq)
+            delay = max(min_delay, next_update - time.time())
+        self.schedule_update(delay, feed, update_callback)
+
     def cancel_update(self, feed):
         try:
             timeout = self.timeouts.pop(feed.id)
@@ -60,40 +188,147 @@ class FeedUpdateQueue(object):
         else:
             timeout.cancel()
 
+    def remove_feed(self, feed):
+        self.cancel_update(feed)
+        state = self._get_state(feed)
+        if state is not None:
+            del self.states[feed.id]
+            state.remove()
+
+    def report_result(self, feed, result):
+        state = self._get_state(feed)
+        if state is None:
+            state = self.states[feed.id] = FeedUpdateState(feed.id)
+        state.record_result(result, time.time())
+
+    def _get_state(self, feed):
+        try:
+            return self.states[feed.id]
+        except KeyError:
+            pass
+        try:
+            state = FeedUpdateState.get_by_feed_id(feed.id)
+        except ObjectNotFoundError:
+            return None
+        self.states[feed.id] = state
+        return state
+
     def do_update(self, feed, update_callback):
-        del self.timeouts[feed.id]
+        self.timeouts.pop(feed.id, None)
         self.update_queue.append((feed, update_callback))
+        self.max_queue_depth = max(self.max_queue_depth,
+                                   len(self.update_queue))
         self.run_update_queue()
 
     def update_finished(self, feed):
         for callback_handle in self.callback_handles.pop(feed.id):
             feed.disconnect(callback_handle)
-        self.currently_updating.remove(feed)
+        host = self.currently_updating.pop(feed)
+        if host:
+            self.host_counts[host] -= 1
+            if self.host_counts[host] == 0:
+                del self.host_counts[host]
         # call run_update_queue in an idle to avoid re-updating the feed that
         # just finished.  That could cause weird effects since we are in the
         # update-finished callback right now.  See #16277
         eventloop.add_idle(self.run_update_queue, 'run feed update queue')
 
     def run_update_queue(self):
-        while (len(self.update_queue) > 0 and 
+        blocked = collections.deque()
+        while (len(self.update_queue) > 0 and
                len(self.currently_updating) < MAX_UPDATES):
             feed, update_callback = self.update_queue.popleft()
             if feed in self.currently_updating:
                 continue
-            handle = feed.connect('update-finished', self.update_finished)
-            handle2 = feed.connect('removed', self.update_finished)
-            self.callback_handles[feed.id] = (handle, handle2)
-            self.currently_updating.add(feed)
-            update_callback()
+            host = self._get_host(feed)
+            if self._host_is_full(host):
+                blocked.append((feed, update_callback))
+                continue
+            self._start_update(feed, host, update_callback)
+        blocked.extend(self.update_queue)
+        self.update_queue = blocked
+
+    def _start_update(self, feed, host, update_callback):
+        handle = feed.connect('update-finished', self.update_finished)
+        handle2 = feed.connect('removed', self.update_finished)
+        self.callback_handles[feed.id] = (handle, handle2)
+        self.currently_updating[feed] = host
+        if host:
+            self.host_counts[host] += 1
+        update_callback()
 
-global_update_queue = FeedUpdateQueue()
+    def _get_host(self, feed):
+        try:
+            return urlparse.urlsplit(feed.get_url()).hostname
+        except StandardError:
+            logging.warn("Error getting host for %s", feed.get_url(),
+                         exc_info=True)
+            return None
+
+    def _host_is_full(self, host):
+        return bool(host) and self.host_counts[host] >= MAX_UPDATES_PER_HOST
+
+    def get_stats(self):
+        """Get a dict describing the current state of the queue."""
+        blocked = 0
+        for feed, update_callback in self.update_queue:
+            if self._host_is_full(self._get_host(feed)):
+                blocked += 1
+        return {
+            'scheduled': len(self.timeouts),
+            'queued': len(self.update_queue),
+            'blocked_by_host': blocked,
+            'updating': len(self.currently_updating),
+            'max_queued': self.max_queue_depth,
+            'hosts': dict(self.host_counts),
+        }
+
+scheduler = FeedUpdateScheduler()
+
+def setup_scheduler():
+    """Start over with a new FeedUpdateScheduler."""
+    global scheduler
+    scheduler = FeedUpdateScheduler()
 
 def cancel_update(feed):
     """Cancel any pending updates for feed."""
-    global_update_queue.cancel_update(feed)
+    scheduler.cancel_update(feed)
 
 def schedule_update(delay, feed, update_callback):
     """Schedules a feed to be updated sometime around delay seconds in
     the future.
     """
-    global_update_queue.schedule_update(delay, feed, update_callback)
+    scheduler.schedule_update(delay, feed, update_callback)
+
+def schedule_periodic_update(update_freq, feed, update_callback):
+    """Schedule the next regular update for a feed.
+
+    update_freq is the feed's normal update frequency.  The actual delay
+    depends on how often the feed has changed in the past.
+    """
+    scheduler.schedule_periodic_update(update_freq, feed, update_callback)
+
+def schedule_startup_update(min_delay, update_freq, feed, update_callback):
+    """Schedule the first update for a feed after startup.
+
+    Feeds that were updated recently (before we shut down) wait until
+    their next regular update is due, but never less than min_delay.
+    """
+    scheduler.schedule_startup_update(min_delay, update_freq, feed,
+                                      update_callback)
+
+def report_result(feed, result):
+    """Record the result of updating a feed.
+
+    result should be UPDATE_CHANGED, UPDATE_UNCHANGED or UPDATE_ERROR.
+    """
+    scheduler.report_result(feed, result)
+
+def remove_feed(feed):
+    """Cancel updates for a feed that is being removed and drop its
+    state.
+    """
+    scheduler.remove_feed(feed)
+
+def get_stats():
+    return scheduler.get_stats()
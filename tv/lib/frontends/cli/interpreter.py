@@ -35,7 +35,11 @@ import Queue
 from miro import app
 from miro import dialogs
 from miro import eventloop
+from miro import feed
+from miro import feedupdate
+from miro import httpclient
 from miro import item
+from miro import perfstats
 from miro import folder
 from miro import tabs
 from miro.frontends.cli import clidialog
@@ -423,3 +427,53 @@ class MiroInterpreter(cmd.Cmd):
         def callback(dialog):
             print "TEST CHOICE: %s" % dialog.choice
         d.run(callback)
+
+    @run_in_event_loop
+    def do_perfstats(self, line):
+        """perfstats on|off|reset|show|dump <path> -- Timing stats."""
+        args = line.split(None, 1)
+        command = args[0] if args else 'show'
+        if command == 'on':
+            perfstats.enable()
+            print "perfstats enabled"
+        elif command == 'off':
+            perfstats.disable()
+            print "perfstats disabled"
+        elif command == 'reset':
+            perfstats.reset()
+            feed.parse_stats.reset()
+            print "perfstats reset"
+        elif command == 'show':
+            self._print_perfstats('SQL', perfstats.sql_stats)
+            self._print_perfstats('CALLBACKS', perfstats.callback_stats)
+            print "FEED PARSING"
+            for key, value in sorted(feed.parse_stats.to_dict().items()):
+                print " * %s: %d" % (key, value)
+            print "FEED UPDATES"
+            for key, value in sorted(feedupdate.get_stats().items()):
+                print " * %s: %s" % (key, value)
+            if httpclient.curl_manager is not None:
+                print "HTTP CONNECTIONS"
+                counts = httpclient.curl_manager.get_connection_counts()
+                for key, value in sorted(counts.items()):
+                    print " * %s: %d" % (key, value)
+            if httpclient.http_cache is not None:
+                print "HTTP CACHE"
+                cache_stats = httpclient.get_http_cache_stats()
+                for key, value in sorted(cache_stats.items()):
+                    print " * %s: %d" % (key, value)
+        elif command == 'dump' and len(args) == 2:
+            perfstats.write_snapshot(args[1])
+            print "perfstats written to %s" % args[1]
+        else:
+            print "usage: perfstats on|off|reset|show|dump <path>"
+
+    def _print_perfstats(self, title, timing_stats, limit=10):
+        print title
+        stats = timing_stats.to_dict().items()
+        stats.sort(key=lambda key_and_info: key_and_info[1]['total'],
+                   reverse=True)
+        for key, info in stats[:limit]:
+            print (" * %(total).3fs total, %(count)d calls, "
+                   "p50 %(p50).4fs, p99 %(p99).4fs" % info)
+            print "   %s" % key
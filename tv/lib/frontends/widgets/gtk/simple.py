@@ -45,6 +45,13 @@ class Image(object):
         self.width = self.pixbuf.get_width()
         self.height = self.pixbuf.get_height()
 
+    @classmethod
+    def from_pixels(cls, pixels):
+        """Create an Image from pixel data that load_scaled_pixels()
+        returned.
+        """
+        return TransformedImage(_pixbuf_from_pixels(pixels))
+
     def _set_pixbuf(self, pixbuf):
         self.pixbuf = pixbuf
         self.width = self.pixbuf.get_width()
@@ -57,6 +64,13 @@ class Image(object):
                 gtk.gdk.INTERP_BILINEAR)
         return TransformedImage(resized_pixbuf)
 
+    def save(self, path):
+        """Save the image to path in PNG format."""
+        try:
+            self.pixbuf.save(path, 'png')
+        except gobject.GError, ge:
+            raise IOError("%s" % ge)
+
     def resize_for_space(self, width, height):
         """Returns an image scaled to fit into the specified space at the
         correct height/width ratio.
@@ -90,6 +104,49 @@ class TransformedImage(Image):
         # this differently
         self._set_pixbuf(pixbuf)
 
+def _pixbuf_from_pixels(pixels):
+    width, height, has_alpha, rowstride, data = pixels
+    # gdk-pixbuf doesn't pad the last row, but pixbuf_new_from_data()
+    # wants a full rowstride for every row
+    if len(data) < rowstride * height:
+        data += '\0' * (rowstride * height - len(data))
+    return gtk.gdk.pixbuf_new_from_data(data, gtk.gdk.COLORSPACE_RGB,
+            has_alpha, 8, width, height, rowstride)
+
+def load_scaled_pixels(path, geometry=None):
+    """Load an image file and get its pixel data.
+
+    This only uses gdk-pixbuf, so it's safe to call outside of the UI
+    thread.
+
+    :param geometry: function that takes the image's width and height and
+        returns how to crop and scale it, like imagepool.scale_geometry()
+    :returns: (width, height, has_alpha, rowstride, pixels) tuple
+    """
+    image = Image(path)
+    if geometry is not None:
+        scaled = geometry(image.width, image.height)
+        if scaled is not None:
+            crop, width, height = scaled
+            if crop is None:
+                image = image.resize(width, height)
+            else:
+                image = image.crop_and_scale(*(crop + (width, height)))
+    pixbuf = image.pixbuf
+    return (pixbuf.get_width(), pixbuf.get_height(), pixbuf.get_has_alpha(),
+            pixbuf.get_rowstride(), pixbuf.get_pixels())
+
+def save_pixels(pixels, path):
+    """Save pixel data from load_scaled_pixels() to path in PNG format.
+
+    Like load_scaled_pixels(), this is safe to call outside of the UI
+    thread.
+    """
+    try:
+        _pixbuf_from_pixels(pixels).save(path, 'png')
+    except gobject.GError, ge:
+        raise IOError("%s" % ge)
+
 class ImageDisplay(Widget):
     def __init__(self, image=None):
         Widget.__init__(self)
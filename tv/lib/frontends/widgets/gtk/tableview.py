@@ -1750,6 +1750,16 @@ class ItemListModelHandler(ModelHandler):
     def __init__(self, model, gtk_treeview):
         ModelHandler.__init__(self, model, gtk_treeview)
         item_list = self.model.item_list
+        weak_connect(self.gtk_treeview, 'expose-event', self.on_expose_event)
+
+    def on_expose_event(self, gtk_treeview, event):
+        # Tell the ItemList which rows are on-screen, so that it loads rows
+        # around them first when it fetches data in the background.
+        visible_range = gtk_treeview.get_visible_range()
+        if visible_range is not None:
+            start_path, end_path = visible_range
+            self.model.item_list.set_visible_range(start_path[0],
+                                                   end_path[0])
 
     def model_changed(self):
         if self.model._model != self.gtk_treeview.get_model():
@@ -60,7 +60,7 @@ from miro.frontends.widgets.gtk.tableviewcells import (CellRenderer,
         ItemListRenderer, ItemListRendererText)
 from miro.frontends.widgets.gtk.simple import (Image, ImageDisplay,
         AnimatedImageDisplay, Label, Scroller, Expander, SolidBackground,
-        ProgressBar, HLine)
+        ProgressBar, HLine, load_scaled_pixels, save_pixels)
 from miro.frontends.widgets.gtk.audio import AudioPlayer
 from miro.frontends.widgets.gtk.video import VideoPlayer
 from miro.frontends.widgets.gtk.widgets import Rect
@@ -33,77 +33,386 @@ filenames.
 imagepool handles creating Image and ImageSurface objects for image
 filenames.  It caches Image/ImageSurface objecsts so to avoid re-creating
 them.
+
+get_surface_async() decodes and scales images in a separate thread, which
+is what thumbnail and cover art renderers should use.  The thread works
+with toolkit-neutral pixel data:
+
+    (width, height, has_alpha, rowstride, pixels)
+
+where pixels is a string of 8-bit RGB or RGBA rows.  Only the final Image
+gets created on the UI thread, using Image.from_pixels().  widgetset
+modules provide load_scaled_pixels() and save_pixels() to work with pixel
+data outside of the UI thread.  If they don't, PIL is used when it's
+installed.
+
+Scaled images loaded in the thread are also saved to a disk cache, keyed
+by the path, mtime and size, so that we don't need to decode the
+full-sized image again after a restart.
 """
 
+import hashlib
 import logging
+import os
 import traceback
 
+from miro import app
+from miro import eventloop
+from miro import prefs
+from miro import signals
 from miro import util
+from miro.clock import clock
 from miro.plat import resources
 from miro.plat.frontends.widgets import widgetset
+from miro.plat.frontends.widgets.threads import call_on_ui_thread
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
 
 broken_image = widgetset.Image(resources.path('images/broken-image.gif'))
 
 CACHE_SIZE = 2000 # number of objects to keep in memory
+CACHE_MAX_BYTES = 64 * 1024 * 1024 # memory to use for each pool
+DISK_CACHE_SIZE = 10000 # number of scaled images to keep on disk
 
-def resize_image(image, dest_width, dest_height, upsize_threshold=1.5):
-    # handle corner case of empty dest
-    if (dest_width * dest_height) == 0:
-        return broken_image
+def scale_geometry(width, height, dest_width, dest_height,
+                   upsize_threshold=1.5):
+    """Work out how resize_image() crops and scales an image.
+
+    :returns: None if the image should be left alone, otherwise a
+        (crop, new_width, new_height) tuple.  crop is the (src_x, src_y,
+        src_width, src_height) rectangle to scale to the new size, or None
+        to scale the entire image.
+    """
     # calculate how much we need to enlarge/shrink the image so that a
     # dimension lines up with the destination size
-    width_scale = float(dest_width) / image.width
-    height_scale = float(dest_height) / image.height
+    width_scale = float(dest_width) / width
+    height_scale = float(dest_height) / height
     # scale such that one dimension lines up and one is overlapping
     scale = max(width_scale, height_scale)
     # check that we don't upsize too much
     if scale > upsize_threshold:
-        return resize_one_dimension(image, width_scale, height_scale)
+        # try to resize only 1 dimension
+        lesser_scale = min(width_scale, height_scale)
+        if lesser_scale <= upsize_threshold:
+            # round() then int(), don't return floats here.
+            return (None, int(round(lesser_scale * width)),
+                    int(round(lesser_scale * height)))
+        # okay, give up on scaling and just return the image
+        return None
     if width_scale > height_scale:
         # crop top/bottom
         src_x = 0
-        src_width = image.width
+        src_width = width
         src_height = dest_height / scale
-        src_y = (image.height - src_height) / 2
+        src_y = (height - src_height) / 2
     else:
         # crop left/right
         src_y = 0
-        src_height = image.height
+        src_height = height
         src_width = dest_width / scale
-        src_x = (image.width - src_width) / 2
-    return image.crop_and_scale(src_x, src_y, src_width, src_height,
-            dest_width, dest_height)
-
-def resize_one_dimension(image, width_scale, height_scale,
-                         upsize_threshold=1.5):
-    """Try to resize only 1 dimension on an image."""
-    lesser_scale = min(width_scale, height_scale)
-    if lesser_scale <= upsize_threshold:
-        # round() then int(), don't return floats here.
-        return image.resize(int(round(lesser_scale * image.width)),
-                int(round(lesser_scale * image.height)))
-    # okay, give up on scaling and just return the image
-    return image
-
-class ImagePool(util.Cache):
+        src_x = (width - src_width) / 2
+    return (src_x, src_y, src_width, src_height), dest_width, dest_height
+
+def resize_image(image, dest_width, dest_height, upsize_threshold=1.5):
+    # handle corner case of empty dest
+    if (dest_width * dest_height) == 0:
+        return broken_image
+    geometry = scale_geometry(image.width, image.height, dest_width,
+                              dest_height, upsize_threshold)
+    if geometry is None:
+        return image
+    crop, width, height = geometry
+    if crop is None:
+        return image.resize(width, height)
+    return image.crop_and_scale(*(crop + (width, height)))
+
+def _pil_load_scaled_pixels(path, geometry=None):
+    """load_scaled_pixels() for platforms without one, using PIL."""
+    try:
+        image = PILImage.open(path)
+        if image.mode not in ('RGB', 'RGBA'):
+            if 'A' in image.mode or 'transparency' in image.info:
+                image = image.convert('RGBA')
+            else:
+                image = image.convert('RGB')
+    except IOError, e:
+        raise ValueError(str(e))
+    if geometry is not None:
+        scaled = geometry(*image.size)
+        if scaled is not None:
+            crop, width, height = scaled
+            if crop is not None:
+                x, y, crop_width, crop_height = crop
+                image = image.crop((int(x), int(y),
+                                    int(round(x + crop_width)),
+                                    int(round(y + crop_height))))
+            image = image.resize((width, height), PILImage.BILINEAR)
+    has_alpha = (image.mode == 'RGBA')
+    width, height = image.size
+    if hasattr(image, 'tobytes'):
+        pixels = image.tobytes()
+    else:
+        pixels = image.tostring()
+    return width, height, has_alpha, len(pixels) // height, pixels
+
+def _pil_save_pixels(pixels, path):
+    """save_pixels() for platforms without one, using PIL."""
+    width, height, has_alpha, rowstride, data = pixels
+    mode = has_alpha and 'RGBA' or 'RGB'
+    image = PILImage.frombuffer(mode, (width, height), data, 'raw', mode,
+                                rowstride, 1)
+    image.save(path, 'PNG')
+
+if hasattr(widgetset, 'load_scaled_pixels'):
+    _load_scaled_pixels = widgetset.load_scaled_pixels
+    _save_pixels = widgetset.save_pixels
+elif PILImage is not None:
+    _load_scaled_pixels = _pil_load_scaled_pixels
+    _save_pixels = _pil_save_pixels
+else:
+    # images can only be loaded on the UI thread
+    _load_scaled_pixels = _save_pixels = None
+
+class ImagePoolStats(object):
+    """Counters for how images get loaded.
+
+    Attributes:
+    - hits -- images that were already in memory
+    - disk_hits -- scaled images loaded from the disk cache
+    - misses -- images loaded and scaled from the original file
+    - load_time -- total time spent in disk_hits and misses
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = self.disk_hits = self.misses = 0
+        self.load_time = 0.0
+
+    def record_load(self, from_disk_cache, elapsed):
+        if from_disk_cache:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+        self.load_time += elapsed
+
+    def average_latency(self):
+        loads = self.disk_hits + self.misses
+        if loads == 0:
+            return 0.0
+        return self.load_time / loads
+
+    def __str__(self):
+        return ('%d hits, %d disk cache hits, %d misses, '
+                '%.1fms average load time' % (self.hits, self.disk_hits,
+                                              self.misses,
+                                              self.average_latency() * 1000))
+
+stats = ImagePoolStats()
+
+def _disk_cache_dir():
+    return os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+                        'image-cache')
+
+def _disk_cache_path(path, size):
+    """Get the path to the scaled version of an image in the disk cache."""
+    mtime = os.stat(path).st_mtime
+    key = repr((path, mtime, tuple(size)))
+    return os.path.join(_disk_cache_dir(),
+                        hashlib.sha1(key).hexdigest() + '.png')
+
+def _save_to_disk_cache(cache_path, pixels):
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        # directory already exists
+        pass
+    # write to a temporary file first so that we never leave a partially
+    # written image in the cache
+    temp_path = cache_path + '.tmp'
+    _save_pixels(pixels, temp_path)
+    os.rename(temp_path, cache_path)
+
+def load_image(path, size):
+    """Load an image on the UI thread, scaling it if size is given.
+
+    Scaled images come from the disk cache if possible.  Encoding images
+    for the disk cache is left to load_pixels().
+
+    :returns: (image, from_disk_cache, elapsed_time) tuple
+    """
+    start = clock()
+    if size is None:
+        return widgetset.Image(path), False, clock() - start
+    cache_path = _disk_cache_path(path, size)
+    if os.path.exists(cache_path):
+        try:
+            image = widgetset.Image(cache_path)
+        except ValueError:
+            logging.warn("error loading cached image %s", cache_path)
+        else:
+            return image, True, clock() - start
+    image = resize_image(widgetset.Image(path), *size)
+    return image, False, clock() - start
+
+def load_pixels(path, size):
+    """Load the pixel data for an image, scaling it if size is given.
+
+    Scaled images come from the disk cache if possible and are added to it
+    otherwise.  This doesn't use the UI toolkit, so it can be called
+    outside of the UI thread.  Pass the pixel data to Image.from_pixels()
+    to get the Image.
+
+    :returns: (pixels, from_disk_cache, elapsed_time) tuple.  pixels is
+        None if size is empty.
+    """
+    start = clock()
+    if size is None:
+        return _load_scaled_pixels(path), False, clock() - start
+    if (size[0] * size[1]) == 0:
+        return None, False, clock() - start
+    cache_path = _disk_cache_path(path, size)
+    if os.path.exists(cache_path):
+        try:
+            pixels = _load_scaled_pixels(cache_path)
+        except ValueError:
+            logging.warn("error loading cached image %s", cache_path)
+        else:
+            return pixels, True, clock() - start
+    def geometry(width, height):
+        return scale_geometry(width, height, *size)
+    pixels = _load_scaled_pixels(path, geometry)
+    try:
+        _save_to_disk_cache(cache_path, pixels)
+    except EnvironmentError:
+        logging.warn("error saving image to the disk cache:\n%s",
+                     traceback.format_exc())
+    return pixels, False, clock() - start
+
+def prune_disk_cache(max_size=DISK_CACHE_SIZE):
+    """Remove the least recently created images from the disk cache until
+    there are at most max_size of them.
+    """
+    cache_dir = _disk_cache_dir()
+    try:
+        names = os.listdir(cache_dir)
+    except EnvironmentError:
+        return
+    if len(names) <= max_size:
+        return
+    paths = [os.path.join(cache_dir, name) for name in names]
+    paths.sort(key=lambda p: os.stat(p).st_mtime)
+    for path in paths[:len(paths) - max_size]:
+        try:
+            os.remove(path)
+        except EnvironmentError:
+            logging.warn("error removing %s from image cache", path)
+
+class _StatsCache(util.Cache):
+    """Cache that counts hits in stats and is bounded by the memory that
+    the decoded images use.
+    """
+    def value_size(self, image):
+        # assume 4 bytes per pixel
+        return int(image.width * image.height * 4)
+
+    def get(self, key, invalidator=None):
+        hits = self.hits
+        value = util.Cache.get(self, key, invalidator=invalidator)
+        if self.hits > hits:
+            stats.hits += 1
+        return value
+
+class ImagePool(_StatsCache):
     def create_new_value(self, (path, size), invalidator=None):
         try:
-            image = widgetset.Image(path)
+            image, from_disk_cache, elapsed = load_image(path, size)
         except StandardError:
             logging.warn("error loading image %s:\n%s", path,
                     traceback.format_exc())
             image = broken_image
-        if size is not None:
-            image = resize_image(image, *size)
+        else:
+            stats.record_load(from_disk_cache, elapsed)
         return image
 
-class ImageSurfacePool(util.Cache):
+class ImageSurfacePool(_StatsCache):
     def create_new_value(self, (path, size), invalidator=None):
         image = _imagepool.get((path, size), invalidator=invalidator)
         return widgetset.ImageSurface(image)
 
-_imagepool = ImagePool(CACHE_SIZE)
-_image_surface_pool = ImageSurfacePool(CACHE_SIZE)
+class BackgroundLoader(signals.SignalEmitter):
+    """Loads images for get_surface_async().
+
+    Images are decoded and scaled using the event loop's thread pool.  The
+    Image objects get created on the UI thread once the pixel data is ready.
+    Platforms that can't do that load images on the UI thread, the same way
+    get() does.
+
+    Signals:
+    - image-loaded (loader, path, size) -- an image finished loading.  This
+      is emitted on the UI thread.
+    """
+    def __init__(self):
+        signals.SignalEmitter.__init__(self, 'image-loaded')
+        self.pending = set()
+        self.pruned_disk_cache = False
+
+    def request(self, path, size, invalidator=None):
+        key = (path, size)
+        if key in self.pending:
+            return
+        self.pending.add(key)
+        if _load_scaled_pixels is None:
+            call_on_ui_thread(self._load_on_ui_thread, key, invalidator)
+            return
+        def callback(result):
+            call_on_ui_thread(self._on_loaded, key, result, invalidator)
+        def errback(error):
+            call_on_ui_thread(self._on_error, key, error, invalidator)
+        eventloop.call_in_thread(callback, errback, self._load,
+                                 'imagepool: load %s' % path, path, size)
+
+    def _load(self, path, size):
+        if not self.pruned_disk_cache:
+            self.pruned_disk_cache = True
+            prune_disk_cache()
+        return load_pixels(path, size)
+
+    def _on_loaded(self, key, (pixels, from_disk_cache, elapsed),
+                   invalidator):
+        self.pending.discard(key)
+        start = clock()
+        try:
+            if pixels is None:
+                image = broken_image
+            else:
+                image = widgetset.Image.from_pixels(pixels)
+        except StandardError:
+            logging.warn("error loading image %s:\n%s", key[0],
+                    traceback.format_exc())
+            image = broken_image
+        else:
+            stats.record_load(from_disk_cache, elapsed + clock() - start)
+        _imagepool.set(key, image, invalidator=invalidator)
+        self.emit('image-loaded', *key)
+
+    def _load_on_ui_thread(self, key, invalidator):
+        self.pending.discard(key)
+        _imagepool.get(key, invalidator=invalidator)
+        self.emit('image-loaded', *key)
+
+    def _on_error(self, key, error, invalidator):
+        self.pending.discard(key)
+        logging.warn("error loading image %s: %s", key[0], error)
+        _imagepool.set(key, broken_image, invalidator=invalidator)
+        self.emit('image-loaded', *key)
+
+_imagepool = ImagePool(CACHE_SIZE, CACHE_MAX_BYTES)
+_image_surface_pool = ImageSurfacePool(CACHE_SIZE, CACHE_MAX_BYTES)
+background_loader = BackgroundLoader()
 
 def get(path, size=None, invalidator=None):
     """Returns an Image for path.
@@ -131,6 +440,34 @@ def get_surface(path, size=None, invalidator=None):
     """
     return _image_surface_pool.get((path, size), invalidator=invalidator)
 
+def get_surface_async(path, size=None, invalidator=None, placeholder=None):
+    """Returns an ImageSurface for path without blocking to load it.
+
+    If the image isn't loaded yet, we start loading it in a separate thread
+    and return placeholder.  background_loader emits the image-loaded signal
+    once it's ready, listen to that to redraw things.
+
+    :param path: the filename for the image
+    :param size: if the image needs to fit into a specified sized
+                 space, then specify this and get will return a
+                 scaled image; if size is not specified, then this
+                 returns the default sized image
+    :param invalidator: an optional functions which returns True if
+                        the cache value is no longer valid
+    :param placeholder: value to return while the image is loading
+    """
+    key = (path, size)
+    surface = _image_surface_pool.get_cached(key)
+    if surface is None:
+        image = _imagepool.get_cached(key)
+        if image is None:
+            background_loader.request(path, size, invalidator)
+            return placeholder
+        surface = widgetset.ImageSurface(image)
+        _image_surface_pool.set(key, surface, invalidator=invalidator)
+    stats.hits += 1
+    return surface
+
 def get_image_display(path, size=None, invalidator=None):
     """Returns an ImageDisplay for path.
 
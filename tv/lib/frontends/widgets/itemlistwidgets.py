@@ -875,6 +875,13 @@ class ItemView(widgetset.TableView):
         self.allow_multiple_select = True
 
         self.create_signal('scroll-position-changed')
+        # thumbnails and album art get loaded in the background, redraw when
+        # they're ready.
+        imagepool.background_loader.connect_weak('image-loaded',
+                                                 self.on_image_loaded)
+
+    def on_image_loaded(self, loader, path, size):
+        self.queue_redraw()
 
 class SorterOwner(object):
     """Mixin for objects that need to handle a set of sort indicators."""
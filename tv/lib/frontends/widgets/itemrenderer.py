@@ -1078,9 +1078,12 @@ class ItemRendererCanvas(object):
         context.fill()
 
     def draw_thumbnail(self, context, x, y, width, height):
-        icon = imagepool.get_surface(self.thumbnail, (width, height),
-                                     invalidator=util.mtime_invalidator(
+        icon = imagepool.get_surface_async(self.thumbnail, (width, height),
+                                           invalidator=util.mtime_invalidator(
                 self.thumbnail))
+        if icon is None:
+            # thumbnail is still loading, we'll get redrawn when it's ready
+            return
         icon_x = x + (width - icon.width) // 2
         icon_y = y + (height - icon.height) // 2
         # if our thumbnail is far enough to the left, we need to set a clip
@@ -997,7 +997,8 @@ class MultiRowAlbumRenderer(widgetset.ItemListRenderer):
     def make_album_art(self, context):
         """Make an image to draw as album art.
 
-        Returns ImageSurface to draw or None if we don't have anything
+        Returns ImageSurface to draw or None if we don't have anything, or
+        the album art is still loading.
         """
         if self.get_total_rows() < 6:
             # don't draw album art if we have less than 6 items in the group
@@ -1006,9 +1007,9 @@ class MultiRowAlbumRenderer(widgetset.ItemListRenderer):
         album_art_path = self.get_image_path()
         if album_art_path is None:
             return None
-        return imagepool.get_surface(album_art_path,
+        return imagepool.get_surface_async(album_art_path,
                 size=(self.album_art_size, self.album_art_size),
-                                     invalidator=util.mtime_invalidator(
+                                           invalidator=util.mtime_invalidator(
                 album_art_path))
 
     def render_album_art(self, context):
@@ -35,13 +35,22 @@ The main ways this module used is grab_url() and grab_headers().  grab_url
 fetches a HTTP or HTTPS url, while grab_headers only fetches the headers.
 """
 
+import hashlib
 import logging
 import os
 import stat
+import tempfile
 import threading
+import time
 import urllib
 import Queue
 from cStringIO import StringIO
+from email.utils import parsedate_tz, mktime_tz
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 import pycurl
 
@@ -67,8 +76,37 @@ except:
 
 REDIRECTION_LIMIT = 10
 MAX_AUTH_ATTEMPTS = 5
+# max number of idle curl handles that LibCURLManager keeps around for reuse
+MAX_POOLED_HANDLES = 16
+# max number of connections that libcurl opens to a single host
+MAX_HOST_CONNECTIONS = 6
+# max number of idle connections that libcurl keeps open for reuse
+MAX_CACHED_CONNECTIONS = 32
+# max number of bytes that HTTPCache stores on disk
+HTTP_CACHE_SIZE = 50 * 1024 * 1024
+# how long to wait before writing out HTTPCache's index after a change
+HTTP_CACHE_SAVE_DELAY = 10
 
 _logged_noproxy_error = False
+_http2_support = None
+
+def _setopt_if_supported(curl_object, option_name, value):
+    """Set a libcurl option that our pycurl/libcurl may not support.
+
+    :returns: True if the option was set
+    """
+    try:
+        curl_object.setopt(getattr(pycurl, option_name), value)
+    except (AttributeError, pycurl.error):
+        return False
+    return True
+
+def _http2_supported():
+    global _http2_support
+    if _http2_support is None:
+        features = pycurl.version_info()[4]
+        _http2_support = bool(features & getattr(pycurl, 'VERSION_HTTP2', 0))
+    return _http2_support
 
 def user_agent():
     return "%s/%s (%s; %s)" % (app.config.get(prefs.SHORT_APP_NAME),
@@ -204,7 +242,7 @@ class TransferOptions(object):
 
     def __init__(self, url, etag=None, modified=None, resume=False,
             post_vars=None, post_files=None, write_file=None,
-                 extra_headers=None):
+                 extra_headers=None, spool_threshold=None):
         self.url = url
         self.etag = etag
         self.modified = modified
@@ -213,9 +251,12 @@ class TransferOptions(object):
         self.post_vars = post_vars
         self.post_files = post_files
         self.write_file = write_file
+        self.spool_threshold = spool_threshold
         self.requires_cookies = False
         self.head_request = False
         self.invalid_url = False
+        # set by HTTPCache when it sends validators in extra_headers
+        self.revalidating = False
         # _cancel_on_body_data is an internal attribute used for grab_headers.
         self._cancel_on_body_data = False
         self.parse_url()
@@ -239,24 +280,24 @@ class TransferOptions(object):
             self.invalid_url = True
             return
 
-    def build_handle(self, out_headers):
-        """Build a libCURL handle.  This should only be called inside the
+    def build_handle(self, handle, out_headers):
+        """Setup a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
+
+        :param handle: a new or reset pycurl.Curl handle
         """
         if self.etag is not None:
-            out_headers['etag'] = self.etag
+            out_headers['If-None-Match'] = self.etag
         if self.modified is not None:
             out_headers['If-Modified-Since'] = self.modified
         if self.extra_headers is not None:
             out_headers.update(self.extra_headers)
 
-        handle = self._init_handle()
+        self._init_handle(handle)
         self._setup_post(handle, out_headers)
         self._setup_headers(handle, out_headers)
-        return handle
 
-    def _init_handle(self):
-        handle = pycurl.Curl()
+    def _init_handle(self, handle):
         handle.setopt(pycurl.USERAGENT, user_agent())
         handle.setopt(pycurl.FOLLOWLOCATION, 1)
         handle.setopt(pycurl.MAXREDIRS, REDIRECTION_LIMIT)
@@ -275,8 +316,13 @@ class TransferOptions(object):
         handle.setopt(pycurl.URL, self.url)
         if self.head_request:
             handle.setopt(pycurl.NOBODY, 1)
+        if self.scheme == 'https' and _http2_supported():
+            # Use HTTP/2 if the server supports it.  LibCURLManager turns on
+            # multiplexing, so transfers to the same host can share a
+            # connection.
+            _setopt_if_supported(handle, 'HTTP_VERSION',
+                                 getattr(pycurl, 'CURL_HTTP_VERSION_2TLS', 4))
         self._setup_proxy(handle)
-        return handle
 
     def _setup_proxy(self, handle):
         if not app.config.get(prefs.HTTP_PROXY_ACTIVE):
@@ -348,6 +394,8 @@ class CurlTransfer(object):
         self.auth_attempts = {'http': 0, 'proxy': 0}
         self.canceled = False
         self.last_url = None
+        # temp file that we're writing the body to, see _write_spooled()
+        self._spool_file = self.spool_path = None
 
         self.stats = TransferStats()
         self._lookup_auth()
@@ -364,10 +412,12 @@ class CurlTransfer(object):
         self.resume_from = 0
         self.out_headers = {}
         self.status_code = None
+        self.reused_handle = False
         self.trying_head_request = False
         self.saw_head_success = False
 
     def _send_new_request(self):
+        self._discard_spool()
         self._reset_transfer_data()
         curl_manager.add_transfer(self)
 
@@ -455,11 +505,14 @@ class CurlTransfer(object):
                 self.proxy_auth = auth
             self._send_new_request()
 
-    def build_handle(self):
-        """Build a libCURL handle.  This should only be called inside the
+    def build_handle(self, handle):
+        """Setup a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
+
+        :param handle: pycurl.Curl handle from LibCURLManager.get_handle()
         """
-        self.handle = self.options.build_handle(self.out_headers)
+        self.handle = handle
+        self.options.build_handle(handle, self.out_headers)
         # don't authenticate SSL certificates see #15180
         self.handle.setopt(pycurl.SSL_VERIFYPEER, 0)
 
@@ -480,6 +533,8 @@ class CurlTransfer(object):
                 self.handle.setopt(pycurl.WRITEFUNCTION, self._write_file)
         elif self.content_check_callback is not None:
             self.handle.setopt(pycurl.WRITEFUNCTION, self._call_content_check)
+        elif self.options.spool_threshold is not None:
+            self.handle.setopt(pycurl.WRITEFUNCTION, self._write_spooled)
         else:
             self.handle.setopt(pycurl.WRITEFUNCTION, self.buffer.write)
         self.handle.setopt(pycurl.HEADERFUNCTION, self.header_func)
@@ -492,6 +547,59 @@ class CurlTransfer(object):
         if self.check_response_code(self.status_code):
             self._filehandle.write(buf)
 
+    def _write_spooled(self, buf):
+        """Buffer the body in memory until it grows past spool_threshold,
+        then move it to a temp file.
+        """
+        if self._spool_file is not None:
+            self._spool_file.write(buf)
+            return
+        self.buffer.write(buf)
+        if self.buffer.tell() > self.options.spool_threshold:
+            fd, self.spool_path = tempfile.mkstemp(prefix='miro-body-')
+            self._spool_file = os.fdopen(fd, 'wb')
+            self._spool_file.write(self.buffer.getvalue())
+            self.buffer = StringIO()
+
+    def _finish_spool(self, info):
+        """Close our spool file and put its path into info."""
+        self._spool_file.close()
+        self._spool_file = None
+        if gzip and info.get('content-encoding', '') == 'gzip':
+            fd, path = tempfile.mkstemp(prefix='miro-body-')
+            output = os.fdopen(fd, 'wb')
+            try:
+                input_ = gzip.GzipFile(self.spool_path, 'rb')
+                try:
+                    while True:
+                        data = input_.read(65536)
+                        if not data:
+                            break
+                        output.write(data)
+                finally:
+                    input_.close()
+            except IOError:
+                logging.warning("Received header with content-encoding "
+                                "gzip, but content is not gzip encoded")
+                output.close()
+                os.remove(path)
+            else:
+                output.close()
+                os.remove(self.spool_path)
+                self.spool_path = path
+        info['body-path'] = self.spool_path
+
+    def _discard_spool(self):
+        if self._spool_file is not None:
+            self._spool_file.close()
+            self._spool_file = None
+        if self.spool_path is not None:
+            try:
+                os.remove(self.spool_path)
+            except OSError:
+                pass
+            self.spool_path = None
+
     def _lookup_auth(self):
         """Lookup existing HTTP passwords to use.
 
@@ -633,7 +741,8 @@ class CurlTransfer(object):
         expected_codes = set([200])
         if self.options.resume:
             expected_codes.add(206)
-        if self.options.etag or self.options.modified:
+        if (self.options.etag or self.options.modified or
+                self.options.revalidating):
             expected_codes.add(304)
         return code in expected_codes
 
@@ -661,7 +770,9 @@ class CurlTransfer(object):
     def on_finished(self):
         info = self._make_callback_info()
         self.last_url = self.handle.getinfo(pycurl.EFFECTIVE_URL)
-        if self.options.write_file is None:
+        if self._spool_file is not None:
+            self._finish_spool(info)
+        elif self.options.write_file is None:
             if gzip and info.get('content-encoding', '') == 'gzip':
                 try:
                     self.buffer.seek(0)
@@ -714,6 +825,7 @@ class CurlTransfer(object):
 
     def on_cancel(self, remove_file):
         self._cleanup_filehandle()
+        self._discard_spool()
         if remove_file and self.options.write_file:
             try:
                 fileutil.remove(self.options.write_file)
@@ -793,11 +905,14 @@ class CurlTransfer(object):
 
     def call_callback(self, info):
         self._cleanup_filehandle()
+        # the callback owns the spool file now
+        self.spool_path = None
         eventloop.add_idle(self.callback, 'curl transfer callback',
                 args=(info,))
 
     def call_errback(self, error):
         self._cleanup_filehandle()
+        self._discard_spool()
         eventloop.add_idle(self.errback, 'curl transfer errback',
                            args=(error,))
 
@@ -820,6 +935,11 @@ class CurlTransfer(object):
         stats.upload_rate = int(getinfo(pycurl.SPEED_UPLOAD))
         stats.status_code = self.status_code
         stats.initial_size = self.resume_from
+        stats.new_connections = int(getinfo(pycurl.NUM_CONNECTS))
+        stats.reused_handle = self.reused_handle
+        stats.namelookup_time = getinfo(pycurl.NAMELOOKUP_TIME)
+        stats.connect_time = getinfo(pycurl.CONNECT_TIME)
+        stats.appconnect_time = getinfo(pycurl.APPCONNECT_TIME)
 
         return stats
 
@@ -850,6 +970,13 @@ class TransferStats(object):
         download_rate -- download rate in bytes/second
         upload_rate -- upload rate in bytes/second
         initial_size -- bytes that we starting downloading from
+        new_connections -- connections opened for the transfer (0 means we
+            reused a connection from an earlier transfer)
+        reused_handle -- did the transfer use a pooled libcurl handle?
+        namelookup_time -- seconds spent on the DNS lookup
+        connect_time -- seconds until the TCP connection was made
+        appconnect_time -- seconds until the SSL handshake was done (0 for
+            plain HTTP and reused connections)
     """
     def __init__(self):
         self.downloaded = self.download_total = 0
@@ -857,6 +984,10 @@ class TransferStats(object):
         self.download_rate = self.upload_rate = 0
         self.initial_size = 0
         self.status_code = None
+        self.new_connections = 0
+        self.reused_handle = False
+        self.namelookup_time = self.connect_time = 0.0
+        self.appconnect_time = 0.0
 
 class LibCURLManager(eventloop.SimpleEventLoop):
     """Manage a set of CurlTransfers.
@@ -866,15 +997,38 @@ class LibCURLManager(eventloop.SimpleEventLoop):
       - Runs a thread for pycurl to use
       - Manages the libcurl multi object
       - Handles adding/removing CurlTransfers objects
+      - Keeps a pool of libcurl handles, so that connections stay open
+        between transfers
+      - Shares the DNS and SSL session caches between handles
     """
 
     def __init__(self):
         eventloop.SimpleEventLoop.__init__(self)
         self.multi = pycurl.CurlMulti()
+        _setopt_if_supported(self.multi, 'M_MAXCONNECTS',
+                             MAX_CACHED_CONNECTIONS)
+        _setopt_if_supported(self.multi, 'M_MAX_HOST_CONNECTIONS',
+                             MAX_HOST_CONNECTIONS)
+        if _http2_supported():
+            _setopt_if_supported(self.multi, 'M_PIPELINING',
+                                 getattr(pycurl, 'PIPE_MULTIPLEX', 2))
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        if hasattr(pycurl, 'LOCK_DATA_SSL_SESSION'):
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        self.free_handles = []
         self.transfer_map = {}
         self.transfers_to_add = Queue.Queue()
         self.transfers_to_remove = Queue.Queue()
         self.after_perform_callbacks = []
+        self.connection_counts = {
+            'transfers': 0,
+            'handles_created': 0,
+            'handles_reused': 0,
+            'new_connections': 0,
+            'connections_reused': 0,
+            'ssl_handshakes_saved': 0,
+        }
 
     def start(self):
         self.thread = threading.Thread(target=utils.thread_body,
@@ -892,7 +1046,43 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         for transfer in self.transfer_map.values():
             self.multi.remove_handle(transfer.handle)
             transfer.handle.close()
+        for handle in self.free_handles:
+            handle.close()
+        self.free_handles = []
         self.multi.close()
+        self.share.close()
+
+    def get_handle(self):
+        """Get a libcurl handle for a new transfer.
+
+        :returns: (handle, reused) tuple
+        """
+        if self.free_handles:
+            self.connection_counts['handles_reused'] += 1
+            return self.free_handles.pop(), True
+        self.connection_counts['handles_created'] += 1
+        handle = pycurl.Curl()
+        handle.setopt(pycurl.SHARE, self.share)
+        return handle, False
+
+    def release_handle(self, handle, reusable=True):
+        """Return a handle that we're done with to the pool.
+
+        Pooled handles keep their connections open, so the next transfer
+        to the same host can skip the TCP and SSL handshakes.
+        """
+        if (not reusable or len(self.free_handles) >= MAX_POOLED_HANDLES or
+                not hasattr(handle, 'reset')):
+            handle.close()
+            return
+        # reset() clears our options, but keeps the connection cache
+        handle.reset()
+        try:
+            handle.setopt(pycurl.SHARE, self.share)
+        except pycurl.error:
+            # newer pycurl versions keep the share object across reset()
+            pass
+        self.free_handles.append(handle)
 
     def add_transfer(self, transfer):
         self.transfers_to_add.put(transfer)
@@ -940,11 +1130,15 @@ class LibCURLManager(eventloop.SimpleEventLoop):
                 transfer = self.transfers_to_add.get_nowait()
             except Queue.Empty:
                 break
+            handle, reused = self.get_handle()
             try:
-                transfer.build_handle()
+                transfer.build_handle(handle)
             except NetworkError, e:
+                transfer.handle = None
+                self.release_handle(handle)
                 transfer.call_errback(e)
                 continue
+            transfer.reused_handle = reused
             self.transfer_map[transfer.handle] = transfer
             self.multi.add_handle(transfer.handle)
 
@@ -964,20 +1158,55 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         queued, finished, errors = self.multi.info_read()
         for handle in finished:
             try:
-                self.pop_transfer(handle).on_finished()
+                transfer = self.pop_transfer(handle)
+                try:
+                    transfer.on_finished()
+                finally:
+                    self.finish_transfer(transfer, handle)
             except StandardError:
                 logging.stacktrace("Error calling on_finished()")
         for handle, code, message in errors:
             try:
-                self.pop_transfer(handle).on_error(code, handle)
+                transfer = self.pop_transfer(handle)
+                try:
+                    transfer.on_error(code, handle)
+                finally:
+                    self.finish_transfer(transfer, handle)
             except StandardError:
                 logging.stacktrace("Error calling on_error()")
 
     def pop_transfer(self, handle):
         transfer = self.transfer_map.pop(handle)
         self.multi.remove_handle(handle)
+        transfer.update_stats()
+        self.count_connections(transfer)
         return transfer
 
+    def finish_transfer(self, transfer, handle):
+        """Release a handle after its transfer's callbacks have run."""
+        if transfer.handle is handle:
+            # Don't let the transfer keep using the handle.  It may get
+            # reused for another transfer.
+            transfer.handle = None
+        # Cookies stick to the handle, even after a reset, so don't reuse
+        # handles for transfers that loaded them.
+        self.release_handle(handle,
+                            reusable=not transfer.options.requires_cookies)
+
+    def count_connections(self, transfer):
+        stats = transfer.get_stats()
+        counts = self.connection_counts
+        counts['transfers'] += 1
+        if stats.new_connections > 0:
+            counts['new_connections'] += stats.new_connections
+        else:
+            counts['connections_reused'] += 1
+            if transfer.options.scheme == 'https':
+                counts['ssl_handshakes_saved'] += 1
+
+    def get_connection_counts(self):
+        return self.connection_counts.copy()
+
 class HTTPClient(object):
     """HTTP client for a grab_url call.
 
@@ -999,6 +1228,291 @@ class HTTPClient(object):
 
         return self.transfer.get_stats()
 
+class CachedResponse(object):
+    """Stands in for HTTPClient when HTTPCache can answer a grab_url() call
+    without going to the network.
+    """
+    def __init__(self, info, callback):
+        self.stats = TransferStats()
+        self.stats.status_code = info['status']
+        self.dc = eventloop.add_idle(callback, 'http cache callback',
+                                     args=(info,))
+
+    def cancel(self, remove_file=False):
+        self.dc.cancel()
+
+    def get_stats(self):
+        return self.stats
+
+class HTTPCache(object):
+    """On-disk cache for grab_url() responses.
+
+    Response bodies are stored in directory, named by the SHA1 of their URL.
+    index.json maps each URL to its validators (ETag/Last-Modified), the
+    time it stays fresh for and the info dict that we passed to the
+    callback.
+
+    Fresh responses are returned without touching the network.  Stale
+    responses are revalidated with a conditional GET, and if the server
+    answers 304 we return the body that we have on disk.  Once the cache
+    grows past max_size bytes, the least recently used responses are thrown
+    out.
+    """
+
+    INDEX_NAME = 'index.json'
+
+    def __init__(self, directory, max_size=HTTP_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.entries = {}
+        self.total_size = 0
+        self.save_dc = None
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.stores = 0
+        self.evictions = 0
+        if not fileutil.exists(directory):
+            fileutil.makedirs(directory)
+        self._load_index()
+
+    def _index_path(self):
+        return os.path.join(self.directory, self.INDEX_NAME)
+
+    def _body_path(self, entry):
+        return os.path.join(self.directory, entry['filename'])
+
+    def _load_index(self):
+        try:
+            f = fileutil.open_file(self._index_path(), 'rb')
+            try:
+                entries = json.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError), e:
+            if fileutil.exists(self._index_path()):
+                logging.warn("Error reading HTTP cache index: %s", e)
+            entries = {}
+        if not isinstance(entries, dict):
+            entries = {}
+        for url, entry in entries.items():
+            try:
+                size = os.path.getsize(self._body_path(entry))
+            except (OSError, KeyError, TypeError):
+                continue
+            if size != entry.get('size'):
+                continue
+            self.entries[url] = entry
+            self.total_size += size
+
+    def save(self):
+        """Write out our index file."""
+        if self.save_dc is not None:
+            self.save_dc.cancel()
+            self.save_dc = None
+        path = self._index_path()
+        temp_path = path + '.tmp'
+        try:
+            f = fileutil.open_file(temp_path, 'wb')
+            try:
+                json.dump(self.entries, f)
+            finally:
+                f.close()
+            if fileutil.exists(path):
+                fileutil.remove(path)
+            fileutil.rename(temp_path, path)
+        except (IOError, OSError), e:
+            logging.warn("Error writing HTTP cache index: %s", e)
+
+    def _schedule_save(self):
+        if self.save_dc is None:
+            self.save_dc = eventloop.add_timeout(HTTP_CACHE_SAVE_DELAY,
+                                                 self.save,
+                                                 'save http cache index')
+
+    def _read_body(self, entry):
+        try:
+            f = fileutil.open_file(self._body_path(entry), 'rb')
+            try:
+                return f.read()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return None
+
+    def _remove_entry(self, url):
+        entry = self.entries.pop(url)
+        self.total_size -= entry['size']
+        try:
+            fileutil.remove(self._body_path(entry))
+        except OSError:
+            pass
+        self._schedule_save()
+
+    def _parse_freshness(self, info, now):
+        """Figure out how long a response stays fresh for.
+
+        :returns: (cacheable, expires) tuple
+        """
+        directives = {}
+        for part in info.get('cache-control', '').split(','):
+            name, sep, value = part.strip().partition('=')
+            directives[name.lower()] = value.strip('"')
+        if 'no-store' in directives:
+            return False, 0
+        expires = 0
+        if 'no-cache' in directives:
+            pass
+        elif 'max-age' in directives:
+            try:
+                expires = now + int(directives['max-age'])
+            except ValueError:
+                pass
+        elif 'expires' in info:
+            parsed = parsedate_tz(info['expires'])
+            if parsed is not None:
+                try:
+                    expires = mktime_tz(parsed)
+                except (OverflowError, ValueError):
+                    pass
+        cacheable = (expires > now or 'etag' in info or
+                     'last-modified' in info)
+        return cacheable, expires
+
+    def _make_info(self, entry, body):
+        info = entry['info'].copy()
+        info['status'] = 200
+        info['body'] = body
+        info['from-cache'] = True
+        return info
+
+    def _evict(self):
+        if self.total_size <= self.max_size:
+            return
+        by_last_used = sorted(self.entries.items(),
+                              key=lambda item: item[1]['last_used'])
+        for url, entry in by_last_used:
+            if self.total_size <= self.max_size:
+                break
+            self._remove_entry(url)
+            self.evictions += 1
+
+    def store(self, url, info):
+        """Store a 200 response for url."""
+        now = time.time()
+        cacheable, expires = self._parse_freshness(info, now)
+        if url in self.entries:
+            self._remove_entry(url)
+        body = info.get('body')
+        if not cacheable or body is None or len(body) > self.max_size:
+            return
+        entry = {
+            'filename': hashlib.sha1(url).hexdigest(),
+            'size': len(body),
+            'etag': info.get('etag'),
+            'last-modified': info.get('last-modified'),
+            'expires': expires,
+            'last_used': now,
+            'info': dict((k, v) for k, v in info.items() if k != 'body'),
+        }
+        try:
+            f = fileutil.open_file(self._body_path(entry), 'wb')
+            try:
+                f.write(body)
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            logging.warn("Error writing to HTTP cache: %s", e)
+            return
+        self.entries[url] = entry
+        self.total_size += entry['size']
+        self.stores += 1
+        self._evict()
+        self._schedule_save()
+
+    def _revalidated(self, entry, info):
+        """Handle a 304 response for an entry."""
+        now = time.time()
+        cacheable, expires = self._parse_freshness(info, now)
+        entry['expires'] = expires
+        entry['last_used'] = now
+        for key in ('etag', 'last-modified'):
+            if key in info:
+                entry[key] = info[key]
+        self.revalidated += 1
+        self.bytes_saved += entry['size']
+        self._schedule_save()
+
+    def grab_url(self, url, callback, errback, extra_headers=None):
+        """Fetch url, using the cache if we can.
+
+        This takes the same arguments as the module-level grab_url(), but
+        only supports simple GET requests.
+        """
+        now = time.time()
+        entry = self.entries.get(url)
+        body = None
+        if entry is not None:
+            body = self._read_body(entry)
+            if body is None:
+                self._remove_entry(url)
+                entry = None
+        if entry is not None and entry['expires'] > now:
+            self.hits += 1
+            self.bytes_saved += entry['size']
+            entry['last_used'] = now
+            self._schedule_save()
+            return CachedResponse(self._make_info(entry, body), callback)
+
+        headers = {}
+        if extra_headers is not None:
+            headers.update(extra_headers)
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last-modified']:
+                headers['If-Modified-Since'] = entry['last-modified']
+
+        def on_success(info):
+            if info['status'] == 304:
+                self._revalidated(entry, info)
+                callback(self._make_info(entry, body))
+            else:
+                self.misses += 1
+                self.store(url, info)
+                callback(info)
+
+        options = TransferOptions(url, extra_headers=headers)
+        options.revalidating = entry is not None
+        transfer = CurlTransfer(options, on_success, errback)
+        transfer.start()
+        return HTTPClient(transfer)
+
+    def get_stats(self):
+        return {
+            'entries': len(self.entries),
+            'size': self.total_size,
+            'hits': self.hits,
+            'revalidated': self.revalidated,
+            'misses': self.misses,
+            'bytes_saved': self.bytes_saved,
+            'stores': self.stores,
+            'evictions': self.evictions,
+        }
+
+# HTTPCache used by grab_url(use_cache=True).  None until
+# setup_http_cache() is called.
+http_cache = None
+
+def setup_http_cache(directory, max_size=HTTP_CACHE_SIZE):
+    global http_cache
+    http_cache = HTTPCache(directory, max_size)
+
+def get_http_cache_stats():
+    if http_cache is None:
+        return {}
+    return http_cache.get_stats()
 
 def sanitize_url(url):
     """Fix poorly constructed URLs.
@@ -1010,7 +1524,8 @@ def sanitize_url(url):
 def grab_url(url, callback, errback, header_callback=None,
         content_check_callback=None, write_file=None, etag=None, modified=None,
         default_mime_type=None, resume=False, post_vars=None,
-        post_files=None, extra_headers=None):
+        post_files=None, extra_headers=None, use_cache=False,
+        spool_threshold=None):
     """Quick way to download a network resource
 
     grab_url is a simple interface to the HTTPClient class.
@@ -1032,11 +1547,22 @@ def grab_url(url, callback, errback, header_callback=None,
     :param post_files: files to send as POST data (see
         xhtmltools.multipart_encode for the format)
     :param extra_headers: an option dictionary of extra headers to send
+    :param use_cache: if True, use the HTTP cache for this request.  This is
+        ignored unless setup_http_cache() was called and the request is a
+        plain GET that doesn't use any of the header_callback,
+        content_check_callback, write_file, etag, modified, resume,
+        post_vars or post_files arguments.
+    :param spool_threshold: if given, bodies bigger than this many bytes get
+        written to a temp file rather than kept in memory.  In that case the
+        callback gets 'body-path' instead of 'body' and is responsible for
+        deleting the file.
 
     The callback will be passed a dictionary that contains all the HTTP
     headers, as well as the following keys:
         'status': HTTP response code
         'body': The request body (if write_file is not given)
+        'body-path': Path to the request body (if spool_threshold was given
+            and the body was bigger than that)
         'content-length': Length of the downloads as an int
         'total-size': Total size of the download (this is different from
             content-length because it includes the data we are resuming from)
@@ -1047,15 +1573,23 @@ def grab_url(url, callback, errback, header_callback=None,
             a permanent redirect or a temporary one.
         'filename': Name of the file that we should use to save the data
         'charset': Charset encoding of the data
+        'from-cache': True if the body came from the HTTP cache (only
+            present for responses served by the cache)
 
     :returns HTTPClient object
     """
     url = sanitize_url(url)
     if url.startswith("file://"):
         return _grab_file_url(url, callback, errback, default_mime_type)
+    elif (use_cache and http_cache is not None and
+            header_callback is None and content_check_callback is None and
+            write_file is None and etag is None and modified is None and
+            not resume and post_vars is None and post_files is None and
+            spool_threshold is None):
+        return http_cache.grab_url(url, callback, errback, extra_headers)
     else:
         options = TransferOptions(url, etag, modified, resume, post_vars,
-                post_files, write_file, extra_headers)
+                post_files, write_file, extra_headers, spool_threshold)
         transfer = CurlTransfer(options, callback, errback, header_callback,
                 content_check_callback)
         transfer.start()
@@ -1130,5 +1664,7 @@ def start_thread():
 
 def stop_thread():
     global curl_manager
+    if http_cache is not None:
+        http_cache.save()
     curl_manager.stop()
     curl_manager = None
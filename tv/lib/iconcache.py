@@ -30,6 +30,7 @@
 import os
 import logging
 import collections
+import contextlib
 
 from miro import httpclient
 from miro import eventloop
@@ -50,12 +51,36 @@ class IconCacheUpdater:
         self.running_count = 0
         self.in_shutdown = False
         self.started = False
+        self.defer_count = 0
+        self.deferred = []
 
     def start_updates(self):
         self.started = True
         self.run_next_update()
 
+    @contextlib.contextmanager
+    def defer_requests(self):
+        """Hold onto update requests made inside the with block until it
+        finishes.
+
+        This lets code that creates lots of objects at once do it without
+        scheduling icon requests in the middle.
+        """
+        self.defer_count += 1
+        try:
+            yield
+        finally:
+            self.defer_count -= 1
+            if self.defer_count == 0:
+                deferred, self.deferred = self.deferred, []
+                for item, is_vital in deferred:
+                    if not item.removed:
+                        self.request_update(item, is_vital)
+
     def request_update(self, item, is_vital=False):
+        if self.defer_count > 0:
+            self.deferred.append((item, is_vital))
+            return
         if is_vital:
             item.dbItem.confirm_db_thread()
             if (item.filename and fileutil.access(item.filename, os.R_OK)
@@ -300,7 +325,7 @@ class IconCache(DDBObject):
 
         # Last try, get the icon from HTTP.
         httpclient.grab_url(url, lambda info: self.update_icon_cache(url, info),
-                lambda error: self.error_callback(url, error))
+                lambda error: self.error_callback(url, error), use_cache=True)
 
     def request_update(self, is_vital=False):
         if hasattr(self, "updating") and hasattr(self, "dbItem"):
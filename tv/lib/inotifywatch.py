@@ -0,0 +1,377 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""inotifywatch -- DirectoryWatcher implementation that uses inotify.
+
+This works on Linux without needing any frontend support, so headless and
+CLI runs get directory watching too.
+
+inotify only watches single directories, so we add a watch for every
+directory in the tree and keep track of the files in each one.  We only
+report files once they've been completely written (IN_CLOSE_WRITE) or
+moved into place (IN_MOVED_TO).  Changes get coalesced: we wait until
+things are quiet for COALESCE_DELAY seconds (but no more than
+MAX_COALESCE_DELAY seconds total), then emit signals for the net changes.
+Copying an album in results in one batch of added signals, and a file
+that gets created then deleted in the same batch doesn't get reported at
+all.
+
+If the kernel's event queue overflows, we've lost track of what happened,
+so we rescan the directories whose mtime has changed since we last listed
+them.
+"""
+
+import ctypes
+import errno
+import logging
+import os
+import struct
+import sys
+import time
+
+from miro import directorywatch
+from miro import eventloop
+from miro.clock import clock
+
+# wait this long after the last event before sending signals
+COALESCE_DELAY = 0.5
+# but don't wait longer than this after the first event
+MAX_COALESCE_DELAY = 5.0
+# Directories modified this close to when we listed them could have
+# changed without their mtime changing, so always relist them after an
+# overflow.
+MTIME_SLOP = 2.0
+# how long to keep the event loop busy when adding watches to a big tree
+MAX_WATCH_TIME = 0.1
+
+# from sys/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_ONLYDIR)
+# struct inotify_event, not counting the name that follows it
+EVENT_FORMAT = 'iIII'
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+READ_SIZE = 64 * 1024
+
+_libc = None
+if sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        _libc.inotify_init1.argtypes = [ctypes.c_int]
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                            ctypes.c_uint32]
+        _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except (OSError, AttributeError):
+        _libc = None
+
+def is_available():
+    """Can we use inotify on this system?"""
+    return _libc is not None
+
+class _InotifyFile(object):
+    """Wraps our inotify file descriptor for eventloop.add_read_callback().
+    """
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+class InotifyDirectoryWatcher(directorywatch.DirectoryWatcher):
+    coalesce_delay = COALESCE_DELAY
+    max_coalesce_delay = MAX_COALESCE_DELAY
+
+    def startup(self, root_directory):
+        self.root_directory = root_directory
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        self._file = _InotifyFile(self.fd)
+        self._watches = {} # map watch descriptor -> path
+        self._watched_paths = {} # map path -> watch descriptor
+        self._contents = {} # map path -> set of files in the directory
+        self._subdirs = {} # map path -> set of watched subdirectories
+        self._listed = {} # map path -> (mtime, time we listed it)
+        # map path -> did the file exist before the current batch
+        self._pending = {}
+        self._first_event = self._last_event = None
+        self._flush_dc = None
+        self._warned_about_limit = False
+        eventloop.add_read_callback(self._file, self._read_events)
+        eventloop.idle_iterate(self._watch_tree,
+                               "watch %s" % root_directory,
+                               args=(root_directory, False))
+
+    def stop(self):
+        if self.fd is None:
+            return
+        eventloop.remove_read_callback(self._file)
+        os.close(self.fd)
+        self.fd = None
+        if self._flush_dc is not None:
+            self._flush_dc.cancel()
+            self._flush_dc = None
+
+    def _watch_tree(self, directory, send_added):
+        """Watch a directory and everything below it.
+
+        This is a generator for eventloop.idle_iterate() so that big trees
+        don't block the event loop.
+
+        :param send_added: should we send added signals for the files we
+            find?
+        """
+        if self.fd is None:
+            # stop() was called before we got to run
+            return
+        to_visit = [directory]
+        start = clock()
+        while to_visit:
+            to_visit.extend(self._watch_directory(to_visit.pop(),
+                                                  send_added))
+            if clock() - start > MAX_WATCH_TIME:
+                yield
+                if self.fd is None:
+                    return
+                start = clock()
+
+    def _watch_directory(self, path, send_added):
+        """Add a watch for a single directory.
+
+        :returns: list of its subdirectories that we need to watch
+        """
+        if path in self.skip_dirs:
+            logging.info("Not watching directory: %s", path)
+            return []
+        if path in self._watched_paths:
+            return []
+        wd = _libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code == errno.ENOSPC:
+                if not self._warned_about_limit:
+                    logging.warn("Hit the inotify watch limit watching %s.  "
+                                 "Increase "
+                                 "/proc/sys/fs/inotify/max_user_watches to "
+                                 "watch the entire directory", path)
+                    self._warned_about_limit = True
+            elif code not in (errno.ENOENT, errno.ENOTDIR):
+                logging.warn("Error watching %s: %s", path,
+                             os.strerror(code))
+            return []
+        self._watches[wd] = path
+        self._watched_paths[path] = wd
+        self._contents[path] = set()
+        self._subdirs[path] = set()
+        if path != self.root_directory:
+            parent, name = os.path.split(path)
+            self._subdirs.setdefault(parent, set()).add(name)
+        return self._list_directory(path, send_added)
+
+    def _list_directory(self, path, send_added):
+        """Update the contents of a watched directory from the filesystem.
+
+        :returns: list of new subdirectories that we need to watch
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+            names = os.listdir(path)
+        except OSError:
+            return []
+        self._listed[path] = (mtime, time.time())
+        contents = self._contents[path]
+        files = set()
+        dirs = set()
+        for name in names:
+            child = os.path.join(path, name)
+            if os.path.isdir(child):
+                dirs.add(name)
+            elif os.path.isfile(child):
+                files.add(name)
+        for name in files - contents:
+            if send_added:
+                self._note_change(os.path.join(path, name), False)
+            contents.add(name)
+        for name in contents - files:
+            self._note_change(os.path.join(path, name), True)
+            contents.discard(name)
+        for name in self._subdirs[path] - dirs:
+            self._unwatch_tree(os.path.join(path, name))
+        return [os.path.join(path, name)
+                for name in dirs - self._subdirs[path]]
+
+    def _unwatch_tree(self, directory):
+        """Stop watching a directory that's gone, along with its children.
+
+        We send deleted signals for all the files that were in it.
+        """
+        to_visit = [directory]
+        while to_visit:
+            path = to_visit.pop()
+            wd = self._watched_paths.pop(path, None)
+            if wd is None:
+                continue
+            del self._watches[wd]
+            # this fails if the directory is already gone, which is fine
+            _libc.inotify_rm_watch(self.fd, wd)
+            for name in self._contents.pop(path):
+                self._note_change(os.path.join(path, name), True)
+            for name in self._subdirs.pop(path):
+                to_visit.append(os.path.join(path, name))
+            self._listed.pop(path, None)
+        parent, name = os.path.split(directory)
+        if parent in self._subdirs:
+            self._subdirs[parent].discard(name)
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        offset = 0
+        while offset + EVENT_SIZE <= len(data):
+            wd, mask, cookie, length = struct.unpack_from(EVENT_FORMAT,
+                                                          data, offset)
+            offset += EVENT_SIZE
+            name = data[offset:offset+length].rstrip('\0')
+            offset += length
+            self._handle_event(wd, mask, name)
+
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logging.warn("inotify queue overflowed for %s, rescanning",
+                         self.root_directory)
+            eventloop.idle_iterate(self._rescan_changed,
+                                   "rescan %s" % self.root_directory)
+            return
+        directory = self._watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            # the directory was deleted or its filesystem was unmounted
+            self._unwatch_tree(directory)
+            return
+        if not name:
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                eventloop.idle_iterate(self._watch_tree, "watch %s" % path,
+                                       args=(path, True))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._unwatch_tree(path)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            contents = self._contents[directory]
+            if name not in contents:
+                self._note_change(path, False)
+                contents.add(name)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            contents = self._contents[directory]
+            if name in contents:
+                self._note_change(path, True)
+                contents.discard(name)
+
+    def _rescan_changed(self):
+        """Relist directories that changed since we last listed them.
+
+        This is a generator for eventloop.idle_iterate().
+        """
+        if self.fd is None:
+            return
+        start = clock()
+        for path in self._watched_paths.keys():
+            if path not in self._watched_paths:
+                # removed while we were rescanning
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                self._unwatch_tree(path)
+                continue
+            old_mtime, listed_at = self._listed.get(path, (None, 0))
+            if mtime != old_mtime or mtime >= listed_at - MTIME_SLOP:
+                for subdir in self._list_directory(path, True):
+                    eventloop.idle_iterate(self._watch_tree,
+                                           "watch %s" % subdir,
+                                           args=(subdir, True))
+            if clock() - start > MAX_WATCH_TIME:
+                yield
+                if self.fd is None:
+                    return
+                start = clock()
+
+    def _note_change(self, path, existed):
+        """Remember that a file was added or deleted.
+
+        :param existed: did the file exist before this change?
+        """
+        self._pending.setdefault(path, existed)
+        self._last_event = clock()
+        if self._flush_dc is None:
+            self._first_event = self._last_event
+            self._flush_dc = eventloop.add_timeout(self.coalesce_delay,
+                    self._check_flush, "flush directory changes")
+
+    def _check_flush(self):
+        self._flush_dc = None
+        now = clock()
+        quiet_time = now - self._last_event
+        if (quiet_time < self.coalesce_delay and
+                now - self._first_event < self.max_coalesce_delay):
+            self._flush_dc = eventloop.add_timeout(
+                    self.coalesce_delay - quiet_time, self._check_flush,
+                    "flush directory changes")
+            return
+        self._flush()
+
+    def _flush(self):
+        """Send signals for the net changes since the last flush."""
+        pending = self._pending
+        self._pending = {}
+        for path, existed in pending.iteritems():
+            directory, name = os.path.split(path)
+            exists = name in self._contents.get(directory, ())
+            if exists and not existed:
+                self.emit('added', path)
+            elif existed and not exists:
+                self.emit('deleted', path)
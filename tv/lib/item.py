@@ -94,6 +94,37 @@ def _check_for_image(path, element):
         return True
     return False
 
+# WHERE clause and joins for each of the per-feed item counts (minus the
+# feed_id check).  These are used both for the feed_*_view() methods and for
+# counting items of many feeds at once with Item.feed_counts().
+FEED_COUNT_CONDITIONS = {
+    'downloaded': (
+        "(is_file_item OR rd.state in ('finished', 'uploading', "
+        "'uploading-paused'))",
+        {'remote_downloader AS rd': 'item.downloader_id=rd.id'}),
+    'downloading': (
+        "rd.state in ('downloading', 'uploading') AND "
+        "rd.main_item_id=item.id",
+        {'remote_downloader AS rd': 'item.downloader_id=rd.id'}),
+    'available': ("new", None),
+    'auto_pending': (
+        'feed.autoDownloadable AND NOT item.was_downloaded AND '
+        '(item.eligible_for_autodownload OR feed.getEverything)',
+        {'feed': 'item.feed_id=feed.id'}),
+    'unwatched': (
+        "item.watched_time IS NULL AND file_type in ('audio', 'video') AND "
+        "(is_file_item OR rd.state in ('finished', 'uploading', "
+        "'uploading-paused'))",
+        {'remote_downloader AS rd': 'item.downloader_id=rd.id'}),
+}
+
+# Item attributes that the conditions above depend on.  Changing one of these
+# invalidates the counts for the item's feed.
+FEED_COUNT_ATTRIBUTES = frozenset([
+    'feed_id', 'new', 'watched_time', 'file_type', 'is_file_item',
+    'downloader_id', 'was_downloaded', 'eligible_for_autodownload',
+])
+
 class FeedParserValues(object):
     """Helper class to get values from feedparser entries
 
@@ -416,13 +447,21 @@ class ItemChangeTracker(signals.SignalEmitter):
 
     def on_item_added(self, item):
         self.added.add(item.id)
+        self._invalidate_feed_counts(item)
 
     def on_item_changed(self, item):
         self.changed.add(item.id)
         self.changed_columns.update(item.changed_attributes)
+        if not FEED_COUNT_ATTRIBUTES.isdisjoint(item.changed_attributes):
+            self._invalidate_feed_counts(item)
 
     def on_item_removed(self, item):
         self.removed.add(item.id)
+        self._invalidate_feed_counts(item)
+
+    def _invalidate_feed_counts(self, item):
+        if item.feed_id is not None:
+            models.Feed.counts.invalidate(item.feed_id)
 
 class ItemBase(database.DDBObject):
     """Base class for Item, DeviceItem, and SharingItem"""
@@ -488,7 +527,13 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
     _allow_nonexistent_paths = False
 
     def setup_new(self, fp_values, link_number=0, feed_id=None, parent_id=None,
-            eligible_for_autodownload=True, channel_title=None):
+            eligible_for_autodownload=True, channel_title=None,
+            look_for_downloader=True):
+        """Initialize a new Item.
+
+        :param look_for_downloader: set to False if the caller already knows
+            that there's no downloader for our URL.  This saves a query.
+        """
         self.init_metadata_attributes()
         self.is_file_item = False
         self.new = True
@@ -504,6 +549,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         entry_title = self.torrent_title = None
         self.metadata_title = None
         self.filename = None
+        self.entry_digest = None
         fp_values.update_item(self)
         self.expired = False
         self.keep = False
@@ -528,7 +574,8 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         # a page. 0 is the topmost, 1 is the next, and so on
         self.link_number = link_number
         self.creation_time = datetime.now()
-        self._look_for_downloader()
+        if look_for_downloader:
+            self._look_for_downloader()
         self._calc_parent_title()
         self.setup_common()
         self.split_item()
@@ -566,11 +613,12 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         """Called when a playlist gets reordered."""
         Item.change_tracker.playlists_changed = True
 
-    def download_stats_changed(self):
+    def download_stats_changed(self, needs_signal_change=True):
         Item.change_tracker.dlstats_changed = True
         # TODO: I don't think we need the signal_change() call here once we
         # finish replacing the ViewTracker code.
-        self.signal_change(needs_save=False)
+        if needs_signal_change:
+            self.signal_change(needs_save=False)
 
     @classmethod
     def auto_pending_view(cls):
@@ -747,42 +795,55 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
     def folder_contents_view(cls, folder_id):
         return cls.make_view('parent_id=?', (folder_id,))
 
+    @classmethod
+    def _feed_count_view(cls, name, feed_id):
+        where, joins = FEED_COUNT_CONDITIONS[name]
+        return cls.make_view('feed_id=? AND ' + where, (feed_id,),
+                             joins=joins)
+
     @classmethod
     def feed_downloaded_view(cls, feed_id):
-        return cls.make_view("feed_id=? AND "
-                "(is_file_item OR rd.state in ('finished', 'uploading', "
-                "'uploading-paused'))",
-                (feed_id,),
-                joins={'remote_downloader AS rd': 'item.downloader_id=rd.id'})
+        return cls._feed_count_view('downloaded', feed_id)
 
     @classmethod
     def feed_downloading_view(cls, feed_id):
-        return cls.make_view("feed_id=? AND "
-                "rd.state in ('downloading', 'uploading') AND "
-                "rd.main_item_id=item.id",
-                (feed_id,),
-                joins={'remote_downloader AS rd': 'item.downloader_id=rd.id'})
+        return cls._feed_count_view('downloading', feed_id)
 
     @classmethod
     def feed_available_view(cls, feed_id):
-        return cls.make_view("feed_id=? AND new", (feed_id,))
+        return cls._feed_count_view('available', feed_id)
 
     @classmethod
     def feed_auto_pending_view(cls, feed_id):
-        return cls.make_view('feed_id=? AND feed.autoDownloadable AND '
-                'NOT item.was_downloaded AND '
-                '(item.eligible_for_autodownload OR feed.getEverything)',
-                (feed_id,),
-                joins={'feed': 'item.feed_id=feed.id'})
+        return cls._feed_count_view('auto_pending', feed_id)
 
     @classmethod
     def feed_unwatched_view(cls, feed_id):
-        return cls.make_view("feed_id=? AND item.watched_time IS NULL AND "
-                "file_type in ('audio', 'video') AND "
-                "(is_file_item OR rd.state in ('finished', 'uploading', "
-                "'uploading-paused'))",
-                (feed_id,),
-                joins={'remote_downloader AS rd': 'item.downloader_id=rd.id'})
+        return cls._feed_count_view('unwatched', feed_id)
+
+    @classmethod
+    def feed_counts(cls, name, feed_ids=None):
+        """Count items for many feeds using a single query per chunk.
+
+        :param name: key in FEED_COUNT_CONDITIONS
+        :param feed_ids: list of feed ids to count, or None for all feeds
+        :returns: dict mapping feed ids to counts.  Feeds without any
+        matching items are not included.
+        """
+        where, joins = FEED_COUNT_CONDITIONS[name]
+        if feed_ids is None:
+            view = cls.make_view('item.feed_id IS NOT NULL AND ' + where,
+                                 joins=joins)
+            return view.count_by('item.feed_id')
+        counts = {}
+        # It's possible for there to be more than 999 feeds in feed_ids.
+        # Split up the query to avoid SQLite's host parameters limit
+        for ids in util.split_values_for_sqlite(feed_ids):
+            placeholders = ', '.join('?' for i in xrange(len(ids)))
+            view = cls.make_view('item.feed_id IN (%s) AND %s' %
+                                 (placeholders, where), ids, joins=joins)
+            counts.update(view.count_by('item.feed_id'))
+        return counts
 
     @classmethod
     def children_view(cls, parent_id):
@@ -1255,6 +1316,8 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
     def set_feed(self, feed_id):
         """Moves this item to another feed.
         """
+        if self.feed_id is not None:
+            models.Feed.counts.invalidate(self.feed_id)
         self.feed_id = feed_id
         # _feed is created by get_feed which caches the result
         if hasattr(self, "_feed"):
@@ -1514,6 +1577,16 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         self.rss_id = None
         self.signal_change()
 
+    def set_entry_digest(self, digest):
+        """Set the digest of the feed entry this item was last updated from.
+
+        No view depends on this, so we skip the view trackers.
+        """
+        self.confirm_db_thread()
+        if digest != self.entry_digest:
+            self.entry_digest = digest
+            self.save_changes()
+
     def set_auto_downloaded(self, autodl=True):
         self.confirm_db_thread()
         if autodl != self.auto_downloaded:
@@ -2096,6 +2169,12 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
             for item in self.get_children():
                 item.remove()
         self._remove_from_playlists()
+        if self.entry_digest is not None:
+            # parsing the same feed body again would bring us back
+            try:
+                self.get_feed().actualFeed.on_item_removed()
+            except database.ObjectNotFoundError:
+                pass
         MetadataItemBase.remove(self)
 
     def setup_links(self):
@@ -33,15 +33,18 @@ import errno
 import os
 import sys
 import itertools
+import select
 import socket
 import random
 import traceback
+import Queue
 # XXX merged into urllib.urlparse in Python 3
 import urlparse
 # XXX merged into http.server in Python 3.
 import BaseHTTPServer
 import SocketServer
 import threading
+import time
 import httplib
 import gzip
 try:
@@ -57,13 +60,15 @@ import mdns
 from const import *
 from subr import (encode_response, decode_response, split_url_path, atoi,
                   atol, StreamObj, ChunkedStreamObj, find_daap_tag,
-                  find_daap_listitems)
+                  find_daap_listitems, daap_tag_dict, EncodedReply,
+                  encode_container)
 
 # Configurable options (or do via command line).
 DEFAULT_PORT = 3689
 DAAP_TIMEOUT = 1800    # timeout (in seconds)
 
 DAAP_MAXCONN = 10      # Number of maximum connections we want to allow.
+DAAP_WORKERS = 8       # Worker threads for make_daap_server(pooled=True)
 
 # !!! No user servicable parts below. !!!
 
@@ -106,6 +111,151 @@ class SessionObject(object):
     # on the requests which come in.
     pass
 
+class DaapItemCache(object):
+    """Cache of DMAP encoded item listings.
+
+    Each item is encoded into its 'mlit' record once per (revision, meta)
+    and the records are reused between requests.  Full listings are cached
+    per playlist and meta for the backend's current revision, so clients
+    asking for the same listing get the same bytes (and the same gzip
+    data).  Delta listings only encode the items that the backend reports
+    changed.
+    """
+    # Clients normally stick to a couple of meta sets.  If somebody goes
+    # through more than this, start over.
+    MAX_META_SETS = 8
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # maps meta tuples to dicts mapping item ids to (revision, record)
+        self.records = dict()
+        # maps (playlist_id, meta tuple) to (revision, EncodedReply).  Only
+        # listings for the latest revision are kept.
+        self.listings = dict()
+        self.records_encoded = 0
+        self.listing_hits = 0
+
+    def _record_cache(self, meta):
+        try:
+            return self.records[meta]
+        except KeyError:
+            if len(self.records) >= self.MAX_META_SETS:
+                self.records.clear()
+            records = self.records[meta] = dict()
+            return records
+
+    def _encode_record(self, itemprop, meta):
+        # NB: mikd must be the first guy in the listing.
+        # GRR stupid Rhythmbox!  The meta reply must appear in order otherwise
+        # it doesn't work!
+        item = [('mikd', DAAP_ITEMKIND_AUDIO)]
+        for m in meta:
+            try:
+                value = itemprop[m]
+                code = dmap_consts_rmap[m]
+            except KeyError:
+                continue
+            if value is not None:
+                item.append((code, value))
+        return str(encode_response([('mlit', item)]))
+
+    def encode_items(self, items, meta):
+        """Get the encoded records for items.
+
+        :param items: dict mapping item ids to item data, as returned by
+        the backend's get_items()
+        :param meta: tuple of meta names to include
+        :returns: (records, deleted) where records is a list of encoded
+        'mlit' records for the valid items and deleted is a list of ids for
+        the deleted ones.
+        """
+        records = []
+        deleted = []
+        with self.lock:
+            cache = self._record_cache(meta)
+            for k, itemprop in items.iteritems():
+                if not itemprop['valid']:
+                    deleted.append(k)
+                    cache.pop(k, None)
+                    continue
+                revision = itemprop['revision']
+                try:
+                    cached_revision, record = cache[k]
+                except KeyError:
+                    cached_revision = None
+                if cached_revision != revision:
+                    record = self._encode_record(itemprop, meta)
+                    cache[k] = (revision, record)
+                    self.records_encoded += 1
+                records.append(record)
+        return records, deleted
+
+    def encode_listing(self, tag, records, deleted, update):
+        """Build an item listing reply from encoded records."""
+        nfiles = len(records)
+        content = [
+            str(encode_response([
+                ('mstt', DAAP_OK),   # Status: OK
+                ('muty', update),    # Update type
+                ('mtco', nfiles),    # Specified total count
+                ('mrco', nfiles),    # Returned count
+            ])),
+            encode_container('mlcl', ''.join(records)),
+        ]
+        if deleted:
+            # Itemlist deleted
+            content.append(str(encode_response(
+                [('mudl', [('miid', k) for k in deleted])])))
+        return EncodedReply(encode_container(tag, ''.join(content)))
+
+    def get_listing(self, backend, playlist_id, meta, delta):
+        """Get the item listing for a playlist.
+
+        :param backend: backend to get item data from
+        :param playlist_id: playlist requested, 2 for the library
+        :param meta: tuple of meta names to include
+        :param delta: revision the client already has, or 0 for a full
+        listing
+        :returns: EncodedReply
+        """
+        backend_id = playlist_id
+        if backend_id == 2:
+            backend_id = None
+        tag = 'apso' if playlist_id else 'adbs'
+        if delta:
+            items = backend.get_items(playlist_id=backend_id, since=delta)
+            records, deleted = self.encode_items(items, meta)
+            return self.encode_listing(tag, records, deleted, 1)
+        # Read the revision before the items.  If things change in between
+        # we cache newer data under the older revision, which is harmless:
+        # clients will get sent the new items again on their next update.
+        revision = backend.get_current_revision()
+        key = (playlist_id, meta)
+        with self.lock:
+            try:
+                cached_revision, listing = self.listings[key]
+            except KeyError:
+                pass
+            else:
+                if cached_revision == revision:
+                    self.listing_hits += 1
+                    return listing
+        items = backend.get_items(playlist_id=backend_id)
+        # A full listing doesn't need to tell the client about deleted
+        # items, it never saw them.
+        records, deleted = self.encode_items(items, meta)
+        listing = self.encode_listing(tag, records, [], 0)
+        with self.lock:
+            # Older listings can't be used again since the backend's
+            # revision only goes up.  Dropping them also drops the listings
+            # for removed playlists.
+            for other_key, (other_revision, other_listing) in \
+                    self.listings.items():
+                if other_revision < revision:
+                    del self.listings[other_key]
+            self.listings[key] = (revision, listing)
+        return listing
+
 class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     # GRRR!  Stupid Windows!  When bind() is called twice on a socket
     # it should return EADDRINUSE on the second one - Windows doesn't!
@@ -113,6 +263,7 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     # a new port.
     # allow_reuse_address = True    # setsockopt(... SO_REUSEADDR, 1)
     daemon_threads = True
+    session_timeout = DAAP_TIMEOUT
 
     def __init__(self, server_address, RequestHandlerClass,
                  bind_and_activate=True):
@@ -123,6 +274,7 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
         self.session_lock = threading.Lock()
         self.debug = False
         self.log_message_callback = None
+        self.item_cache = DaapItemCache()
 
     # New functions in subclass.  Note: we can separate some of these out
     # into separate libraries but not now.
@@ -148,6 +300,15 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     def daap_timeout_callback(self, s):
         self.del_session(s)
 
+    def make_session_timer(self, s):
+        """Make the timer that expires session s after session_timeout.
+
+        The caller starts it, and cancels it when the session is renewed or
+        deleted.
+        """
+        return threading.Timer(self.session_timeout,
+                               self.daap_timeout_callback, [s])
+
     def session_count(self):
         return len(self.activeconn)
 
@@ -161,10 +322,11 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
                 if not s in self.activeconn:
                     break
             session_obj = SessionObject()
+            session_obj.bytes_sent = 0
+            session_obj.send_time = 0.0
+            session_obj.streams = 0
             self.activeconn[s] = session_obj
-            session_obj.timer = threading.Timer(DAAP_TIMEOUT,
-                                                self.daap_timeout_callback,
-                                                [s])
+            session_obj.timer = self.make_session_timer(s)
             session_obj.counter = itertools.count()
             current_thread = threading.current_thread()
             current_thread.generation = session_obj.counter.next()
@@ -178,15 +340,54 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
             except KeyError:
                 return False
             # Pants...  we need to create a new timer object.
-            self.activeconn[s].timer = threading.Timer(DAAP_TIMEOUT,
-                                                   self.daap_timeout_callback,
-                                                   [s])
+            self.activeconn[s].timer = self.make_session_timer(s)
             current_thread = threading.current_thread()
             current_thread.generation = self.activeconn[s].counter.next()
             self.activeconn[s].timer.start()
             # OK, thank the caller for telling us the guy's alive
             return True
 
+    def wait_for_revision(self, handler, session, old_revision):
+        """Wait for the backend to have a newer revision than old_revision.
+
+        Blocks the handler's thread.  Returns the new revision, or None if
+        the server will reply later with handler.send_update().
+        """
+        return self.backend.get_revision(session, old_revision,
+                                         handler.request)
+
+    def record_transfer(self, s, nbytes, seconds):
+        """Add a file transfer to the counters for session s."""
+        with self.session_lock:
+            try:
+                session_obj = self.activeconn[s]
+            except KeyError:
+                return
+            session_obj.bytes_sent += nbytes
+            session_obj.send_time += seconds
+            session_obj.streams += 1
+
+    def get_session_stats(self):
+        """Get file transfer counters for the active sessions.
+
+        :returns: dict mapping session ids to dicts with bytes_sent,
+        send_time, streams and rate (bytes/second while sending) keys
+        """
+        stats = dict()
+        with self.session_lock:
+            for s, session_obj in self.activeconn.items():
+                if session_obj.send_time:
+                    rate = session_obj.bytes_sent / session_obj.send_time
+                else:
+                    rate = 0.0
+                stats[s] = {
+                    'bytes_sent': session_obj.bytes_sent,
+                    'send_time': session_obj.send_time,
+                    'streams': session_obj.streams,
+                    'rate': rate,
+                }
+        return stats
+
     def handle_error(self, request, client_address):
         pass
 
@@ -202,6 +403,311 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
             except KeyError:
                 pass
 
+def make_socket_pair():
+    """Make a pair of connected sockets.  Like socket.socketpair(), but
+    works on Windows too.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        first = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        first.connect(listener.getsockname())
+        second, address = listener.accept()
+    finally:
+        listener.close()
+    return first, second
+
+class SessionDeadline(object):
+    """Stand-in for threading.Timer used by DaapPooledTCPServer.
+
+    Rather than starting a thread per session, this records the deadline
+    with the server and lets its poller expire the session.
+    """
+    def __init__(self, server, s):
+        self.server = server
+        self.s = s
+
+    def start(self):
+        self.server.set_session_deadline(self.s,
+                time.time() + self.server.session_timeout)
+
+    def cancel(self):
+        self.server.set_session_deadline(self.s, None)
+
+class DaapPooledTCPServer(DaapTCPServer):
+    """DAAP server that uses a fixed number of worker threads.
+
+    Between requests, connections get parked in a select() loop instead of
+    holding a thread.  When a parked connection becomes readable, a worker
+    handles the next request on it.  /update long polls are parked the same
+    way: we register a callback with the backend's wait_for_revision() and
+    send the reply from a worker once the revision changes.  If the client
+    sends anything (or closes the connection) while we are waiting, we
+    reply with the old revision, like the blocking version does.
+
+    Use this with DaapPooledHttpRequestHandler.  Backends without
+    wait_for_revision() still work, but /update then blocks a worker.
+    Sessions are expired by the poller too, see SessionDeadline.
+    """
+    # Clients use a couple of connections per session (control, /update,
+    # streaming), so allow this many connections per session.
+    CONNECTIONS_PER_SESSION = 4
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 bind_and_activate=True, workers=DAAP_WORKERS):
+        DaapTCPServer.__init__(self, server_address, RequestHandlerClass,
+                               bind_and_activate)
+        self.worker_count = workers
+        self.jobs = Queue.Queue()
+        # conn_lock protects connections, parked and handler state
+        self.conn_lock = threading.Lock()
+        self.connections = set()
+        # maps file descriptors to the handlers parked on them
+        self.parked = dict()
+        self.threads = []
+        self.wake_r, self.wake_w = make_socket_pair()
+        # maps session ids to the time they expire
+        self.deadline_lock = threading.Lock()
+        self.session_deadlines = dict()
+
+    def start_threads(self):
+        if self.threads:
+            return
+        for i in xrange(self.worker_count):
+            thread = threading.Thread(target=self.worker_loop,
+                                      name='DAAP worker %d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        thread = threading.Thread(target=self.poll_loop, name='DAAP poller')
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def max_connections(self):
+        return self.maxconn * self.CONNECTIONS_PER_SESSION
+
+    def make_session_timer(self, s):
+        return SessionDeadline(self, s)
+
+    def set_session_deadline(self, s, deadline):
+        with self.deadline_lock:
+            if deadline is None:
+                self.session_deadlines.pop(s, None)
+                return
+            first = not self.session_deadlines
+            self.session_deadlines[s] = deadline
+        if first:
+            # The poller may be waiting without a timeout.
+            self.wake_poller()
+
+    def poll_timeout(self):
+        with self.deadline_lock:
+            if not self.session_deadlines:
+                return None
+            deadline = min(self.session_deadlines.itervalues())
+        return max(0, deadline - time.time())
+
+    def expire_sessions(self):
+        now = time.time()
+        with self.deadline_lock:
+            expired = [s for s, deadline in self.session_deadlines.items()
+                       if deadline <= now]
+            for s in expired:
+                del self.session_deadlines[s]
+        for s in expired:
+            self.daap_timeout_callback(s)
+
+    def connection_count(self):
+        with self.conn_lock:
+            return len(self.connections)
+
+    def process_request(self, request, client_address):
+        self.start_threads()
+        with self.conn_lock:
+            full = len(self.connections) >= self.max_connections()
+        if full:
+            self.shutdown_request(request)
+            return
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except socket.error:
+            self.shutdown_request(request)
+            return
+        with self.conn_lock:
+            self.connections.add(handler)
+        self.jobs.put((self.handle_next, (handler,)))
+
+    def worker_loop(self):
+        while True:
+            func, args = self.jobs.get()
+            if func is None:
+                return
+            handler = args[0]
+            try:
+                func(*args)
+            except Exception, e:
+                (typ, value, tb) = sys.exc_info()
+                parts = 'Error: Exception in worker: %s\nTraceback:\n'
+                parts += ''.join(traceback.format_list(
+                    traceback.extract_tb(tb)))
+                handler.log_message(parts, e)
+                self.close_connection(handler)
+
+    def poll_loop(self):
+        while True:
+            with self.conn_lock:
+                rset = [self.wake_r] + self.parked.keys()
+            try:
+                r, w, x = select.select(rset, [], [], self.poll_timeout())
+            except select.error, (err, errstring):
+                if err == errno.EINTR:
+                    continue
+                if err == errno.EBADF:
+                    self.drop_bad_fds()
+                    continue
+                raise
+            for fd in r:
+                if fd is self.wake_r:
+                    if not self.wake_r.recv(512):
+                        # server_close() closed the other end
+                        return
+                    continue
+                self.wake_parked(fd)
+            self.expire_sessions()
+
+    def drop_bad_fds(self):
+        with self.conn_lock:
+            parked = self.parked.items()
+        for fd, handler in parked:
+            try:
+                select.select([fd], [], [], 0)
+            except select.error:
+                with self.conn_lock:
+                    self.parked.pop(fd, None)
+                self.close_connection(handler)
+
+    def wake_poller(self):
+        try:
+            self.wake_w.send('x')
+        except socket.error:
+            pass
+
+    def wake_parked(self, fd):
+        with self.conn_lock:
+            try:
+                handler = self.parked.pop(fd)
+            except KeyError:
+                return
+            if handler.waiting_revision is not None:
+                self.stop_waiting(handler)
+                return
+        self.jobs.put((self.handle_next, (handler,)))
+
+    def stop_waiting(self, handler):
+        # The client sent something or closed the connection while waiting
+        # for a revision change.  Stop waiting and reply with the old
+        # revision.  Called with conn_lock held.
+        revision = handler.waiting_revision
+        handler.waiting_revision = None
+        self.jobs.put((self.send_update, (handler, revision)))
+
+    def park(self, handler):
+        # Wait for the next request on handler's connection.  Called with
+        # conn_lock held.
+        if handler.has_buffered_data():
+            # Already read, select() won't tell us about it.
+            if handler.waiting_revision is not None:
+                self.stop_waiting(handler)
+            else:
+                self.jobs.put((self.handle_next, (handler,)))
+        else:
+            self.parked[handler.connection.fileno()] = handler
+            self.wake_poller()
+
+    def handle_next(self, handler):
+        keep_open = handler.handle_next()
+        with self.conn_lock:
+            if handler.update_revision is not None:
+                # The revision changed while we were still handling the
+                # request.
+                revision = handler.update_revision
+                handler.update_revision = None
+                self.jobs.put((self.send_update, (handler, revision)))
+                return
+            if handler.waiting_revision is not None:
+                self.park(handler)
+                return
+            if keep_open:
+                self.park(handler)
+                return
+        self.close_connection(handler)
+
+    def send_update(self, handler, revision):
+        try:
+            handler.send_update(revision)
+        except (IOError, socket.error):
+            self.close_connection(handler)
+            return
+        if handler.close_connection:
+            self.close_connection(handler)
+        else:
+            with self.conn_lock:
+                self.park(handler)
+
+    def wait_for_revision(self, handler, session, old_revision):
+        try:
+            wait_for_revision = self.backend.wait_for_revision
+        except AttributeError:
+            return DaapTCPServer.wait_for_revision(self, handler, session,
+                                                   old_revision)
+        handler.waiting_revision = old_revision
+        def callback(revision):
+            self.revision_ready(handler, revision)
+        wait_for_revision(old_revision, callback)
+        return None
+
+    def revision_ready(self, handler, revision):
+        # Called by the backend, possibly from handler's own thread if the
+        # revision had already changed.
+        with self.conn_lock:
+            if handler.waiting_revision is None:
+                # We already gave up waiting
+                return
+            handler.waiting_revision = None
+            fd = handler.connection.fileno()
+            if self.parked.get(fd) is handler:
+                del self.parked[fd]
+                self.jobs.put((self.send_update, (handler, revision)))
+            else:
+                # handle_next() is still running, let it send the reply
+                handler.update_revision = revision
+
+    def close_connection(self, handler):
+        with self.conn_lock:
+            if handler not in self.connections:
+                return
+            self.connections.discard(handler)
+            handler.waiting_revision = None
+            for fd, parked in self.parked.items():
+                if parked is handler:
+                    del self.parked[fd]
+        try:
+            handler.close()
+        except (IOError, socket.error):
+            pass
+
+    def server_close(self):
+        DaapTCPServer.server_close(self)
+        for thread in self.threads:
+            self.jobs.put((None, None))
+        self.wake_w.close()
+        with self.conn_lock:
+            handlers = list(self.connections)
+        for handler in handlers:
+            self.close_connection(handler)
+
 class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     protocol_version = 'HTTP/1.1'
     server_version = 'daap.py' + ' ' + VERSION
@@ -247,8 +753,11 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             for k, v in blob.get_headers():
                 self.send_header(k, v)
             self.end_headers()
-            for chunk in blob:
-                self.wfile.write(chunk)
+            if isinstance(blob, ChunkedStreamObj):
+                self.send_stream(blob)
+            else:
+                for chunk in blob:
+                    self.wfile.write(chunk)
         # Remote guy could be mean and cut us off.  If so, silence the broken
         # pipe error, and continue on our merry way
         except IOError:
@@ -257,6 +766,34 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 self.server.del_session(session)
             raise    # Give upper layer a chance to deal
 
+    def send_stream(self, stream):
+        # Send a file to the client, using sendfile() if we can so the data
+        # doesn't need to go through Python.  Either way, count the bytes
+        # towards the session's transfer stats.
+        start = time.time()
+        sent = 0
+        try:
+            if stream.can_sendfile():
+                self.wfile.flush()
+                sent = stream.send_to(self.connection)
+            else:
+                for chunk in stream:
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+        finally:
+            session = self.get_session_id()
+            if session:
+                self.server.record_transfer(session, sent,
+                                            time.time() - start)
+
+    def get_session_id(self):
+        # Like get_session(), but doesn't renew the session.
+        path, query = split_url_path(self.path)
+        try:
+            return int(query['session-id'])
+        except (KeyError, ValueError):
+            return 0
+
     # Convenience function: convenient that session-id must be non-zero so
     # you can use it for True/False testing too.
     def get_session(self):
@@ -357,11 +894,19 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             return (DAAP_BADREQUEST, [], [])
         if not session:
             return (DAAP_FORBIDDEN, [], [])
-        revision = self.server.backend.get_revision(session, old_revision,
-                                                    self.request)
-        reply = []
-        reply.append(('mupd', [('mstt', DAAP_OK), ('musr', revision)]))
-        return (DAAP_OK, reply, [])
+        revision = self.server.wait_for_revision(self, session, old_revision)
+        if revision is None:
+            # The server will call send_update() once there is a new
+            # revision.
+            return (None, None, None)
+        return (DAAP_OK, self.make_update_reply(revision), [])
+
+    def make_update_reply(self, revision):
+        return [('mupd', [('mstt', DAAP_OK), ('musr', revision)])]
+
+    def send_update(self, revision):
+        self.do_send_reply(DAAP_OK, self.make_update_reply(revision),
+                           content_encoding=self.reply_encoding())
 
     def do_stream_file(self, db_id, item_id, ext, chunk):
         rc = DAAP_OK
@@ -388,8 +933,12 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if not file_obj:
             return (DAAP_FILENOTFOUND, [], extra_headers)
         self.log_message('daap server: streaming with filobj %s', file_obj)
-        # Return a special response, the encode_reponse() will handle correctly
-        return (rc, [(file_obj, hint, seekpos, seekend)], extra_headers)
+        # Transcoded chunks and playlists are small temporary files handed
+        # to us by the transcode code, just read those the normal way.
+        use_sendfile = ext not in ('ts', 'm3u8')
+        stream = ChunkedStreamObj(file_obj, hint, seekpos, seekend,
+                                  use_sendfile=use_sendfile)
+        return (rc, stream, extra_headers)
 
     def get_request_path(self, itemid, enclosure):
         # XXX
@@ -539,62 +1088,16 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     # try to invoke any of this the server will go BOH BOH!!!! no support!!!
     def do_itemlist(self, path, query, playlist_id=None):
         # Library playlist?
-        # Save this variable, we use it to determine which code to send later
-        # on.  playlist_id is Library default so it if asks for that as a 
+        # playlist_id is Library default so it if asks for that as a
         # container (playlist) we still want to send the playlist version.
-        backend_id = playlist_id
-        if backend_id == 2:
-            backend_id = None
-        items = self.server.backend.get_items(playlist_id=backend_id)
-        itemlist = []
-        deleted = []
         try:
             meta = query['meta']
         except KeyError:
             meta = DEFAULT_DAAP_META
-        revision, delta = self.get_revision(query) 
-        meta_list = [m.strip() for m in meta.split(',')]
-        # NB: mikd must be the first guy in the listing.
-        # GRR stupid Rhythmbox!  The meta reply must appear in order otherwise
-        # it doesn't work!
-        for k in items.keys():
-            itemprop = items[k]
-            if itemprop['revision'] <= delta:
-                continue
-            if itemprop['valid']:
-                item = []
-                for m in meta_list:
-                    if m in itemprop.keys():
-                        try:
-                            code = dmap_consts_rmap[m]
-                        except KeyError:
-                            continue
-                        if itemprop[m] is not None:
-                            attribute = (code, itemprop[m])
-                            item.append(attribute)
-                itemlist.append(('mlit', [       # Listing item
-                                      # item kind - seems OK to hardcode this.
-                                          ('mikd', DAAP_ITEMKIND_AUDIO),
-                                         ] + item
-                           )) 
-            else:
-                deleted.append(('miid', k))
-
-        tag = 'apso' if playlist_id else 'adbs'
-        nfiles = len(itemlist)
-        update = 1 if delta else 0
-        reply = []
-        content = [                          # Container type
-                        ('mstt', DAAP_OK),   # Status: OK
-                        ('muty', update),    # Update type
-                        ('mtco', nfiles),    # Specified total count
-                        ('mrco', nfiles),    # Returned count
-                        ('mlcl', itemlist)
-                  ]
-        if deleted:
-            content.append(('mudl', deleted))    # Itemlist deleted
-
-        reply = [(tag, content)]
+        revision, delta = self.get_revision(query)
+        meta = tuple(m.strip() for m in meta.split(','))
+        reply = self.server.item_cache.get_listing(self.server.backend,
+                                                   playlist_id, meta, delta)
         return (DAAP_OK, reply, [])
 
     def do_database_items(self, path, query):
@@ -663,6 +1166,9 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 rcode, reply, extra_headers = self.do_activity()
             elif self.path.startswith('/update'):
                 rcode, reply, extra_headers = self.do_update()
+                if rcode is None:
+                    # Reply deferred until the revision changes.
+                    return
             elif self.path.startswith('/databases'):
                 rcode, reply, extra_headers = self.do_databases()
             else:
@@ -734,6 +1240,39 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         # prohibited list.
         return None
 
+class DaapPooledHttpRequestHandler(DaapHttpRequestHandler):
+    """Request handler for DaapPooledTCPServer.
+
+    Instead of handling every request on the connection from the
+    constructor, the server calls handle_next() for each request.
+    """
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        # revision of the /update request we're waiting to reply to
+        self.waiting_revision = None
+        # new revision to send, if it changed while handling the request
+        self.update_revision = None
+        self.setup()
+
+    def handle_next(self):
+        """Handle one request.  Returns False if the connection should be
+        closed.
+        """
+        self.close_connection = 1
+        self.handle_one_request()
+        return not self.close_connection
+
+    def has_buffered_data(self):
+        # socket._fileobject keeps data it read past the last line in _rbuf.
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        return rbuf is not None and rbuf.tell() > 0
+
+    def close(self):
+        self.finish()
+        self.server.shutdown_request(self.request)
+
 def mdns_init():
     return mdns.mdns_init()
 
@@ -795,12 +1334,17 @@ def runloop(daapserver):
     daapserver.serve_forever()
 
 def make_daap_server(backend, debug=False, name='pydaap', port=DEFAULT_PORT,
-                     max_conn=DAAP_MAXCONN, robust=True):
-    handler = DaapHttpRequestHandler
+                     max_conn=DAAP_MAXCONN, robust=True, pooled=False):
+    if pooled:
+        server_class = DaapPooledTCPServer
+        handler = DaapPooledHttpRequestHandler
+    else:
+        server_class = DaapTCPServer
+        handler = DaapHttpRequestHandler
     failed = False
     while True:
         try:
-            httpd = DaapTCPServer(('', port), handler)
+            httpd = server_class(('', port), handler)
             break
         except socket.error, e:
             if robust and not port == 0:
@@ -907,50 +1451,41 @@ class DaapClient(object):
         self.old_revision = self.revision
         self.revision = revision
 
-    def handle_playlist(self, data, meta):
+    def decode_listing(self, data, meta):
+        """Decode a playlist or item listing.
+
+        :returns: (dict mapping ids to dicts of meta values, deleted ids)
+        """
         r = decode_response(data)
-        listing = find_daap_tag('mlcl', r)
-        deleted = find_daap_tag('mudl', r)
-        playlist_dict = dict()
+        # Look in the reply container directly, rather than searching, since
+        # find_daap_tag() would go through every listing item on the way to
+        # mudl.
+        reply = daap_tag_dict(r[0][1]) if r else dict()
+        listing = reply.get('mlcl')
+        deleted = reply.get('mudl')
+        meta_codes = []
+        for m in meta.split(','):
+            m = m.strip()
+            try:
+                meta_codes.append((m, dmap_consts_rmap[m]))
+            except KeyError:
+                continue
+        itemdict = dict()
         deleted_list = []
-        meta_list = [m.strip() for m in meta.split(',')]
         if listing is not None:
             for item in find_daap_listitems(listing):
-                playlist_id = find_daap_tag('miid', item)
-                playlist_dict[playlist_id] = dict()
-                for m in meta_list:
-                    try:
-                        playlist_dict[playlist_id][m] = find_daap_tag(
-                                                    dmap_consts_rmap[m], item)
-                    except KeyError:
-                        continue
+                values = daap_tag_dict(item)
+                itemdict[values.get('miid')] = dict(
+                    (m, values.get(code)) for m, code in meta_codes)
         if deleted is not None:
-            for item_id in find_daap_listitems(deleted):
-                deleted_list.append(item_id)
+            deleted_list = find_daap_listitems(deleted)
+        return itemdict, deleted_list
 
-        self.daap_playlists = (playlist_dict, deleted_list)
+    def handle_playlist(self, data, meta):
+        self.daap_playlists = self.decode_listing(data, meta)
 
     def handle_items(self, data, playlist_id, meta):
-        r = decode_response(data)
-        listing = find_daap_tag('mlcl', r)
-        deleted = find_daap_tag('mudl', r)
-        meta_list = [m.strip() for m in meta.split(',')]
-        itemdict = dict()
-        deleted_list = []
-        if listing is not None:
-            for item in find_daap_listitems(listing):
-                itemid = find_daap_tag('miid', item)
-                itemdict[itemid] = dict()
-                for m in meta_list:
-                    try:
-                        itemdict[itemid][m] = find_daap_tag(
-                                              dmap_consts_rmap[m], item)
-                    except KeyError:
-                        continue
-        if deleted is not None:
-            for item_id in find_daap_listitems(deleted):
-                deleted_list.append(item_id)
-        self.daap_items = itemdict, deleted_list
+        self.daap_items = self.decode_listing(data, meta)
 
     def sessionize(self, request, query):
         if not self.session:
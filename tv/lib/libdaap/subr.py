@@ -28,9 +28,13 @@
 
 # subr.py
 
+import ctypes
+import errno
 import os
+import select
 import stat
 import struct
+import sys
 import urllib
 import gzip
 
@@ -40,6 +44,37 @@ except ImportError:
     from StringIO import StringIO
 from const import *
 
+def _load_sendfile():
+    # Python 2 doesn't have os.sendfile(), so get it from libc ourselves.
+    # Only Linux for now, the BSD/OS X version has a different signature.
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        try:
+            func = libc.sendfile64
+        except AttributeError:
+            func = libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int,
+                     ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+    def _sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        rv = func(out_fd, in_fd, ctypes.byref(offset), count)
+        if rv < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return rv
+    return _sendfile
+
+# sendfile(out_fd, in_fd, offset, count) -> bytes sent, or None if we can't
+# do sendfile on this platform.
+sendfile = _load_sendfile()
+
 # XXX calcsize()?  We need to do some overriding however.
 fmts = {
     DMAP_TYPE_LIST: ('0s', 0),
@@ -56,18 +91,26 @@ fmts = {
     DMAP_TYPE_VERSION: ('I', 4),
 }
 
+def gzip_data(data):
+    """
+       gzip_data(data) -> compressed data
+    """
+    gzdata = StringIO()
+    f = gzip.GzipFile(fileobj=gzdata, mode='wb')
+    f.write(data)
+    f.close()
+    return gzdata.getvalue()
+
 class StreamObj(object):
     """
        Data object for encoding HTTP responses.  Use once then dispose.
+
+       Pass compressed=True if data is already encoded with content_encoding.
     """
-    def __init__(self, data, content_encoding=None):
+    def __init__(self, data, content_encoding=None, compressed=False):
         self.content_encoding = content_encoding
-        if content_encoding == 'gzip':
-            gzdata = StringIO()
-            f = gzip.GzipFile(fileobj=gzdata, mode='wb')
-            f.write(data)
-            f.close()
-            self.data = gzdata.getvalue()
+        if content_encoding == 'gzip' and not compressed:
+            self.data = gzip_data(data)
         else:
             self.data = data
 
@@ -90,6 +133,30 @@ class StreamObj(object):
     def get_rangetext(self):
         return ''
 
+class EncodedReply(object):
+    """
+       A reply that has already been DMAP encoded.  Unlike StreamObj, this
+       can be kept around and sent to any number of clients.  The gzip
+       variant is compressed the first time somebody asks for it and then
+       kept.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.gzdata = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def get_stream(self, content_encoding=None):
+        if content_encoding == 'gzip':
+            # Two threads may race to fill this in.  They would both compute
+            # the same thing, so don't bother locking.
+            if self.gzdata is None:
+                self.gzdata = gzip_data(self.data)
+            return StreamObj(self.gzdata, content_encoding=content_encoding,
+                             compressed=True)
+        return StreamObj(self.data)
+
 class ChunkedStreamObj(object):
     """
        Streaming object.  Use once and then you must dispose.
@@ -100,15 +167,22 @@ class ChunkedStreamObj(object):
 
        for chunk in streamobj:
            write(chunk)
+
+       Or, if can_sendfile() returns True, call send_to() to have the kernel
+       copy the file to the socket.  Pass use_sendfile=False for files that
+       aren't plain files on disk.
     """
     DEFAULT_CHUNK_SIZE = 128 * 1024
+    # Timeout for send_to() to use for sockets that don't have one.
+    DEFAULT_SEND_TIMEOUT = 60
 
     def __init__(self, file_obj, hint, start=0, end=0,
-                 chunksize=DEFAULT_CHUNK_SIZE):
+                 chunksize=DEFAULT_CHUNK_SIZE, use_sendfile=False):
         hint = os.path.basename(hint) if hint else ''
         self.file_hint = hint
         self.chunksize = chunksize
         self.file_obj = file_obj
+        self.use_sendfile = use_sendfile
         self.end = end
         self.filesize = os.fstat(file_obj.fileno())[stat.ST_SIZE]
         self.streamsize = self.filesize
@@ -153,6 +227,60 @@ class ChunkedStreamObj(object):
     def __len__(self):
         return self.streamsize
 
+    def can_sendfile(self):
+        return self.use_sendfile and sendfile is not None
+
+    def send_to(self, sock):
+        """
+           send_to(sock) -> bytes sent
+
+           Send the rest of the stream to sock with sendfile().  The file
+           data never gets copied into Python.  Errors sending are raised as
+           IOError, like socket writes.  If the socket isn't writable for
+           the socket's timeout (or DEFAULT_SEND_TIMEOUT if it doesn't have
+           one) we give up and raise IOError with ETIMEDOUT.
+        """
+        timeout = sock.gettimeout()
+        if timeout is not None:
+            return self._send_to(sock, timeout)
+        # Blocking sockets would block inside sendfile() with no way to
+        # time out.  Sockets with a timeout are non-blocking underneath.
+        sock.settimeout(self.DEFAULT_SEND_TIMEOUT)
+        try:
+            return self._send_to(sock, self.DEFAULT_SEND_TIMEOUT)
+        finally:
+            sock.settimeout(None)
+
+    def _send_to(self, sock, timeout):
+        in_fd = self.file_obj.fileno()
+        out_fd = sock.fileno()
+        # The backend already seeked to the start of the range for us.
+        offset = self.file_obj.tell()
+        sent = 0
+        while self.unread > 0:
+            try:
+                count = sendfile(out_fd, in_fd, offset, self.unread)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                elif e.errno == errno.EAGAIN:
+                    # sockets with a timeout are non-blocking underneath
+                    r, w, x = select.select([], [sock], [], timeout)
+                    if not w:
+                        self.file_obj.seek(offset, os.SEEK_SET)
+                        raise IOError(errno.ETIMEDOUT,
+                                      'timed out sending file')
+                    continue
+                raise IOError(e.errno, e.strerror)
+            # Maybe file got truncated
+            if count == 0:
+                break
+            offset += count
+            sent += count
+            self.unread -= count
+        self.file_obj.seek(offset, os.SEEK_SET)
+        return sent
+
     def get_headers(self):
         headers = []
         if self.rangetext:
@@ -196,6 +324,66 @@ def atox(s, func, base=10):
             break
     return res
 
+# Header for every DMAP entry: code (4 bytes), length (4 bytes), network byte
+# order.
+_header = struct.Struct('!4sI')
+_HEADER_SIZE = _header.size
+
+# Maps fixed size DMAP types to Struct objects that pack the header and value
+# together, and to ones that unpack just the value.
+_encoders = dict()
+_decoders = dict()
+for _typ, (_fmt, _size) in fmts.items():
+    if _typ not in (DMAP_TYPE_LIST, DMAP_TYPE_STRING):
+        _encoders[_typ] = struct.Struct('!4sI' + _fmt)
+        _decoders[_typ] = struct.Struct('!' + _fmt)
+
+class DmapContainer(object):
+    """
+       Decoded DMAP_TYPE_LIST value.
+
+       The contents are decoded from the original reply the first time
+       they're accessed.  Until then this just stores offsets into the
+       reply, so skipping over containers you don't care about is cheap.
+
+       Acts like a read-only list of (code, value) tuples.
+    """
+    __slots__ = ('data', 'start', 'end', '_items')
+
+    def __init__(self, data, start, end):
+        self.data = data
+        self.start = start
+        self.end = end
+        self._items = None
+
+    def _get_items(self):
+        if self._items is None:
+            try:
+                self._items = _decode(self.data, self.start, self.end)
+            except (struct.error, KeyError, ValueError):
+                self._items = [(-1, [])]
+            # We don't need the reply anymore
+            self.data = None
+        return self._items
+
+    def __iter__(self):
+        return iter(self._get_items())
+
+    def __len__(self):
+        return len(self._get_items())
+
+    def __getitem__(self, index):
+        return self._get_items()[index]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._get_items())
+
 def find_daap_listitems(listing):
     """find_daap_listitems(listing) -> items
 
@@ -211,6 +399,20 @@ def find_daap_listitems(listing):
     except ValueError:
         return []
 
+def daap_tag_dict(data):
+    """daap_tag_dict(data) -> dict
+
+       Map the tags in one level of a decoded response to their values.  If
+       a tag appears more than once, the first value is used.
+    """
+    tags = dict()
+    try:
+        for tag, value in data:
+            tags.setdefault(tag, value)
+    except (TypeError, ValueError):
+        pass
+    return tags
+
 def find_daap_tag(searchtag, data):
     """find_daap_tag(searchtag, data) -> value
 
@@ -224,7 +426,7 @@ def find_daap_tag(searchtag, data):
         for tag, value in data:
             if searchtag == tag:
                 return value
-            if type(value) == list:
+            if isinstance(value, (list, DmapContainer)):
                 value = find_daap_tag(searchtag, value)
                 if value:
                     return value
@@ -232,6 +434,27 @@ def find_daap_tag(searchtag, data):
     except (RuntimeError, ValueError):
         return None
 
+def _decode(data, offset, end):
+    decoded = []
+    while offset < end:
+        code, size = _header.unpack_from(data, offset)
+        offset += _HEADER_SIZE
+        if offset + size > end:
+            raise ValueError('DMAP entry %r runs past its container' % code)
+        realname, realtype = dmap_consts[code]
+        if realtype == DMAP_TYPE_LIST:
+            value = DmapContainer(data, offset, offset + size)
+        elif realtype == DMAP_TYPE_STRING:
+            value = data[offset:offset + size]
+        else:
+            decoder = _decoders[realtype]
+            if decoder.size != size:
+                raise ValueError
+            (value, ) = decoder.unpack_from(data, offset)
+        decoded.append((code, value))
+        offset += size
+    return decoded
+
 def decode_response(reply):
     """
        decode_response(reply) -> reply
@@ -239,43 +462,49 @@ def decode_response(reply):
        decode_response takes a binary buffer containing the reply, then
        converts to an a Python representation.
 
-       Things in a DMAP_TYPE_LIST container will contain a list with other
-       response codes.
+       Things in a DMAP_TYPE_LIST container will contain a DmapContainer with
+       other response codes.  These are decoded when first accessed.
     """
     # This must be wrapped around a try ... except block in case the other
     # end lies to us about the size of the individual items.
-    decoded = []
     try:
-        while reply:
-            headerfmt = '!4sI'
-            headersize = struct.calcsize(headerfmt)
-            code, size = struct.unpack(headerfmt, reply[:headersize])
-            reply = reply[headersize:]
-            realname, realtype = dmap_consts[code]
-            realfmt, realsize = fmts[realtype]
-            # XXX check size == realsize
-            if realtype == DMAP_TYPE_LIST:
-                decoded.append((code,
-                                decode_response(reply[:size])))
-                # next guy
-                reply = reply[size:]
-                continue
-            if realtype == DMAP_TYPE_STRING:
-                # overwrite the size for string with the size specified
-                # by the server.
-                realfmt = str(size) + realfmt 
-            else:
-                if realsize != size:
-                    raise ValueError
-                realfmt = '!' + realfmt
-            realfmtsize = struct.calcsize(realfmt)
-            (value, ) = struct.unpack(realfmt, reply[:realfmtsize])
-            decoded.append((code, value))
-            reply = reply[realfmtsize:]
-        return decoded
+        return _decode(reply, 0, len(reply))
     except (struct.error, KeyError, ValueError), e:
         return [(-1, [])]
 
+def _encode(reply, parts):
+    # Append the encoded entries in reply to parts and return the number of
+    # bytes added.  Containers get a placeholder that we fill in with the
+    # header once we know how big their contents are.
+    total = 0
+    for code, value in reply:
+        nam, typ = dmap_consts[code]
+        if typ == DMAP_TYPE_LIST:
+            index = len(parts)
+            parts.append(None)
+            size = _encode(value, parts)
+            parts[index] = _header.pack(code, size)
+        elif typ == DMAP_TYPE_STRING:
+            # This ensures we always get a string type even if we are lame
+            # and passed a unicode in.
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            else:
+                value = str(buffer(value))
+            size = len(value)
+            parts.append(_header.pack(code, size))
+            parts.append(value)
+        else:
+            encoder = _encoders[typ]
+            try:
+                parts.append(encoder.pack(code, fmts[typ][1], value))
+            except struct.error:
+                # This pack did not work.  Let's ignore it
+                continue
+            size = fmts[typ][1]
+        total += _HEADER_SIZE + size
+    return total
+
 def encode_response(reply, content_encoding=None):
     """
        encode_response(reply) -> StreamObj/ChunkedStreamObj
@@ -289,37 +518,18 @@ def encode_response(reply, content_encoding=None):
 
        content_encoding: specify content encoding.  Right now we only support
        gzip.
+
+       reply may also be an EncodedReply or ChunkedStreamObj, in which case
+       the data is sent as is.
     """
-    blob = ''
-    subblob = ''
+    if isinstance(reply, EncodedReply):
+        return reply.get_stream(content_encoding)
+    if isinstance(reply, ChunkedStreamObj):
+        return reply
+    parts = []
     try:
-        for code, value in reply:
-            nam, typ = dmap_consts[code]
-            fmt, size = fmts[typ]
-            if typ == DMAP_TYPE_LIST:
-                # list container - override the value and the size.  Set
-                # value to '' to append nothingness but tack on the subblob at 
-                # the end. 
-                subblob = str(encode_response(value))
-                size = len(subblob)
-                value = ''
-            if typ == DMAP_TYPE_STRING:
-                fmt = str(len(value)) + fmt
-                size = len(value)
-                # This ensures we always get a string type even if we are lame
-                # and passed a unicode in.
-                value = str(buffer(value))
-            # code (4 bytes), length (4 bytes), data (variable), network byte
-            # order
-            fmt = '!4sI' + fmt
-            # XXX slow - should bunch up
-            try:
-                blob += struct.pack(fmt, code, size, value)
-            except struct.error:
-                # This pack did not work.  Let's ignore it
-                pass
-            blob += subblob
-        blob = StreamObj(blob, content_encoding=content_encoding)
+        _encode(reply, parts)
+        blob = StreamObj(''.join(parts), content_encoding=content_encoding)
     except ValueError:
         # This is probably a file.  Just pass up to the
         # caller and let the caller deal with it.
@@ -327,6 +537,14 @@ def encode_response(reply, content_encoding=None):
         blob = ChunkedStreamObj(file_obj, hint, start, end)
     return blob
 
+def encode_container(code, data):
+    """
+       encode_container(code, data) -> blob
+
+       Wrap already encoded DMAP data in a DMAP_TYPE_LIST container.
+    """
+    return struct.pack('!4sI', code, len(data)) + data
+
 def split_url_path(urlpath):
     """
        split_url_path(urlpath) -> path, dict
@@ -37,7 +37,9 @@ This class also defines the base Exception classes used by httpclient.
 
 """
 
+from collections import deque
 import errno
+from itertools import islice
 import logging
 import socket
 
@@ -117,38 +119,93 @@ class NetworkBuffer(object):
     """Responsible for storing incomming network data and doing some basic
     parsing of it.  I think this is about as fast as we can do things in pure
     python, someday we may want to make it C...
+
+    Data is stored as a deque of the strings passed to addData().  Rather
+    than slicing the first chunk after every read, we keep an offset into it,
+    so reads only copy the data they return.
     """
     def __init__(self):
-        self.chunks = []
+        self.chunks = deque()
+        # how much of chunks[0] has already been read
+        self.offset = 0
         self.length = 0
+        self._reset_readline_scan()
+
+    def _reset_readline_scan(self):
+        # readline() remembers how far it searched for a newline, so that
+        # calling it repeatedly while a long line trickles in doesn't search
+        # the same data over and over.
+        self._scanned_chunks = 0
+        self._scanned_length = 0
 
     def addData(self, data):
-        self.chunks.append(data)
-        self.length += len(data)
+        if data:
+            self.chunks.append(data)
+            self.length += len(data)
 
     def _mergeChunks(self):
-        self.chunks = [''.join(self.chunks)]
+        if len(self.chunks) == 1 and self.offset == 0:
+            return
+        if self.offset:
+            self.chunks[0] = self.chunks[0][self.offset:]
+            self.offset = 0
+        self.chunks = deque([''.join(self.chunks)])
+        self._reset_readline_scan()
 
     def has_data(self):
         return self.length > 0
 
     def discard_data(self):
-        self.chunks = []
+        self.chunks = deque()
+        self.offset = 0
         self.length = 0
+        self._reset_readline_scan()
+
+    def _take(self, size):
+        """Remove size bytes from the front of the buffer and return them.
+
+        size must not be larger than length.
+        """
+        chunks = self.chunks
+        first = chunks[0]
+        end = self.offset + size
+        if end <= len(first):
+            # fast path: all the data comes from the first chunk.  Note that
+            # if we're reading an entire chunk, slicing it doesn't copy.
+            rv = first[self.offset:end]
+            if end == len(first):
+                chunks.popleft()
+                self.offset = 0
+            else:
+                self.offset = end
+        else:
+            parts = [first[self.offset:]]
+            chunks.popleft()
+            self.offset = 0
+            remaining = size - len(parts[0])
+            while remaining > 0:
+                chunk = chunks[0]
+                if len(chunk) <= remaining:
+                    parts.append(chunks.popleft())
+                    remaining -= len(chunk)
+                else:
+                    parts.append(chunk[:remaining])
+                    self.offset = remaining
+                    remaining = 0
+            rv = ''.join(parts)
+        self.length -= size
+        self._reset_readline_scan()
+        return rv
 
     def read(self, size=None):
         """Read at most size bytes from the data that has been added to the
         buffer.  """
 
-        self._mergeChunks()
-        if size is not None:
-            rv = self.chunks[0][:size]
-            self.chunks[0] = self.chunks[0][len(rv):]
-        else:
-            rv = self.chunks[0]
-            self.chunks = []
-        self.length -= len(rv)
-        return rv
+        if size is None or size > self.length:
+            size = self.length
+        if size <= 0:
+            return ''
+        return self._take(size)
 
     def readline(self):
         """Like a file readline, with several difference:  
@@ -157,28 +214,52 @@ class NetworkBuffer(object):
         * Both "\r\n" and "\n" act as a line ender
         """
 
-        self._mergeChunks()
-        split = self.chunks[0].split("\n", 1)
-        if len(split) == 2:
-            self.chunks[0] = split[1]
-            self.length = len(self.chunks[0])
-            if split[0].endswith("\r"):
-                return split[0][:-1]
+        index = self._scanned_chunks
+        line_length = self._scanned_length
+        for chunk in islice(self.chunks, index, None):
+            if index == 0:
+                start = self.offset
             else:
-                return split[0]
-        else:
-            return None
+                start = 0
+            pos = chunk.find("\n", start)
+            if pos >= 0:
+                line = self._take(line_length + pos - start + 1)
+                if line.endswith("\r\n"):
+                    return line[:-2]
+                else:
+                    return line[:-1]
+            line_length += len(chunk) - start
+            index += 1
+        self._scanned_chunks = index
+        self._scanned_length = line_length
+        return None
 
     def unread(self, data):
         """Put back read data.  This make is like the data was never read at
         all.
         """
-        self.chunks.insert(0, data)
-        self.length += len(data)
+        if not data:
+            return
+        size = len(data)
+        if (self.offset >= size and
+                self.chunks[0].startswith(data, self.offset - size)):
+            # data was just read from the first chunk, just move our offset
+            # back
+            self.offset -= size
+        else:
+            if self.offset:
+                self.chunks[0] = self.chunks[0][self.offset:]
+                self.offset = 0
+            self.chunks.appendleft(data)
+        self.length += size
+        self._reset_readline_scan()
 
     def getValue(self):
         self._mergeChunks()
-        return self.chunks[0]
+        if self.chunks:
+            return self.chunks[0]
+        else:
+            return ''
 
 class _Packet(object):
     """A packet of data for the AsyncSocket class
@@ -0,0 +1,221 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.perfstats`` -- Timing statistics for SQL and eventloop callbacks.
+
+Collecting stats is off by default.  Call enable() to start.  When enabled,
+we keep a count, the total time and a histogram of timings for:
+
+- each SQL statement shape that LiveStorage runs.  Literal numbers and
+  strings are replaced with "?", and IN lists are collapsed, so that
+  statements that only differ in their values are counted together.
+- each idle and timeout callback that the eventloop dispatches.
+
+Memory use is bounded: histograms use a fixed set of buckets, and once
+MAX_KEYS keys have been seen for a category, new keys get lumped together
+under OTHER_KEY.
+
+Use snapshot() or write_snapshot() to get the results as JSON.
+"""
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import re
+import time
+
+# Set by enable()/disable().  Callers check this before doing any work, so
+# that the overhead is a single attribute lookup when we're disabled.
+enabled = False
+
+# Upper bounds, in seconds, for the histogram buckets.  The final bucket
+# catches everything slower than the last bound.
+BUCKET_BOUNDS = tuple(0.00001 * (2 ** i) for i in xrange(24))
+
+MAX_KEYS = 1000
+OTHER_KEY = '<other>'
+
+class Histogram(object):
+    """Fixed-size timing histogram."""
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        # BUCKET_BOUNDS doubles each time, so a linear scan from the start
+        # finishes quickly for the fast timings that make up most samples.
+        index = 0
+        for bound in BUCKET_BOUNDS:
+            if seconds <= bound:
+                break
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """Estimate a percentile.
+
+        :returns: the upper bound of the bucket that contains the
+            percentile, or the max time for the last bucket.
+        """
+        if self.count == 0:
+            return 0.0
+        target = self.count * percent / 100.0
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= target and bucket_count > 0:
+                if index < len(BUCKET_BOUNDS):
+                    return min(BUCKET_BOUNDS[index], self.max)
+                break
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+class TimingStats(object):
+    """Histograms for a category of timings, keyed by name."""
+    def __init__(self, max_keys=MAX_KEYS):
+        self.max_keys = max_keys
+        self.histograms = {}
+
+    def record(self, key, seconds):
+        try:
+            histogram = self.histograms[key]
+        except KeyError:
+            if len(self.histograms) >= self.max_keys:
+                key = OTHER_KEY
+            histogram = self.histograms.setdefault(key, Histogram())
+        histogram.add(seconds)
+
+    def reset(self):
+        self.histograms = {}
+
+    def to_dict(self):
+        return dict((key, histogram.to_dict())
+                    for key, histogram in self.histograms.iteritems())
+
+_whitespace_re = re.compile(r'\s+')
+_string_literal_re = re.compile(r"'(?:[^']|'')*'")
+_number_literal_re = re.compile(r'\b\d+(?:\.\d+)?\b')
+_in_list_re = re.compile(r'IN \((?:\?, ?)*\?\)', re.IGNORECASE)
+_address_re = re.compile(r'0x[0-9a-fA-F]+')
+
+# Maps raw SQL to its statement shape.  Most statements are run over and
+# over, so this saves us from running the regexes each time.
+_shape_cache = {}
+
+def statement_shape(sql):
+    """Get the shape of an SQL statement.
+
+    Literal values are replaced with "?" and IN lists are collapsed.
+    """
+    try:
+        return _shape_cache[sql]
+    except KeyError:
+        pass
+    shape = _whitespace_re.sub(' ', sql).strip()
+    shape = _string_literal_re.sub('?', shape)
+    shape = _number_literal_re.sub('?', shape)
+    shape = _in_list_re.sub('IN (...)', shape)
+    if len(_shape_cache) >= MAX_KEYS:
+        _shape_cache.clear()
+    _shape_cache[sql] = shape
+    return shape
+
+def callback_shape(name):
+    """Get the key to use for an eventloop callback name.
+
+    Object addresses are replaced, so that callbacks for different objects
+    are counted together.
+    """
+    return _address_re.sub('0x?', name)
+
+sql_stats = TimingStats()
+callback_stats = TimingStats()
+_enabled_at = None
+
+def enable():
+    global enabled, _enabled_at
+    if not enabled:
+        enabled = True
+        _enabled_at = time.time()
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    global _enabled_at
+    sql_stats.reset()
+    callback_stats.reset()
+    _shape_cache.clear()
+    if enabled:
+        _enabled_at = time.time()
+
+def record_sql(sql, seconds):
+    sql_stats.record(statement_shape(sql), seconds)
+
+def record_callback(name, seconds):
+    callback_stats.record(callback_shape(name), seconds)
+
+def snapshot():
+    """Get the current stats.
+
+    :returns: dict that can be converted to JSON
+    """
+    return {
+        'enabled': enabled,
+        'enabled_at': _enabled_at,
+        'snapshot_time': time.time(),
+        'sql': sql_stats.to_dict(),
+        'callbacks': callback_stats.to_dict(),
+    }
+
+def write_snapshot(path):
+    """Write the current stats to path as JSON."""
+    f = open(path, 'w')
+    try:
+        json.dump(snapshot(), f, indent=2, sort_keys=True)
+    finally:
+        f.close()
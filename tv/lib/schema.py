@@ -373,6 +373,7 @@ from miro.feed import (Feed, FeedImpl, RSSFeedImpl, SavedSearchFeedImpl,
 from miro.feed import (SearchFeedImpl, DirectoryWatchFeedImpl,
                        DirectoryFeedImpl, SearchDownloadsFeedImpl)
 from miro.feed import ManualFeedImpl
+from miro.feedupdate import FeedUpdateState
 from miro.folder import (HideableTab, ChannelFolder, PlaylistFolder,
                          PlaylistFolderItemMap)
 from miro.guide import ChannelGuide
@@ -444,6 +445,7 @@ class ItemSchema(MultiClassObjectSchema):
         ('channel_title', SchemaString(noneOk=True)),
         ('license', SchemaString(noneOk=True)),
         ('rss_id', SchemaString(noneOk=True)),
+        ('entry_digest', SchemaString(noneOk=True)),
         ('thumbnail_url', SchemaURL(noneOk=True)),
         ('entry_title', SchemaString(noneOk=True)),
         ('torrent_title', SchemaString(noneOk=True)),
@@ -493,6 +495,9 @@ class ItemSchema(MultiClassObjectSchema):
             ('item_feed_downloader', ('feed_id', 'downloader_id',)),
             ('item_file_type', ('file_type',)),
             ('item_filename', ('filename',)),
+            ('item_feed_rss_id', ('feed_id', 'rss_id')),
+            ('item_feed_url_title', ('feed_id', 'url', 'entry_title')),
+            ('item_feed_entry_digest', ('feed_id', 'entry_digest')),
     )
 
 class DeviceItemSchema(ObjectSchema):
@@ -653,8 +658,27 @@ class RSSFeedImplSchema(FeedImplSchema):
         ('initialHTML', SchemaBinary(noneOk=True)),
         ('etag', SchemaString(noneOk=True)),
         ('modified', SchemaString(noneOk=True)),
+        ('body_digest', SchemaString(noneOk=True)),
+        ('link', SchemaString(noneOk=True)),
+        ('license', SchemaString(noneOk=True)),
+    ]
+
+class FeedUpdateStateSchema(DDBObjectSchema):
+    klass = FeedUpdateState
+    table_name = 'feed_update_state'
+    fields = DDBObjectSchema.fields + [
+        ('feed_id', SchemaInt()),
+        ('last_update', SchemaFloat(noneOk=True)),
+        ('last_change', SchemaFloat(noneOk=True)),
+        ('change_interval', SchemaFloat(noneOk=True)),
+        ('unchanged_count', SchemaInt()),
+        ('error_count', SchemaInt()),
     ]
 
+    indexes = (
+        ('feed_update_state_feed', ('feed_id',)),
+    )
+
 class SavedSearchFeedImplSchema(FeedImplSchema):
     klass = SavedSearchFeedImpl
     table_name = 'saved_search_feed_impl'
@@ -998,12 +1022,12 @@ class MetadataEntrySchema(DDBObjectSchema):
         ('metadata_entry_status_and_source', ('status_id', 'source')),
     )
 
-VERSION = 197
+VERSION = 200
 
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
     FeedImplSchema, RSSFeedImplSchema, SavedSearchFeedImplSchema,
-    ScraperFeedImplSchema,
+    ScraperFeedImplSchema, FeedUpdateStateSchema,
     SearchFeedImplSchema, DirectoryFeedImplSchema, DirectoryWatchFeedImplSchema,
     SearchDownloadsFeedImplSchema, RemoteDownloaderSchema,
     ChannelGuideSchema, ManualFeedImplSchema,
@@ -26,6 +26,7 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import bisect
 import errno
 import logging
 import os
@@ -33,6 +34,7 @@ import sys
 import socket
 import select
 import struct
+import tempfile
 import threading
 import time
 import traceback
@@ -1048,10 +1050,17 @@ class _SharedDataSet(object):
         # condition gets signaled when changes occur.
         self.lock = threading.RLock()
         self.condition = threading.Condition(self.lock)
-        # current revision number
-        self.revision = 0
+        # callbacks from wait_for_revision() to call on the next change
+        self.revision_waiters = []
+        # current revision number.  Start at 1, DAAP clients ask for a delta
+        # of 0 when they want everything.
+        self.revision = 1
         # map DAAP ids to dicts of item data
         self.daap_items = dict()
+        # (revision, DAAP id) tuples for each change to daap_items, in
+        # revision order.  Used to find the items that changed since a
+        # client's revision without going through all of them.
+        self.item_changes = []
         # map DAAP ids to dicts of playlist data
         self.daap_playlists = dict()
         # map DAAP playlist ids to sets of items in that playlist
@@ -1165,8 +1174,8 @@ class _SharedDataSet(object):
             for item_info in added + changed:
                 self.make_daap_item(item_info)
             for item_id in removed:
-                self.daap_items[item_id] = self._deleted_item(item_id)
-            self.condition.notify_all()
+                self._set_daap_item(item_id, self._deleted_item(item_id))
+            self.revision_changed()
 
     def on_playlist_added(self, tracker, playlist_or_feed):
         self.playlists_changed.add(playlist_or_feed)
@@ -1188,18 +1197,26 @@ class _SharedDataSet(object):
                 self.daap_playlists[obj.id] = self._deleted_item(obj.id)
             self.playlists_changed = set()
             self.playlists_removed = set()
-            self.condition.notify_all()
+            self.revision_changed()
 
     def on_item_changes(self, tracker, message):
-        if 'feed_id' in message.changed_columns:
-            # items have changed feeds, regenerate the item lists
-            for feed in models.Feed.visible_view():
-                self.make_daap_playlist(feed)
-        if message.playlists_changed:
-            # items have been added/removed from playlists,
-            # regenerate the item lists
-            for playlist in models.SavedPlaylist.make_view():
-                self.make_daap_playlist(playlist)
+        feeds_changed = 'feed_id' in message.changed_columns
+        if not (feeds_changed or message.playlists_changed):
+            return
+        with self.lock:
+            # playlist contents are changing, so clients need a new revision
+            # to refetch them
+            self.revision += 1
+            if feeds_changed:
+                # items have changed feeds, regenerate the item lists
+                for feed in models.Feed.visible_view():
+                    self.make_daap_playlist(feed)
+            if message.playlists_changed:
+                # items have been added/removed from playlists,
+                # regenerate the item lists
+                for playlist in models.SavedPlaylist.make_view():
+                    self.make_daap_playlist(playlist)
+            self.revision_changed()
 
     def _make_item_tracker_query(self):
         query = itemtrack.ItemTrackerQuery()
@@ -1269,7 +1286,17 @@ class _SharedDataSet(object):
             if isinstance(value, unicode):
                 daap_item[key] = value.encode('utf-8')
         # store the data
-        self.daap_items[item_info.id] = daap_item
+        self._set_daap_item(item_info.id, daap_item)
+
+    def _set_daap_item(self, item_id, daap_item):
+        self.daap_items[item_id] = daap_item
+        self.item_changes.append((daap_item['revision'], item_id))
+        # Every item is in daap_items exactly once, so once the change list
+        # gets much bigger than that, most of it is stale.  Rebuild it.
+        if len(self.item_changes) > 2 * len(self.daap_items) + 1000:
+            self.item_changes = sorted((data['revision'], id_)
+                                       for id_, data
+                                       in self.daap_items.iteritems())
 
     # XXX TEMPORARY: should this item be podcast?  We won't need this when
     # the item type's metadata is completely accurate and won't lie to us.
@@ -1393,14 +1420,16 @@ class _SharedDataSet(object):
                 if changed.intersection([self.SHARE_AUDIO, self.SHARE_VIDEO]):
                     query = self._make_item_tracker_query()
                     self.item_tracker.change_query(query)
-                self.condition.notify_all()
+                self.revision_changed()
 
     def get_item(self, item_id):
         with self.lock:
             return self.daap_items[item_id]
 
-    def get_items(self, playlist_id):
+    def get_items(self, playlist_id, since=0):
         with self.lock:
+            if since:
+                return self._get_items_since(playlist_id, since)
             if playlist_id is None:
                 return self.daap_items.copy()
             else:
@@ -1412,10 +1441,50 @@ class _SharedDataSet(object):
                         logging.warn("Error looking up DAAP item: %s", id_)
                 return items_dict
 
+    def _get_items_since(self, playlist_id, since):
+        if playlist_id is not None:
+            playlist_items = self.playlist_item_map[playlist_id]
+        # (since + 1,) sorts before any change with a revision of since + 1
+        start = bisect.bisect_left(self.item_changes, (since + 1,))
+        items_dict = dict()
+        for revision, id_ in self.item_changes[start:]:
+            if playlist_id is not None and id_ not in playlist_items:
+                continue
+            daap_item = self.daap_items[id_]
+            # skip stale entries for items that changed again
+            if daap_item['revision'] == revision:
+                items_dict[id_] = daap_item
+        return items_dict
+
+    def get_current_revision(self):
+        with self.lock:
+            return self.revision
+
     def get_playlists(self):
         with self.lock:
             return self.daap_playlists.copy()
 
+    def revision_changed(self):
+        """Wake up everybody waiting for a new revision.
+
+        Call this with our lock held, after incrementing revision.
+        """
+        self.condition.notify_all()
+        waiters = self.revision_waiters
+        self.revision_waiters = []
+        for callback in waiters:
+            try:
+                callback(self.revision)
+            except StandardError:
+                logging.exception("Error in revision callback")
+
+    def wait_for_revision(self, old_revision, callback):
+        with self.lock:
+            if self.revision != old_revision:
+                callback(self.revision)
+            else:
+                self.revision_waiters.append(callback)
+
     def get_revision(self, old_revision, request_socket):
         with self.lock:
             while self.revision == old_revision:
@@ -1447,7 +1516,10 @@ class SharingManagerBackend(object):
     def __init__(self):
         self.data_set = _SharedDataSet()
         self.transcode_lock = threading.Lock()
+        # maps sessions to (generation, TranscodeObject) tuples
         self.transcode = dict()
+        # created on the first transcode request
+        self.segment_cache = None
         self.in_shutdown = False
 
     # Reserved for future use: you can register new sharing protocols here.
@@ -1475,6 +1547,17 @@ class SharingManagerBackend(object):
         """
         return self.data_set.get_revision(old_revision, request)
 
+    def wait_for_revision(self, old_revision, callback):
+        """Call callback once there is a newer revision than old_revision.
+
+        This is the non-blocking version of get_revision().  callback gets
+        called with the new revision, either right away or from whatever
+        thread changes the revision, so it should return quickly.  There's
+        no way to cancel the wait; callbacks for clients that have gone
+        away just get dropped at the next change.
+        """
+        self.data_set.wait_for_revision(old_revision, callback)
+
     def get_file(self, itemid, generation, ext, session, request_path_func,
                  offset=0, chunk=None):
         """Get a file to serve
@@ -1493,56 +1576,26 @@ class SharingManagerBackend(object):
         if ext in ('ts', 'm3u8'):
             # If we are requesting a playlist, this basically means that
             # transcode is required.
-            old_transcode_obj = None
-            need_create = False
-            with self.transcode_lock:
-                if self.in_shutdown:
-                    return no_file
-                try:
-                    transcode_obj = self.transcode[session]
-                    if transcode_obj.itemid != itemid:
-                        need_create = True
-                        old_transcode_obj = transcode_obj
-                    else:
-                        # This request has already been satisfied by a more
-                        # recent request.  Bye ...
-                        if generation < transcode_obj.generation:
-                            logging.debug('item %s transcode out of order',
-                                          itemid)
-                            return no_file
-                        if chunk is not None and transcode_obj.isseek(chunk):
-                            need_create = True
-                            old_transcode_obj = transcode_obj
-                except KeyError:
-                    need_create = True
-                if need_create:
-                    yes, info = transcode.needs_transcode(path)
-                    transcode_obj = transcode.TranscodeObject(
-                                                          path,
-                                                          itemid,
-                                                          generation,
-                                                          chunk,
-                                                          info,
-                                                          request_path_func)
-                self.transcode[session] = transcode_obj
-
-            # If there was an old object, shut it down.  Do it outside the
-            # loop so that we don't hold onto the transcode lock for excessive
-            # time
-            if old_transcode_obj:
-                old_transcode_obj.shutdown()
-            if need_create:
-                transcode_obj.transcode()
-
+            if chunk is None:
+                chunk = 0
+            try:
+                stream = transcode.segment_stream_key(path)
+            except OSError, e:
+                logging.warning('error: transcode stat failed: %s', e)
+                return no_file
             if ext == 'm3u8':
-                file_obj = transcode_obj.get_playlist()
+                file_obj = self.get_playlist(session, itemid, generation,
+                                             path, stream, chunk,
+                                             request_path_func)
+                if not file_obj:
+                    return no_file
                 file_obj.seek(offset, os.SEEK_SET)
-            elif ext == 'ts':
-                file_obj = transcode_obj.get_chunk()
             else:
-                # Should this be a ValueError instead?  But returning -1
-                # will make the caller return 404.
-                logging.warning('error: transcode should be one of ts or m3u8')
+                file_obj = self.get_segment(session, itemid, generation,
+                                            path, stream, chunk,
+                                            request_path_func)
+                if not file_obj:
+                    return no_file
         elif ext == 'coverart':
             try:
                 cover_art = daapitem['cover_art']
@@ -1554,10 +1607,7 @@ class SharingManagerBackend(object):
                     file_obj.close()
         else:
             # If there is an outstanding job delete it first.
-            try:
-                del self.transcode[session]
-            except KeyError:
-                pass
+            self.release_transcode(session)
             try:
                 file_obj = open(path, 'rb')
                 file_obj.seek(offset, os.SEEK_SET)
@@ -1566,6 +1616,150 @@ class SharingManagerBackend(object):
                     file_obj.close()
         return file_obj, os.path.basename(path)
 
+    def get_segment_cache(self):
+        with self.transcode_lock:
+            if self.segment_cache is None:
+                directory = os.path.join(
+                    app.config.get(prefs.SUPPORT_DIRECTORY),
+                    'transcode-cache')
+                self.segment_cache = transcode.SegmentCache(directory)
+            return self.segment_cache
+
+    def get_playlist(self, session, itemid, generation, path, stream, chunk,
+                     request_path_func):
+        """Get the m3u8 playlist for a transcode.
+
+        :returns: file object, or None if the request is out of date
+        """
+        file_obj = self.get_segment_cache().open_segment(stream, chunk)
+        if file_obj is None:
+            # Get a transcode going, so the first chunk is ready by the
+            # time the client asks for it.
+            transcode_obj, created = self.get_transcode(session, itemid,
+                    generation, path, stream, chunk, request_path_func)
+            if not transcode_obj:
+                return None
+            return transcode_obj.get_playlist()
+        file_obj.close()
+        yes, info = transcode.needs_transcode(path)
+        return transcode.playlist_file(transcode.create_playlist(itemid,
+                info[0], request_path_func))
+
+    def get_segment(self, session, itemid, generation, path, stream, chunk,
+                    request_path_func):
+        """Get a transcoded segment for session.
+
+        :returns: file object, or None if the request is out of date
+        """
+        segment_cache = self.get_segment_cache()
+        file_obj = segment_cache.open_segment(stream, chunk)
+        if file_obj is not None:
+            # Let the session's transcode keep running ahead of the client
+            with self.transcode_lock:
+                try:
+                    transcode_obj = self.transcode[session][1]
+                except KeyError:
+                    pass
+                else:
+                    if transcode_obj.stream == stream:
+                        transcode_obj.request_chunk(chunk)
+            return file_obj
+        while True:
+            transcode_obj, created = self.get_transcode(session, itemid,
+                    generation, path, stream, chunk, request_path_func)
+            if not transcode_obj:
+                return None
+            file_obj = transcode_obj.get_chunk(chunk)
+            if file_obj is not None:
+                return file_obj
+            if created:
+                # The transcode ended before our chunk, so we estimated the
+                # number of chunks wrong.  Send an empty file.
+                return tempfile.TemporaryFile()
+            # The transcode that we waited on went away without producing
+            # the chunk, start a new one.
+
+    def get_transcode(self, session, itemid, generation, path, stream, chunk,
+                      request_path_func):
+        """Get a TranscodeObject that will produce chunk for session.
+
+        If a TranscodeObject for any session is about to produce chunk, we
+        share that one.  Otherwise we start a new one.  The previous
+        TranscodeObject for session gets shut down if nobody else is using
+        it.
+
+        :returns: (transcode_obj, created) tuple.  transcode_obj is None if
+        the request is out of date or we're shutting down.
+        """
+        segment_cache = self.get_segment_cache()
+        created = False
+        with self.transcode_lock:
+            if self.in_shutdown:
+                return None, False
+            try:
+                old_generation, old_transcode_obj = self.transcode[session]
+            except KeyError:
+                old_transcode_obj = None
+            else:
+                # This request has already been satisfied by a more
+                # recent request.  Bye ...
+                if (old_transcode_obj.itemid == itemid and
+                  generation < old_generation):
+                    logging.debug('item %s transcode out of order', itemid)
+                    return None, False
+            transcode_obj = segment_cache.find_producer(stream, chunk)
+            if transcode_obj is None:
+                yes, info = transcode.needs_transcode(path)
+                transcode_obj = transcode.TranscodeObject(path,
+                                                          itemid,
+                                                          generation,
+                                                          chunk,
+                                                          info,
+                                                          request_path_func,
+                                                          segment_cache,
+                                                          stream)
+                segment_cache.add_producer(transcode_obj)
+                created = True
+            if transcode_obj is not old_transcode_obj:
+                transcode_obj.users += 1
+                old_transcode_obj = self._release_transcode_obj(
+                    old_transcode_obj)
+            else:
+                old_transcode_obj = None
+            self.transcode[session] = (generation, transcode_obj)
+
+        # If there was an old object, shut it down.  Do it outside the
+        # loop so that we don't hold onto the transcode lock for excessive
+        # time
+        if old_transcode_obj:
+            old_transcode_obj.shutdown()
+        if created:
+            transcode_obj.transcode()
+        return transcode_obj, created
+
+    def _release_transcode_obj(self, transcode_obj):
+        # Stop using transcode_obj.  If nobody else is using it, stop anyone
+        # else from finding it and return it so the caller can shut it down.
+        # Call this with transcode_lock held.
+        if transcode_obj is None:
+            return None
+        transcode_obj.users -= 1
+        if transcode_obj.users > 0:
+            return None
+        self.segment_cache.remove_producer(transcode_obj)
+        return transcode_obj
+
+    def release_transcode(self, session):
+        """Stop transcoding for session."""
+        with self.transcode_lock:
+            try:
+                generation, transcode_obj = self.transcode.pop(session)
+            except KeyError:
+                return
+            transcode_obj = self._release_transcode_obj(transcode_obj)
+        if transcode_obj:
+            transcode_obj.shutdown()
+
     def get_playlists(self):
         """Get the current list of playlists
 
@@ -1582,7 +1776,7 @@ class SharingManagerBackend(object):
         """
         return self.data_set.get_playlists()
 
-    def get_items(self, playlist_id=None):
+    def get_items(self, playlist_id=None, since=0):
         """Get the current list of items
 
         This should return a dict mapping DAAP item ids to dicts of item data.
@@ -1595,19 +1789,25 @@ class SharingManagerBackend(object):
 
         :param playlist_id: playlist to fetch items from, or None to fetch all
         items.
+        :param since: if non-zero, only return items that have changed after
+        this revision.
+        """
+        return self.data_set.get_items(playlist_id, since)
+
+    def get_current_revision(self):
+        """Get the current revision number without blocking.
+
+        Item listings for the same revision are the same, so libdaap uses
+        this to cache them.
         """
-        return self.data_set.get_items(playlist_id)
+        return self.data_set.get_current_revision()
 
     def finished_callback(self, session):
         # Like shutdown but only shuts down one of the sessions.  No need to
         # set shutdown.   XXX - could race - if we terminate control connection
         # and and reach here, before a transcode job arrives.  Then the
         # transcode job gets created anyway.
-        with self.transcode_lock:
-            try:
-                self.transcode[session].shutdown()
-            except KeyError:
-                pass
+        self.release_transcode(session)
 
     def shutdown(self):
         # Set the in_shutdown flag inside the transcode lock to ensure that
@@ -1615,8 +1815,11 @@ class SharingManagerBackend(object):
         # waste time creating any more objects after this flag is set.
         with self.transcode_lock:
             self.in_shutdown = True
-            for key in self.transcode.keys():
-                self.transcode[key].shutdown()
+            transcode_objs = set(transcode_obj for generation, transcode_obj
+                                 in self.transcode.values())
+            self.transcode = dict()
+            for transcode_obj in transcode_objs:
+                transcode_obj.shutdown()
 
 class SharingManager(object):
     """SharingManager is the sharing server.  It publishes Miro media items
@@ -1850,6 +2053,9 @@ class SharingManager(object):
                         cmd = self.r.recv(4)
                         logging.debug('sharing: CMD %s' % cmd)
                         if cmd == SharingManager.CMD_QUIT:
+                            # close the listening socket and break off
+                            # existing connections
+                            self.server.server_close()
                             del self.thread
                             del self.server
                             self.reload_done_event.set()
@@ -1896,7 +2102,7 @@ class SharingManager(object):
 
         name = app.config.get(prefs.SHARE_NAME).encode('utf-8')
         self.server = libdaap.make_daap_server(self.backend, debug=True,
-                                               name=name)
+                                               name=name, pooled=True)
         if not self.server:
             self.sharing = False
             return
@@ -1935,7 +2141,6 @@ class SharingManager(object):
         if self.sharing:
             if self.discoverable:
                 self.disable_discover()
-            # XXX: need to break off existing connections
             self.disable_sharing()
         self.backend.shutdown()
 
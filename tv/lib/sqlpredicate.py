@@ -0,0 +1,448 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.sqlpredicate`` -- Evaluate simple SQL WHERE clauses in python.
+
+ViewTracker needs to know if a single object is in its view every time
+that object changes.  Asking SQLite means a ``SELECT COUNT(*)`` query for
+each tracker on each change.  For the simple WHERE clauses that most
+views use, we can get the same answer by looking at the attributes of the
+already-loaded DDBObject.
+
+This module compiles a WHERE clause into a python callable.  It
+understands a small subset of the SQLite grammar:
+
+- column references (optionally qualified with the table name)
+- ``?`` parameters, string/number literals and ``NULL``
+- ``=``, ``==``, ``!=``, ``<>``, ``<``, ``<=``, ``>``, ``>=``
+- ``IS [NOT] NULL``, ``[NOT] IN (...)``, ``[NOT] LIKE``
+- ``AND``, ``OR``, ``NOT`` and parentheses
+
+Evaluation follows SQL's 3-valued logic, where None stands for NULL.
+Anything else (joins, sub-selects, functions, comparisons that would
+depend on SQLite's type affinity rules) makes compile_where() raise
+UnsupportedExpression so that the caller can fall back to SQL.
+"""
+
+import re
+
+from miro import schema
+
+class UnsupportedExpression(ValueError):
+    """Raised when a WHERE clause can't be evaluated in python."""
+    pass
+
+# column types that we know how to compare in python.  Other columns can
+# only be used with IS NULL/IS NOT NULL.
+_NUMERIC_TYPES = (schema.SchemaBool, schema.SchemaInt, schema.SchemaFloat)
+_TEXT_TYPES = (schema.SchemaString, schema.SchemaURL, schema.SchemaFilename)
+
+NUMERIC = 'numeric'
+TEXT = 'text'
+OTHER = 'other'
+
+_token_re = re.compile(r"""
+    \s*(?:
+    (?P<string>'(?:[^']|'')*') |
+    (?P<number>\d+(?:\.\d+)?) |
+    (?P<name>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)?) |
+    (?P<op>==|!=|<>|<=|>=|=|<|>|\(|\)|,|\?)
+    )""", re.VERBOSE)
+
+_KEYWORDS = frozenset(['and', 'or', 'not', 'is', 'null', 'in', 'like'])
+
+def _tokenize(where):
+    tokens = []
+    pos = 0
+    where = where.rstrip()
+    while pos < len(where):
+        m = _token_re.match(where, pos)
+        if m is None:
+            raise UnsupportedExpression("can't parse %r at %d" % (where, pos))
+        pos = m.end()
+        kind = m.lastgroup
+        text = m.group(kind)
+        if kind == 'string':
+            tokens.append(('const', text[1:-1].replace("''", "'")))
+        elif kind == 'number':
+            if '.' in text:
+                tokens.append(('const', float(text)))
+            else:
+                tokens.append(('const', int(text)))
+        elif kind == 'name' and text.lower() in _KEYWORDS:
+            tokens.append(('keyword', text.lower()))
+        else:
+            tokens.append((kind, text))
+    return tokens
+
+def _category_for_value(value):
+    if value is None:
+        return None
+    elif isinstance(value, (bool, int, long, float)):
+        return NUMERIC
+    elif isinstance(value, basestring):
+        return TEXT
+    else:
+        return OTHER
+
+def _to_text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+class _Operand(object):
+    """Value used in an expression.
+
+    :attr category: NUMERIC, TEXT, OTHER or None for a NULL constant
+    :attr constant: True if the value doesn't depend on the object
+    :attr getter: callable that returns the value for an object
+    """
+    def __init__(self, category, getter, constant=False, value=None):
+        self.category = category
+        self.getter = getter
+        self.constant = constant
+        self.value = value
+
+def _const_operand(value):
+    category = _category_for_value(value)
+    if category == OTHER:
+        raise UnsupportedExpression("can't handle parameter: %r" % value)
+    if category == TEXT:
+        value = _to_text(value)
+    return _Operand(category, lambda obj: value, True, value)
+
+def _check_comparable(left, right):
+    """Make sure that comparing left and right doesn't depend on SQLite's
+    type affinity rules.
+    """
+    if left.category is None or right.category is None:
+        return
+    if (left.category != right.category or left.category == OTHER):
+        raise UnsupportedExpression("can't compare %s to %s" %
+                                    (left.category, right.category))
+
+def _truth(operand):
+    """Convert an operand to a boolean expression."""
+    if operand.category == NUMERIC:
+        getter = operand.getter
+        def truth(obj):
+            value = getter(obj)
+            if value is None:
+                return None
+            return value != 0
+        return truth
+    elif operand.category is None:
+        return lambda obj: None
+    elif operand.category == 'boolean':
+        return operand.getter
+    else:
+        raise UnsupportedExpression("can't use %s value as a boolean" %
+                                    operand.category)
+
+def _boolean_operand(func):
+    return _Operand('boolean', func)
+
+_comparisons = {
+    '=': lambda a, b: a == b,
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+def _like_regex(pattern):
+    parts = []
+    for char in pattern:
+        if char == '%':
+            parts.append('.*')
+        elif char == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+    # SQLite's LIKE is case-insensitive for ASCII characters only, so we
+    # can't use re.IGNORECASE for unicode strings.
+    return re.compile(''.join(parts) + r'\Z', re.DOTALL)
+
+def _like_lower(text):
+    return re.sub('[A-Z]+', lambda m: m.group(0).lower(), text)
+
+class _Parser(object):
+    def __init__(self, where, values, table_name, columns):
+        self.tokens = _tokenize(where)
+        self.pos = 0
+        self.values = list(values)
+        self.value_pos = 0
+        self.table_name = table_name
+        self.columns = columns
+
+    def parse(self):
+        expr = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise UnsupportedExpression("extra tokens: %s" %
+                                        (self.tokens[self.pos:],))
+        if self.value_pos != len(self.values):
+            raise UnsupportedExpression("wrong number of values")
+        return _truth(expr)
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise UnsupportedExpression("unexpected end of expression")
+        self.pos += 1
+        return token
+
+    def accept(self, kind, text):
+        if self.peek() == (kind, text):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, text):
+        if not self.accept(kind, text):
+            raise UnsupportedExpression("expected %s, got %s" %
+                                        (text, self.peek()))
+
+    def parse_or(self):
+        expr = self.parse_and()
+        while self.accept('keyword', 'or'):
+            left = _truth(expr)
+            right = _truth(self.parse_and())
+            def or_(obj, left=left, right=right):
+                lval = left(obj)
+                if lval:
+                    return True
+                rval = right(obj)
+                if rval:
+                    return True
+                if lval is None or rval is None:
+                    return None
+                return False
+            expr = _boolean_operand(or_)
+        return expr
+
+    def parse_and(self):
+        expr = self.parse_not()
+        while self.accept('keyword', 'and'):
+            left = _truth(expr)
+            right = _truth(self.parse_not())
+            def and_(obj, left=left, right=right):
+                lval = left(obj)
+                if lval is False:
+                    return False
+                rval = right(obj)
+                if rval is False:
+                    return False
+                if lval is None or rval is None:
+                    return None
+                return True
+            expr = _boolean_operand(and_)
+        return expr
+
+    def parse_not(self):
+        if self.accept('keyword', 'not'):
+            inner = _truth(self.parse_not())
+            def not_(obj):
+                value = inner(obj)
+                if value is None:
+                    return None
+                return not value
+            return _boolean_operand(not_)
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_operand()
+        kind, text = self.peek()
+        if kind == 'op' and text in _comparisons:
+            self.next()
+            right = self.parse_operand()
+            return self.make_comparison(left, right, _comparisons[text])
+        elif self.accept('keyword', 'is'):
+            negate = self.accept('keyword', 'not')
+            self.expect('keyword', 'null')
+            return self.make_is_null(left, negate)
+        negate = self.accept('keyword', 'not')
+        if self.accept('keyword', 'in'):
+            return self.make_in(left, self.parse_value_list(), negate)
+        elif self.accept('keyword', 'like'):
+            return self.make_like(left, self.parse_operand(), negate)
+        elif negate:
+            raise UnsupportedExpression("NOT must be followed by IN or LIKE")
+        return left
+
+    def parse_value_list(self):
+        self.expect('op', '(')
+        operands = [self.parse_operand()]
+        while self.accept('op', ','):
+            operands.append(self.parse_operand())
+        self.expect('op', ')')
+        for operand in operands:
+            if not operand.constant:
+                raise UnsupportedExpression("IN list must be constant")
+        return operands
+
+    def parse_operand(self):
+        kind, text = self.next()
+        if kind == 'op' and text == '(':
+            expr = self.parse_or()
+            self.expect('op', ')')
+            return expr
+        elif kind == 'op' and text == '?':
+            if self.value_pos >= len(self.values):
+                raise UnsupportedExpression("not enough values")
+            value = self.values[self.value_pos]
+            self.value_pos += 1
+            return _const_operand(value)
+        elif kind == 'const':
+            return _const_operand(text)
+        elif kind == 'keyword' and text == 'null':
+            return _const_operand(None)
+        elif kind == 'name':
+            return self.column_operand(text)
+        else:
+            raise UnsupportedExpression("unexpected token: %r" % text)
+
+    def column_operand(self, name):
+        if '.' in name:
+            table, name = name.split('.')
+            if table.lower() != self.table_name.lower():
+                raise UnsupportedExpression("unknown table: %s" % table)
+        try:
+            category, getter = self.columns[name.lower()]
+        except KeyError:
+            raise UnsupportedExpression("unknown column: %s" % name)
+        return _Operand(category, getter)
+
+    def make_comparison(self, left, right, compare):
+        _check_comparable(left, right)
+        if left.category == 'boolean' or right.category == 'boolean':
+            raise UnsupportedExpression("can't compare boolean expressions")
+        left_getter = left.getter
+        right_getter = right.getter
+        def comparison(obj):
+            lval = left_getter(obj)
+            if lval is None:
+                return None
+            rval = right_getter(obj)
+            if rval is None:
+                return None
+            return compare(lval, rval)
+        return _boolean_operand(comparison)
+
+    def make_is_null(self, operand, negate):
+        if operand.category == 'boolean':
+            raise UnsupportedExpression("IS NULL on boolean expression")
+        getter = operand.getter
+        if negate:
+            return _boolean_operand(lambda obj: getter(obj) is not None)
+        else:
+            return _boolean_operand(lambda obj: getter(obj) is None)
+
+    def make_in(self, operand, value_operands, negate):
+        for value_operand in value_operands:
+            _check_comparable(operand, value_operand)
+        values = frozenset(o.value for o in value_operands
+                           if o.value is not None)
+        has_null = len(values) < len(value_operands)
+        getter = operand.getter
+        def in_(obj):
+            value = getter(obj)
+            if value is None:
+                return None
+            if value in values:
+                result = True
+            elif has_null:
+                return None
+            else:
+                result = False
+            return result != negate
+        return _boolean_operand(in_)
+
+    def make_like(self, operand, pattern, negate):
+        if operand.category != TEXT or not pattern.constant:
+            raise UnsupportedExpression("LIKE only supported for text "
+                                        "columns and constant patterns")
+        if pattern.value is None:
+            return _boolean_operand(lambda obj: None)
+        if pattern.category != TEXT:
+            raise UnsupportedExpression("LIKE pattern must be text")
+        regex = _like_regex(_like_lower(pattern.value))
+        getter = operand.getter
+        def like(obj):
+            value = getter(obj)
+            if value is None:
+                return None
+            return (regex.match(_like_lower(value)) is not None) != negate
+        return _boolean_operand(like)
+
+def _column_getter(name, category, to_sql):
+    if category == TEXT:
+        def getter(obj):
+            return _to_text(to_sql(name, getattr(obj, name)))
+    else:
+        def getter(obj):
+            return to_sql(name, getattr(obj, name))
+    return getter
+
+def compile_where(where, values, table_name, fields, to_sql):
+    """Compile a WHERE clause to a python predicate.
+
+    :param where: WHERE clause to compile, or None to match everything
+    :param values: values for the ? placeholders in where
+    :param table_name: name of the table we are selecting from
+    :param fields: list of (name, schema_item) tuples for the table
+    :param to_sql: function that takes a column name and python value and
+        returns the value that gets stored in the database
+    :returns: function that takes an object and returns True if it matches
+        where
+    :raises UnsupportedExpression: if where can't be evaluated in python
+    """
+    if where is None or not where.strip():
+        if values:
+            raise UnsupportedExpression("values without a WHERE clause")
+        return lambda obj: True
+    columns = {}
+    for name, schema_item in fields:
+        if isinstance(schema_item, _NUMERIC_TYPES):
+            category = NUMERIC
+        elif isinstance(schema_item, _TEXT_TYPES):
+            category = TEXT
+        else:
+            category = OTHER
+        columns[name.lower()] = (category,
+                                 _column_getter(name, category, to_sql))
+    predicate = _Parser(where, values, table_name, columns).parse()
+    return lambda obj: predicate(obj) is True
@@ -65,6 +65,7 @@ from miro import guide
 from miro import httpauth
 from miro import httpclient
 from miro import iconcache
+from miro import inotifywatch
 from miro import item
 from miro import itemsource
 from miro import feed
@@ -223,6 +224,12 @@ def startup():
     logging.info("Starting libCURL thread")
     httpclient.init_libcurl()
     httpclient.start_thread()
+    httpclient.setup_http_cache(os.path.join(
+        app.config.get(prefs.SUPPORT_DIRECTORY), 'http-cache'))
+    if app.directory_watcher is None and inotifywatch.is_available():
+        # the frontend doesn't have its own directory watcher, use inotify
+        logging.info("Using inotify to watch directories")
+        inotifywatch.InotifyDirectoryWatcher.install()
     logging.info("Starting event loop thread")
     eventloop.startup()
     if DEBUG_DB_MEM_USAGE:
@@ -472,6 +479,7 @@ def on_frontend_started():
     item.setup_metadata_manager()
 
     item.setup_change_tracker()
+    feed.setup_feed_counts()
     app.sharing_tracker = sharing.SharingTracker()
     app.sharing_manager.startup()
     app.sharing_tracker.start_tracking()
@@ -72,8 +72,10 @@ from miro import dialogs
 from miro import eventloop
 from miro import fileutil
 from miro import messages
+from miro import perfstats
 from miro import schema
 from miro import signals
+from miro import sqlpredicate
 from miro import prefs
 from miro import util
 from miro.data import fulltextsearch
@@ -432,7 +434,6 @@ class LiveStorage(signals.SignalEmitter):
         self.cache = DatabaseObjectCache()
         self.raise_load_errors = False # only gets set in unittests
         self.force_directory_creation = True # False for device databases
-        self._query_times = {}
         self.path = path
         self._quitting_from_operational_error = False
         self._object_schemas = object_schemas
@@ -924,7 +925,11 @@ class LiveStorage(signals.SignalEmitter):
             obj.reset_changed_attributes()
 
     def update_obj(self, obj):
-        """Update a DDBObject on disk."""
+        """Update a DDBObject on disk.
+
+        The id is passed as a parameter, so updates that change the same
+        columns share one statement and sqlite can reuse it.
+        """
 
         obj_schema = self._schema_map[obj.__class__]
         setters = []
@@ -944,8 +949,9 @@ class LiveStorage(signals.SignalEmitter):
                 schema_item, value))
         obj.reset_changed_attributes()
         if values:
-            sql = "UPDATE %s SET %s WHERE id=%s" % (obj_schema.table_name,
-                    ', '.join(setters), obj.id)
+            values.append(obj.id)
+            sql = "UPDATE %s SET %s WHERE id=?" % (obj_schema.table_name,
+                    ', '.join(setters))
             self.execute(sql, values, is_update=True)
             if (self.cursor.rowcount != 1 and not
                     self._quitting_from_operational_error):
@@ -1027,6 +1033,33 @@ class LiveStorage(signals.SignalEmitter):
     def object_from_class_table(self, obj, klass):
         return self._schema_map[klass] is self._schema_map[obj.__class__]
 
+    def compile_view_predicate(self, table_name, where, values):
+        """Compile a WHERE clause into a python predicate.
+
+        The predicate takes a DDBObject from table_name and returns True if
+        it matches the WHERE clause, without going to SQLite.
+
+        :returns: predicate function, or None if where can't be evaluated in
+            python (in that case the caller should run a query instead).
+        """
+        for obj_schema in self._all_schemas:
+            if obj_schema.table_name == table_name:
+                break
+        else:
+            return None
+        schema_items = dict(obj_schema.fields)
+        converter = self._converter
+        def to_sql(name, value):
+            return converter.to_sql(obj_schema, name, schema_items[name],
+                                    value)
+        try:
+            return sqlpredicate.compile_where(where, values, table_name,
+                                              obj_schema.fields, to_sql)
+        except sqlpredicate.UnsupportedExpression, e:
+            logging.debug("using SQL to track %s view (%s): %s",
+                          table_name, where, e)
+            return None
+
     def _get_query_bottom(self, table_name, where, joins, order_by, limit):
         sql = StringIO()
         sql.write("FROM %s\n" % table_name)
@@ -1132,6 +1165,20 @@ class LiveStorage(signals.SignalEmitter):
             None, limit))
         return self.execute(sql.getvalue(), values)[0][0]
 
+    def query_group_count(self, table_name, group_by, where, values=None,
+            joins=None):
+        """Count rows, grouped by a column.
+
+        :returns: dict mapping values of group_by to their row count.  Values
+        with no matching rows are not included.
+        """
+        sql = StringIO()
+        sql.write('SELECT %s, COUNT(*) ' % group_by)
+        sql.write(self._get_query_bottom(table_name, where, joins,
+            None, None))
+        sql.write(' GROUP BY %s' % group_by)
+        return dict(self.execute(sql.getvalue(), values))
+
     def delete(self, klass, where, values):
         schema = self._schema_map[klass]
         sql = StringIO()
@@ -1308,27 +1355,10 @@ class LiveStorage(signals.SignalEmitter):
 
     def _check_time(self, sql, query_time):
         SINGLE_QUERY_LIMIT = 0.5
-        CUMULATIVE_LIMIT = 1.0
         if query_time > SINGLE_QUERY_LIMIT:
             logging.timing("query slow (%0.3f seconds): %s", query_time, sql)
-
-        return # comment out to test cumulative query times
-
-        # more than half a second in the last
-        old_times = self._query_times.setdefault(sql, [])
-        now = time.time()
-        dropoff_time = now - 5
-        cumulative = query_time
-        for i in reversed(xrange(len(old_times))):
-            old_time, old_query_time = old_times[i]
-            if old_time < dropoff_time:
-                old_times = old_times[i+1:]
-                break
-            cumulative += old_query_time
-        old_times.append((now, query_time))
-        if cumulative > CUMULATIVE_LIMIT:
-            logging.timing('query cumulatively slow: %0.2f '
-                    '(%0.03f): %s', cumulative, query_time, sql)
+        if perfstats.enabled:
+            perfstats.record_sql(sql, query_time)
 
     def _calc_created_new(self):
         """Decide if the database that we just opened is new."""
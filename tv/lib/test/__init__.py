@@ -56,10 +56,13 @@ from miro.test.subscriptiontest import *
 from miro.test.opmltest import *
 from miro.test.schedulertest import *
 from miro.test.networktest import *
+from miro.test.statuscodectest import *
+from miro.test.perfstatstest import *
 from miro.test.httpclienttest import *
 from miro.test.httpdownloadertest import *
 from miro.test.httpauthtoolstest import *
 from miro.test.feedtest import *
+from miro.test.feedupdatetest import *
 from miro.test.feedparsertest import *
 from miro.test.parseurltest import *
 from miro.test.utiltest import *
@@ -80,6 +83,7 @@ from miro.test.metadatatest import *
 from miro.test.tableselectiontest import *
 from miro.test.filetagstest import *
 from miro.test.watchedfoldertest import *
+from miro.test.inotifywatchtest import *
 from miro.test.subprocesstest import *
 from miro.test.itemfiltertest import *
 from miro.test.extensiontest import *
@@ -87,7 +91,10 @@ from miro.test.idleiteratetest import *
 from miro.test.itemtracktest import *
 from miro.test.itemlisttest import *
 from miro.test.itemrenderertest import *
+from miro.test.imagepooltest import *
 from miro.test.sharingtest import *
+from miro.test.libdaaptest import *
+from miro.test.transcodetest import *
 from miro.test.databaseerrortest import *
 
 # platform specific tests
@@ -159,6 +159,89 @@ class ViewTrackerTest(DatabaseTestCase):
         self.clear_ddb_object_cache()
         tracker.check_all_objects()
 
+class ViewTrackerPredicateTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.feed.set_title(u"booya")
+        self.i1.title = u"Item O'Brien"
+        self.i1.signal_change()
+        self.i2.keep = True
+        self.i2.signal_change()
+
+    def check_predicate(self, klass, where, values=()):
+        tracker = klass.make_view(where, values).make_tracker()
+        self.assertNotEquals(tracker._predicate, None)
+        table_name = app.db.table_name(klass)
+        sql_where = '%s.id=?' % table_name
+        if where is not None:
+            sql_where += ' AND (%s)' % where
+        for obj in klass.make_view():
+            in_sql = app.db.query_count(table_name, sql_where,
+                                        (obj.id,) + values) > 0
+            self.assertEquals(tracker._predicate(obj), in_sql,
+                              "%s (values: %s) for %s" % (where, values, obj))
+        tracker.unlink()
+
+    def test_predicates_match_sql(self):
+        self.check_predicate(item.Item, 'feed_id=?', (self.feed.id,))
+        self.check_predicate(item.Item, 'feed_id == ? AND new',
+                             (self.feed2.id,))
+        self.check_predicate(item.Item, 'feed_id IS NULL')
+        self.check_predicate(item.Item, 'item.watched_time IS NOT NULL')
+        self.check_predicate(item.Item, 'NOT keep OR keep IS NULL')
+        self.check_predicate(item.Item, 'keep = 0')
+        self.check_predicate(item.Item, 'keep != 1 AND NOT item.new')
+        self.check_predicate(item.Item,
+                             "file_type in ('audio', 'video', NULL)")
+        self.check_predicate(item.Item, "file_type NOT IN ('other')")
+        self.check_predicate(item.Item, "title='Item O''Brien'")
+        self.check_predicate(item.Item, "title LIKE 'ITEM%'")
+        self.check_predicate(item.Item, "title NOT LIKE '_tem_'")
+        self.check_predicate(item.Item, "(deleted IS NULL or not deleted)")
+        self.check_predicate(item.Item, "feed_id > ? OR feed_id <= ?",
+                             (self.feed.id, self.feed.id - 1))
+        self.check_predicate(feed.Feed, "userTitle LIKE 'booya%'")
+        self.check_predicate(feed.Feed, "visible")
+        self.check_predicate(feed.Feed, "orig_url=? AND searchTerm IS NULL",
+                             (u'http://feed.com',))
+        self.check_predicate(feed.Feed, None)
+
+    def test_fallback_to_sql(self):
+        # views that depend on other tables or on SQLite's type conversions
+        # can't be compiled
+        for where, values, joins in [
+            ("feed.userTitle='booya'", (), {'feed': 'feed.id=item.feed_id'}),
+            ('feed_id NOT IN (SELECT id from feed)', (), None),
+            ("feed_id = '1'", (), None),
+            ("title", (), None),
+            ("creation_time < ?", (self.i1.creation_time,), None),
+            ]:
+            view = item.Item.make_view(where, values, joins=joins)
+            tracker = view.make_tracker()
+            self.assertEquals(tracker._predicate, None)
+            tracker.unlink()
+
+    def test_no_queries_on_change(self):
+        tracker = item.Item.make_view('feed_id=? AND NOT keep',
+                                      (self.feed.id,)).make_tracker()
+        self.assertSameSet(tracker.current_ids, [self.i1.id])
+        queries = []
+        old_query_count = app.db.query_count
+        def query_count(*args, **kwargs):
+            queries.append(args)
+            return old_query_count(*args, **kwargs)
+        app.db.query_count = query_count
+        try:
+            self.i1.keep = True
+            self.i1.signal_change()
+            self.i2.keep = False
+            self.i2.signal_change()
+            self.i3.signal_change()
+        finally:
+            app.db.query_count = old_query_count
+        self.assertEquals(queries, [])
+        self.assertSameSet(tracker.current_ids, [self.i2.id])
+
 # class TestViewLimiter(database.ViewLimiter):
 #     def __init__(self, *feeds_to_include):
 #         self.feeds_to_include = feeds_to_include
@@ -127,6 +127,35 @@ class DownloaderTest(MiroTestCase):
     def test_download(self):
         self.run_download()
 
+    def test_volatile_status_update(self):
+        self.start_download()
+        self.update_status(0.3, 10)
+        rd = self.item.downloader
+        self.assertEquals(rd.changed_attributes, set())
+        # only current_size, rate and eta change here.  The view trackers
+        # shouldn't run, but the new values should still be saved, since
+        # the frontend reads them from the database.
+        tracker_calls = []
+        self.patch_function(
+            'miro.database.ViewTrackerManager.update_view_trackers',
+            lambda *args: tracker_calls.append(args))
+        self.update_status(0.5, 20)
+        self.assertEquals(tracker_calls, [])
+        self.assertEquals(rd.current_size, 50000)
+        self.assertEquals(rd.changed_attributes, set())
+        app.db.cursor.execute("SELECT current_size, rate, eta "
+                              "FROM remote_downloader WHERE id=?", (rd.id,))
+        self.assertEquals(app.db.cursor.fetchone(),
+                          (50000, rd.rate, rd.eta))
+        self.update_status(0.6, 30)
+        self.assertEquals(rd.changed_attributes, set())
+        self.update_status(0.9, 40)
+        with open(self.final_path, 'w') as f:
+            f.write("bogus data")
+        self.update_status(1.0, 50)
+        self.check_download_finished()
+        self.assertEquals(rd.changed_attributes, set())
+
     def test_delete(self):
         self.run_download()
         self.assertEquals(self.feed.downloaded_items.count(), 1)
@@ -1,14 +1,19 @@
 import os
+import shutil
 import unittest
 from time import sleep
 
 from miro import app
 from miro import prefs
 from miro import dialogs
+from miro import feed
 from miro import feedparserutil
+from miro import models
 from miro.item import Item
-from miro.feed import validate_feed_url, normalize_feed_url, Feed
+from miro.feed import (validate_feed_url, normalize_feed_url, Feed,
+                       entry_digest, parse_stats)
 
+from miro.test import testobjects
 from miro.test.framework import MiroTestCase, EventLoopTest
 
 class FakeDownloader(object):
@@ -461,5 +466,369 @@ by-nd/1.0</creativeCommons:license>
         self.save_then_restore_db()
         self.assertEquals(self.item.get_rss_id(), None)
 
+class FeedDigestTest(FeedTestCase):
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        self.titles = ['First', 'Second', 'Third']
+        self.write_new_feed()
+        self.feed = self.make_feed()
+        parse_stats.reset()
+
+    def write_new_feed(self):
+        items = []
+        items.append("""<?xml version="1.0"?>
+<rss version="2.0">
+   <channel>
+      <title>Digest Test</title>
+      <link>http://example.com/</link>
+      <creativeCommons:license>http://example.com/license</creativeCommons:license>
+""")
+        for i, title in enumerate(self.titles):
+            items.append("""\
+<item>
+ <title>%s</title>
+ <guid>guid-%d</guid>
+ <enclosure url="http://example.com/%d.mpg" />
+</item>
+""" % (title, i, i))
+        items.append("""
+   </channel>
+</rss>""")
+        self.write_file("\n".join(items))
+
+    def check_stats(self, **correct):
+        stats = parse_stats.to_dict()
+        for key, value in correct.items():
+            self.assertEquals(stats[key], value)
+
+    def test_digests_saved(self):
+        digests = set(i.entry_digest for i in Item.make_view())
+        self.assertEquals(len(digests), 3)
+        self.assert_(None not in digests)
+
+    def test_unchanged_body(self):
+        self.update_feed(self.feed)
+        self.check_stats(parses_run=0, parses_skipped=1)
+        self.assertEquals(Item.make_view().count(), 3)
+
+    def test_unchanged_body_after_restart(self):
+        # the digest and the values we take from the feed header are saved,
+        # so we don't need to parse the body again after a restart
+        link = self.feed.get_link()
+        self.assertEquals(self.feed.get_license(),
+                          u'http://example.com/license')
+        self.clear_ddb_object_cache()
+        self.feed = Feed.make_view().get_singleton()
+        self.update_feed(self.feed)
+        self.check_stats(parses_run=0, parses_skipped=1)
+        self.assertEquals(Item.make_view().count(), 3)
+        self.assertEquals(self.feed.get_link(), link)
+        self.assertEquals(self.feed.get_license(),
+                          u'http://example.com/license')
+
+    def test_removed_item_after_restart(self):
+        list(Item.make_view())[0].remove()
+        self.clear_ddb_object_cache()
+        self.feed = Feed.make_view().get_singleton()
+        self.update_feed(self.feed)
+        self.check_stats(parses_run=1, parses_skipped=0)
+        self.assertEquals(Item.make_view().count(), 3)
+
+    def test_changed_entry(self):
+        self.titles[1] = 'Second (updated)'
+        self.write_new_feed()
+        self.update_feed(self.feed)
+        self.check_stats(parses_run=1, parses_skipped=0,
+                         entries_compared=1, entries_skipped=2)
+        titles = set(i.entry_title for i in Item.make_view())
+        self.assertEquals(titles,
+                          set([u'First', u'Second (updated)', u'Third']))
+
+    def test_removed_item(self):
+        # if an item from the last update is gone, we need to parse the feed
+        # again
+        removed = list(Item.make_view())[0]
+        removed.remove()
+        self.update_feed(self.feed)
+        self.check_stats(parses_run=1, parses_skipped=0,
+                         entries_compared=1, entries_skipped=2)
+        self.assertEquals(Item.make_view().count(), 3)
+
+    def test_clean_old_items(self):
+        # clean_old_items() needs to run through the full parse so that old
+        # items get truncated
+        self.feed.actualFeed.clean_old_items()
+        self.process_idles()
+        self.processThreads()
+        self.process_idles()
+        self.check_stats(parses_run=1, parses_skipped=0, entries_skipped=3)
+
+    def update_from_spooled_body(self):
+        # simulate httpclient spooling a big feed body to a temp file
+        body_path = self.make_temp_path('.xml')
+        shutil.copy(self.filename, body_path)
+        self.feed.actualFeed.updating = True
+        self.feed.actualFeed._update_callback({
+            'status': 200,
+            'body-path': body_path,
+            'updated-url': self.url,
+        })
+        self.process_idles()
+        self.processThreads()
+        self.process_idles()
+        # the feed should clean up the file once it's done with it
+        self.assert_(not os.path.exists(body_path))
+
+    def test_spooled_body(self):
+        self.titles[1] = 'Second (updated)'
+        self.write_new_feed()
+        self.update_from_spooled_body()
+        self.check_stats(parses_run=1, parses_skipped=0,
+                         entries_compared=1, entries_skipped=2)
+        titles = set(i.entry_title for i in Item.make_view())
+        self.assertEquals(titles,
+                          set([u'First', u'Second (updated)', u'Third']))
+
+    def test_spooled_body_unchanged(self):
+        self.update_from_spooled_body()
+        self.check_stats(parses_run=0, parses_skipped=1)
+
+    def test_entry_digest(self):
+        entry1 = {'title': u'Foo', 'enclosures': [{'url': 'a', 'length': 1}]}
+        entry2 = {'enclosures': [{'length': 1, 'url': 'a'}], 'title': u'Foo'}
+        entry3 = {'title': u'Foo', 'enclosures': [{'url': 'b', 'length': 1}]}
+        self.assertEquals(entry_digest(entry1), entry_digest(entry2))
+        self.assertNotEquals(entry_digest(entry1), entry_digest(entry3))
+
+class FeedItemBatchTest(FeedTestCase):
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        self.old_batch_size = feed.NEW_ITEM_BATCH_SIZE
+        feed.NEW_ITEM_BATCH_SIZE = 2
+        entries = []
+        for i in xrange(5):
+            entries.append("""\
+<item>
+ <title>Entry %d</title>
+ <guid>guid-%d</guid>
+ <enclosure url="http://example.com/%d.mpg" />
+</item>""" % (i, i, i))
+        self.write_file("""<?xml version="1.0"?>
+<rss version="2.0">
+   <channel>
+      <title>Batch Test</title>
+      <link>http://example.com/</link>
+      %s
+   </channel>
+</rss>""" % '\n'.join(entries))
+
+    def tearDown(self):
+        feed.NEW_ITEM_BATCH_SIZE = self.old_batch_size
+        FeedTestCase.tearDown(self)
+
+    def test_batches(self):
+        my_feed = Feed(self.url)
+        self.process_idles()
+        my_feed.update()
+        self.process_idles()
+        self.processThreads()
+        self.process_idles()
+        # the first batch gets created right away, the rest as idle
+        # callbacks.  The feed shouldn't finish updating until they're done.
+        self.assert_(Item.make_view().count() < 5)
+        self.assert_(my_feed.is_updating())
+        self.runPendingIdles()
+        self.assertEquals(Item.make_view().count(), 5)
+        self.assert_(not my_feed.is_updating())
+        self.assert_(my_feed.actualFeed.body_digest is not None)
+
+    def test_feed_removed(self):
+        my_feed = Feed(self.url)
+        self.process_idles()
+        my_feed.update()
+        self.process_idles()
+        self.processThreads()
+        self.process_idles()
+        my_feed.remove()
+        # removing the feed should stop us from creating more items
+        self.runPendingIdles()
+        self.assertEquals(Item.make_view().count(), 0)
+
+class FeedItemMatchTest(FeedTestCase):
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        # entries are (title, guid, enclosure url) tuples
+        self.entries = [
+            ('First', None, 'http://example.com/1.mpg'),
+            ('Second', None, 'http://example.com/2.mpg'),
+            ('Third', 'guid-3', 'http://example.com/3.mpg'),
+        ]
+        self.write_new_feed()
+        self.feed = self.make_feed()
+
+    def write_new_feed(self):
+        items = []
+        for title, guid, url in self.entries:
+            if guid is not None:
+                guid = '<guid>%s</guid>' % guid
+            else:
+                guid = ''
+            items.append("""\
+<item>
+ <title>%s</title>
+ %s
+ <enclosure url="%s" length="100" type="video/mpeg" />
+</item>""" % (title, guid, url))
+        self.write_file("""<?xml version="1.0"?>
+<rss version="2.0">
+   <channel>
+      <title>Match Test</title>
+      <link>http://example.com/</link>
+      %s
+   </channel>
+</rss>""" % '\n'.join(items))
+
+    def check_titles(self, titles):
+        self.assertEquals(sorted(i.entry_title for i in self.feed.items),
+                          sorted(titles))
+
+    def test_normalized_title(self):
+        self.entries[0] = (' first\n', None, 'http://example.com/1.mpg')
+        self.write_new_feed()
+        self.update_feed(self.feed)
+        self.assertEquals(self.feed.items.count(), 3)
+
+    def test_keyless_enclosure(self):
+        # keyless items with the same enclosure should get updated, rather
+        # than creating a new item
+        self.entries[1] = ('Second (fixed)', None, 'http://example.com/2.mpg')
+        self.write_new_feed()
+        self.update_feed(self.feed)
+        self.check_titles([u'First', u'Second (fixed)', u'Third'])
+
+    def test_guid_match(self):
+        self.entries[2] = ('Third (moved)', 'guid-3',
+                           'http://example.com/4.mpg')
+        self.write_new_feed()
+        self.update_feed(self.feed)
+        self.check_titles([u'First', u'Second', u'Third (moved)'])
+
+    def test_new_entry(self):
+        self.entries.append(('Fourth', None, 'http://example.com/4.mpg'))
+        self.write_new_feed()
+        self.update_feed(self.feed)
+        self.check_titles([u'First', u'Second', u'Third', u'Fourth'])
+
+    def test_other_feed(self):
+        # items from other feeds never match
+        other_url = self.url
+        self.filename = self.make_temp_path()
+        self.write_new_feed()
+        self.assertNotEquals(self.url, other_url)
+        other_feed = self.make_feed()
+        self.assertEquals(other_feed.items.count(), 3)
+        self.assertEquals(Item.make_view().count(), 6)
+
+class FeedCountsTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed, self.items = testobjects.make_feed_with_items(5)
+        self.file_feed, self.file_items = testobjects.make_feed_with_items(
+            3, file_items=True)
+        for item in self.file_items:
+            item.file_type = u'video'
+            item.signal_change()
+        self.empty_feed = testobjects.make_feed()
+        # count calls to Item.feed_counts() to check that feeds get counted
+        # together.
+        self.count_calls = []
+        self.old_feed_counts = models.Item.__dict__['feed_counts']
+        real_feed_counts = models.Item.feed_counts
+        def feed_counts(name, feed_ids=None):
+            self.count_calls.append((name, feed_ids))
+            return real_feed_counts(name, feed_ids)
+        models.Item.feed_counts = staticmethod(feed_counts)
+
+    def tearDown(self):
+        models.Item.feed_counts = self.old_feed_counts
+        MiroTestCase.tearDown(self)
+
+    def check_consistency(self):
+        self.assertEquals(Feed.counts.check_consistency(), [])
+
+    def test_counts(self):
+        self.assertEquals(self.feed.num_available(), 5)
+        self.assertEquals(self.feed.num_downloaded(), 0)
+        self.assertEquals(self.file_feed.num_downloaded(), 3)
+        self.assertEquals(self.file_feed.num_unwatched(), 3)
+        self.assertEquals(self.empty_feed.num_available(), 0)
+        self.assertEquals(self.empty_feed.num_unwatched(), 0)
+        self.check_consistency()
+
+    def test_counted_together(self):
+        for feed in (self.feed, self.file_feed, self.empty_feed):
+            feed.num_available()
+            feed.num_unwatched()
+        # the first lookup should count every feed at once
+        self.assertEquals(len(self.count_calls),
+                          len(Feed.counts.COUNT_NAMES))
+        for name, feed_ids in self.count_calls:
+            self.assertEquals(feed_ids, None)
+        # invalidating feeds should recount just those feeds, together
+        self.count_calls = []
+        self.feed.recalc_counts()
+        self.file_feed.recalc_counts()
+        self.feed.num_available()
+        self.file_feed.num_available()
+        self.empty_feed.num_available()
+        self.assertEquals(len(self.count_calls),
+                          len(Feed.counts.COUNT_NAMES))
+        for name, feed_ids in self.count_calls:
+            self.assertSameSet(feed_ids, [self.feed.id, self.file_feed.id])
+
+    def test_item_changes(self):
+        self.assertEquals(self.feed.num_available(), 5)
+        self.items[0].unset_new()
+        self.assertEquals(self.feed.num_available(), 4)
+        self.file_items[0].mark_watched()
+        self.assertEquals(self.file_feed.num_unwatched(), 2)
+        self.check_consistency()
+
+    def test_item_added_and_removed(self):
+        self.assertEquals(self.feed.num_available(), 5)
+        new_item = testobjects.make_item(self.feed, u'new-item')
+        self.assertEquals(self.feed.num_available(), 6)
+        new_item.remove()
+        self.items[0].remove()
+        self.assertEquals(self.feed.num_available(), 4)
+        self.check_consistency()
+
+    def test_item_moved(self):
+        self.assertEquals(self.file_feed.num_downloaded(), 3)
+        self.assertEquals(self.empty_feed.num_downloaded(), 0)
+        self.file_items[0].set_feed(self.empty_feed.id)
+        self.file_items[0].signal_change()
+        self.check_consistency()
+
+    def test_mark_as_viewed(self):
+        self.assertEquals(self.feed.num_available(), 5)
+        self.feed.mark_as_viewed()
+        self.assertEquals(self.feed.num_available(), 0)
+        self.check_consistency()
+
+    def test_auto_download_mode(self):
+        self.assertEquals(self.feed.num_available(), 5)
+        self.feed.set_auto_download_mode(u'all')
+        self.check_consistency()
+        self.feed.set_auto_download_mode(u'off')
+        self.check_consistency()
+
+    def test_feed_removed(self):
+        self.feed.num_available()
+        self.feed.remove()
+        for counts in Feed.counts.counts.values():
+            self.assert_(self.feed.id not in counts)
+        self.check_consistency()
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,320 @@
+import os
+
+from miro import eventloop
+from miro import feedupdate
+from miro import signals
+from miro.feed import Feed, RSSFeedImpl
+from miro.feedupdate import (FeedUpdateState, UPDATE_CHANGED,
+                             UPDATE_UNCHANGED, UPDATE_ERROR)
+from miro.test.framework import MiroTestCase, EventLoopTest, uses_httpclient
+
+class FeedUpdateStateTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.state = FeedUpdateState(1)
+
+    def test_default(self):
+        self.assertEquals(self.state.calc_delay(60), 60)
+
+    def test_unchanged(self):
+        self.state.record_result(UPDATE_UNCHANGED, 100.0)
+        self.state.record_result(UPDATE_UNCHANGED, 200.0)
+        self.assertEquals(self.state.unchanged_count, 2)
+        self.assertAlmostEquals(self.state.calc_delay(60),
+                                60 * feedupdate.UNCHANGED_BACKOFF ** 2)
+        # we should never back off more than MAX_BACKOFF
+        for i in xrange(100):
+            self.state.record_result(UPDATE_UNCHANGED, 300.0 + i)
+        self.assertEquals(self.state.calc_delay(60),
+                          60 * feedupdate.MAX_BACKOFF)
+
+    def test_errors(self):
+        self.state.record_result(UPDATE_ERROR, 100.0)
+        self.assertEquals(self.state.calc_delay(60), 120)
+        self.state.record_result(UPDATE_ERROR, 200.0)
+        self.assertEquals(self.state.calc_delay(60), 240)
+        for i in xrange(10):
+            self.state.record_result(UPDATE_ERROR, 300.0 + i)
+        self.assertEquals(self.state.calc_delay(60),
+                          60 * feedupdate.MAX_BACKOFF)
+        # a successful update resets the error count
+        self.state.record_result(UPDATE_UNCHANGED, 400.0)
+        self.assertEquals(self.state.error_count, 0)
+
+    def test_change_interval(self):
+        self.state.record_result(UPDATE_CHANGED, 0.0)
+        self.assertEquals(self.state.change_interval, None)
+        self.state.record_result(UPDATE_CHANGED, 1000.0)
+        self.assertEquals(self.state.change_interval, 1000)
+        # we should check about twice as often as the feed changes
+        self.assertEquals(self.state.calc_delay(100), 500)
+        # but never more often than the feed's update frequency
+        self.assertEquals(self.state.calc_delay(600), 600)
+        self.state.record_result(UPDATE_CHANGED, 1100.0)
+        self.assertAlmostEquals(self.state.change_interval,
+                                0.3 * 100 + 0.7 * 1000)
+
+    def test_signal_change(self):
+        signal_changes = []
+        real_signal_change = self.state.signal_change
+        def signal_change():
+            signal_changes.append(self.state.unchanged_count)
+            real_signal_change()
+        self.state.signal_change = signal_change
+        for i in xrange(feedupdate.MAX_UNCHANGED_COUNT + 5):
+            self.state.record_result(UPDATE_UNCHANGED, 100.0 + i)
+        # once we hit MAX_BACKOFF, only last_update changes, and that
+        # shouldn't need a signal_change()
+        self.assertEquals(signal_changes,
+                          range(1, feedupdate.MAX_UNCHANGED_COUNT + 1))
+        self.assertEquals(self.state.calc_delay(60),
+                          60 * feedupdate.MAX_BACKOFF)
+        self.assertEquals(self.state.last_update,
+                          100 + feedupdate.MAX_UNCHANGED_COUNT + 4)
+        self.assertEquals(self.state.changed_attributes, set())
+
+    def test_changed_resets_backoff(self):
+        self.state.record_result(UPDATE_UNCHANGED, 100.0)
+        self.state.record_result(UPDATE_UNCHANGED, 200.0)
+        self.state.record_result(UPDATE_CHANGED, 300.0)
+        self.assertEquals(self.state.unchanged_count, 0)
+        self.assertEquals(self.state.calc_delay(60), 60)
+
+class FakeFeed(signals.SignalEmitter):
+    def __init__(self, id_, url):
+        signals.SignalEmitter.__init__(self, 'update-finished', 'removed')
+        self.id = id_
+        self.url = url
+        self.update_count = 0
+
+    def get_title(self):
+        return self.url
+
+    def get_url(self):
+        return self.url
+
+    def update(self):
+        self.update_count += 1
+
+class FeedUpdateSchedulerTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.scheduler = feedupdate.scheduler
+        self.old_max_updates = feedupdate.MAX_UPDATES
+        self.old_max_updates_per_host = feedupdate.MAX_UPDATES_PER_HOST
+        feedupdate.MAX_UPDATES = 4
+        feedupdate.MAX_UPDATES_PER_HOST = 2
+        self.feeds = []
+        for i in xrange(5):
+            self.feeds.append(FakeFeed(i, u'http://a.example.com/%d' % i))
+        for i in xrange(5, 8):
+            self.feeds.append(FakeFeed(i, u'http://b.example.com/%d' % i))
+        # keep track of the delays passed to schedule_update()
+        self.delays = {}
+        real_schedule_update = self.scheduler.schedule_update
+        def schedule_update(delay, feed, update_callback):
+            self.delays[feed.id] = delay
+            real_schedule_update(delay, feed, update_callback)
+        self.scheduler.schedule_update = schedule_update
+
+    def tearDown(self):
+        feedupdate.MAX_UPDATES = self.old_max_updates
+        feedupdate.MAX_UPDATES_PER_HOST = self.old_max_updates_per_host
+        EventLoopTest.tearDown(self)
+
+    def queue_all(self):
+        for feed in self.feeds:
+            self.scheduler.do_update(feed, feed.update)
+
+    def updating_feeds(self):
+        return [f for f in self.feeds if f.update_count > 0]
+
+    def test_limits(self):
+        feedupdate.schedule_update(0, self.feeds[0], self.feeds[0].update)
+        self.assertEquals(feedupdate.get_stats()['scheduled'], 1)
+        feedupdate.cancel_update(self.feeds[0])
+        self.queue_all()
+        # 2 feeds from each host should be updating, the rest are queued
+        self.assertEquals(self.updating_feeds(),
+                          self.feeds[:2] + self.feeds[5:7])
+        stats = feedupdate.get_stats()
+        self.assertEquals(stats['scheduled'], 0)
+        self.assertEquals(stats['updating'], 4)
+        self.assertEquals(stats['queued'], 4)
+        self.assertEquals(stats['max_queued'], 4)
+        self.assertEquals(stats['hosts'],
+                          {'a.example.com': 2, 'b.example.com': 2})
+        # when a feed finishes, the next feed from the same host should
+        # start, even though there's one from the other host ahead of it.
+        self.feeds[0].emit('update-finished')
+        self.runPendingIdles()
+        self.assertEquals(self.updating_feeds(),
+                          self.feeds[:3] + self.feeds[5:7])
+        # the global limit applies too.
+        self.feeds[5].emit('update-finished')
+        self.feeds[6].emit('update-finished')
+        self.runPendingIdles()
+        self.assertEquals(self.updating_feeds(), self.feeds[:3] +
+                          self.feeds[5:8])
+        self.assertEquals(feedupdate.get_stats()['updating'], 3)
+        self.assertEquals(feedupdate.get_stats()['blocked_by_host'], 2)
+
+    def test_global_limit(self):
+        feedupdate.MAX_UPDATES = 3
+        self.queue_all()
+        self.assertEquals(len(self.updating_feeds()), 3)
+        self.assertEquals(feedupdate.get_stats()['queued'], 5)
+
+    def test_removed_while_updating(self):
+        self.queue_all()
+        self.feeds[1].emit('removed')
+        self.runPendingIdles()
+        self.assertEquals(feedupdate.get_stats()['hosts'],
+                          {'a.example.com': 2, 'b.example.com': 2})
+
+    def test_periodic_update(self):
+        feed = self.feeds[0]
+        feedupdate.schedule_periodic_update(60, feed, feed.update)
+        self.assertEquals(self.delays[feed.id], 60)
+        feedupdate.report_result(feed, UPDATE_ERROR)
+        feedupdate.schedule_periodic_update(60, feed, feed.update)
+        self.assertEquals(self.delays[feed.id], 120)
+
+    def test_state_saved(self):
+        tempdb = os.path.join(self.tempdir, 'feed-update-db')
+        self.reload_database(tempdb)
+        feed = self.feeds[0]
+        feedupdate.report_result(feed, UPDATE_UNCHANGED)
+        self.reload_database(tempdb)
+        state = FeedUpdateState.get_by_feed_id(feed.id)
+        self.assertEquals(state.unchanged_count, 1)
+        self.assert_(state.last_update is not None)
+        feedupdate.remove_feed(feed)
+        self.assertEquals(FeedUpdateState.make_view().count(), 0)
+
+    def test_startup_update(self):
+        new_feed, recent_feed = self.feeds[:2]
+        feedupdate.report_result(recent_feed, UPDATE_UNCHANGED)
+        feedupdate.schedule_startup_update(5, 600, new_feed, new_feed.update)
+        feedupdate.schedule_startup_update(5, 600, recent_feed,
+                                           recent_feed.update)
+        # feeds that we've never updated should update right away.  Feeds
+        # that were updated recently should wait until their next update is
+        # due.
+        self.assertEquals(self.delays[new_feed.id], 5)
+        self.assert_(self.delays[recent_feed.id] > 600)
+        self.assert_(self.delays[recent_feed.id] <=
+                     600 * feedupdate.UNCHANGED_BACKOFF)
+
+class FeedUpdateHTTPTest(EventLoopTest):
+    """Update a bunch of feeds from the test HTTP server."""
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.start_http_server()
+        self.hosts = ['localhost', '127.0.0.1']
+        self.feed_names = []
+        self.result_count = 0
+        for host in self.hosts:
+            for i in xrange(4):
+                name = '%s-%d' % (host, i)
+                self.feed_names.append(name)
+                self.httpserver.set_feed(name, self.make_feed_body(name, 1))
+        # keep track of the most feeds we see updating from a single host
+        self.max_host_counts = {}
+        scheduler = feedupdate.scheduler
+        real_start_update = scheduler._start_update
+        def start_update(feed, host, update_callback):
+            count = scheduler.host_counts[host] + 1
+            self.max_host_counts[host] = max(count,
+                    self.max_host_counts.get(host, 0))
+            real_start_update(feed, host, update_callback)
+        scheduler._start_update = start_update
+        real_report_result = scheduler.report_result
+        def report_result(feed, result):
+            self.result_count += 1
+            real_report_result(feed, result)
+        scheduler.report_result = report_result
+
+    def make_feed_body(self, name, entry_count):
+        entries = []
+        for i in xrange(entry_count):
+            entries.append("""\
+<item>
+ <title>%s entry %d</title>
+ <guid>%s-%d</guid>
+ <enclosure url="http://example.com/%s/%d.mpg" />
+</item>""" % (name, i, name, i, name, i))
+        return """<?xml version="1.0"?>
+<rss version="2.0">
+   <channel>
+      <title>%s</title>
+      <link>http://example.com/</link>
+      %s
+   </channel>
+</rss>""" % (name, '\n'.join(entries))
+
+    def feed_url(self, name):
+        host = name.rsplit('-', 1)[0]
+        return u'http://%s:%s/feeds/%s' % (host, self.httpserver.port, name)
+
+    def wait_for_updates(self, result_count):
+        """Run the eventloop until result_count updates have finished and
+        no feeds are updating.
+        """
+        def check():
+            stats = feedupdate.get_stats()
+            done = (self.result_count >= result_count and
+                    stats['updating'] == stats['queued'] == 0 and
+                    not [f for f in Feed.make_view() if f.is_updating()])
+            if done:
+                self.stopEventLoop(abnormal=False)
+            else:
+                eventloop.add_timeout(0.05, check, 'check feed updates')
+        eventloop.add_timeout(0.05, check, 'check feed updates')
+        self.runEventLoop(timeout=20)
+
+    def update_all(self):
+        for feed in Feed.make_view():
+            feed.schedule_update_events(0)
+
+    def get_state(self, name):
+        feed = Feed.get_by_url(self.feed_url(name))
+        return FeedUpdateState.get_by_feed_id(feed.id)
+
+    @uses_httpclient
+    def test_update(self):
+        for name in self.feed_names:
+            Feed(self.feed_url(name))
+        self.wait_for_updates(len(self.feed_names))
+        for feed in Feed.make_view():
+            self.assert_(isinstance(feed.actualFeed, RSSFeedImpl))
+            self.assertEquals(feed.items.count(), 1)
+        for name in self.feed_names:
+            self.assertEquals(self.get_state(name).last_change is None,
+                              False)
+
+        # nothing changed, so every feed should get a 304 response
+        self.update_all()
+        self.wait_for_updates(len(self.feed_names) * 2)
+        for name in self.feed_names:
+            self.assertEquals(self.get_state(name).unchanged_count, 1)
+
+        # change one of the feeds
+        changed = self.feed_names[0]
+        self.httpserver.set_feed(changed, self.make_feed_body(changed, 2))
+        self.update_all()
+        self.wait_for_updates(len(self.feed_names) * 3)
+        self.assertEquals(Feed.get_by_url(self.feed_url(changed)).items.count(),
+                          2)
+        self.assertEquals(self.get_state(changed).unchanged_count, 0)
+        for name in self.feed_names[1:]:
+            self.assertEquals(self.get_state(name).unchanged_count, 2)
+
+        # we should never run more than MAX_UPDATES_PER_HOST updates from a
+        # single host at once, and every feed should have hit the server.
+        self.assertEquals(set(self.httpserver.feed_requests()),
+                          set(self.feed_names))
+        for host in self.hosts:
+            self.assert_(self.max_host_counts[host] <=
+                         feedupdate.MAX_UPDATES_PER_HOST)
@@ -18,6 +18,7 @@ from miro import devices
 from miro import eventloop
 from miro import extensionmanager
 from miro import feed
+from miro import feedupdate
 from miro import downloader
 from miro import httpauth
 from miro import httpclient
@@ -293,6 +294,8 @@ class MiroTestCase(unittest.TestCase):
         item.start_deleted_checker()
         # Skip worker proccess for feedparser
         feed._RUN_FEED_PARSER_INLINE = True
+        # Scan watched folders without using the thread pool
+        feed._RUN_DIRECTORY_SCAN_INLINE = True
         signals.system.connect('new-dialog', self.handle_new_dialog)
         # reload config and initialize it to temprary
         config.load_temporary()
@@ -550,6 +553,8 @@ class MiroTestCase(unittest.TestCase):
                 # exceptions to keep propagating
                 app.db._upgrade_database(context='main')
         item.setup_change_tracker()
+        feed.setup_feed_counts()
+        feedupdate.setup_scheduler()
         database.initialize()
 
     def init_data_package(self):
@@ -641,12 +646,13 @@ class EventLoopTest(MiroTestCase):
     def runPendingIdles(self):
         idle_queue = eventloop._eventloop.idle_queue
         urgent_queue = eventloop._eventloop.urgent_queue
+        # make sure that idles scheduled for the next loop run as well.
+        eventloop._eventloop._add_idles_for_next_loop()
         while idle_queue.has_pending_idle() or urgent_queue.has_pending_idle():
             if urgent_queue.has_pending_idle():
                 urgent_queue.process_idles()
             if idle_queue.has_pending_idle():
                 idle_queue.process_next_idle()
-            # make sure that idles scheduled for the next loop run as well.
             eventloop._eventloop._add_idles_for_next_loop()
 
     def runUrgentCalls(self):
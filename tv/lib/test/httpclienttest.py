@@ -1,4 +1,5 @@
 import functools
+import hashlib
 import os
 import logging
 import pycurl
@@ -85,6 +86,57 @@ class HTTPClientTest(HTTPClientTestBase):
         self.grab_url(self.httpserver.build_url('test.txt'))
         self.assertEquals(self.grab_url_info['body'], self.test_response_data)
 
+    @uses_httpclient
+    def test_handle_reuse(self):
+        url = self.httpserver.build_url('test.txt')
+        self.grab_url(url)
+        stats = self.client.get_stats()
+        self.assertEquals(stats.reused_handle, False)
+        self.assertEquals(stats.new_connections, 1)
+        # the second transfer should get the pooled handle and reuse its
+        # connection
+        self.grab_url(url)
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        stats = self.client.get_stats()
+        self.assertEquals(stats.reused_handle, True)
+        self.assertEquals(stats.new_connections, 0)
+        counts = httpclient.curl_manager.get_connection_counts()
+        self.assertEquals(counts['transfers'], 2)
+        self.assertEquals(counts['handles_created'], 1)
+        self.assertEquals(counts['handles_reused'], 1)
+        self.assertEquals(counts['connections_reused'], 1)
+
+    @uses_httpclient
+    def test_pooled_handle_is_reset(self):
+        # options from one transfer shouldn't leak into the next one
+        url = self.httpserver.build_url('test.txt')
+        self.grab_url(url, etag='abcdef')
+        self.grab_url(url)
+        self.check_header_not_present('etag')
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+
+    @uses_httpclient
+    def test_spool_threshold(self):
+        url = self.httpserver.build_url('test.txt')
+        self.grab_url(url, spool_threshold=len(self.test_response_data))
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        self.assert_('body-path' not in self.grab_url_info)
+        # bigger bodies should get written to a file
+        self.grab_url(url, spool_threshold=10)
+        self.assert_('body' not in self.grab_url_info)
+        path = self.grab_url_info['body-path']
+        self.assertEquals(open(path, 'rb').read(), self.test_response_data)
+        os.remove(path)
+
+    @uses_httpclient
+    def test_spool_gzip(self):
+        self.httpserver.add_header("content-encoding", "gzip")
+        self.grab_url(self.httpserver.build_url('test.txt.gz'),
+                      spool_threshold=10)
+        path = self.grab_url_info['body-path']
+        self.assertEquals(open(path, 'rb').read(), self.test_response_data)
+        os.remove(path)
+
     @uses_httpclient
     def test_file_get(self):
         path = resources.path("testdata/httpserver/test.txt")
@@ -120,9 +172,9 @@ class HTTPClientTest(HTTPClientTestBase):
     @uses_httpclient
     def test_etag(self):
         self.grab_url(self.httpserver.build_url('test.txt'))
-        self.check_header_not_present('etag')
+        self.check_header_not_present('if-none-match')
         self.grab_url(self.httpserver.build_url('test.txt'), etag='abcdef')
-        self.check_header('etag', 'abcdef')
+        self.check_header('if-none-match', 'abcdef')
 
     @uses_httpclient
     def test_modified(self):
@@ -483,6 +535,99 @@ class HTTPClientTest(HTTPClientTestBase):
         self.wait_for_libcurl_manager()
         self.assert_(not os.path.exists(filename))
 
+class HTTPCacheTest(HTTPClientTestBase):
+    def setUp(self):
+        HTTPClientTestBase.setUp(self)
+        self.cache_dir = os.path.join(self.tempdir, 'http-cache')
+        httpclient.setup_http_cache(self.cache_dir)
+
+    def tearDown(self):
+        httpclient.http_cache = None
+        HTTPClientTestBase.tearDown(self)
+
+    def check_stats(self, **expected):
+        stats = httpclient.get_http_cache_stats()
+        for key, value in expected.items():
+            self.assertEquals(stats[key], value)
+
+    @uses_httpclient
+    def test_revalidate(self):
+        self.httpserver.set_feed('cached', 'cached body')
+        url = self.httpserver.build_url('feeds/cached')
+        self.grab_url(url, use_cache=True)
+        self.assertEquals(self.grab_url_info['body'], 'cached body')
+        self.assert_('from-cache' not in self.grab_url_info)
+        self.check_stats(misses=1, stores=1, entries=1)
+        # we should send the etag and get a 304 back, but callers should
+        # see a normal 200 response.
+        self.grab_url(url, use_cache=True)
+        self.assertEquals(self.grab_url_info['status'], 200)
+        self.assertEquals(self.grab_url_info['body'], 'cached body')
+        self.assertEquals(self.grab_url_info['from-cache'], True)
+        self.check_stats(misses=1, revalidated=1,
+                         bytes_saved=len('cached body'))
+        self.assertEquals(self.httpserver.feed_requests(),
+                          ['cached', 'cached'])
+        # if the resource changes, we should get the new version
+        self.httpserver.set_feed('cached', 'new body')
+        self.grab_url(url, use_cache=True)
+        self.assertEquals(self.grab_url_info['body'], 'new body')
+        self.check_stats(misses=2, stores=2, entries=1,
+                         size=len('new body'))
+
+    @uses_httpclient
+    def test_fresh_hit(self):
+        self.httpserver.add_header('Cache-Control', 'max-age=3600')
+        url = self.httpserver.build_url('test.txt')
+        self.grab_url(url, use_cache=True)
+        self.grab_url(url, use_cache=True)
+        # the response is still fresh, so we shouldn't make a request
+        self.assert_(isinstance(self.client, httpclient.CachedResponse))
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        self.check_stats(hits=1, misses=1,
+                         bytes_saved=len(self.test_response_data))
+
+    @uses_httpclient
+    def test_no_store(self):
+        self.httpserver.add_header('Cache-Control', 'no-store')
+        self.grab_url(self.httpserver.build_url('test.txt'), use_cache=True)
+        self.check_stats(stores=0, entries=0)
+
+    @uses_httpclient
+    def test_opt_in(self):
+        url = self.httpserver.build_url('test.txt')
+        self.grab_url(url)
+        self.grab_url(url, use_cache=True, post_vars={'foo': 'bar'})
+        self.check_stats(misses=0, stores=0, entries=0)
+
+    @uses_httpclient
+    def test_eviction(self):
+        httpclient.setup_http_cache(self.cache_dir, max_size=150)
+        for name in ('a', 'b'):
+            self.httpserver.set_feed(name, name * 100)
+        self.grab_url(self.httpserver.build_url('feeds/a'), use_cache=True)
+        self.grab_url(self.httpserver.build_url('feeds/b'), use_cache=True)
+        # a is the least recently used, so it should get thrown out
+        self.check_stats(stores=2, evictions=1, entries=1, size=100)
+        self.assertEquals(httpclient.http_cache.entries.keys(),
+                          [self.httpserver.build_url('feeds/b')])
+        a_filename = hashlib.sha1(
+            self.httpserver.build_url('feeds/a')).hexdigest()
+        self.assert_(not os.path.exists(os.path.join(self.cache_dir,
+                                                     a_filename)))
+
+    @uses_httpclient
+    def test_index_saved(self):
+        self.httpserver.set_feed('cached', 'cached body')
+        url = self.httpserver.build_url('feeds/cached')
+        self.grab_url(url, use_cache=True)
+        httpclient.http_cache.save()
+        httpclient.setup_http_cache(self.cache_dir)
+        self.check_stats(entries=1, size=len('cached body'))
+        self.grab_url(url, use_cache=True)
+        self.assertEquals(self.grab_url_info['body'], 'cached body')
+        self.check_stats(revalidated=1, misses=0)
+
 class HTTPAuthTest(HTTPClientTestBase):
     def setUp(self):
         HTTPClientTestBase.setUp(self)
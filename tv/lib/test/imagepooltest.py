@@ -0,0 +1,167 @@
+import os
+import shutil
+
+from miro.frontends.widgets import imagepool
+from miro.plat import resources
+from miro.test import mock
+from miro.test.framework import MiroTestCase
+
+class ImagePoolTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        # 122x122 image
+        self.path = os.path.join(self.tempdir, 'image.png')
+        shutil.copyfile(
+            resources.path('images/album-view-default-audio.png'), self.path)
+        self.size = (50, 50)
+        imagepool.stats.reset()
+        imagepool.background_loader.pruned_disk_cache = True
+        # call_in_thread() calls are run by run_thread_calls()
+        self.thread_calls = []
+        self.patch_function('miro.eventloop.call_in_thread',
+                            self.fake_call_in_thread)
+        self.patch_function(
+            'miro.frontends.widgets.imagepool.call_on_ui_thread',
+            lambda func, *args: func(*args))
+        self.loaded = []
+        self.loaded_handle = imagepool.background_loader.connect(
+            'image-loaded', self.on_loaded)
+
+    def tearDown(self):
+        imagepool.background_loader.disconnect(self.loaded_handle)
+        imagepool.clear_cache_for_path(self.path)
+        MiroTestCase.tearDown(self)
+
+    def fake_call_in_thread(self, callback, errback, function, name,
+                            *args, **kwargs):
+        self.thread_calls.append((callback, errback, function, args))
+
+    def run_thread_calls(self):
+        calls, self.thread_calls = self.thread_calls, []
+        for callback, errback, function, args in calls:
+            try:
+                result = function(*args)
+            except StandardError, e:
+                errback(e)
+            else:
+                callback(result)
+
+    def on_loaded(self, loader, path, size):
+        self.loaded.append((path, size))
+
+    def cache_files(self):
+        return os.listdir(imagepool._disk_cache_dir())
+
+    def test_disk_cache(self):
+        pixels, from_disk_cache, elapsed = imagepool.load_pixels(self.path,
+                                                                 self.size)
+        self.assertEquals(from_disk_cache, False)
+        self.assertEquals(pixels[:2], self.size)
+        self.assertEquals(len(self.cache_files()), 1)
+        pixels, from_disk_cache, elapsed = imagepool.load_pixels(self.path,
+                                                                 self.size)
+        self.assertEquals(from_disk_cache, True)
+        self.assertEquals(pixels[:2], self.size)
+        # load_image() uses the disk cache, but doesn't add to it
+        image, from_disk_cache, elapsed = imagepool.load_image(self.path,
+                                                               self.size)
+        self.assertEquals(from_disk_cache, True)
+        self.assertEquals((image.width, image.height), self.size)
+        imagepool.load_image(self.path, (30, 30))
+        self.assertEquals(len(self.cache_files()), 1)
+
+    def test_disk_cache_key(self):
+        imagepool.load_pixels(self.path, self.size)
+        imagepool.load_pixels(self.path, (30, 30))
+        self.assertEquals(len(self.cache_files()), 2)
+        # changing the file means the cached images can't be used
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+        pixels, from_disk_cache, elapsed = imagepool.load_pixels(self.path,
+                                                                 self.size)
+        self.assertEquals(from_disk_cache, False)
+        self.assertEquals(len(self.cache_files()), 3)
+
+    def test_scale_geometry(self):
+        # crop the sides of wide images and the top/bottom of tall ones
+        self.assertEquals(imagepool.scale_geometry(200, 100, 50, 50),
+                          ((50.0, 0, 100.0, 100), 50, 50))
+        self.assertEquals(imagepool.scale_geometry(100, 200, 50, 50),
+                          ((0, 50.0, 100, 100.0), 50, 50))
+        # small images only get scaled up along one dimension
+        self.assertEquals(imagepool.scale_geometry(40, 20, 50, 50),
+                          (None, 50, 25))
+        self.assertEquals(imagepool.scale_geometry(10, 10, 50, 50), None)
+
+    def test_prune(self):
+        cache_dir = imagepool._disk_cache_dir()
+        os.makedirs(cache_dir)
+        for i in xrange(5):
+            path = os.path.join(cache_dir, '%d.png' % i)
+            open(path, 'wb').close()
+            os.utime(path, (1000 + i, 1000 + i))
+        imagepool.prune_disk_cache(max_size=5)
+        self.assertEquals(len(self.cache_files()), 5)
+        imagepool.prune_disk_cache(max_size=3)
+        self.assertEquals(sorted(self.cache_files()),
+                          ['2.png', '3.png', '4.png'])
+
+    def test_stats(self):
+        pool_hits = imagepool._imagepool.hits
+        pool_misses = imagepool._imagepool.misses
+        imagepool.get(self.path, self.size)
+        imagepool.get(self.path, self.size)
+        self.assertEquals(imagepool.stats.hits, 1)
+        self.assertEquals(imagepool.stats.misses, 1)
+        imagepool.clear_cache_for_path(self.path)
+        imagepool.load_pixels(self.path, self.size)
+        imagepool.get(self.path, self.size)
+        self.assertEquals(imagepool.stats.disk_hits, 1)
+        # each lookup should only be counted once
+        self.assertEquals(imagepool._imagepool.hits - pool_hits, 1)
+        self.assertEquals(imagepool._imagepool.misses - pool_misses, 2)
+
+    def test_async_load(self):
+        get_surface = lambda: imagepool.get_surface_async(
+            self.path, self.size, placeholder='placeholder')
+        self.assertEquals(get_surface(), 'placeholder')
+        self.assertEquals(get_surface(), 'placeholder')
+        # only one load should be started
+        self.assertEquals(len(self.thread_calls), 1)
+        self.run_thread_calls()
+        self.assertEquals(self.loaded, [(self.path, self.size)])
+        surface = get_surface()
+        self.assertEquals((surface.width, surface.height), self.size)
+        self.assertEquals(get_surface(), surface)
+        self.assertEquals(imagepool.stats.misses, 1)
+        self.assertEquals(imagepool.stats.hits, 2)
+        self.assertEquals(len(self.cache_files()), 1)
+
+    def test_async_load_from_disk_cache(self):
+        imagepool.load_pixels(self.path, self.size)
+        self.assertEquals(imagepool.get_surface_async(self.path, self.size),
+                          None)
+        self.run_thread_calls()
+        self.assertEquals(imagepool.stats.disk_hits, 1)
+        surface = imagepool.get_surface_async(self.path, self.size)
+        self.assertEquals((surface.width, surface.height), self.size)
+
+    def test_async_load_error(self):
+        os.remove(self.path)
+        imagepool.get_surface_async(self.path, self.size)
+        with self.allow_warnings():
+            self.run_thread_calls()
+        self.assertEquals(self.loaded, [(self.path, self.size)])
+        self.assertEquals(imagepool.get(self.path, self.size),
+                          imagepool.broken_image)
+
+    @mock.patch('miro.frontends.widgets.imagepool._load_scaled_pixels', None)
+    def test_async_load_on_ui_thread(self):
+        # without a way to decode images outside the UI thread, they get
+        # loaded like get() does
+        imagepool.get_surface_async(self.path, self.size)
+        self.assertEquals(self.thread_calls, [])
+        self.assertEquals(self.loaded, [(self.path, self.size)])
+        surface = imagepool.get_surface_async(self.path, self.size)
+        self.assertEquals((surface.width, surface.height), self.size)
+        self.assert_(not os.path.exists(imagepool._disk_cache_dir()))
@@ -0,0 +1,169 @@
+import os
+import shutil
+
+from miro import inotifywatch
+from miro.test.framework import EventLoopTest, only_on_platforms
+
+@only_on_platforms('linux')
+class InotifyWatcherTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.dir = self.make_temp_dir_path()
+        self.watcher = None
+        self.added = []
+        self.deleted = []
+
+    def tearDown(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+        EventLoopTest.tearDown(self)
+
+    def start_watcher(self, skip_dirs=None):
+        self.watcher = inotifywatch.InotifyDirectoryWatcher(self.dir,
+                                                            skip_dirs)
+        # send signals as soon as we process the timeout
+        self.watcher.coalesce_delay = 0.0
+        self.watcher.connect('added', self.on_added)
+        self.watcher.connect('deleted', self.on_deleted)
+        self.runPendingIdles()
+
+    def on_added(self, watcher, path):
+        self.added.append(path)
+
+    def on_deleted(self, watcher, path):
+        self.deleted.append(path)
+
+    def path(self, *parts):
+        return os.path.join(self.dir, *parts)
+
+    def write_file(self, *parts):
+        f = open(self.path(*parts), 'w')
+        f.write('data')
+        f.close()
+
+    def process_events(self):
+        # new directories get watched in idle callbacks, which can generate
+        # more events, so do this a couple times
+        for i in xrange(2):
+            self.watcher._read_events()
+            self.runPendingIdles()
+        self.run_pending_timeouts()
+
+    def check_changes(self, added=(), deleted=()):
+        self.assertSameSet(self.added, [self.path(*p.split('/'))
+                                        for p in added])
+        self.assertSameSet(self.deleted, [self.path(*p.split('/'))
+                                          for p in deleted])
+        self.added = []
+        self.deleted = []
+
+    def test_added(self):
+        self.start_watcher()
+        self.write_file('a.mp3')
+        self.write_file('b.mp3')
+        self.process_events()
+        self.check_changes(added=['a.mp3', 'b.mp3'])
+
+    def test_deleted(self):
+        self.write_file('a.mp3')
+        self.start_watcher()
+        os.remove(self.path('a.mp3'))
+        self.process_events()
+        self.check_changes(deleted=['a.mp3'])
+
+    def test_subdirectories(self):
+        os.mkdir(self.path('old'))
+        self.write_file('old', 'a.mp3')
+        self.start_watcher()
+        # files in existing subdirectories should get noticed
+        self.write_file('old', 'b.mp3')
+        # so should new subdirectories, including any files that got
+        # written before we started watching them
+        os.makedirs(self.path('new', 'deeper'))
+        self.write_file('new', 'c.mp3')
+        self.write_file('new', 'deeper', 'd.mp3')
+        self.process_events()
+        self.check_changes(added=['old/b.mp3', 'new/c.mp3',
+                                  'new/deeper/d.mp3'])
+
+    def test_directory_removed(self):
+        os.makedirs(self.path('album', 'disc2'))
+        self.write_file('album', 'a.mp3')
+        self.write_file('album', 'disc2', 'b.mp3')
+        self.start_watcher()
+        shutil.rmtree(self.path('album'))
+        self.process_events()
+        self.check_changes(deleted=['album/a.mp3', 'album/disc2/b.mp3'])
+
+    def test_directory_moved(self):
+        os.mkdir(self.path('album'))
+        self.write_file('album', 'a.mp3')
+        self.start_watcher()
+        os.rename(self.path('album'), self.path('renamed'))
+        self.process_events()
+        self.check_changes(added=['renamed/a.mp3'], deleted=['album/a.mp3'])
+
+    def test_coalesce(self):
+        self.write_file('a.mp3')
+        self.start_watcher()
+        # a file that comes and goes in the same batch shouldn't get
+        # reported
+        self.write_file('temp.mp3')
+        os.remove(self.path('temp.mp3'))
+        # neither should replacing a file
+        self.write_file('a.mp3.part')
+        os.rename(self.path('a.mp3.part'), self.path('a.mp3'))
+        self.process_events()
+        self.check_changes()
+
+    def test_batching(self):
+        self.start_watcher()
+        self.watcher.coalesce_delay = 60.0
+        self.write_file('a.mp3')
+        self.watcher._read_events()
+        self.run_pending_timeouts()
+        # we should wait for things to quiet down before sending signals
+        self.check_changes()
+        self.watcher._flush_dc.cancel()
+        self.watcher._flush()
+        self.check_changes(added=['a.mp3'])
+
+    def test_overflow(self):
+        self.write_file('a.mp3')
+        os.mkdir(self.path('sub'))
+        self.start_watcher()
+        self.write_file('sub', 'b.mp3')
+        os.remove(self.path('a.mp3'))
+        # throw away the events, then pretend that the queue overflowed
+        os.read(self.watcher.fd, inotifywatch.READ_SIZE)
+        with self.allow_warnings():
+            self.watcher._handle_event(-1, inotifywatch.IN_Q_OVERFLOW, '')
+        self.process_events()
+        self.check_changes(added=['sub/b.mp3'], deleted=['a.mp3'])
+
+    def test_skip_dirs(self):
+        os.mkdir(self.path('skip'))
+        self.start_watcher(skip_dirs=[self.path('skip')])
+        self.write_file('skip', 'a.mp3')
+        self.write_file('b.mp3')
+        self.process_events()
+        self.check_changes(added=['b.mp3'])
+
+    def test_stop(self):
+        self.start_watcher()
+        self.watcher.stop()
+        self.write_file('a.mp3')
+        self.runPendingIdles()
+        self.run_pending_timeouts()
+        self.check_changes()
+
+    def test_stop_before_watching(self):
+        # stopping before the idle callback that adds the watches runs
+        # shouldn't make the callback fail
+        self.write_file('a.mp3')
+        self.watcher = inotifywatch.InotifyDirectoryWatcher(self.dir, None)
+        self.watcher.connect('added', self.on_added)
+        self.watcher.stop()
+        self.runPendingIdles()
+        self.run_pending_timeouts()
+        self.check_changes()
@@ -306,6 +306,56 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
             self.assertNotEquals(row, None)
         self.check_tracker_items()
 
+    def set_idle_chunk_size(self, size):
+        self.tracker.MIN_IDLE_CHUNK_SIZE = size
+        self.tracker.MAX_IDLE_CHUNK_SIZE = size
+        self.tracker.idle_chunk_size = size
+
+    def loaded_rows(self):
+        return set(self.tracker.get_index(id_)
+                   for id_ in self.tracker.row_data)
+
+    def test_background_fetch_visible_rows_first(self):
+        self.set_idle_chunk_size(2)
+        self.tracker.set_visible_range(8, 8)
+        # rows around the visible range should be fetched first
+        self.run_tracker_idle()
+        self.assertEquals(self.loaded_rows(), set([7, 8]))
+        self.run_tracker_idle()
+        self.assertEquals(self.loaded_rows(), set([7, 8, 9]))
+        # then we go back to fetching from the start of the list
+        self.run_tracker_idle()
+        self.assertEquals(self.loaded_rows(), set([0, 1, 7, 8, 9]))
+        self.run_all_tracker_idles()
+        self.assertEquals(self.loaded_rows(), set(range(10)))
+        self.check_tracker_items()
+
+    def test_background_fetch_cursor(self):
+        self.set_idle_chunk_size(3)
+        self.run_tracker_idle()
+        self.assertEquals(self.tracker.load_cursor, 0)
+        self.run_tracker_idle()
+        self.assertEquals(self.tracker.load_cursor, 3)
+        self.assertEquals(self.loaded_rows(), set(range(6)))
+        # uncaching a row before the cursor should move it back
+        self.tracker._uncache_row_data([self.tracker.get_row(1).id])
+        self.assertEquals(self.tracker.load_cursor, 1)
+        self.run_tracker_idle()
+        self.assertEquals(self.loaded_rows(), set(range(8)))
+        self.run_all_tracker_idles()
+        self.assertEquals(self.loaded_rows(), set(range(10)))
+
+    def test_idle_chunk_size_adapts(self):
+        self.tracker.idle_chunk_size = 100
+        # fast fetches should increase the chunk size, slow ones decrease it
+        self.tracker._adjust_idle_chunk_size(100, 0.001)
+        self.assertTrue(self.tracker.idle_chunk_size > 100)
+        self.tracker.idle_chunk_size = 100
+        self.tracker._adjust_idle_chunk_size(100, 1.0)
+        self.assertTrue(self.tracker.idle_chunk_size < 100)
+        self.assertTrue(self.tracker.idle_chunk_size >=
+                        self.tracker.MIN_IDLE_CHUNK_SIZE)
+
     def check_items_changed_after_message(self, changed_items):
         self.process_items_changed_messages()
         signal_args = self.check_one_signal('items-changed')
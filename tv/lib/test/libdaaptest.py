@@ -0,0 +1,383 @@
+import errno
+import httplib
+import os
+import select
+import socket
+import threading
+import time
+
+from miro import libdaap
+from miro.libdaap import subr
+from miro.test.framework import MiroTestCase, only_on_platforms
+
+class DMAPCodecTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.reply = [('adbs', [
+            ('mstt', libdaap.DAAP_OK),
+            ('muty', 0),
+            ('mtco', 2),
+            ('mrco', 2),
+            ('mlcl', [
+                ('mlit', [('mikd', libdaap.DAAP_ITEMKIND_AUDIO),
+                          ('miid', 1),
+                          ('minm', 'First'),
+                          ('assz', 4000000)]),
+                ('mlit', [('mikd', libdaap.DAAP_ITEMKIND_AUDIO),
+                          ('miid', 2),
+                          ('minm', ''),
+                          ('astm', 180000)]),
+            ]),
+            ('mudl', [('miid', 3)]),
+        ])]
+
+    def encode(self, reply):
+        return str(subr.encode_response(reply))
+
+    def test_round_trip(self):
+        decoded = subr.decode_response(self.encode(self.reply))
+        self.assertEquals(decoded, self.reply)
+        # encoding the decoded reply should get us the same bytes back
+        self.assertEquals(self.encode(decoded), self.encode(self.reply))
+
+    def test_encoding(self):
+        data = self.encode([('mlit', [('miid', 1), ('minm', 'ab')]),
+                            ('mstt', 200)])
+        self.assertEquals(data,
+                          'mlit\x00\x00\x00\x16'
+                          'miid\x00\x00\x00\x04\x00\x00\x00\x01'
+                          'minm\x00\x00\x00\x02ab'
+                          'mstt\x00\x00\x00\x04\x00\x00\x00\xc8')
+
+    def test_unicode(self):
+        data = self.encode([('minm', u'caf\xe9')])
+        self.assertEquals(subr.decode_response(data),
+                          [('minm', 'caf\xc3\xa9')])
+
+    def test_bad_value_skipped(self):
+        # values that don't pack are left out
+        decoded = subr.decode_response(self.encode([('miid', None),
+                                                    ('mstt', 200)]))
+        self.assertEquals(decoded, [('mstt', 200)])
+
+    def test_lazy_containers(self):
+        decoded = subr.decode_response(self.encode(self.reply))
+        container = decoded[0][1]
+        self.assert_(isinstance(container, subr.DmapContainer))
+        self.assertEquals(container[0], ('mstt', libdaap.DAAP_OK))
+        listing = subr.find_daap_tag('mlcl', decoded)
+        self.assertEquals(len(listing), 2)
+        self.assertEquals(subr.find_daap_tag('minm', listing), 'First')
+        self.assertEquals(subr.find_daap_tag('mudl', decoded), [('miid', 3)])
+
+    def test_truncated(self):
+        data = self.encode(self.reply)
+        self.assertEquals(subr.decode_response(data[:-2]), [(-1, [])])
+        self.assertEquals(subr.decode_response(data[:5]), [(-1, [])])
+
+    def test_bad_container(self):
+        # a container that lies about its contents only breaks itself
+        inner = 'miid\x00\x00\x00\x09\x00\x00\x00\x01'
+        data = ('mlit' + '\x00\x00\x00\x0c' + inner[:12] +
+                'mstt\x00\x00\x00\x04\x00\x00\x00\xc8')
+        decoded = subr.decode_response(data)
+        self.assertEquals(decoded[0][1], [(-1, [])])
+        self.assertEquals(decoded[1], ('mstt', 200))
+
+    def test_gzip(self):
+        data = self.encode(self.reply)
+        stream = subr.encode_response(self.reply, content_encoding='gzip')
+        self.assertEquals(stream.get_headers(),
+                          [('Content-encoding', 'gzip')])
+        reply = subr.EncodedReply(data)
+        self.assertEquals(str(reply.get_stream()), data)
+        gzdata = reply.get_stream('gzip').data
+        self.assert_(reply.get_stream('gzip').data is gzdata)
+
+class DaapClientDecodeTest(MiroTestCase):
+    def test_decode_listing(self):
+        reply = [('adbs', [
+            ('mstt', libdaap.DAAP_OK),
+            ('mlcl', [
+                ('mlit', [('miid', 1), ('minm', 'First'), ('astm', 1000)]),
+                ('mlit', [('miid', 2), ('minm', 'Second')]),
+            ]),
+            ('mudl', [('miid', 3), ('miid', 4)]),
+        ])]
+        data = str(subr.encode_response(reply))
+        client = libdaap.make_daap_client('localhost')
+        items, deleted = client.decode_listing(
+            data, 'dmap.itemid,dmap.itemname,daap.songtime,bogus.meta')
+        self.assertEquals(items, {
+            1: {'dmap.itemid': 1, 'dmap.itemname': 'First',
+                'daap.songtime': 1000},
+            2: {'dmap.itemid': 2, 'dmap.itemname': 'Second',
+                'daap.songtime': None},
+        })
+        self.assertEquals(deleted, [3, 4])
+
+class ChunkedStreamTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.data = ''.join(chr(i % 256) for i in xrange(50000))
+        self.path = os.path.join(self.tempdir, 'song.mp3')
+        f = open(self.path, 'wb')
+        f.write(self.data)
+        f.close()
+
+    def open_stream(self, start=0, end=0, use_sendfile=True):
+        file_obj = open(self.path, 'rb')
+        file_obj.seek(start)
+        return subr.ChunkedStreamObj(file_obj, self.path, start, end,
+                                     use_sendfile=use_sendfile)
+
+    def recv_all(self, sock, size):
+        data = []
+        while size > 0:
+            chunk = sock.recv(size)
+            if not chunk:
+                break
+            data.append(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    @only_on_platforms('linux')
+    def test_sendfile(self):
+        stream = self.open_stream(1000, 1999)
+        self.assert_(stream.can_sendfile())
+        self.assertEquals(stream.get_rangetext(), 'bytes 1000-1999/50000')
+        sender, receiver = socket.socketpair()
+        try:
+            self.assertEquals(stream.send_to(sender), 1000)
+            self.assertEquals(self.recv_all(receiver, 1000),
+                              self.data[1000:2000])
+        finally:
+            sender.close()
+            receiver.close()
+
+    @only_on_platforms('linux')
+    def test_sendfile_timeout(self):
+        # write more than the socket buffers can hold
+        f = open(self.path, 'wb')
+        f.write(self.data * 100)
+        f.close()
+        stream = self.open_stream()
+        sender, receiver = socket.socketpair()
+        try:
+            # nobody reads from receiver, so we should give up
+            stream.DEFAULT_SEND_TIMEOUT = 0.1
+            try:
+                stream.send_to(sender)
+            except IOError, e:
+                self.assertEquals(e.errno, errno.ETIMEDOUT)
+            else:
+                self.fail("send_to() didn't time out")
+            # the socket should be left blocking
+            self.assertEquals(sender.gettimeout(), None)
+        finally:
+            sender.close()
+            receiver.close()
+
+    def test_fallback(self):
+        stream = self.open_stream(1000, use_sendfile=False)
+        self.assert_(not stream.can_sendfile())
+        self.assertEquals(len(stream), 49000)
+        self.assertEquals(''.join(stream), self.data[1000:])
+
+class SessionStatsTest(MiroTestCase):
+    def test_record_transfer(self):
+        server = libdaap.DaapTCPServer(('127.0.0.1', 0),
+                                       libdaap.DaapHttpRequestHandler)
+        try:
+            server.set_maxconn(libdaap.DAAP_MAXCONN)
+            session = server.new_session()
+            server.record_transfer(session, 1000, 0.5)
+            server.record_transfer(session, 3000, 0.5)
+            # unknown sessions get ignored
+            server.record_transfer(session + 1, 1000, 1.0)
+            self.assertEquals(server.get_session_stats(), {
+                session: {'bytes_sent': 4000, 'send_time': 1.0,
+                          'streams': 2, 'rate': 4000.0}
+            })
+            server.del_session(session)
+            self.assertEquals(server.get_session_stats(), {})
+        finally:
+            server.server_close()
+
+class FakeServerBackend(object):
+    """Just enough of a backend to log in, long poll /update and stream a
+    file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.revision = 1
+        self.waiters = []
+
+    def set_revision(self, revision):
+        with self.lock:
+            self.revision = revision
+            waiters = self.waiters
+            self.waiters = []
+            self.condition.notify_all()
+        for callback in waiters:
+            callback(revision)
+
+    def get_revision(self, session, old_revision, request):
+        with self.lock:
+            while self.revision == old_revision:
+                self.condition.wait(1.0)
+                if self.revision == old_revision:
+                    r, w, x = select.select([request], [], [], 0)
+                    if r:
+                        break
+            return self.revision
+
+    def wait_for_revision(self, old_revision, callback):
+        with self.lock:
+            if self.revision == old_revision:
+                self.waiters.append(callback)
+                return
+        callback(self.revision)
+
+    def get_file(self, itemid, generation, ext, session, request_path_func,
+                 offset=0, chunk=None):
+        file_obj = open(self.path, 'rb')
+        file_obj.seek(offset)
+        return file_obj, self.path
+
+    def get_items(self, playlist_id=None, since=0):
+        return {}
+
+    def get_playlists(self):
+        return {}
+
+def wait_for(condition, timeout=5.0):
+    """Wait for condition() to return True for up to timeout seconds."""
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError("timed out waiting for %s" % condition)
+        time.sleep(0.01)
+
+class PooledServerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.data = os.urandom(300000)
+        path = os.path.join(self.tempdir, 'song.mp3')
+        f = open(path, 'wb')
+        f.write(self.data)
+        f.close()
+        self.backend = FakeServerBackend(path)
+        self.server = libdaap.make_daap_server(self.backend, port=0,
+                                               max_conn=2, pooled=True)
+        self.port = self.server.server_address[1]
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.connections = []
+
+    def tearDown(self):
+        for conn in self.connections:
+            conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+        MiroTestCase.tearDown(self)
+
+    def connect(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        self.connections.append(conn)
+        return conn
+
+    def get(self, conn, path, headers={}):
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        return response, response.read()
+
+    def login(self, conn):
+        response, data = self.get(conn, '/login')
+        return subr.find_daap_tag('mlid', subr.decode_response(data))
+
+    def test_update_long_poll(self):
+        conn = self.connect()
+        session = self.login(conn)
+        conn.request('GET', '/update?revision-number=1&session-id=%d' %
+                     session)
+        # the server shouldn't reply until there's a new revision, and it
+        # shouldn't tie up a worker thread waiting for it.
+        wait_for(lambda: len(self.server.parked) == 1)
+        r, w, x = select.select([conn.sock], [], [], 0.2)
+        self.assertEquals(r, [])
+        self.assertEquals(self.server.jobs.qsize(), 0)
+        self.backend.set_revision(2)
+        data = conn.getresponse().read()
+        self.assertEquals(subr.find_daap_tag('musr',
+                                             subr.decode_response(data)), 2)
+        # the connection should still be usable
+        response, data = self.get(conn, '/server-info')
+        self.assertEquals(response.status, libdaap.DAAP_OK)
+
+    def test_update_already_changed(self):
+        conn = self.connect()
+        session = self.login(conn)
+        self.backend.set_revision(5)
+        response, data = self.get(conn,
+            '/update?revision-number=1&session-id=%d' % session)
+        self.assertEquals(subr.find_daap_tag('musr',
+                                             subr.decode_response(data)), 5)
+
+    def test_client_closes_while_waiting(self):
+        conn = self.connect()
+        session = self.login(conn)
+        conn.request('GET', '/update?revision-number=1&session-id=%d' %
+                     session)
+        wait_for(lambda: len(self.server.parked) == 1)
+        conn.close()
+        wait_for(lambda: self.server.connection_count() == 0)
+        # closing the control connection ends the session
+        self.assertEquals(self.server.session_count(), 0)
+
+    def test_stream(self):
+        conn = self.connect()
+        session = self.login(conn)
+        stream_conn = self.connect()
+        response, data = self.get(stream_conn,
+            '/databases/1/items/1.mp3?session-id=%d' % session,
+            headers={'Range': 'bytes=1000-'})
+        self.assertEquals(response.status, libdaap.DAAP_PARTIAL_CONTENT)
+        self.assertEquals(data, self.data[1000:])
+        # the stats get updated after the last byte is sent, which can be
+        # after we've read it
+        wait_for(lambda: self.server.get_session_stats()[session]['streams'])
+        stats = self.server.get_session_stats()[session]
+        self.assertEquals(stats['bytes_sent'], len(self.data) - 1000)
+        self.assertEquals(stats['streams'], 1)
+
+    def test_max_connections(self):
+        # max_conn is 2 sessions, so we allow 8 connections
+        for i in xrange(8):
+            response, data = self.get(self.connect(), '/server-info')
+            self.assertEquals(response.status, libdaap.DAAP_OK)
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        try:
+            # the server should close the connection right away
+            self.assertEquals(sock.recv(1024), '')
+        finally:
+            sock.close()
+        # no matter how many connections there are, the number of threads
+        # stays the same
+        self.assertEquals(len(self.server.threads),
+                          libdaap.DAAP_WORKERS + 1)
+
+    def test_session_timeout(self):
+        self.server.session_timeout = 0.2
+        conn = self.connect()
+        session = self.login(conn)
+        self.assertEquals(self.server.session_count(), 1)
+        # sessions expire from the poller rather than a timer thread
+        self.assert_(not isinstance(self.server.activeconn[session].timer,
+                                    threading.Thread))
+        wait_for(lambda: self.server.session_count() == 0)
+        self.assertEquals(self.server.session_deadlines, {})
@@ -89,11 +89,12 @@ class MockMetadataProcessor(object):
             self.add_task_data(task.source_path, 'mutagen', task_data)
         elif isinstance(task, workerprocess.MovieDataProgramTask):
             self.add_task_data(task.source_path, 'movie-data', task_data)
-        elif isinstance(task, workerprocess.CancelFileOperations):
-            self.canceled_files.update(task.paths)
         else:
             raise TypeError(task)
 
+    def cancel_tasks_for_files(self, paths):
+        self.canceled_files.update(paths)
+
     def exec_codegen(self, codegen_info, path, callback, errback):
         task_data = (callback, errback)
         self.add_task_data(path, 'echonest-codegen', task_data)
@@ -159,6 +160,8 @@ class MetadataManagerTest(MiroTestCase):
         self.net_lookup_enabled = {}
         self.processor = MockMetadataProcessor()
         self.patch_function('miro.workerprocess.send', self.processor.send)
+        self.patch_function('miro.workerprocess.cancel_tasks_for_files',
+                            self.processor.cancel_tasks_for_files)
         self.patch_function('miro.echonest.exec_codegen',
                             self.processor.exec_codegen)
         self.patch_function('miro.echonest.query_echonest',
@@ -1674,11 +1677,12 @@ class TestEchonestQueries(MiroTestCase):
                                 self.callback, self.errback)
 
     def check_grab_url(self, url, query_dict=None, post_vars=None,
-                       write_file=None):
+                       write_file=None, use_cache=False):
         """Check that grab_url was called with a given URL.
         """
         self.assertEquals(mock_grab_url.call_count, 1)
         args, kwargs = mock_grab_url.call_args
+        self.assertEquals(kwargs.pop('use_cache', False), use_cache)
         if post_vars is not None:
             grab_url_post_vars = kwargs.pop('post_vars')
             # handle query specially, since it's a json encoded dict so it can
@@ -1751,7 +1755,7 @@ class TestEchonestQueries(MiroTestCase):
             'artist': [self.query_metadata['artist'].encode('utf-8')],
             'title': [self.query_metadata['title'].encode('utf-8')],
         }
-        self.check_grab_url(search_url, query_dict)
+        self.check_grab_url(search_url, query_dict, use_cache=True)
 
     def check_echonest_grab_url_call_with_code(self):
         """Check the url sent to grab_url to perform our echonest query."""
@@ -1781,7 +1785,7 @@ class TestEchonestQueries(MiroTestCase):
             'bucket': ['tracks', 'id:7digital'],
             'id': [self.query_metadata['echonest_id']],
         }
-        self.check_grab_url(profile_url, query_dict)
+        self.check_grab_url(profile_url, query_dict, use_cache=True)
 
     def send_echonest_reply(self, response_file):
         """Send a reply back from echonest.
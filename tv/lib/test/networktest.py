@@ -339,6 +339,35 @@ class NetworkBufferTest(MiroTestCase):
         # check to make sure the value doesn't change as a result
         self.assertEquals(self.buffer.getValue(), "ONETWOTHREE")
 
+    def test_read_across_chunks(self):
+        self.buffer.addData("ONE")
+        self.buffer.addData("TWO")
+        self.buffer.addData("THREE")
+        self.assertEquals(self.buffer.read(2), "ON")
+        self.assertEquals(self.buffer.read(5), "ETWOT")
+        self.assertEquals(self.buffer.read(100), "HREE")
+        self.assertEquals(self.buffer.length, 0)
+        self.assertEquals(self.buffer.read(), "")
+
+    def test_read_line_across_chunks(self):
+        self.buffer.addData("ONE")
+        self.assertEquals(self.buffer.readline(), None)
+        self.buffer.addData("TWO\r")
+        self.assertEquals(self.buffer.readline(), None)
+        self.buffer.addData("\nTHREE\n")
+        self.assertEquals(self.buffer.readline(), "ONETWO")
+        self.assertEquals(self.buffer.readline(), "THREE")
+        self.assertEquals(self.buffer.readline(), None)
+
+    def test_unread(self):
+        self.buffer.addData("ONE\nTWO")
+        self.assertEquals(self.buffer.read(2), "ON")
+        self.buffer.unread("ON")
+        self.assertEquals(self.buffer.readline(), "ONE")
+        self.buffer.unread("ZERO\n")
+        self.assertEquals(self.buffer.readline(), "ZERO")
+        self.assertEquals(self.buffer.read(), "TWO")
+
 
 class WeirdCloseConnectionTest(AsyncSocketTest):
     def test_close_during_open_connection(self):
@@ -0,0 +1,948 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""performancetest -- Benchmarks for performance sensitive code.
+
+These tests aren't run by default.  Run them by naming this module when
+running the unittests, for example::
+
+    ./run.sh --unittest performancetest
+
+Each benchmark prints its results rather than asserting on timings, since
+those depend on the machine running them.
+"""
+
+import contextlib
+import cPickle
+import glob
+import httplib
+import os
+import resource
+import struct
+import tempfile
+import threading
+import time
+from cStringIO import StringIO
+
+from miro import app
+from miro import directoryscan
+from miro import eventloop
+from miro import feed
+from miro import feedparserutil
+from miro import fileutil
+from miro import libdaap
+from miro.libdaap import subr
+from miro import models
+from miro import net
+from miro import workerprocess
+from miro.data import item
+from miro.data import itemtrack
+from miro.dl_daemon import command
+from miro.dl_daemon import daemon
+from miro.test import testobjects
+from miro.test.libdaaptest import FakeServerBackend, wait_for
+from miro.plat import resources
+from miro.test.framework import MiroTestCase, EventLoopTest
+from miro.xhtmltools import fix_xml_header
+
+def report(name, **results):
+    """Print the results of a benchmark."""
+    parts = ['%s: %s' % (key, results[key]) for key in sorted(results)]
+    print '\n%s -- %s' % (name, ', '.join(parts))
+
+@contextlib.contextmanager
+def count_queries(db):
+    """Count the SQL statements sent to SQLite by a LiveStorage.
+
+    Yields a dict that maps SQL statements to the number of times they were
+    executed.
+    """
+    counts = {}
+    real_time_execute = db._time_execute
+    def _time_execute(sql, values, many):
+        counts[sql] = counts.get(sql, 0) + 1
+        return real_time_execute(sql, values, many)
+    db._time_execute = _time_execute
+    try:
+        yield counts
+    finally:
+        del db._time_execute
+
+class ViewTrackerPerformanceTest(MiroTestCase):
+    """Replay a burst of item changes with a set of live view trackers."""
+
+    feed_count = 20
+    items_per_feed = 250
+    changes = 2000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feeds = []
+        self.items = []
+        app.bulk_sql_manager.start()
+        for i in xrange(self.feed_count):
+            feed = testobjects.make_feed()
+            self.feeds.append(feed)
+            self.items.extend(testobjects.add_items_to_feed(
+                feed, self.items_per_feed))
+        app.bulk_sql_manager.finish()
+        # trackers similar to the ones the backend keeps around
+        self.trackers = []
+        for feed in self.feeds:
+            self.make_tracker(models.Item.feed_view(feed.id))
+            self.make_tracker(models.Item.visible_feed_view(feed.id))
+            self.make_tracker(models.Item.feed_available_view(feed.id))
+        self.make_tracker(models.Item.make_view('pending_manual_download'))
+        self.make_tracker(models.Item.make_view('keep AND NOT expired'))
+        self.make_tracker(models.Item.auto_downloads_view())
+
+    def make_tracker(self, view):
+        tracker = view.make_tracker()
+        self.trackers.append(tracker)
+        return tracker
+
+    def replay_changes(self):
+        start = time.time()
+        with count_queries(app.db) as counts:
+            for i in xrange(self.changes):
+                item = self.items[i % len(self.items)]
+                item.new = not item.new
+                item.signal_change()
+        count_queries_run = sum(count for sql, count in counts.items()
+                                if sql.startswith('SELECT COUNT(*)'))
+        return time.time() - start, count_queries_run
+
+    def test_signal_change_burst(self):
+        compiled = [t for t in self.trackers if t._predicate is not None]
+        python_time, python_queries = self.replay_changes()
+        for tracker in compiled:
+            tracker._predicate = None
+        sql_time, sql_queries = self.replay_changes()
+        report('ViewTracker burst of %d changes, %d trackers (%d compiled)' %
+               (self.changes, len(self.trackers), len(compiled)),
+               python_predicates='%.3fs/%d COUNT queries' % (python_time,
+                                                             python_queries),
+               sql_only='%.3fs/%d COUNT queries' % (sql_time, sql_queries))
+
+class ItemTrackerPerformanceTest(MiroTestCase):
+    """Load every row of large ItemTrackers using idle callbacks."""
+
+    list_sizes = (10000, 50000, 200000)
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.init_data_package()
+        self.feed, items = testobjects.make_feed_with_items(1)
+        self.template_id = items[0].id
+        app.db.finish_transaction()
+        self.item_count = 1
+
+    def add_items(self, count):
+        """Copy our template item until the feed has count items."""
+        app.db.cursor.execute("PRAGMA table_info(item)")
+        columns = [row[1] for row in app.db.cursor.fetchall()]
+        select_columns = ['?' if c == 'id' else c for c in columns]
+        sql = ("INSERT INTO item (%s) SELECT %s FROM item WHERE id=?" %
+               (', '.join(columns), ', '.join(select_columns)))
+        app.db.cursor.execute("SELECT MAX(id) FROM item")
+        next_id = app.db.cursor.fetchone()[0] + 1
+        to_add = count - self.item_count
+        app.db.cursor.executemany(sql, ((next_id + i, self.template_id)
+                                        for i in xrange(to_add)))
+        app.db.finish_transaction()
+        self.item_count = count
+
+    def load_all_rows(self, chunk_size=None):
+        callbacks = []
+        query = itemtrack.ItemTrackerQuery()
+        query.add_condition('feed_id', '=', self.feed.id)
+        query.set_order_by(['release_date'])
+        start = time.time()
+        tracker = itemtrack.ItemTracker(callbacks.append, query,
+                                        item.ItemSource())
+        if chunk_size is not None:
+            tracker.MIN_IDLE_CHUNK_SIZE = chunk_size
+            tracker.MAX_IDLE_CHUNK_SIZE = chunk_size
+            tracker.idle_chunk_size = chunk_size
+        idle_calls = 0
+        while callbacks:
+            callbacks.pop(0)()
+            idle_calls += 1
+        elapsed = time.time() - start
+        self.assertEquals(len(tracker.row_data), self.item_count)
+        tracker.destroy()
+        return elapsed, idle_calls
+
+    def test_background_load(self):
+        for size in self.list_sizes:
+            self.add_items(size)
+            adaptive_time, adaptive_calls = self.load_all_rows()
+            fixed_time, fixed_calls = self.load_all_rows(
+                itemtrack.ItemTracker.FETCH_ROW_CHUNK_SIZE)
+            report('ItemTracker background load of %d rows' % size,
+                   adaptive_chunks='%.3fs/%d idle calls' % (adaptive_time,
+                                                            adaptive_calls),
+                   fixed_chunks='%.3fs/%d idle calls' % (fixed_time,
+                                                         fixed_calls))
+
+class NetworkBufferPerformanceTest(MiroTestCase):
+    """Read framed commands like the ones the downloader daemon sends out of
+    a NetworkBuffer.
+
+    The data arrives in large bursts and gets read in small pieces, so the
+    time per megabyte should stay flat as the bursts get bigger.
+    """
+
+    burst_sizes = (1, 4, 16) # in megabytes
+    command_size = 200
+
+    def make_burst(self, megabytes):
+        command = 'x' * self.command_size
+        frame = struct.pack("Q", len(command)) + command
+        return frame * (megabytes * 1024 * 1024 // len(frame))
+
+    def read_commands(self, buf):
+        header_size = struct.calcsize("Q")
+        count = 0
+        while buf.length >= header_size:
+            (size,) = struct.unpack("Q", buf.read(header_size))
+            buf.read(size)
+            count += 1
+        return count
+
+    def test_framed_commands(self):
+        for megabytes in self.burst_sizes:
+            burst = self.make_burst(megabytes)
+            buf = net.NetworkBuffer()
+            start = time.time()
+            # split the burst up like socket reads would
+            for i in xrange(0, len(burst), 65536):
+                buf.addData(burst[i:i+65536])
+            count = self.read_commands(buf)
+            elapsed = time.time() - start
+            report('NetworkBuffer read of %dMB burst' % megabytes,
+                   commands=count, total='%.3fs' % elapsed,
+                   per_mb='%.3fs' % (elapsed / megabytes))
+
+class StatusBatchPerformanceTest(MiroTestCase):
+    """Send status batches for a lot of active torrents through the daemon
+    encoding, and compare against pickling the commands.  The decode time is
+    what the main process spends.
+    """
+
+    download_count = 300
+    batch_count = 100
+
+    def make_statuses(self, batch):
+        statuses = []
+        for i in xrange(self.download_count):
+            statuses.append({
+                'dlid': 'download%08d' % i,
+                'url': 'http://example.com/%d.torrent' % i,
+                'state': u'downloading',
+                'total_size': 700 * 1024 * 1024,
+                'current_size': batch * 1024 * i,
+                'eta': 3600 - batch,
+                'rate': 1024.0 * (batch % 7),
+                'upload_rate': 512.0 * (batch % 5),
+                'upload_size': batch * 512 * i,
+                'filename': '/tmp/Incomplete Downloads/%d.avi' % i,
+                'start_time': 1330000000.0,
+                'end_time': None,
+                'short_filename': '%d.avi' % i,
+                'reason_failed': '',
+                'short_reason_failed': '',
+                'type': 'BitTorrent',
+                'retry_time': None,
+                'retry_count': -1,
+                'activity': None,
+                'seeders': 10 + batch % 3,
+                'leechers': 5,
+                'connections': 15,
+                'info_hash': 'a' * 40,
+                })
+        return statuses
+
+    def run_batches(self, encode, decode):
+        batches = [self.make_statuses(i) for i in xrange(self.batch_count)]
+        total_bytes = 0
+        encode_time = decode_time = 0.0
+        for statuses in batches:
+            comm = command.BatchUpdateDownloadStatus(None, statuses, False)
+            start = time.time()
+            raw = encode(comm)
+            encode_time += time.time() - start
+            total_bytes += len(raw)
+            start = time.time()
+            decode(raw)
+            decode_time += time.time() - start
+        return '%.3fs encode/%.3fs decode/%dKB' % (encode_time, decode_time,
+                                                  total_bytes // 1024)
+
+    def test_status_batches(self):
+        connection = daemon.Daemon.__new__(daemon.Daemon)
+        marshal = self.run_batches(connection.encode_command,
+                                   connection.decode_command)
+        def pickle_command(comm):
+            return cPickle.dumps(comm, cPickle.HIGHEST_PROTOCOL)
+        pickle = self.run_batches(pickle_command, cPickle.loads)
+        report('%d status batches of %d downloads' % (self.batch_count,
+                                                      self.download_count),
+               marshal=marshal, pickle=pickle)
+
+class FeedCountsPerformanceTest(MiroTestCase):
+    """Read the counts for every feed, like the tab list does at startup and
+    after "update all feeds".
+    """
+
+    feed_count = 500
+    items_per_feed = 20
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        app.bulk_sql_manager.start()
+        self.feeds = []
+        for i in xrange(self.feed_count):
+            feed, items = testobjects.make_feed_with_items(
+                self.items_per_feed)
+            self.feeds.append(feed)
+        app.bulk_sql_manager.finish()
+
+    def read_counts(self):
+        start = time.time()
+        with count_queries(app.db) as counts:
+            for feed in self.feeds:
+                feed.num_downloaded()
+                feed.num_downloading()
+                feed.num_unwatched()
+                feed.num_available()
+        return time.time() - start, sum(counts.values())
+
+    def read_counts_per_feed(self):
+        start = time.time()
+        with count_queries(app.db) as counts:
+            for feed in self.feeds:
+                feed.downloaded_items.count()
+                feed.downloading_items.count()
+                feed.unwatched_items.count()
+                (feed.available_items.count() -
+                 feed.auto_pending_items.count())
+        return time.time() - start, sum(counts.values())
+
+    def test_read_counts(self):
+        models.Feed.counts.invalidate_all()
+        startup_time, startup_queries = self.read_counts()
+        for feed in self.feeds:
+            feed.recalc_counts()
+        update_time, update_queries = self.read_counts()
+        per_feed_time, per_feed_queries = self.read_counts_per_feed()
+        report('Counts for %d feeds' % self.feed_count,
+               startup='%.3fs/%d queries' % (startup_time, startup_queries),
+               update_all='%.3fs/%d queries' % (update_time, update_queries),
+               per_feed='%.3fs/%d queries' % (per_feed_time,
+                                              per_feed_queries))
+
+class UpdatePerformanceTest(MiroTestCase):
+    """Save changes to a lot of items, like marking a big folder watched."""
+
+    item_count = 5000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        app.bulk_sql_manager.start()
+        self.feed, self.items = testobjects.make_feed_with_items(
+            self.item_count)
+        app.bulk_sql_manager.finish()
+
+    def run_updates(self, update):
+        start = time.time()
+        for obj in self.items:
+            obj.new = not obj.new
+            update(obj)
+        app.db.finish_transaction()
+        return time.time() - start
+
+    def test_update_items(self):
+        def literal_ids(obj):
+            # what update_obj() used to do
+            obj.reset_changed_attributes()
+            app.db.execute("UPDATE item SET new=? WHERE id=%s" % obj.id,
+                           (obj.new,), is_update=True)
+        literal_time = self.run_updates(literal_ids)
+        parameter_time = self.run_updates(app.db.update_obj)
+        report('Updating %d items' % self.item_count,
+               literal_ids='%.3fs' % literal_time,
+               id_parameter='%.3fs' % parameter_time)
+
+class WorkerPoolPerformanceTest(EventLoopTest):
+    """Parse saved feeds and read tags from sample media with different
+    numbers of worker processes.
+    """
+
+    process_counts = (1, 2, 4, 8)
+    # each file gets sent this many times, to get a decent amount of work
+    repeat = 20
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        feed_dir = resources.path("testdata/feedparsertests/feeds")
+        self.feed_bodies = [open(path).read()
+                            for path in glob.glob(os.path.join(feed_dir,
+                                                               '*.xml'))]
+        media_dir = resources.path("testdata/metadata")
+        self.media_paths = [os.path.join(media_dir, name)
+                            for name in ('mp3-0.mp3', 'mp3-1.mp3',
+                                         'mp3-2.mp3', 'mp4-0.mp4')]
+
+    def tearDown(self):
+        workerprocess.shutdown()
+        EventLoopTest.tearDown(self)
+
+    def run_tasks(self, process_count, make_tasks):
+        workerprocess.startup(process_count=process_count)
+        tasks = make_tasks()
+        self.finished = 0
+        def callback(msg, result):
+            self.finished += 1
+            if self.finished == len(tasks):
+                self.stopEventLoop(abnormal=False)
+        start = time.time()
+        for msg in tasks:
+            workerprocess.send(msg, callback, callback)
+        self.runEventLoop(600)
+        elapsed = time.time() - start
+        workerprocess.shutdown()
+        return elapsed
+
+    def make_feedparser_tasks(self):
+        return [workerprocess.FeedparserTask(body)
+                for body in self.feed_bodies * self.repeat]
+
+    def make_mutagen_tasks(self):
+        return [workerprocess.MutagenTask(path, self.tempdir)
+                for path in self.media_paths * self.repeat]
+
+    def test_worker_pool(self):
+        results = {}
+        for count in self.process_counts:
+            feed_time = self.run_tasks(count, self.make_feedparser_tasks)
+            tag_time = self.run_tasks(count, self.make_mutagen_tasks)
+            results['%d_processes' % count] = (
+                'feeds %.3fs/tags %.3fs' % (feed_time, tag_time))
+        report('%d feeds and %d media files' % (
+            len(self.feed_bodies) * self.repeat,
+            len(self.media_paths) * self.repeat), **results)
+
+class FeedSpoolPerformanceTest(MiroTestCase):
+    """Compare the peak memory it takes to hand a huge feed body to the
+    worker process in memory with spooling it to a file.
+
+    Each way runs in a forked child, so that one doesn't affect the other's
+    peak RSS.
+    """
+
+    feed_megabytes = 50
+    chunk_size = 16384
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed_path = os.path.join(self.tempdir, 'big-feed.xml')
+        entry = ('<item><title>Entry %d</title><guid>guid-%d</guid>'
+                 '<enclosure url="http://example.com/%d.mpg" /></item>\n')
+        f = open(self.feed_path, 'wb')
+        f.write('<?xml version="1.0"?>\n<rss version="2.0"><channel>\n'
+                '<title>Big Feed</title>\n')
+        i = 0
+        while f.tell() < self.feed_megabytes * 1024 * 1024:
+            f.write(entry % (i, i, i))
+            i += 1
+        f.write('</channel></rss>\n')
+        f.close()
+
+    def read_chunks(self):
+        # simulate libcurl handing us the body in pieces
+        f = open(self.feed_path, 'rb')
+        try:
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            f.close()
+
+    def peak_rss_growth(self, func):
+        """Run func in a child process and return how much it grew the
+        process's peak RSS by (in KB on Linux).
+        """
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_fd)
+                start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                func()
+                end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                os.write(write_fd, str(end - start))
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        result = os.read(read_fd, 100)
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        return int(result)
+
+    def send_in_memory(self):
+        buf = StringIO()
+        for data in self.read_chunks():
+            buf.write(data)
+        html = fix_xml_header(buf.getvalue(), 'utf-8')
+        feed.body_digest(html)
+        cPickle.dumps(workerprocess.FeedparserTask(html),
+                      cPickle.HIGHEST_PROTOCOL)
+
+    def send_spooled(self):
+        fd, path = tempfile.mkstemp(dir=self.tempdir)
+        output = os.fdopen(fd, 'wb')
+        for data in self.read_chunks():
+            output.write(data)
+        output.close()
+        feed.body_file_digest(path)
+        cPickle.dumps(workerprocess.FeedparserTask(None, path, 'utf-8'),
+                      cPickle.HIGHEST_PROTOCOL)
+        os.remove(path)
+
+    def test_peak_rss(self):
+        report('Sending a %dMB feed to the worker' % self.feed_megabytes,
+               in_memory='%dKB' % self.peak_rss_growth(self.send_in_memory),
+               spooled='%dKB' % self.peak_rss_growth(self.send_spooled))
+
+class FeedItemCreationPerformanceTest(EventLoopTest):
+    """Create items for a synthetic feed with lots of new entries.
+
+    The parsed feed goes through RSSFeedImpl.feedparser_callback(), like it
+    does when the worker process finishes parsing a feed.  Reports the total
+    time, the longest stretch that we kept the event loop from running and
+    the number of SQL statements.
+    """
+
+    entry_count = 10000
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        entries = []
+        for i in xrange(self.entry_count):
+            entries.append(
+                '<item><title>Entry %d</title><guid>guid-%d</guid>'
+                '<enclosure url="http://example.com/%d.mpg" '
+                'type="video/mpeg" /></item>' % (i, i, i))
+        body = ('<?xml version="1.0"?><rss version="2.0"><channel>'
+                '<title>Big Feed</title>%s</channel></rss>' %
+                '\n'.join(entries))
+        self.parsed = feedparserutil.parse(body)
+        self.feed = testobjects.make_feed()
+        self.feed.finish_generate_feed(feed.RSSFeedImpl(self.feed.url,
+                                                        self.feed))
+        self.feed.actualFeed.cancel_update_events()
+        app.db.finish_transaction()
+
+    def test_create_items(self):
+        idle_queue = eventloop._eventloop.idle_queue
+        feed_impl = self.feed.actualFeed
+        # pretend that update() sent the feed body to the worker
+        feed_impl.updating = True
+        with count_queries(app.db) as counts:
+            start = last = time.time()
+            feed_impl.feedparser_callback(self.parsed)
+            longest_block = time.time() - last
+            while self.feed.is_updating():
+                last = time.time()
+                if idle_queue.has_pending_idle():
+                    idle_queue.process_next_idle()
+                eventloop._eventloop._add_idles_for_next_loop()
+                longest_block = max(longest_block, time.time() - last)
+            total = time.time() - start
+        self.assertEquals(self.feed.items.count(), self.entry_count)
+        report('Creating items for %d new entries' % self.entry_count,
+               total='%.3fs' % total,
+               longest_block='%.3fs' % longest_block,
+               sql_statements=sum(counts.values()))
+
+class DirectoryScanPerformanceTest(MiroTestCase):
+    """Scan a generated directory tree.
+
+    Compares walking the tree with fileutil.miro_allfiles() to the first
+    (nothing in the snapshot) and second (nothing changed) scans with a
+    DirectorySnapshot.
+    """
+
+    dir_count = 200
+    files_per_dir = 100
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.root = self.make_temp_dir_path()
+        old = time.time() - 60
+        for i in xrange(self.dir_count):
+            directory = os.path.join(self.root, 'dir-%d' % (i // 20),
+                                     'sub-%d' % i)
+            os.makedirs(directory)
+            for j in xrange(self.files_per_dir):
+                open(os.path.join(directory, '%d.mp3' % j), 'w').close()
+        # recently modified directories don't get stored in the snapshot
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            os.utime(dirpath, (old, old))
+        self.snapshot_path = os.path.join(self.tempdir, 'snapshot')
+
+    def scan(self):
+        start = time.time()
+        snapshot = directoryscan.DirectorySnapshot.load(self.root,
+                                                        self.snapshot_path)
+        files = snapshot.walk()
+        snapshot.save()
+        return time.time() - start, len(files), snapshot
+
+    def test_scan(self):
+        start = time.time()
+        file_count = len(list(fileutil.miro_allfiles(self.root)))
+        allfiles_time = time.time() - start
+        first_time, first_count, snapshot = self.scan()
+        second_time, second_count, snapshot = self.scan()
+        self.assertEquals(first_count, file_count)
+        self.assertEquals(second_count, file_count)
+        self.assertEquals(snapshot.dirs_listed, 0)
+        report('Scanning %d files in %d directories' %
+               (file_count, self.dir_count),
+               miro_allfiles='%.3fs' % allfiles_time,
+               first_scan='%.3fs' % first_time,
+               unchanged_scan='%.3fs' % second_time,
+               dirs_skipped=snapshot.dirs_skipped)
+
+class FakeDaapBackend(object):
+    """Just enough of SharingManagerBackend to serve item listings."""
+    def __init__(self, item_count):
+        self.revision = 1
+        self.items = {}
+        for i in xrange(item_count):
+            self.items[i] = {
+                'dmap.itemid': i,
+                'dmap.itemname': 'Track %d' % i,
+                'dmap.containeritemid': i,
+                'daap.songtime': 180000 + i,
+                'daap.songsize': 4000000 + i,
+                'daap.songformat': 'mp3',
+                'daap.songalbumartist': 'Artist %d' % (i // 100),
+                'com.apple.itunes.mediakind': libdaap.DAAP_MEDIAKIND_AUDIO,
+                'path': '/music/%d.mp3' % i,
+                'revision': 1,
+                'valid': True,
+            }
+
+    def change_items(self, count):
+        self.revision += 1
+        for i in xrange(count):
+            self.items[i] = self.items[i].copy()
+            self.items[i]['revision'] = self.revision
+
+    def get_current_revision(self):
+        return self.revision
+
+    def get_items(self, playlist_id=None, since=0):
+        if since:
+            return dict((k, v) for k, v in self.items.iteritems()
+                        if v['revision'] > since)
+        return self.items.copy()
+
+class DaapListingPerformanceTest(MiroTestCase):
+    """Serve item listings for a synthetic 100k item share.
+
+    Compares building the nested reply and encoding it for each request to
+    DaapItemCache's first, repeated, after-a-change and delta listings.
+    """
+
+    item_count = 100000
+    changed_count = 100
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.backend = FakeDaapBackend(self.item_count)
+        self.meta = tuple(libdaap.DEFAULT_DAAP_META.split(','))
+
+    def encode_uncached(self):
+        itemlist = []
+        for itemprop in self.backend.get_items().values():
+            item = [('mikd', libdaap.DAAP_ITEMKIND_AUDIO)]
+            for m in self.meta:
+                if m in itemprop and m in libdaap.dmap_consts_rmap:
+                    item.append((libdaap.dmap_consts_rmap[m], itemprop[m]))
+            itemlist.append(('mlit', item))
+        reply = [('adbs', [('mstt', libdaap.DAAP_OK), ('muty', 0),
+                           ('mtco', len(itemlist)), ('mrco', len(itemlist)),
+                           ('mlcl', itemlist)])]
+        return str(libdaap.encode_response(reply))
+
+    def serve(self, cache, delta=0):
+        start = time.time()
+        listing = cache.get_listing(self.backend, None, self.meta, delta)
+        stream = listing.get_stream('gzip')
+        return time.time() - start, listing, stream
+
+    def test_listing(self):
+        start = time.time()
+        uncached = self.encode_uncached()
+        libdaap.StreamObj(uncached, content_encoding='gzip')
+        uncached_time = time.time() - start
+        cache = libdaap.DaapItemCache()
+        first_time, listing, stream = self.serve(cache)
+        self.assertEquals(listing.data, uncached)
+        repeat_time, repeat, stream = self.serve(cache)
+        self.assert_(repeat is listing)
+        old_revision = self.backend.revision
+        self.backend.change_items(self.changed_count)
+        changed_time, listing, stream = self.serve(cache)
+        delta_time, delta, delta_stream = self.serve(cache, old_revision)
+        report('Serving a %d item listing' % self.item_count,
+               uncached='%.3fs' % uncached_time,
+               first='%.3fs' % first_time,
+               repeat='%.3fs' % repeat_time,
+               after_change='%.3fs' % changed_time,
+               delta='%.3fs' % delta_time,
+               size='%dKB' % (len(listing) // 1024),
+               gzip_size='%dKB' % (len(stream) // 1024))
+
+def old_encode_response(reply):
+    """The string concatenating DMAP encoder that subr used to have."""
+    blob = ''
+    subblob = ''
+    for code, value in reply:
+        nam, typ = libdaap.dmap_consts[code]
+        fmt, size = subr.fmts[typ]
+        if typ == libdaap.DMAP_TYPE_LIST:
+            subblob = old_encode_response(value)
+            size = len(subblob)
+            value = ''
+        if typ == libdaap.DMAP_TYPE_STRING:
+            fmt = str(len(value)) + fmt
+            size = len(value)
+            value = str(buffer(value))
+        fmt = '!4sI' + fmt
+        try:
+            blob += struct.pack(fmt, code, size, value)
+        except struct.error:
+            pass
+        blob += subblob
+    return blob
+
+def old_decode_response(reply):
+    """The string slicing DMAP decoder that subr used to have."""
+    decoded = []
+    try:
+        while reply:
+            headerfmt = '!4sI'
+            headersize = struct.calcsize(headerfmt)
+            code, size = struct.unpack(headerfmt, reply[:headersize])
+            reply = reply[headersize:]
+            realname, realtype = libdaap.dmap_consts[code]
+            realfmt, realsize = subr.fmts[realtype]
+            if realtype == libdaap.DMAP_TYPE_LIST:
+                decoded.append((code, old_decode_response(reply[:size])))
+                reply = reply[size:]
+                continue
+            if realtype == libdaap.DMAP_TYPE_STRING:
+                realfmt = str(size) + realfmt
+            else:
+                if realsize != size:
+                    raise ValueError
+                realfmt = '!' + realfmt
+            realfmtsize = struct.calcsize(realfmt)
+            (value, ) = struct.unpack(realfmt, reply[:realfmtsize])
+            decoded.append((code, value))
+            reply = reply[realfmtsize:]
+        return decoded
+    except (struct.error, KeyError, ValueError), e:
+        return [(-1, [])]
+
+class DMAPCodecPerformanceTest(MiroTestCase):
+    """Encode and decode a large item listing.
+
+    Compares the old string concatenating/slicing DMAP code to subr's
+    encode_response() and decode_response().  Decoding includes walking
+    every item, since subr decodes containers lazily.
+    """
+
+    item_count = 20000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        backend = FakeDaapBackend(self.item_count)
+        meta = libdaap.DEFAULT_DAAP_META.split(',')
+        itemlist = []
+        for itemprop in backend.get_items().values():
+            item = [('mikd', libdaap.DAAP_ITEMKIND_AUDIO)]
+            for m in meta:
+                if m in itemprop and m in libdaap.dmap_consts_rmap:
+                    item.append((libdaap.dmap_consts_rmap[m], itemprop[m]))
+            itemlist.append(('mlit', item))
+        self.reply = [('adbs', [('mstt', libdaap.DAAP_OK), ('muty', 0),
+                                ('mtco', len(itemlist)),
+                                ('mrco', len(itemlist)),
+                                ('mlcl', itemlist)])]
+
+    def walk(self, decoded):
+        count = 0
+        for code, value in decoded:
+            count += 1
+            if isinstance(value, (list, subr.DmapContainer)):
+                count += self.walk(value)
+        return count
+
+    def time_it(self, func, *args):
+        start = time.time()
+        rv = func(*args)
+        return time.time() - start, rv
+
+    def test_codec(self):
+        old_encode_time, old_data = self.time_it(old_encode_response,
+                                                 self.reply)
+        encode_time, data = self.time_it(
+            lambda reply: str(subr.encode_response(reply)), self.reply)
+        self.assertEquals(data, old_data)
+        old_decode_time, old_count = self.time_it(
+            lambda data: self.walk(old_decode_response(data)), data)
+        decode_time, count = self.time_it(
+            lambda data: self.walk(subr.decode_response(data)), data)
+        self.assertEquals(count, old_count)
+        megabytes = len(data) / (1024.0 * 1024.0)
+        report('Encoding/decoding a %d item listing (%.1fMB)' %
+               (self.item_count, megabytes),
+               old_encode='%.1fMB/s' % (megabytes / old_encode_time),
+               encode='%.1fMB/s' % (megabytes / encode_time),
+               old_decode='%.1fMB/s' % (megabytes / old_decode_time),
+               decode='%.1fMB/s' % (megabytes / decode_time))
+
+class DaapServerLoadTest(MiroTestCase):
+    """Serve 200 idle clients waiting on /update plus a few streaming ones.
+
+    Runs the thread per connection server and the pooled one, and reports
+    the number of threads, the streaming throughput and how long it takes
+    to wake up all the idle clients when the revision changes.
+    """
+
+    idle_count = 200
+    stream_count = 4
+    file_size = 20 * 1024 * 1024
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = os.path.join(self.tempdir, 'video.mp4')
+        f = open(self.path, 'wb')
+        f.write(os.urandom(self.file_size))
+        f.close()
+
+    def start_server(self, pooled):
+        backend = FakeServerBackend(self.path)
+        server = libdaap.make_daap_server(backend, port=0, pooled=pooled,
+                max_conn=self.idle_count + self.stream_count + 10)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        return backend, server
+
+    def login(self, conn):
+        conn.request('GET', '/login')
+        data = conn.getresponse().read()
+        return subr.find_daap_tag('mlid', subr.decode_response(data))
+
+    def stream(self, port, results):
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        session = self.login(conn)
+        start = time.time()
+        conn.request('GET', '/databases/1/items/1.mp4?session-id=%d' %
+                     session)
+        response = conn.getresponse()
+        size = 0
+        while True:
+            data = response.read(256 * 1024)
+            if not data:
+                break
+            size += len(data)
+        results.append((size, time.time() - start))
+        conn.close()
+
+    def run_load(self, pooled):
+        threads_before = threading.active_count()
+        backend, server = self.start_server(pooled)
+        port = server.server_address[1]
+        idle = []
+        for i in xrange(self.idle_count):
+            conn = httplib.HTTPConnection('127.0.0.1', port)
+            session = self.login(conn)
+            conn.request('GET', '/update?revision-number=1&session-id=%d' %
+                         session)
+            idle.append(conn)
+        # give the server a moment to get everyone waiting
+        time.sleep(0.5)
+        results = []
+        streamers = [threading.Thread(target=self.stream,
+                                      args=(port, results))
+                     for i in xrange(self.stream_count)]
+        for thread in streamers:
+            thread.start()
+        time.sleep(0.2)
+        server_threads = threading.active_count() - threads_before
+        for thread in streamers:
+            thread.join()
+        start = time.time()
+        backend.set_revision(2)
+        for conn in idle:
+            data = conn.getresponse().read()
+            self.assertEquals(subr.find_daap_tag('musr',
+                subr.decode_response(data)), 2)
+        wake_time = time.time() - start
+        for conn in idle:
+            conn.close()
+        server.shutdown()
+        server.server_close()
+        # let the handler threads exit before the next run counts threads
+        wait_for(lambda: threading.active_count() <= threads_before, 10.0)
+        total_size = sum(size for size, elapsed in results)
+        total_time = max(elapsed for size, elapsed in results)
+        self.assertEquals(total_size, self.file_size * self.stream_count)
+        return server_threads, total_size / total_time / 1e6, wake_time
+
+    def test_load(self):
+        for pooled in (False, True):
+            threads, rate, wake_time = self.run_load(pooled)
+            report('%d idle and %d streaming DAAP clients (%s)' %
+                   (self.idle_count, self.stream_count,
+                    'pooled' if pooled else 'thread per connection'),
+                   threads=threads,
+                   stream_rate='%.1fMB/s' % rate,
+                   wake_time='%.3fs' % wake_time)
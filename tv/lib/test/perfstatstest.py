@@ -0,0 +1,102 @@
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from miro import app
+from miro import eventloop
+from miro import perfstats
+from miro.test.framework import MiroTestCase, EventLoopTest
+
+class HistogramTest(MiroTestCase):
+    def test_percentiles(self):
+        histogram = perfstats.Histogram()
+        for i in xrange(98):
+            histogram.add(0.001)
+        histogram.add(0.1)
+        histogram.add(2.0)
+        self.assertEquals(histogram.count, 100)
+        self.assertAlmostEquals(histogram.total, 2.198)
+        self.assertEquals(histogram.max, 2.0)
+        # percentiles are the upper bound of the bucket they fall into
+        self.assert_(0.001 <= histogram.percentile(50) < 0.002)
+        self.assert_(0.001 <= histogram.percentile(95) < 0.002)
+        self.assert_(0.1 <= histogram.percentile(99) < 0.2)
+        self.assertEquals(histogram.percentile(100), 2.0)
+
+    def test_slow_timings(self):
+        histogram = perfstats.Histogram()
+        histogram.add(1000.0)
+        self.assertEquals(histogram.percentile(50), 1000.0)
+
+    def test_empty(self):
+        histogram = perfstats.Histogram()
+        self.assertEquals(histogram.percentile(99), 0.0)
+        self.assertEquals(histogram.to_dict()['mean'], 0.0)
+
+class TimingStatsTest(MiroTestCase):
+    def test_max_keys(self):
+        stats = perfstats.TimingStats(max_keys=2)
+        stats.record('a', 0.1)
+        stats.record('b', 0.1)
+        stats.record('c', 0.1)
+        stats.record('d', 0.1)
+        stats.record('a', 0.1)
+        self.assertSameSet(stats.histograms.keys(),
+                           ['a', 'b', perfstats.OTHER_KEY])
+        self.assertEquals(stats.histograms['a'].count, 2)
+        self.assertEquals(stats.histograms[perfstats.OTHER_KEY].count, 2)
+
+    def test_statement_shape(self):
+        self.assertEquals(perfstats.statement_shape(
+            "UPDATE item SET new=?\n  WHERE id=123"),
+            "UPDATE item SET new=? WHERE id=?")
+        self.assertEquals(perfstats.statement_shape(
+            "SELECT id FROM item WHERE title='it''s' AND id IN (?, ?, ?)"),
+            "SELECT id FROM item WHERE title=? AND id IN (...)")
+        self.assertEquals(perfstats.statement_shape(
+            "SELECT id FROM item WHERE id IN (?,?)"),
+            "SELECT id FROM item WHERE id IN (...)")
+
+    def test_callback_shape(self):
+        self.assertEquals(perfstats.callback_shape(
+            "idle (delayed call to <function foo at 0x7f3a2c1b>)"),
+            "idle (delayed call to <function foo at 0x?>)")
+
+class PerfStatsRecordingTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        perfstats.reset()
+
+    def tearDown(self):
+        perfstats.disable()
+        perfstats.reset()
+        EventLoopTest.tearDown(self)
+
+    def test_disabled(self):
+        app.db.execute("SELECT COUNT(*) FROM item WHERE id=1")
+        eventloop.add_idle(lambda: None, 'test idle')
+        self.runPendingIdles()
+        self.assertEquals(perfstats.snapshot()['sql'], {})
+        self.assertEquals(perfstats.snapshot()['callbacks'], {})
+
+    def test_enabled(self):
+        perfstats.enable()
+        app.db.execute("SELECT COUNT(*) FROM item WHERE id=1")
+        app.db.execute("SELECT COUNT(*) FROM item WHERE id=2")
+        eventloop.add_idle(lambda: None, 'test idle')
+        self.runPendingIdles()
+        snapshot = perfstats.snapshot()
+        sql_info = snapshot['sql']['SELECT COUNT(*) FROM item WHERE id=?']
+        self.assertEquals(sql_info['count'], 2)
+        self.assertEquals(snapshot['callbacks']['idle (test idle)']['count'],
+                          1)
+
+    def test_write_snapshot(self):
+        perfstats.enable()
+        app.db.execute("SELECT COUNT(*) FROM item")
+        path = self.make_temp_path('.json')
+        perfstats.write_snapshot(path)
+        data = json.load(open(path))
+        self.assertEquals(data['enabled'], True)
+        self.assert_('SELECT COUNT(*) FROM item' in data['sql'])
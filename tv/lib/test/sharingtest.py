@@ -33,6 +33,7 @@ import os
 import sqlite3
 
 from miro import app
+from miro import libdaap
 from miro import messages
 from miro import messagehandler
 from miro import models
@@ -489,6 +490,106 @@ class SharingServerTest(EventLoopTest):
         self.check_daap_list(self.backend.get_items(), new_item_list)
         self.check_daap_item_deleted(self.backend.get_items(), removed)
 
+    def test_get_items_since(self):
+        self.setup_sharing_manager_backend()
+        initial_revision = self.backend.data_set.revision
+        changed = self.audio_items[0]
+        changed.set_user_metadata({'title': u'New title'})
+        changed.signal_change()
+        removed = self.audio_items[-1]
+        removed.remove()
+        self.send_changes_from_trackers()
+        # only the items that changed should be returned
+        changes = self.backend.get_items(since=initial_revision)
+        self.assertSameSet(changes.keys(), [changed.id, removed.id])
+        self.check_daap_item_deleted(changes, removed)
+        # both items were in the audio playlist
+        changes = self.backend.get_items(self.audio_playlist.id,
+                                         since=initial_revision)
+        self.assertSameSet(changes.keys(), [changed.id, removed.id])
+        self.check_daap_item_deleted(changes, removed)
+        changes = self.backend.get_items(self.video_playlist.id,
+                                         since=initial_revision)
+        self.assertEquals(changes, {})
+        # nothing has changed since the current revision
+        self.assertEquals(self.backend.get_items(
+            since=self.backend.get_current_revision()), {})
+
+    def test_wait_for_revision(self):
+        self.setup_sharing_manager_backend()
+        initial_revision = self.backend.get_current_revision()
+        revisions = []
+        self.backend.wait_for_revision(initial_revision, revisions.append)
+        # the callback should wait for the next change
+        self.assertEquals(revisions, [])
+        changed = self.audio_items[0]
+        changed.set_user_metadata({'title': u'New title'})
+        changed.signal_change()
+        self.send_changes_from_trackers()
+        self.assertEquals(revisions, [self.backend.get_current_revision()])
+        # if the revision already changed, the callback runs right away
+        self.backend.wait_for_revision(initial_revision, revisions.append)
+        self.assertEquals(len(revisions), 2)
+        self.assertEquals(self.backend.data_set.revision_waiters, [])
+
+    def get_listing_items(self, listing):
+        data = libdaap.decode_response(listing.data)
+        mlcl = libdaap.find_daap_tag('mlcl', data)
+        return libdaap.find_daap_listitems(mlcl)
+
+    def get_listing_ids(self, listing):
+        return [libdaap.find_daap_tag('miid', item)
+                for item in self.get_listing_items(listing)]
+
+    def test_item_listing_cache(self):
+        self.setup_sharing_manager_backend()
+        initial_revision = self.backend.data_set.revision
+        cache = libdaap.DaapItemCache()
+        meta = tuple(libdaap.DEFAULT_DAAP_META.split(','))
+        listing = cache.get_listing(self.backend, 2, meta, 0)
+        library_items = self.audio_items + self.video_playlist_items
+        self.assertSameSet(self.get_listing_ids(listing),
+                           [i.id for i in library_items])
+        self.assertEquals(cache.records_encoded, len(library_items))
+        # for the same revision, we should send the same data
+        self.assert_(cache.get_listing(self.backend, 2, meta, 0) is listing)
+        gzip_data = listing.get_stream('gzip').data
+        self.assert_(listing.get_stream('gzip').data is gzip_data)
+        # playlists use the cached records
+        playlist_listing = cache.get_listing(self.backend,
+                                             self.audio_playlist.id, meta, 0)
+        self.assertSameSet(self.get_listing_ids(playlist_listing),
+                           [i.id for i in self.audio_items])
+        self.assertEquals(cache.records_encoded, len(library_items))
+        # after a change, only the changed item should get re-encoded
+        changed = self.audio_items[0]
+        changed.set_user_metadata({'title': u'New title'})
+        changed.signal_change()
+        self.send_changes_from_trackers()
+        new_listing = cache.get_listing(self.backend, 2, meta, 0)
+        self.assert_(new_listing is not listing)
+        self.assertEquals(cache.records_encoded, len(library_items) + 1)
+        # delta listings only contain the changes
+        delta = cache.get_listing(self.backend, 2, meta, initial_revision)
+        items = self.get_listing_items(delta)
+        self.assertEquals(len(items), 1)
+        self.assertEquals(libdaap.find_daap_tag('miid', items[0]), changed.id)
+        self.assertEquals(libdaap.find_daap_tag('minm', items[0]),
+                          'New title')
+
+    def test_item_listing_cache_removed_playlist(self):
+        self.setup_sharing_manager_backend()
+        cache = libdaap.DaapItemCache()
+        meta = tuple(libdaap.DEFAULT_DAAP_META.split(','))
+        cache.get_listing(self.backend, 2, meta, 0)
+        cache.get_listing(self.backend, self.audio_playlist.id, meta, 0)
+        self.audio_playlist.remove()
+        self.send_changes_from_trackers()
+        # listings for the old revision, including the removed playlist,
+        # should be dropped
+        cache.get_listing(self.backend, 2, meta, 0)
+        self.assertEquals(cache.listings.keys(), [(2, meta)])
+
     def test_feed_changes(self):
         self.setup_sharing_manager_backend()
         initial_revision = self.backend.data_set.revision
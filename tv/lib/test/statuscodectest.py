@@ -0,0 +1,103 @@
+import marshal
+
+from miro.dl_daemon import command
+from miro.dl_daemon import daemon
+from miro.dl_daemon import statuscodec
+from miro.test.framework import MiroTestCase
+
+class Size(int):
+    # marshal can't handle subclasses of the basic types
+    pass
+
+class StatusCodecTest(MiroTestCase):
+    def make_status(self, dlid='download1', **kwargs):
+        status = {
+            'dlid': dlid,
+            'url': u'http://example.com/video.mp4',
+            'state': u'downloading',
+            'total_size': 1000,
+            'current_size': 10,
+            'rate': 1.5,
+            'eta': None,
+            'filename': '/tmp/video.mp4.part',
+            'reason_failed': u'',
+            'type': 'HTTP',
+            'paused': False,
+            }
+        status.update(kwargs)
+        return status
+
+    def round_trip(self, statuses, cmd_done=False):
+        data = statuscodec.encode(statuses, cmd_done)
+        decoded, decoded_cmd_done = statuscodec.decode(data)
+        self.assertEquals(decoded_cmd_done, cmd_done)
+        self.assertEquals(decoded, statuses)
+        for status, decoded_status in zip(statuses, decoded):
+            for key in status:
+                self.assertEquals(type(status[key]),
+                                  type(decoded_status[key]))
+        return data
+
+    def test_round_trip(self):
+        data = self.round_trip([self.make_status(),
+                                self.make_status('download2',
+                                                 state=u'paused',
+                                                 activity=u'\u4e2d\u6587')],
+                               cmd_done=True)
+        self.assertEquals(data[0], statuscodec.FORMAT_MARSHAL)
+
+    def test_types_preserved(self):
+        self.round_trip([self.make_status(seeders=1)])
+        self.round_trip([self.make_status(seeders=True)])
+        self.round_trip([self.make_status(seeders=1.0)])
+        self.round_trip([self.make_status(seeders=1L)])
+        self.round_trip([self.make_status(type=u'HTTP')])
+
+    def test_pickle_fallback(self):
+        data = statuscodec.encode([self.make_status(total_size=Size(5))],
+                                  False)
+        self.assertEquals(data[0], statuscodec.FORMAT_PICKLE)
+        statuses, cmd_done = statuscodec.decode(data)
+        self.assertEquals(statuses[0]['total_size'], 5)
+
+    def test_truncated_data(self):
+        for status in (self.make_status(), self.make_status(rate=object)):
+            data = statuscodec.encode([status], False)
+            self.assertRaises(statuscodec.StatusCodecError,
+                              statuscodec.decode, data[:-3])
+
+    def test_bad_data(self):
+        self.assertRaises(statuscodec.StatusCodecError,
+                          statuscodec.decode, 'x' + 'data')
+        self.assertRaises(statuscodec.StatusCodecError,
+                          statuscodec.decode, '')
+        data = statuscodec.FORMAT_MARSHAL + marshal.dumps(({}, True))
+        self.assertRaises(statuscodec.StatusCodecError,
+                          statuscodec.decode, data)
+
+class DaemonEncodingTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        # Don't call Daemon.__init__, we just want to test the encoding
+        # methods.
+        self.daemon = daemon.Daemon.__new__(daemon.Daemon)
+
+    def round_trip(self, comm):
+        raw = self.daemon.encode_command(comm)
+        return self.daemon.decode_command(raw)
+
+    def test_status_batch(self):
+        statuses = [{'dlid': 'download1', 'state': u'downloading'}]
+        comm = command.BatchUpdateDownloadStatus(None, statuses, True)
+        decoded = self.round_trip(comm)
+        self.assertEquals(type(decoded), command.BatchUpdateDownloadStatus)
+        self.assertEquals(decoded.command_id, comm.command_id)
+        self.assertEquals(decoded.orig, comm.orig)
+        self.assertEquals(decoded.args, (statuses, True))
+
+    def test_pickled_command(self):
+        comm = command.UpdateConfigCommand(None, 'key', 'value')
+        decoded = self.round_trip(comm)
+        self.assertEquals(type(decoded), command.UpdateConfigCommand)
+        self.assertEquals(decoded.command_id, comm.command_id)
+        self.assertEquals(decoded.args, comm.args)
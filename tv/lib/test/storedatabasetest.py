@@ -612,6 +612,51 @@ class ValidationTest(FakeSchemaTest):
         self.joe.high_scores[1943] = 1234123
         self.assert_object_invalid(self.joe)
 
+class UpdateStatementTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        app.db.finish_transaction()
+        self.statements = []
+        real_time_execute = app.db._time_execute
+        def _time_execute(sql, values, many):
+            self.statements.append((sql, values))
+            return real_time_execute(sql, values, many)
+        app.db._time_execute = _time_execute
+
+    def update_statements(self):
+        return [(sql, values) for (sql, values) in self.statements
+                if sql.startswith('UPDATE')]
+
+    def fetch_name(self, obj):
+        app.db.cursor.execute("SELECT name FROM human WHERE id=?",
+                              (obj.id,))
+        return app.db.cursor.fetchone()[0]
+
+    def test_id_parameter(self):
+        sue = Human(u"sue", 30, 1.6, [])
+        app.db.finish_transaction()
+        self.statements = []
+        self.lee.name = u'lee2'
+        self.lee.signal_change()
+        sue.name = u'sue2'
+        sue.signal_change()
+        # both updates run right away, using the same statement with the id
+        # as a parameter
+        statements = self.update_statements()
+        self.assertEquals(len(statements), 2)
+        self.assertEquals(statements[0][0], statements[1][0])
+        self.assert_(statements[0][0].endswith('WHERE id=?'))
+        self.assertEquals(statements[0][1][-1], self.lee.id)
+        self.assertEquals(statements[1][1][-1], sue.id)
+        self.assertEquals(self.fetch_name(self.lee), 'lee2')
+        self.assertEquals(self.fetch_name(sue), 'sue2')
+
+    def test_missing_row(self):
+        app.db.forget_object(self.lee)
+        app.db.cursor.execute("DELETE FROM human WHERE id=?", (self.lee.id,))
+        self.lee.name = u'lee2'
+        self.assertRaises(KeyError, app.db.update_obj, self.lee)
+
 class CorruptReprTest(FakeSchemaTest):
     # Test what happens when SchemaReprContainer objects have bad data
     # (#12028)
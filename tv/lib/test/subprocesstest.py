@@ -236,7 +236,7 @@ class UnittestWorkerProcessHandler(workerprocess.WorkerProcessHandler):
 
     def handle_slow_running_task(self, msg):
         time.sleep(0.5)
-        return None
+        return os.getpid()
 
 class WorkerProcessTest(EventLoopTest):
     """Test our worker process."""
@@ -299,15 +299,15 @@ class FeedParserTest(WorkerProcessTest):
 
     def test_crash(self):
         # force a crash of our subprocess right after we send the task
-        workerprocess.startup()
-        original_pid = workerprocess._subprocess_manager.process.pid
+        workerprocess.startup(process_count=1)
+        worker = workerprocess._subprocess_manager.workers[0]
+        original_pid = worker.process.pid
         self.send_feedparser_task()
-        workerprocess._subprocess_manager.process.terminate()
+        worker.process.terminate()
         with self.allow_warnings():
             self.runEventLoop(4.0)
         # check that we really restarted the subprocess
-        self.assertNotEqual(original_pid,
-                workerprocess._subprocess_manager.process.pid)
+        self.assertNotEqual(original_pid, worker.process.pid)
         self.check_successful_result()
 
     def test_queue_before_start(self):
@@ -320,6 +320,80 @@ class FeedParserTest(WorkerProcessTest):
         self.runEventLoop(4.0)
         self.check_successful_result()
 
+class WorkerPoolTest(WorkerProcessTest):
+    def setUp(self):
+        WorkerProcessTest.setUp(self)
+        self.results = []
+
+    def collect_result(self, msg, result):
+        self.results.append(result)
+        if len(self.results) == self.expected_results:
+            self.stopEventLoop(abnormal=False)
+
+    def test_tasks_spread_over_processes(self):
+        workerprocess.startup(thread_count=1, process_count=2)
+        self.expected_results = 4
+        for i in xrange(self.expected_results):
+            workerprocess.send(SlowRunningTask(), self.collect_result,
+                               self.errback)
+        self.runEventLoop(6.0)
+        self.assertEquals(self.error, None)
+        self.assertEquals(len(self.results), 4)
+        # each result is the pid of the process that ran it
+        self.assertEquals(len(set(self.results)), 2)
+
+    def test_priority_order(self):
+        # before the processes start, tasks wait in the main process.  They
+        # should be sent out highest priority first.
+        slow_task = SlowRunningTask()
+        feedparser_task = workerprocess.FeedparserTask('')
+        workerprocess.send(slow_task, self.callback, self.errback)
+        workerprocess.send(feedparser_task, self.callback, self.errback)
+        task_queue = workerprocess._miro_task_queue
+        self.assertEquals(task_queue.next_unsent_task(), feedparser_task)
+        self.assertEquals(task_queue.next_unsent_task(), slow_task)
+        self.assertEquals(task_queue.next_unsent_task(), None)
+
+    def test_cancel_unsent_tasks(self):
+        msg = workerprocess.MutagenTask('/foo/bar.mp3', self.tempdir)
+        other_msg = workerprocess.MutagenTask('/foo/baz.mp3', self.tempdir)
+        workerprocess.send(msg, self.callback, self.errback)
+        workerprocess.send(other_msg, self.callback, self.errback)
+        workerprocess.cancel_tasks_for_files(['/foo/bar.mp3'])
+        task_queue = workerprocess._miro_task_queue
+        self.assert_(msg.task_id not in task_queue.tasks_in_progress)
+        self.assertEquals(task_queue.next_unsent_task(), other_msg)
+        self.assertEquals(task_queue.next_unsent_task(), None)
+
+    def test_cancel_sent_tasks(self):
+        # cancelled tasks don't get results, so they shouldn't keep taking up
+        # room in the worker process
+        workerprocess.startup(thread_count=1, process_count=1)
+        worker = workerprocess._subprocess_manager.workers[0]
+        task_queue = workerprocess._miro_task_queue
+        for i in xrange(3):
+            msgs = [workerprocess.MutagenTask('/foo/bar.mp3', self.tempdir)
+                    for j in xrange(2)]
+            for msg in msgs:
+                workerprocess.send(msg, self.callback, self.errback)
+            self.assertEquals(worker.task_ids,
+                              set(msg.task_id for msg in msgs))
+            workerprocess.cancel_tasks_for_files(['/foo/bar.mp3'])
+            self.assertEquals(worker.task_ids, set())
+            for msg in msgs:
+                self.assert_(msg.task_id not in task_queue.tasks_in_progress)
+        # the worker should still get new tasks
+        msg = workerprocess.FeedparserTask('')
+        workerprocess.send(msg, self.callback, self.errback)
+        self.assertEquals(worker.task_ids, set([msg.task_id]))
+        self.runEventLoop(4.0)
+        self.assertEquals(self.error, None)
+        self.assertNotEquals(self.result, None)
+
+    def test_default_process_count(self):
+        count = workerprocess.default_process_count()
+        self.assert_(1 <= count <= workerprocess.MAX_PROCESS_COUNT)
+
 class MovieDataTest(WorkerProcessTest):
 
     def setUp(self):
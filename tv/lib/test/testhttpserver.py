@@ -8,6 +8,7 @@ import BaseHTTPServer
 import hashlib
 import cgi
 import os
+from cStringIO import StringIO
 import posixpath
 import urllib
 import socket
@@ -117,6 +118,8 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         location_header = None
         self.start_pos = self.end_pos = -1
         headers_to_send = []
+        if self.path.startswith('/feeds/'):
+            return self.send_feed_head(self.path[len('/feeds/'):])
         if self.path == '/temp-redirect':
             code = 302
             location_header = self.build_url("test.txt")
@@ -247,6 +250,37 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.end_headers()
         return f
 
+    def send_feed_head(self, name):
+        """Send the headers for a feed added with HTTPServer.set_feed().
+
+        Feeds get an ETag based on their content, so we can simulate
+        servers that send 304 responses.
+        """
+        self.server.feed_requests.append(name)
+        # The server handles one connection at a time, so don't let idle
+        # keep-alive connections block requests for other feeds.
+        self.close_connection = 1
+        try:
+            body = self.server.feeds[name]
+        except KeyError:
+            self.send_error(404, "Feed not found")
+            return None
+        etag = '"%s"' % md5(body)
+        if self.headers.get('if-none-match') == etag:
+            self.send_response(304)
+            self.send_header("Connection", "close")
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        self.send_response(200)
+        self.send_header("Connection", "close")
+        self.send_header("Content-Type", "application/rss+xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return StringIO(body)
+
     def parse_client_digest_auth(self):
         try:
             client_auth = self.headers['authorization']
@@ -314,6 +348,8 @@ class HTTPServer(threading.Thread):
         self.httpserver.close_connection = False
         self.httpserver.allow_resume = True
         self.httpserver.pause_after = -1
+        self.httpserver.feeds = {}
+        self.httpserver.feed_requests = []
         self.event.set()
         try:
             self.httpserver.serve_forever()
@@ -365,3 +401,11 @@ class HTTPServer(threading.Thread):
 
     def pause_after(self, bytes):
         self.httpserver.pause_after = bytes
+
+    def set_feed(self, name, body):
+        """Serve body at /feeds/<name>."""
+        self.httpserver.feeds[name] = body
+
+    def feed_requests(self):
+        """Get the names of the feeds that have been requested so far."""
+        return list(self.httpserver.feed_requests)
@@ -0,0 +1,177 @@
+import os
+import threading
+
+from miro import transcode
+from miro.test.framework import MiroTestCase
+
+class FakeProducer(object):
+    def __init__(self, stream, next_chunk):
+        self.stream = stream
+        self.next_chunk = next_chunk
+        self.finished = False
+        self.requested = []
+
+    def will_produce(self, chunk):
+        return (not self.finished and
+                self.next_chunk <= chunk < self.next_chunk + 2)
+
+    def request_chunk(self, chunk):
+        self.requested.append(chunk)
+
+class SegmentCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.directory = os.path.join(self.tempdir, 'segments')
+        self.cache = transcode.SegmentCache(self.directory, max_size=250)
+        self.stream = ('/videos/foo.avi', 1000, ('params',))
+
+    def add_segment(self, index, data, stream=None):
+        if stream is None:
+            stream = self.stream
+        f, filename = self.cache.new_segment_file()
+        f.write(data)
+        f.close()
+        self.cache.add_segment(stream, index, filename)
+
+    def read_segment(self, index):
+        f = self.cache.open_segment(self.stream, index)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_add_and_open(self):
+        self.add_segment(0, 'a' * 100)
+        self.assertEquals(self.read_segment(0), 'a' * 100)
+        # every caller gets their own file
+        f1 = self.cache.open_segment(self.stream, 0)
+        f2 = self.cache.open_segment(self.stream, 0)
+        self.assertEquals(f1.read(10), 'a' * 10)
+        self.assertEquals(len(f2.read()), 100)
+        f1.close()
+        f2.close()
+        self.assertEquals(self.cache.open_segment(self.stream, 1), None)
+        # if the file changes, the old segments aren't used
+        changed = ('/videos/foo.avi', 2000, ('params',))
+        self.assertEquals(self.cache.open_segment(changed, 0), None)
+
+    def test_eviction(self):
+        self.add_segment(0, 'a' * 100)
+        self.add_segment(1, 'b' * 100)
+        self.read_segment(0)
+        self.add_segment(2, 'c' * 100)
+        # segment 1 was the least recently used
+        self.assertEquals(self.cache.open_segment(self.stream, 1), None)
+        self.assertEquals(self.read_segment(0), 'a' * 100)
+        self.assertEquals(self.read_segment(2), 'c' * 100)
+        self.assertEquals(len(os.listdir(self.directory)), 2)
+        stats = self.cache.stats()
+        self.assertEquals(stats['segments'], 2)
+        self.assertEquals(stats['bytes'], 200)
+        self.assertEquals(stats['evictions'], 1)
+
+    def test_clear_directory(self):
+        self.add_segment(0, 'a' * 100)
+        cache = transcode.SegmentCache(self.directory)
+        self.assertEquals(os.listdir(self.directory), [])
+        self.assertEquals(cache.open_segment(self.stream, 0), None)
+
+    def test_find_producer(self):
+        producer = FakeProducer(self.stream, 5)
+        self.cache.add_producer(producer)
+        self.assertEquals(self.cache.find_producer(self.stream, 5), producer)
+        self.assertEquals(self.cache.find_producer(self.stream, 6), producer)
+        self.assertEquals(self.cache.find_producer(self.stream, 4), None)
+        self.assertEquals(self.cache.find_producer(self.stream, 20), None)
+        self.cache.remove_producer(producer)
+        self.assertEquals(self.cache.find_producer(self.stream, 5), None)
+        self.assertEquals(self.cache.producers, {})
+
+    def start_waiting(self, producer, index):
+        results = []
+        def wait():
+            results.append(self.cache.wait_for_segment(producer, index))
+        thread = threading.Thread(target=wait)
+        thread.start()
+        thread.join(0.1)
+        # we should be waiting on the producer
+        self.assert_(thread.isAlive())
+        return thread, results
+
+    def test_wait_for_segment(self):
+        producer = FakeProducer(self.stream, 5)
+        self.cache.add_producer(producer)
+        thread, results = self.start_waiting(producer, 6)
+        self.assertEquals(producer.requested, [6])
+        self.add_segment(6, 'f' * 10)
+        thread.join(5.0)
+        self.assertEquals(results[0].read(), 'f' * 10)
+        results[0].close()
+
+    def test_wait_for_finished_producer(self):
+        producer = FakeProducer(self.stream, 5)
+        self.cache.add_producer(producer)
+        thread, results = self.start_waiting(producer, 5)
+        producer.finished = True
+        self.cache.producer_changed()
+        thread.join(5.0)
+        self.assertEquals(results, [None])
+
+class TranscodeObjectTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.patch_function('miro.transcode.setup_ffmpeg_presets',
+                            lambda: None)
+        self.cache = transcode.SegmentCache(
+            os.path.join(self.tempdir, 'segments'))
+        self.stream = ('/videos/foo.mp3', 1000, ('params',))
+        media_info = (35, True, 'mp3', 44100, False, None, None)
+        def request_path_func(itemid, ext):
+            return 'daap://127.0.0.1:3689/item.%s?session-id=1' % ext
+        self.transcode_obj = transcode.TranscodeObject(
+            '/videos/foo.mp3', 1, 0, 2, media_info, request_path_func,
+            self.cache, self.stream)
+
+    def tearDown(self):
+        # we never ran transcode(), so let shutdown() go through
+        self.transcode_obj.transcode_gate.set()
+        self.transcode_obj.shutdown()
+        MiroTestCase.tearDown(self)
+
+    def send_segment(self, data):
+        self.transcode_obj.data_callback(data)
+        self.transcode_obj.data_callback('')
+
+    def test_segments_cached(self):
+        self.assert_(self.transcode_obj.will_produce(2))
+        self.assert_(not self.transcode_obj.will_produce(1))
+        self.send_segment('abc')
+        f = self.cache.open_segment(self.stream, 2)
+        self.assertEquals(f.read(), 'abc')
+        f.close()
+        self.assert_(not self.transcode_obj.will_produce(2))
+        self.assert_(self.transcode_obj.will_produce(3))
+        f = self.transcode_obj.get_chunk(2)
+        self.assertEquals(f.read(), 'abc')
+        f.close()
+
+    def test_throttle(self):
+        for i in xrange(transcode.TranscodeObject.buffer_high_watermark):
+            self.send_segment('abc')
+        self.assert_(not self.transcode_obj.chunk_throttle.isSet())
+        self.transcode_obj.request_chunk(3)
+        self.assert_(self.transcode_obj.chunk_throttle.isSet())
+
+    def test_end_of_transcode(self):
+        self.send_segment('abc')
+        self.transcode_obj.data_callback('')
+        self.assert_(not self.transcode_obj.will_produce(3))
+        self.assertEquals(self.transcode_obj.get_chunk(3), None)
+        # the empty end marker shouldn't leave a file behind
+        self.assertEquals(len(os.listdir(self.cache.directory)), 1)
+
+    def test_playlist(self):
+        playlist = self.transcode_obj.get_playlist().read()
+        self.assertEquals(playlist.count('#EXTINF'), 4)
+        self.assert_('http://127.0.0.1:3689/item.ts?session-id=1&chunk=3'
+                     in playlist)
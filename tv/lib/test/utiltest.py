@@ -45,13 +45,17 @@ class MockCache(util.Cache):
     the value passed in and a counter value, incremented each time a new value
     is made.
     """
-    def __init__(self, size):
-        util.Cache.__init__(self, size)
+    def __init__(self, size, max_bytes=None):
+        util.Cache.__init__(self, size, max_bytes)
         self.value_counter = itertools.count()
 
     def create_new_value(self, val, invalidator=None):
         return (val, self.value_counter.next())
 
+class SizedMockCache(MockCache):
+    def value_size(self, value):
+        return len(value)
+
 class AutoFlushingStreamTest(unittest.TestCase):
     def setUp(self):
         unittest.TestCase.setUp(self)
@@ -1061,6 +1065,13 @@ class CacheTestCase(MiroTestCase):
         self.assertEquals(self.cache.get(1), (1, 0))
         self.assertEquals(self.cache.get(3), (3, 1))
 
+    def test_get_cached(self):
+        self.assertEquals(self.cache.get_cached(1), None)
+        self.cache.set(1, 1)
+        self.assertEquals(self.cache.get_cached(1), 1)
+        self.cache.set(2, 2, invalidator=lambda key: True)
+        self.assertEquals(self.cache.get_cached(2), None)
+
     def test_remove(self):
         self.cache.set(1, 1)
         self.cache.remove(1)
@@ -1089,6 +1100,57 @@ class CacheTestCase(MiroTestCase):
         self.assertEquals(self.cache.get(1, invalidator=invalidator),
                           (1, 1))
 
+    def test_lru_order(self):
+        self.cache.get(1)
+        self.cache.get(2)
+        # using 1 again makes 2 the least recently used
+        self.cache.get(1)
+        self.cache.get(3)
+        self.assertEquals(set(self.cache.keys()), set((1, 3)))
+        self.assertEquals(self.cache.evictions, 1)
+
+    def test_invalidators_removed(self):
+        for i in xrange(10):
+            self.cache.set(i, i, invalidator=lambda key: False)
+        self.assertEquals(len(self.cache.nodes), 2)
+
+    def test_stats(self):
+        self.cache.get(1)
+        self.cache.get(1)
+        self.cache.get(1)
+        self.cache.get(2)
+        self.assertEquals(self.cache.hits, 2)
+        self.assertEquals(self.cache.misses, 2)
+        self.assertEquals(self.cache.hit_rate(), 0.5)
+
+    def test_max_bytes(self):
+        cache = SizedMockCache(100, max_bytes=10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        self.assertEquals(cache.total_bytes, 8)
+        cache.set('c', 'cccc')
+        self.assertEquals(set(cache.keys()), set(('b', 'c')))
+        self.assertEquals(cache.total_bytes, 8)
+        cache.remove('b')
+        self.assertEquals(cache.total_bytes, 4)
+        # values bigger than max_bytes are still kept, if they're the only
+        # value in the cache
+        cache.set('d', 'd' * 20)
+        self.assertEquals(set(cache.keys()), set(('d',)))
+
+    def test_value_removed(self):
+        removed = []
+        self.cache.value_removed = lambda key, value: removed.append(key)
+        self.cache.set(1, 1)
+        self.cache.set(1, 2)
+        self.assertEquals(removed, [1])
+        self.cache.set(2, 2)
+        self.cache.set(3, 3)
+        self.assertEquals(removed, [1, 1])
+        self.cache.remove(2)
+        self.cache.remove(2)
+        self.assertEquals(removed, [1, 1, 2])
+
 
 class AlarmTestCase(MiroTestCase):
     @staticmethod
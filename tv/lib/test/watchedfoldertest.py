@@ -1,7 +1,11 @@
 import os
 import shutil
+import time
 
 from miro import app
+from miro import directoryscan
+from miro import feed
+from miro import fileutil
 from miro import models
 from miro import signals
 from miro.test import mock
@@ -13,6 +17,9 @@ class FakeDirectoryWatcher(signals.SignalEmitter):
     def __init__(self, directory, skip_dirs=None):
         signals.SignalEmitter.__init__(self, 'added', 'deleted')
 
+    def stop(self):
+        pass
+
 class WatchedFolderTest(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
@@ -154,3 +161,117 @@ class WatchedFolderTest(EventLoopTest):
         self.feed.actualFeed._make_child(os.path.join(self.dir, 'a.mp3'))
         self.run_feed_update()
         self.check_failed_soft_count(1)
+
+    def test_subdirectories(self):
+        subdir = os.path.join(self.dir, 'sub')
+        os.mkdir(subdir)
+        self.copy_new_file('a.mp3')
+        self.copy_new_file('sub/b.mp3')
+        self.copy_new_file('.hidden.mp3')
+        self.run_feed_update()
+        self.check_items('a.mp3', 'sub/b.mp3')
+
+    def test_scan_in_thread(self):
+        feed._RUN_DIRECTORY_SCAN_INLINE = False
+        try:
+            self.copy_new_file('a.mp3')
+            self.copy_new_file('b.mp3')
+            self.feed.update()
+            self.runPendingIdles()
+            self.processThreads()
+            self.runPendingIdles()
+            self.check_items('a.mp3', 'b.mp3')
+            self.assert_(not self.feed.actualFeed.updating)
+        finally:
+            feed._RUN_DIRECTORY_SCAN_INLINE = True
+
+    def test_remove_cancels_watcher_update(self):
+        self.feed.actualFeed.DIRECTORY_WATCH_UPDATE_TIMEOUT = 10.0
+        self.copy_new_file('a.mp3')
+        self.directory_watcher.emit('added', os.path.join(self.dir, 'a.mp3'))
+        timeout = self.feed.actualFeed._watcher_update_timeout
+        self.assert_(timeout is not None)
+        self.feed.remove()
+        self.assert_(timeout.canceled)
+
+    def test_scan_error(self):
+        def scan_directory(*args):
+            raise OSError("error reading directory")
+        self.patch_function('miro.directoryscan.scan_directory',
+                            scan_directory)
+        with self.allow_warnings():
+            self.run_feed_update()
+        # the update should still finish
+        self.assert_(not self.feed.actualFeed.updating)
+        self.assert_(not self.feed.actualFeed.firstUpdate)
+
+    def test_remove_snapshot(self):
+        self.run_feed_update()
+        snapshot_path = self.feed.actualFeed._snapshot_path()
+        self.assert_(os.path.exists(snapshot_path))
+        self.feed.remove()
+        self.assert_(not os.path.exists(snapshot_path))
+
+class DirectoryScanTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.dir = self.make_temp_dir_path()
+        self.snapshot_path = os.path.join(self.tempdir, 'snapshot')
+        self.source_path = resources.path("testdata/pop.mp3")
+
+    def copy_new_file(self, filename):
+        dest_path = os.path.join(self.dir, filename)
+        shutil.copyfile(self.source_path, dest_path)
+
+    def make_old(self, *dirs):
+        # directories modified in the last couple seconds don't get stored
+        # in the snapshot, so pretend that they were modified a while ago.
+        old = time.time() - 60
+        for path in dirs:
+            os.utime(path, (old, old))
+
+    def scan(self):
+        snapshot = directoryscan.DirectorySnapshot.load(self.dir,
+                                                        self.snapshot_path)
+        files = snapshot.walk()
+        snapshot.save()
+        return snapshot, files
+
+    def test_snapshot(self):
+        subdir = os.path.join(self.dir, 'sub')
+        os.mkdir(subdir)
+        self.copy_new_file('a.mp3')
+        self.copy_new_file('sub/b.mp3')
+        self.make_old(self.dir, subdir)
+        snapshot, files = self.scan()
+        self.assertEquals(snapshot.dirs_listed, 2)
+        self.assertSameSet(files, list(fileutil.miro_allfiles(self.dir)))
+        # nothing changed, we shouldn't need to list any directories
+        snapshot, files = self.scan()
+        self.assertEquals(snapshot.dirs_listed, 0)
+        self.assertEquals(snapshot.dirs_skipped, 2)
+        self.assertSameSet(files, list(fileutil.miro_allfiles(self.dir)))
+        # adding a file changes the directory's mtime, so we should list it
+        # again, but not the other one
+        self.copy_new_file('sub/c.mp3')
+        snapshot, files = self.scan()
+        self.assertEquals(snapshot.dirs_listed, 1)
+        self.assertEquals(snapshot.dirs_skipped, 1)
+        self.assertSameSet(files, list(fileutil.miro_allfiles(self.dir)))
+
+    def test_recent_changes_not_stored(self):
+        self.copy_new_file('a.mp3')
+        snapshot, files = self.scan()
+        # self.dir was just modified, so we can't trust its mtime yet
+        snapshot, files = self.scan()
+        self.assertEquals(snapshot.dirs_listed, 1)
+        self.assertEquals(snapshot.dirs_skipped, 0)
+
+    def test_snapshot_for_other_dir(self):
+        self.copy_new_file('a.mp3')
+        self.make_old(self.dir)
+        self.scan()
+        other_dir = self.make_temp_dir_path()
+        snapshot = directoryscan.DirectorySnapshot.load(other_dir,
+                                                        self.snapshot_path)
+        self.assertEquals(snapshot.dirs, {})
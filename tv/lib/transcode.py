@@ -68,6 +68,10 @@ duration_regex = re.compile('Duration: ')
 has_video_regex = re.compile('Video: \w+( \(hq\))*(, \w+)*(, \d+x\d+)*')
 has_audio_regex = re.compile('Audio: \w+(, \d+ Hz)*')
 
+# Transcoded segments are kept in a SegmentCache on disk, so clients seeking
+# back or several clients playing the same item don't run ffmpeg again.
+SEGMENT_CACHE_SIZE = 500 * 1024 * 1024
+
 class TranscodeManager(object):
     MAX_TRANSCODE_PIPELINES = 5
     def __init__(self):
@@ -230,6 +234,200 @@ class TranscodeRequestHandler(SocketServer.BaseRequestHandler):
                 self.server.obj.data_callback('')
                 return
 
+def transcode_params():
+    """Get the parameters that decide how we transcode files.
+
+    Along with the source file, these determine the segments we produce.
+    """
+    return (TranscodeObject.segment_duration,
+            tuple(get_transcode_video_options()),
+            tuple(get_transcode_audio_options()),
+            tuple(get_transcode_video_copy_options()),
+            tuple(get_transcode_audio_copy_options()))
+
+def segment_stream_key(path):
+    """Get the key for the segments of a transcode of path.
+
+    Raises OSError if path can't be stat'ed.
+    """
+    return (path, os.stat(path).st_mtime, transcode_params())
+
+def _remove_segment_file(filename):
+    try:
+        os.remove(filename)
+    except OSError, e:
+        # On windows, we can't remove files that somebody is reading.
+        # clear_directory() will get it next time.
+        logging.debug('error removing segment file %s: %s', filename, e)
+
+class _SegmentFiles(util.Cache):
+    """LRU index for SegmentCache.
+
+    Values are (filename, size) tuples.  Files get deleted when their values
+    are removed from the cache.
+    """
+    def value_size(self, value):
+        return value[1]
+
+    def value_removed(self, key, value):
+        _remove_segment_file(value[0])
+
+class SegmentCache(object):
+    """Disk-backed cache of transcoded mpegts segments.
+
+    Segments are keyed by their stream key (source path, source mtime and
+    transcode parameters, see segment_stream_key()) and their index.  Once
+    the segment files add up to more than max_size bytes, the least recently
+    used ones are deleted.
+
+    Every open_segment() call gets its own file object, so any number of
+    sessions can read a segment at once.  TranscodeObjects register
+    themselves with add_producer() and requests for a segment that one of
+    them is about to produce wait for it in wait_for_segment() instead of
+    starting another transcode.
+    """
+    def __init__(self, directory, max_size=SEGMENT_CACHE_SIZE):
+        self.directory = directory
+        # lock protects segments and producers.  condition gets signaled
+        # when a segment gets added or a producer changes state.
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.segments = _SegmentFiles(sys.maxint, max_size)
+        # maps stream keys to lists of TranscodeObjects
+        self.producers = {}
+        self.clear_directory()
+
+    def clear_directory(self):
+        # We only keep our index in memory, so anything already in the
+        # directory is left over from an old run.
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+            return
+        for name in os.listdir(self.directory):
+            _remove_segment_file(os.path.join(self.directory, name))
+
+    def new_segment_file(self):
+        """Make a file to write a segment to.
+
+        :returns: (file object, filename) tuple.  Once the segment is
+        written, close the file and pass filename to add_segment().
+        """
+        fd, filename = tempfile.mkstemp(suffix='.ts', dir=self.directory)
+        return os.fdopen(fd, 'w+b'), filename
+
+    def add_segment(self, stream, index, filename):
+        size = os.path.getsize(filename)
+        with self.lock:
+            self.segments.set((stream, index), (filename, size))
+            self.condition.notify_all()
+
+    def _open_segment(self, stream, index):
+        value = self.segments.get_cached((stream, index))
+        if value is None:
+            return None
+        try:
+            return open(value[0], 'rb')
+        except IOError:
+            self.segments.remove((stream, index))
+            return None
+
+    def open_segment(self, stream, index):
+        """Open a cached segment.
+
+        :returns: file object, or None if the segment isn't cached.
+        """
+        with self.lock:
+            return self._open_segment(stream, index)
+
+    def find_producer(self, stream, index):
+        """Find a TranscodeObject that will produce a segment soon."""
+        with self.lock:
+            for producer in self.producers.get(stream, []):
+                if producer.will_produce(index):
+                    return producer
+            return None
+
+    def add_producer(self, producer):
+        with self.lock:
+            self.producers.setdefault(producer.stream, []).append(producer)
+
+    def remove_producer(self, producer):
+        with self.lock:
+            producers = self.producers.get(producer.stream, [])
+            if producer in producers:
+                producers.remove(producer)
+            if not producers:
+                self.producers.pop(producer.stream, None)
+            self.condition.notify_all()
+
+    def producer_changed(self):
+        """Wake up wait_for_segment() after a producer finished or shut down.
+        """
+        with self.lock:
+            self.condition.notify_all()
+
+    def wait_for_segment(self, producer, index):
+        """Wait for producer to produce a segment.
+
+        :returns: file object for the segment, or None if producer finished
+        or shut down without producing it.
+        """
+        with self.lock:
+            while True:
+                file_obj = self._open_segment(producer.stream, index)
+                if file_obj is not None or not producer.will_produce(index):
+                    return file_obj
+                producer.request_chunk(index)
+                self.condition.wait()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'segments': len(self.segments),
+                'bytes': self.segments.total_bytes,
+                'hits': self.segments.hits,
+                'misses': self.segments.misses,
+                'evictions': self.segments.evictions,
+            }
+
+def create_playlist(itemid, duration, request_path_func):
+    """Create the m3u8 playlist for the transcoded chunks of an item."""
+    segment_duration = TranscodeObject.segment_duration
+    nchunks = duration / segment_duration
+    trailer = duration % segment_duration
+    if trailer:
+        nchunks += 1
+    playlist = ''
+    playlist += '#EXTM3U\n'
+    playlist += '#EXT-X-TARGETDURATION:%d\n' % segment_duration
+    playlist += '#EXT-X-MEDIA-SEQUENCE:0\n'
+    playlist += '#EXT-X-ALLOW-CACHE:NO\n'
+    for i in xrange(nchunks):
+        # XXX check corner case
+        # Special case
+        if i == (nchunks - 1) and trailer:
+            chunk_duration = trailer
+        else:
+            chunk_duration = segment_duration
+        playlist += '#EXTINF:%d,\n' % chunk_duration
+        urlpath = request_path_func(itemid, 'ts')
+        # This returns us a pedantically correct path but we want to be
+        # able to use http, which is understood by everybody and is 
+        # what's used by the underlying.
+        urlpath = urlpath.replace('daap://', 'http://')
+        # Append our chunk XXX - bad way to append a query like this
+        urlpath += '&chunk=%d' % i
+        playlist += urlpath + '\n'
+    playlist += '#EXT-X-ENDLIST\n'
+    return playlist
+
+def playlist_file(playlist):
+    tmpf = tempfile.TemporaryFile()
+    tmpf.write(playlist)
+    tmpf.flush()
+    tmpf.seek(0, os.SEEK_SET)
+    return tmpf
+
 # How does the transcoding pipeline work?
 #
 # A media object that needs to be transcoded is basically represented
@@ -257,15 +455,16 @@ class TranscodeRequestHandler(SocketServer.BaseRequestHandler):
 # Miro program: the control pipe and the data pipe.  The data pipe handles
 # outputting the actual mpegts segments while the control pipe handles
 # the signaling.  This mainly allows for two things: (1) to allow the segmenter
-# signal when data is ready, and (2) for throttling.  One advantage of this
-# scheme is there is no need to deal with temporary files on the filesystem.
-# Once a chunk is sent to the client, it is thrown away.
+# signal when data is ready, and (2) for throttling.
+#
+# Each segment gets written to a SegmentCache.  Clients read segments from
+# the cache, so a segment that was transcoded once can be sent to any
+# client that wants it, until it gets evicted.
 #
-# When a client seeks to a position that is not in its current playing chunk
-# and does not have the seeked-to chunk in its cache, it may request
-# the chunk from the server.  In this case, the current transcode operation
-# stops, and a new transcode operation begins at the requested time offset
-# calculated based on which chunk was requested.
+# When a client requests a chunk that isn't cached and that no transcode
+# operation is about to produce, a new transcode operation begins at the
+# requested time offset calculated based on which chunk was requested.
+# The server shuts down a transcode operation once no session is using it.
 class TranscodeObject(object):
     """TranscodeObject
 
@@ -275,6 +474,8 @@ class TranscodeObject(object):
     can support.
 
     This is meant to be a use-once object.  Create, transcode, discard.
+    The segments it produces go to cache, keyed by stream.  Several sessions
+    may share one TranscodeObject: users counts them.
 
     conversions.py is too specialized for what it does, so, hence there may
     be some duplication here.
@@ -292,8 +493,11 @@ class TranscodeObject(object):
     buffer_high_watermark = 6
 
     def __init__(self, media_file, itemid, generation, chunk, media_info,
-                 request_path_func):
+                 request_path_func, cache, stream):
         self.media_file = media_file
+        self.cache = cache
+        self.stream = stream
+        self.users = 0
         self.in_shutdown = False
         if chunk is not None:
             self.time_offset = chunk * TranscodeObject.segment_duration
@@ -333,15 +537,17 @@ class TranscodeObject(object):
         logging.debug('TRANSCODE INFO, trailer %s' % self.trailer)
 
         if chunk is not None:
-            self.current_chunk = self.start_chunk = chunk
+            self.start_chunk = chunk
         else:
-            self.current_chunk = self.start_chunk = 0
-        self.chunk_buffer = []
+            self.start_chunk = 0
+        # chunk_lock protects next_chunk, requested_chunk and finished.
+        # next_chunk is the chunk the segmenter is working on,
+        # requested_chunk is the latest chunk a client asked for.
+        self.next_chunk = self.requested_chunk = self.start_chunk
         self.chunk_throttle = threading.Event()
         self.chunk_throttle.set()
         self.chunk_lock = threading.Lock()
-        self.chunk_sem = threading.Semaphore(0)
-        self.tmp_file = tempfile.TemporaryFile()
+        self.segment_file = self.segment_filename = None
         self.finished = False
 
         self.transcode_gate = threading.Event()
@@ -353,42 +559,32 @@ class TranscodeObject(object):
         self.shutdown()
 
     def create_playlist(self):
-        self.playlist = ''
-        self.playlist += '#EXTM3U\n'
-        self.playlist += ('#EXT-X-TARGETDURATION:%d\n' % 
-                          TranscodeObject.segment_duration)
-        self.playlist += '#EXT-X-MEDIA-SEQUENCE:0\n'
-        self.playlist += '#EXT-X-ALLOW-CACHE:NO\n'
-        for i in xrange(self.nchunks):
-            # XXX check corner case
-            # Special case
-            if i == (self.nchunks - 1) and self.trailer:
-                chunk_duration = self.trailer
-            else:
-                chunk_duration = self.segment_duration
-            self.playlist += '#EXTINF:%d,\n' % chunk_duration
-            urlpath = self.request_path_func(self.itemid, 'ts')
-            # This returns us a pedantically correct path but we want to be
-            # able to use http, which is understood by everybody and is 
-            # what's used by the underlying.
-            urlpath = urlpath.replace('daap://', 'http://')
-            # Append our chunk XXX - bad way to append a query like this
-            urlpath += '&chunk=%d' % i
-            self.playlist += urlpath + '\n'
-        self.playlist += '#EXT-X-ENDLIST\n'
+        self.playlist = create_playlist(self.itemid, self.duration,
+                                        self.request_path_func)
 
     def get_playlist(self):
-        tmpf = tempfile.TemporaryFile()
-        tmpf.write(self.playlist)
-        tmpf.flush()
-        tmpf.seek(0, os.SEEK_SET)
-        return tmpf
-
-    def isseek(self, chunk):
-        # Is it requesting the next available chunk in the sequence?
-        if self.current_chunk == chunk:
-            return False
-        return True
+        return playlist_file(self.playlist)
+
+    def will_produce(self, chunk):
+        """Are we going to produce chunk soon?
+
+        We handle chunks from the one we are working on up to
+        buffer_high_watermark chunks ahead.  Anything else is better served
+        by a new transcode.
+        """
+        with self.chunk_lock:
+            if self.finished or self.in_shutdown:
+                return False
+            return (self.next_chunk <= chunk <
+                    self.next_chunk + TranscodeObject.buffer_high_watermark)
+
+    def request_chunk(self, chunk):
+        """Tell us that a client wants chunk, so we should keep going."""
+        with self.chunk_lock:
+            self.requested_chunk = max(self.requested_chunk, chunk)
+            if (self.next_chunk - self.requested_chunk <
+              TranscodeObject.buffer_high_watermark):
+                self.chunk_throttle.set()
 
     def transcode(self):
         rc = True
@@ -450,35 +646,42 @@ class TranscodeObject(object):
             (typ, value, tb) = sys.exc_info()
             logging.error('ERROR: %s %s' % (str(typ), str(value)))
             rc = False
+            with self.chunk_lock:
+                self.finished = True
+            self.cache.producer_changed()
         self.transcode_gate.set()
         return rc
 
     def data_callback(self, d):
-        self.tmp_file.write(d)
+        if self.segment_file is None:
+            self.segment_file, self.segment_filename = \
+                    self.cache.new_segment_file()
+        self.segment_file.write(d)
         if not d:
-            self.tmp_file.flush()
-            with self.chunk_lock:
+            empty = not self.segment_file.tell()
+            self.segment_file.close()
+            filename = self.segment_filename
+            # ready for next segment
+            self.segment_file = self.segment_filename = None
+            if empty:
                 # This is empty ... we haven't actually written anything.
                 # This an end of transcode marker.
-                if not self.tmp_file.tell():
-                    logging.debug('Transcode: end-of-transcode marker')
+                logging.debug('Transcode: end-of-transcode marker')
+                _remove_segment_file(filename)
+                with self.chunk_lock:
                     self.finished = True
-                else:
-                    self.tmp_file.seek(0, os.SEEK_SET)
-                    self.chunk_buffer.append(self.tmp_file)
-                    chunk_buffer_size = len(self.chunk_buffer)
-                    if (chunk_buffer_size >= 
-                      TranscodeObject.buffer_high_watermark):
-                        logging.debug('TranscodeObject: throttling')
-                        self.chunk_throttle.clear()
-
-            # Tell consumer there is stuff available.  We do this for the
-            # end of transcode marker too.  Why?  Because it may be stuck in
-            # the chunk_sem acquiring state.  This will kick start it.
-            self.chunk_sem.release()
-            # ready for next segment
-            self.tmp_file = tempfile.TemporaryFile()
-           
+                self.cache.producer_changed()
+                return
+            # Add the segment before moving on to the next chunk, so that
+            # will_produce() doesn't give up on it in the meantime.
+            self.cache.add_segment(self.stream, self.next_chunk, filename)
+            with self.chunk_lock:
+                self.next_chunk += 1
+                if (self.next_chunk - self.requested_chunk >=
+                  TranscodeObject.buffer_high_watermark):
+                    logging.debug('TranscodeObject: throttling')
+                    self.chunk_throttle.clear()
+
 
     # Data consumer from segmenter.  Here, we listen for incoming request.
     # no need to handle quit signal - the sink should return a zero read
@@ -503,28 +706,12 @@ class TranscodeObject(object):
             except StandardError:
                 raise
 
-    def get_chunk(self):
-        # End of transcode check: if the transcode returned not enough
-        # chunks, then send an empty file.
-        with self.chunk_lock:
-            if self.finished and not self.chunk_buffer:
-                return tempfile.TemporaryFile()
+    def get_chunk(self, chunk):
+        """Wait for chunk and return a file object for it.
 
-        # Consume an item
-        self.chunk_sem.acquire()
-        with self.chunk_lock:
-            # If we got woken up, and there is nothing there, maybe it's
-            # because the job has been aborted?  If this is the case,
-            # ensure we return a sensible empty file. (or maybe alternatively
-            # an error).
-            if self.chunk_buffer:
-                tmpf = self.chunk_buffer[0]
-                self.current_chunk += 1
-                self.chunk_buffer = self.chunk_buffer[1:]
-                self.chunk_throttle.set()
-            else:
-                tmpf = tempfile.TemporaryFile()
-        return tmpf
+        Returns None if we finished or got shut down before producing it.
+        """
+        return self.cache.wait_for_segment(self, chunk)
 
     # Shutdown the transcode job.  If we quitting, make sure you call this
     # so the segmenter et al have a chance to clean up.
@@ -579,8 +766,13 @@ class TranscodeObject(object):
             # Catch RuntimeError in case sink_thread hasn't been started yet.
             logging.debug('transcode shutdown: sink join %s', e)
 
+        # Throw away the segment we were in the middle of
+        if self.segment_file is not None:
+            self.segment_file.close()
+            _remove_segment_file(self.segment_filename)
+            self.segment_file = self.segment_filename = None
         # Ensure we unblock the get_chunk().
-        self.chunk_sem.release()
+        self.cache.producer_changed()
         logging.info('TranscodeObject sink reaped')
         # Set these last: sink thread relies on it.
         self.ffmpeg_handle = None
@@ -1117,57 +1117,142 @@ def mtime_invalidator(path):
 
     return invalidator
 
+# indexes for the fields of Cache's linked list nodes
+_CACHE_PREV, _CACHE_NEXT, _CACHE_KEY, _CACHE_VALUE, _CACHE_INVALIDATOR, \
+        _CACHE_BYTES = range(6)
+
 class Cache(object):
-    def __init__(self, size):
+    """Least recently used cache.
+
+    Subclasses should implement create_new_value() to create values for
+    keys that aren't in the cache.
+
+    Values are kept in a doubly linked list ordered by how recently they
+    were used, so get(), set() and evicting the least recently used value
+    are all constant-time.
+
+    The cache holds at most size values.  If max_bytes is given, it also
+    holds values whose value_size() add up to at most max_bytes.
+
+    Attributes for tracking how well the cache works:
+    - hits -- number of lookups that found a valid value
+    - misses -- number of lookups that didn't
+    - evictions -- number of values removed to make room for others
+    """
+    def __init__(self, size, max_bytes=None):
         self.size = size
-        self.dict = {}
-        self.counter = itertools.count()
-        self.access_times = {}
-        self.invalidators = {}
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        # maps keys to linked list nodes
+        self.nodes = {}
+        # root of our circular linked list.  root[_CACHE_NEXT] is the most
+        # recently used node, root[_CACHE_PREV] is the least recently used.
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, None, 0]
+
+    def _unlink(self, node):
+        node[_CACHE_PREV][_CACHE_NEXT] = node[_CACHE_NEXT]
+        node[_CACHE_NEXT][_CACHE_PREV] = node[_CACHE_PREV]
+
+    def _link_at_front(self, node):
+        root = self.root
+        node[_CACHE_PREV] = root
+        node[_CACHE_NEXT] = root[_CACHE_NEXT]
+        root[_CACHE_NEXT][_CACHE_PREV] = node
+        root[_CACHE_NEXT] = node
+
+    def _lookup(self, key):
+        """Find the node for a valid value and mark it as recently used.
+
+        Returns None if there's no valid value for key.
+        """
+        node = self.nodes.get(key)
+        if node is not None:
+            invalidator = node[_CACHE_INVALIDATOR]
+            if invalidator is None or not invalidator(key):
+                self._unlink(node)
+                self._link_at_front(node)
+                self.hits += 1
+                return node
+        self.misses += 1
+        return None
 
     def get(self, key, invalidator=None):
-        if key in self.dict:
-            existing_invalidator = self.invalidators[key]
-            if (existing_invalidator is None or
-                not existing_invalidator(key)):
-                self.access_times[key] = self.counter.next()
-                return self.dict[key]
+        node = self._lookup(key)
+        if node is not None:
+            return node[_CACHE_VALUE]
 
         value = self.create_new_value(key, invalidator=invalidator)
         self.set(key, value, invalidator=invalidator)
         return value
 
+    def get_cached(self, key):
+        """Get a value only if it's already in the cache.
+
+        Unlike get(), this never calls create_new_value().  If there's no
+        valid value for key, None is returned.
+        """
+        node = self._lookup(key)
+        if node is not None:
+            return node[_CACHE_VALUE]
+        return None
+
     def set(self, key, value, invalidator=None):
-        if len(self.dict) == self.size:
-            self.shrink_size()
-        self.access_times[key] = self.counter.next()
-        self.dict[key] = value
-        self.invalidators[key] = invalidator
+        self.remove(key)
+        if self.max_bytes is not None:
+            value_bytes = self.value_size(value)
+        else:
+            value_bytes = 0
+        node = [None, None, key, value, invalidator, value_bytes]
+        self._link_at_front(node)
+        self.nodes[key] = node
+        self.total_bytes += value_bytes
+        self.shrink_size()
 
     def remove(self, key):
-        if key in self.dict:
-            del self.dict[key]
-            del self.access_times[key]
-        if key in self.invalidators:
-            del self.invalidators[key]
+        node = self.nodes.pop(key, None)
+        if node is not None:
+            self._unlink(node)
+            self.total_bytes -= node[_CACHE_BYTES]
+            self.value_removed(key, node[_CACHE_VALUE])
 
     def keys(self):
-        return self.dict.iterkeys()
+        return self.nodes.iterkeys()
+
+    def __len__(self):
+        return len(self.nodes)
 
     def shrink_size(self):
-        # shrink by LRU
-        to_sort = self.access_times.items()
-        to_sort.sort(key=lambda m: m[1])
-        new_dict = {}
-        new_access_times = {}
-        new_invalidators = {}
-        latest_times = to_sort[len(self.dict) // 2:]
-        for (key, time) in latest_times:
-            new_dict[key] = self.dict[key]
-            new_invalidators[key] = self.invalidators[key]
-            new_access_times[key] = time
-        self.dict = new_dict
-        self.access_times = new_access_times
+        """Evict least recently used values until we fit inside size and
+        max_bytes.
+        """
+        while len(self.nodes) > self.size or (
+                self.max_bytes is not None and
+                self.total_bytes > self.max_bytes and len(self.nodes) > 1):
+            self.remove(self.root[_CACHE_PREV][_CACHE_KEY])
+            self.evictions += 1
+
+    def hit_rate(self):
+        """Get the fraction of lookups that found a value."""
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def value_size(self, value):
+        """Get the size of a value in bytes.
+
+        Subclasses that use max_bytes should implement this.
+        """
+        return 0
+
+    def value_removed(self, key, value):
+        """Called when a value is removed, replaced or evicted.
+
+        Subclasses can implement this to clean up after their values.
+        """
+        pass
 
     def create_new_value(self, val, invalidator=None):
         raise NotImplementedError()
@@ -30,13 +30,17 @@
 """```workerprocess.py``` -- Miro worker subprocess
 
 To avoid UI freezing due to the GIL, we farm out all CPU-intensive backend
-tasks to this process.  See #17328 for more details.  Right now this just
-includes feedparser, but we could pretty easily extend this to other tasks.
+tasks to worker processes.  See #17328 for more details.  This includes
+feedparser, mutagen and movie data tasks.
+
+We run a pool of worker processes, sized to the number of CPUs, so that
+big jobs like importing a music library can use more than one core.
 """
 
 from collections import deque, namedtuple
 import itertools
 import logging
+import multiprocessing
 import threading
 
 from miro import clock
@@ -71,10 +75,18 @@ class TaskMessage(WorkerMessage):
         self.task_id = TaskMessage._id_counter.next()
 
 class FeedparserTask(TaskMessage):
+    """Parse a feed.
+
+    Pass in either html, the feed body, or body_path, the path to a file
+    containing it.  For large feeds, body_path saves us from pickling the
+    body to send it over.
+    """
     priority = 20
-    def __init__(self, html):
+    def __init__(self, html, body_path=None, charset=None):
         TaskMessage.__init__(self)
         self.html = html
+        self.body_path = body_path
+        self.charset = charset
 
 class MovieDataProgramTask(TaskMessage):
     priority = 10
@@ -192,8 +204,9 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         self.task_queue.cancel_file_operations(path_set)
         # we need to handle main_thread_tasks, since those skip the task
         # queue
-        filtered_tasks = deque(t for t in self.main_thread_tasks
-                               if t.source_path not in path_set)
+        filtered_tasks = deque((method, msg)
+                               for (method, msg) in self.main_thread_tasks
+                               if msg.source_path not in path_set)
         self.main_thread_tasks = filtered_tasks
         return None
 
@@ -209,7 +222,11 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
     # worker threads, so they should only call thread-safe functions
 
     def handle_feedparser_task(self, msg):
-        parsed_feed = feedparserutil.parse(msg.html)
+        if msg.body_path is not None:
+            parsed_feed = feedparserutil.parse_file(msg.body_path,
+                                                    msg.charset)
+        else:
+            parsed_feed = feedparserutil.parse(msg.html)
         # bozo_exception is sometimes C object that is not picklable.  We
         # don't use it anyways, so just unset the value
         parsed_feed['bozo_exception'] = None
@@ -258,12 +275,19 @@ class _SinglePriorityQueue(object):
 
         :param filterfunc: function to determine if messages should stay
         :param message_class: type of messages to filter
+        :returns: list of messages removed
         """
         fifo = self.fifo_map[message_class]
-        new_items = tuple((method, msg) for (method, msg) in fifo
-                         if filterfunc(msg))
+        new_items = []
+        removed = []
+        for method, msg in fifo:
+            if filterfunc(msg):
+                new_items.append((method, msg))
+            else:
+                removed.append(msg)
         fifo.clear()
         fifo.extend(new_items)
+        return removed
 
 class WorkerTaskQueue(object):
     """Store the pending tasks for the worker process.
@@ -322,6 +346,15 @@ class WorkerTaskQueue(object):
                 return None
             return self._get_next_task()
 
+    def get_next_task_nowait(self):
+        """Get the next task from the queue without blocking.
+
+        :returns: (handler_method, message) tuple, or None if the queue is
+            empty
+        """
+        with self.condition:
+            return self._get_next_task()
+
     def _get_next_task(self):
         for queue in self.queues_by_priority:
             next_for_queue = queue.get_next_task()
@@ -331,15 +364,20 @@ class WorkerTaskQueue(object):
         return None
 
     def cancel_file_operations(self, path_set):
-        """Cancels all mutagen/movie data tasks for a list of paths."""
+        """Cancels all mutagen/movie data tasks for a list of paths.
+
+        :returns: list of messages that were removed
+        """
         # Acquire our lock as soon as possible.  We want to prevent other
         # tasks from getting tasks, since they may be about to deleted.
+        removed = []
         with self.condition:
             def filter_func(msg):
                 return msg.source_path not in path_set
             for cls in (MutagenTask, MovieDataProgramTask):
                 queue = self.queue_map[cls.priority]
-                queue.filter_messages(filter_func, cls)
+                removed.extend(queue.filter_messages(filter_func, cls))
+        return removed
 
     def shutdown(self):
         # should be save to set this without the lock, since it's a boolean
@@ -385,15 +423,16 @@ MovieDataTaskStatusInfo = namedtuple('MovieDataTaskStatusInfo',
                                      'task_id start_time')
 
 class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
-    def __init__(self):
+    def __init__(self, pool, worker):
         subprocessmanager.SubprocessResponder.__init__(self)
+        self.pool = pool
+        self.worker = worker
         self.worker_ready = False
-        self.startup_message = None
         self.movie_data_task_status = None
 
     def on_startup(self):
-        self.startup_message.send_to_process()
-        _miro_task_queue.run_pending_tasks()
+        self.worker.send_message(self.pool.startup_message)
+        self.pool.on_worker_started(self.worker)
 
     def on_shutdown(self):
         # do the tasks that we've already gotten
@@ -404,7 +443,9 @@ class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
         self.worker_ready = False
 
     def handle_task_result(self, msg):
+        self.worker.task_ids.discard(msg.task_id)
         _miro_task_queue.process_result(msg)
+        self.pool.dispatch_tasks()
 
     def handle_worker_process_ready(self, msg):
         self.worker_ready = True
@@ -422,57 +463,211 @@ class MiroTaskQueue(object):
     Responsible for:
         - Storing callbacks/errbacks for each pending task
         - Calling the callback/errback for a finished task
+        - Holding tasks until a worker process has room for them.  Tasks
+          are handed out in priority order, so that high priority tasks
+          don't get stuck behind a long line of low priority ones in a
+          worker process.
     """
     def __init__(self):
-        # maps task_ids to (msg, callback, errback) tuples
-        self.tasks_in_progress = {}
+        self.reset()
 
     def reset(self):
+        # maps task_ids to (msg, callback, errback) tuples
         self.tasks_in_progress = {}
+        # tasks that we haven't sent to a worker process yet
+        self.unsent_tasks = WorkerTaskQueue()
 
     def add_task(self, msg, callback, errback):
         """Add a new task to the queue."""
         self.tasks_in_progress[msg.task_id] = (msg, callback, errback)
-        if _subprocess_manager.is_running:
-            msg.send_to_process()
+        self.unsent_tasks.add_task(None, msg)
+        _subprocess_manager.dispatch_tasks()
+
+    def next_unsent_task(self):
+        """Get the highest priority task that we haven't sent yet.
+
+        :returns: TaskMessage or None if there are no tasks left to send
+        """
+        task_info = self.unsent_tasks.get_next_task_nowait()
+        if task_info is None:
+            return None
+        return task_info[1]
+
+    def requeue_tasks(self, task_ids):
+        """Send tasks again after a worker process restarts."""
+        for task_id in task_ids:
+            if task_id in self.tasks_in_progress:
+                msg = self.tasks_in_progress[task_id][0]
+                self.unsent_tasks.add_task(None, msg)
+
+    def cancel_file_operations(self, path_set):
+        """Drop mutagen/movie data tasks for a set of paths.
+
+        :returns: set of ids for cancelled tasks that were already sent to a
+            worker process
+        """
+        for msg in self.unsent_tasks.cancel_file_operations(path_set):
+            del self.tasks_in_progress[msg.task_id]
+        # The worker processes don't send results for tasks that they
+        # cancel, so forget about the sent tasks here.
+        sent_task_ids = set()
+        for task_id, (msg, callback, errback) in \
+                self.tasks_in_progress.items():
+            if (isinstance(msg, (MutagenTask, MovieDataProgramTask)) and
+                    msg.source_path in path_set):
+                del self.tasks_in_progress[task_id]
+                sent_task_ids.add(task_id)
+        return sent_task_ids
 
     def process_result(self, reply):
         """Process a TaskResult from our subprocess."""
-        msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        try:
+            msg, callback, errback = self.tasks_in_progress.pop(
+                reply.task_id)
+        except KeyError:
+            # We sent CancelFileOperations to all of our workers, or a task
+            # already failed because its worker process hung.
+            return
         if isinstance(reply.result, Exception):
             errback(msg, reply.result)
         else:
             callback(msg, reply.result)
 
-    def run_pending_tasks(self):
-        """Rerun all tasks in the queue."""
-        for msg, callback, errback in self.tasks_in_progress.values():
-            msg.send_to_process()
-
 _miro_task_queue = MiroTaskQueue()
 
-# Manage subprocess
-class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
+# Manage subprocesses
+
+# Maximum number of worker processes to start by default
+MAX_PROCESS_COUNT = 8
+# Seconds a movie data task can run before we consider its process hung
+HUNG_TIMEOUT = 90
+
+def default_process_count():
+    """Pick the number of worker processes to use, based on the CPU count."""
+    try:
+        cpu_count = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpu_count = 1
+    return max(1, min(cpu_count, MAX_PROCESS_COUNT))
+
+class WorkerProcess(subprocessmanager.SubprocessManager):
+    """Manages one worker process in the pool."""
+    def __init__(self, pool, handler_class, restart_delay):
+        # pass None for message_base_class, the pool handles WorkerMessages
+        # and decides which process gets them.
+        subprocessmanager.SubprocessManager.__init__(self, None,
+                WorkerProcessResponder(pool, self), handler_class,
+                restart_delay=restart_delay)
+        # ids of tasks we sent to this process and haven't heard back about
+        self.task_ids = set()
+
+    def send_task(self, msg):
+        self.task_ids.add(msg.task_id)
+        self.send_message(msg)
+
+    def restart(self, clean=False):
+        self.responder.movie_data_task_status = None
+        subprocessmanager.SubprocessManager.restart(self, clean)
+
+class WorkerSubprocessManager(object):
+    """Manages the pool of worker processes.
+
+    Tasks are held in the main process by MiroTaskQueue and sent to the
+    worker process with the fewest tasks in progress, up to
+    tasks_per_process tasks per process.
+    """
     def __init__(self):
-        subprocessmanager.SubprocessManager.__init__(self, WorkerMessage,
-                WorkerProcessResponder(), WorkerProcessHandler)
+        WorkerMessage.install_handler(self)
+        self.handler_class = WorkerProcessHandler
+        self.restart_delay = 60
+        self.startup_message = None
+        self.tasks_per_process = 1
+        self.workers = []
+        self.is_running = False
         self.check_hung_timeout = None
 
-    def _start(self):
-        subprocessmanager.SubprocessManager._start(self)
+    def start(self, process_count, thread_count):
+        if self.is_running:
+            return
+        self.startup_message = WorkerStartupInfo(thread_count)
+        # keep enough tasks in each process to keep its threads busy, but no
+        # more, so that we can still hand high priority tasks to the next
+        # free process
+        self.tasks_per_process = thread_count + 1
+        self.workers = [WorkerProcess(self, self.handler_class,
+                                      self.restart_delay)
+                        for i in xrange(process_count)]
+        for worker in self.workers:
+            worker.start()
+        # wait until all processes are started before sending tasks, so that
+        # they get spread out evenly
+        self.is_running = True
+        self.dispatch_tasks()
         self.schedule_check_subprocess_hung()
 
     def shutdown(self):
+        if not self.is_running:
+            return
         self.cancel_check_subprocess_hung()
-        subprocessmanager.SubprocessManager.shutdown(self)
+        # set is_running first so that we don't dispatch any more tasks while
+        # the processes shut down
+        self.is_running = False
+        for worker in self.workers:
+            worker.shutdown()
+        # Tasks sent to the old processes get sent again if we start back up
+        for worker in self.workers:
+            _miro_task_queue.requeue_tasks(worker.task_ids)
+        self.workers = []
 
     def restart(self, clean=False):
-        self.cancel_check_subprocess_hung()
-        self.responder.movie_data_task_status = None
-        subprocessmanager.SubprocessManager.restart(self, clean)
+        """Restart all of our worker processes."""
+        for worker in self.workers:
+            if worker.is_running:
+                worker.restart(clean)
+
+    def on_worker_started(self, worker):
+        # If the process was restarted after crashing or hanging, send the
+        # tasks it was handling again.
+        _miro_task_queue.requeue_tasks(worker.task_ids)
+        worker.task_ids = set()
+        self.dispatch_tasks()
+
+    def dispatch_tasks(self):
+        """Send unsent tasks to worker processes that have room for them."""
+        if not self.is_running:
+            return
+        while True:
+            worker = self._least_busy_worker()
+            if worker is None:
+                return
+            msg = _miro_task_queue.next_unsent_task()
+            if msg is None:
+                return
+            worker.send_task(msg)
+
+    def _least_busy_worker(self):
+        best = None
+        for worker in self.workers:
+            if (worker.is_running and
+                    len(worker.task_ids) < self.tasks_per_process and
+                    (best is None or
+                     len(worker.task_ids) < len(best.task_ids))):
+                best = worker
+        return best
+
+    def send_to_all(self, msg):
+        for worker in self.workers:
+            if worker.is_running:
+                worker.send_message(msg)
+
+    def forget_tasks(self, task_ids):
+        """Stop counting cancelled tasks against their worker processes."""
+        for worker in self.workers:
+            worker.task_ids -= task_ids
+        self.dispatch_tasks()
 
     def schedule_check_subprocess_hung(self):
-        self.check_hung_timeout = eventloop.add_timeout(90,
+        self.check_hung_timeout = eventloop.add_timeout(HUNG_TIMEOUT,
                 self.check_subprocess_hung, 'check workerprocess hung')
 
     def cancel_check_subprocess_hung(self):
@@ -481,29 +676,40 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
             self.check_hung_timeout = None
 
     def check_subprocess_hung(self):
-        task_status = self.responder.movie_data_task_status
-
-        if (task_status is not None and
-                clock.clock() - task_status.start_time > 90):
-            logging.warn("Worker process is hanging on a movie data task.")
-            error_result = TaskResult(task_status.task_id,
-                    SubprocessTimeoutError())
-            self.responder.handle_task_result(error_result)
-            self.restart()
-        else:
-            self.schedule_check_subprocess_hung()
+        for worker in self.workers:
+            task_status = worker.responder.movie_data_task_status
+            if (task_status is not None and worker.is_running and
+                    clock.clock() - task_status.start_time > HUNG_TIMEOUT):
+                logging.warn("Worker process is hanging on a movie data "
+                             "task.")
+                error_result = TaskResult(task_status.task_id,
+                        SubprocessTimeoutError())
+                worker.responder.handle_task_result(error_result)
+                worker.restart()
+        self.schedule_check_subprocess_hung()
+
+    # implement the MessageHandler interface
+
+    def handle(self, msg):
+        # Tasks go through MiroTaskQueue.  Anything else gets sent to every
+        # process.
+        self.send_to_all(msg)
 
 _subprocess_manager = WorkerSubprocessManager()
 
-def startup(thread_count=3):
-    """Startup the worker process."""
+def startup(thread_count=3, process_count=None):
+    """Startup the worker processes.
 
-    startup_msg = WorkerStartupInfo(thread_count)
-    _subprocess_manager.responder.startup_message = startup_msg
-    _subprocess_manager.start()
+    :param thread_count: number of threads to use in each process
+    :param process_count: number of processes to start.  If None, we pick a
+        number based on the CPU count.
+    """
+    if process_count is None:
+        process_count = default_process_count()
+    _subprocess_manager.start(process_count, thread_count)
 
 def shutdown():
-    """Shutdown the worker process."""
+    """Shutdown the worker processes."""
     _subprocess_manager.shutdown()
 
 # API for sending tasks
@@ -518,9 +724,8 @@ def send(msg, callback, errback):
 
 def cancel_tasks_for_files(paths):
     """Cancel mutagen and movie data tasks for a list of paths."""
-    msg = CancelFileOperations(paths)
-    # we don't care about the return value, but we still want to use the task
-    # queue to queue up this message.
-    def null_callback(msg, result):
-        pass
-    send(msg, null_callback, null_callback)
+    # tasks that we haven't sent yet can just be dropped.  For the rest, tell
+    # each process to cancel them.
+    sent_task_ids = _miro_task_queue.cancel_file_operations(set(paths))
+    _subprocess_manager.send_to_all(CancelFileOperations(paths))
+    _subprocess_manager.forget_tasks(sent_task_ids)
@@ -49,6 +49,24 @@ class Image(object):
         self._set_image(NSImage.alloc().initByReferencingFile_(
             filename_to_unicode(path)))
 
+    @classmethod
+    def from_pixels(cls, (width, height, has_alpha, rowstride, pixels)):
+        """Create an Image from (width, height, has_alpha, rowstride,
+        pixels) pixel data.
+        """
+        samples = has_alpha and 4 or 3
+        # the bitmap uses our buffer without copying it, so keep the buffer
+        # alive as long as the image
+        data = bytearray(pixels)
+        rep = NSBitmapImageRep.alloc().initWithBitmapDataPlanes_pixelsWide_pixelsHigh_bitsPerSample_samplesPerPixel_hasAlpha_isPlanar_colorSpaceName_bytesPerRow_bitsPerPixel_(
+                (data, None, None, None, None), width, height, 8, samples,
+                has_alpha, NO, NSDeviceRGBColorSpace, rowstride, 8 * samples)
+        nsimage = NSImage.alloc().initWithSize_(NSSize(width, height))
+        nsimage.addRepresentation_(rep)
+        image = TransformedImage(nsimage)
+        image.pixel_data = data
+        return image
+
     def _set_image(self, nsimage):
         self.nsimage = nsimage
         self.width = self.nsimage.size().width
@@ -80,6 +98,14 @@ class Image(object):
         finally:
             dest.unlockFocus()
         return TransformedImage(dest)
+
+    def save(self, path):
+        """Save the image to path in PNG format."""
+        rep = NSBitmapImageRep.imageRepWithData_(
+            self.nsimage.TIFFRepresentation())
+        data = rep.representationUsingType_properties_(NSPNGFileType, None)
+        if not data.writeToFile_atomically_(filename_to_unicode(path), YES):
+            raise IOError("error saving image to %s" % path)
     
     def resize_for_space(self, width, height):
         """Returns an image scaled to fit into the specified space at the